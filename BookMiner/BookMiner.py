@@ -9,13 +9,15 @@ import cshogi
 import sys
 import re
 import random
+import heapq
 from pathlib import Path
 
-from dataclasses import dataclass
-from typing import TypeAlias, Any, Callable, Generic, TypeVar
-from collections import deque
+from dataclasses import dataclass, field
+from typing import TypeAlias, Any, Callable, Generic, TypeVar, Iterable
+from collections.abc import MutableMapping
 from threading import Condition, Lock, Thread
 from itertools import zip_longest
+from array import array
 from contextlib import nullcontext
 
 try:
@@ -27,7 +29,12 @@ COMMON_LIB_DIR = Path(__file__).resolve().parent.parent / "CommonLib"
 sys.path.insert(0, str(COMMON_LIB_DIR))
 
 import YaneuraOuBookLib as BookLib
-from YaneShogiLib import trim_sfen, make_time_stamp, flipped_sfen, flipped_move , trim_sfen_ply, PositionStr, enable_print_log, print_log
+from PackedBookLib import PackedBookStore, PackedRecord, MOVE16_TO_USI, PACKED_SFEN_SIZE, usi_to_packed_move16, pack_sfen, unpack_sfen
+from BookJournalLib import BookJournal
+from PetaShockLib import PetaShockGraph
+from YaneShogiLib import trim_sfen, make_time_stamp, flipped_sfen, flipped_move , canonical_sfen, trim_sfen_ply, PositionStr, enable_print_log, print_log
+from YaneShogiLib import EngineSupervisor, record_usi_option
+from RemoteEngineLib import is_mux_path, open_remote_engine
 
 print = print_log
 enable_print_log()
@@ -44,6 +51,9 @@ BOOK_BACKUP_DIR= os.path.join(BOOK_DIR, "backup")
 BOOK_DB_NAME   = "book_miner"
 BOOK_BACKUP_EXTENSION = ".db"
 
+# 思考結果を追記するジャーナルのファイル名。book/backup/book_miner_journal-NNNNNN.journal になる。
+BOOK_JOURNAL_NAME = "book_miner_journal"
+
 # エンジン設定が書いてあるjson5ファイルのpath
 ENGINE_SETTINGS_JSON_PATH    = "settings/engine_settings.json5"
 
@@ -53,6 +63,17 @@ BOOK_MINER_SETTINGS_JSON_PATH = "settings/book_miner_settings.json5"
 # peta_nextコマンドの開始局面集合。settings/book_miner_settings.json5 で上書きされる。
 PETA_NEXT_START_SFENS_PATH = os.path.join(BOOK_DIR, "peta_start_sfens.txt")
 
+# メモリ上の定跡の持ち方。settings/book_miner_settings.json5 で上書きされる。
+#   "dict"   : sfen文字列をkeyとするdictに、PositionInfo/MoveInfoのまま持つ。(従来どおり)
+#   "packed" : PackedSfenをkeyとして、指し手を(Move16, eval, depth)の配列に詰めて持つ。メモリが数分の1になる。
+BOOK_BACKEND_DICT   = "dict"
+BOOK_BACKEND_PACKED = "packed"
+BOOK_BACKENDS       = (BOOK_BACKEND_DICT, BOOK_BACKEND_PACKED)
+
+# Bookのlockを局面のkeyのhashで分ける数。(Book.stripe())
+# 探索スレッドが多いときに、1つのlockの取り合いにならないようにする。
+BOOK_LOCK_STRIPES = 64
+
 # 開始局面のsfen文字列
 SFEN_START      = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b -"
 SFEN_START_PLY1 = "lnsgkgsnl/1r5b1/ppppppppp/9/9/9/PPPPPPPPP/1B5R1/LNSGKGSNL b - 1" # 手数つき
@@ -63,6 +84,26 @@ YANEURAOU_BOOK_HEADER_V1 = "#YANEURAOU-DB2016 1.00"
 # ペタショック化された定跡ファイルのprefix
 PETA_BOOK_DB_NAME = "peta_book"
 PETA_SHOCK_ENGINE_NAME = "YO-MATERIAL.exe"
+
+# peta shock化の方法。settings/book_miner_settings.json5 で上書きされる。
+#   "engine" : YO-MATERIAL.exe の makebook peta_shock で、書き出した通常bookを変換する。(従来どおり)
+#   "native" : メモリ上の定跡からBookMiner.py自身で変換する。外部プロセスを使わず、通常bookの書き出しも不要。
+#              YO-MATERIAL.exe の出力と一致することをまだ確かめていないので、実験的な機能。(bench_book_miner.py --check_peta_shock_fixture)
+PETA_SHOCK_BACKEND_ENGINE = "engine"
+PETA_SHOCK_BACKEND_NATIVE = "native"
+PETA_SHOCK_BACKENDS       = (PETA_SHOCK_BACKEND_ENGINE, PETA_SHOCK_BACKEND_NATIVE)
+
+# peta_shock_backend = "native" のとき、前回のpeta shock化の結果をメモリに残しておき、
+# 次回は変更された局面から影響のあるところだけ計算し直すか。settings/book_miner_settings.json5 で上書きされる。
+PETA_SHOCK_INCREMENTAL = True
+
+# MultiPVで、bestとN番目の指し手の評価値の差がmultipv_delta以内だったときに、MultiPVを広げて再探索する方法。
+# settings/book_miner_settings.json5 で上書きされる。
+#   "full"        : MultiPVを広げて、すべての指し手を探索し直す。(従来どおり)
+#   "searchmoves" : まだ順位のついていない指し手だけを go searchmoves で探索して、これまでの順位にマージする。
+MULTIPV_WIDENING_FULL        = "full"
+MULTIPV_WIDENING_SEARCHMOVES = "searchmoves"
+MULTIPV_WIDENINGS            = (MULTIPV_WIDENING_FULL, MULTIPV_WIDENING_SEARCHMOVES)
 PETA_SHOCK_PROGRESS_INTERVAL = 10
 BOOK_READ_PROGRESS_INTERVAL = 10000
 BOOK_WRITE_PROGRESS_INTERVAL = 10000
@@ -87,9 +128,20 @@ BOOK_OPPONENT_DIR = os.path.join(BOOK_DIR, "book_opponent")
 # 自動保存の間隔 [s]。settings/book_miner_settings.json5 で上書きされる。
 AUTO_SAVE_INTERVAL = 3 * 60 * 60 # 3時間おき
 
+# ジャーナルがこのサイズ[MB]を超えたら、自動保存のときに定跡DB全体を書き出す。0ならジャーナルを使わない。
+# settings/book_miner_settings.json5 で上書きされる。
+JOURNAL_SNAPSHOT_MB = 256
+
+# ジャーナルをfsyncする間隔 [s]。settings/book_miner_settings.json5 で上書きされる。
+JOURNAL_SYNC_INTERVAL = 5
+
 # 定跡の最大手数。settings/book_miner_settings.json5 で上書きされる。
 MAX_BOOK_PLY = 200
 
+# エンジンが落ちたときの差し替え用に、エンジンのpathごとに起動しておく予備エンジンの数。
+# settings/book_miner_settings.json5 で上書きされる。
+SPARE_ENGINES = 0
+
 # VALUE, PLY の -∞
 VALUE_MIN      = -(2**31)
 PLY_MIN        = -(2**31)
@@ -107,8 +159,18 @@ DEFAULT_BOOK_EXTEND_PLY = 6
 
 TASK_RESULT_DONE = "done"
 TASK_RESULT_DEFERRED = "deferred"
+# 他workerが探索中の局面に当たって、その探索が終わるのを待った回数の上限
 MAX_TASK_DEFER_COUNT = 1000
-TASK_DEFER_SLEEP_SECONDS = 0.01
+
+# taskを取り出す優先度。task_priority()で、小さいほど先に取り出す。
+#   棋譜末端(taskの開始局面)のbookでのbestの評価値の絶対値 × TASK_PRIORITY_EVAL_WEIGHT
+#   + 棋譜末端の手数 × TASK_PRIORITY_PLY_WEIGHT
+# 互角に近い局面と、手数の浅い局面から掘る。bookにない局面の評価値は0として扱う。
+TASK_PRIORITY_EVAL_WEIGHT = 1.0
+TASK_PRIORITY_PLY_WEIGHT = 10.0
+
+# `e`コマンドのjobの重み。重みに比例した回数だけ、そのjobのtaskを取り出す。
+DEFAULT_JOB_WEIGHT = 1.0
 
 # ============================================================
 #                     型定義
@@ -151,28 +213,253 @@ class PositionInfo:
     # 手数(初期局面をply=1とする)
     ply : int
 
+    # Book.bodyのkeyは先手番の局面(canonical_sfen())。
+    # Trueなら、moveinfosはkeyをflipした後手番の局面の指し手として格納されている。
+    # (最初に登録したときの向きのまま持っておき、定跡の書き出しもその向きで行う)
+    flipped : bool = False
+
     # その他、何か情報があれば…。
 
+def copy_position_info(position_info:PositionInfo)->PositionInfo:
+    """
+    Book.bodyに格納されているPositionInfoは、書き出し中のsnapshotから参照されていることがあるので書き換えない。
+    書き換えるときは、これでcopyしたものを書き換えて store() / update() で書き戻す。
+    """
+    return PositionInfo(
+        [MoveInfo(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in position_info.moveinfos],
+        position_info.ply,
+        position_info.flipped,
+    )
+
+class PackedBookBody(PackedBookStore):
+    """
+    book_backend = "packed" のときのBook.body。
+    dict[Sfen, PositionInfo]と同じように使えるが、読み出したPositionInfoは毎回作り直したものなので、
+    書き換えたときは book.update() などで書き戻す必要がある。
+    """
+
+    def record_to_value(self, record:PackedRecord)->PositionInfo:
+        ply, moves, flags = record
+        return PositionInfo([MoveInfo(move, eval, depth) for move, eval, depth in moves], ply, bool(flags))
+
+    def value_to_record(self, value:PositionInfo)->PackedRecord:
+        return value.ply, [(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in value.moveinfos], int(value.flipped)
+
+
+# Book()でbackendを省略したときのbackend。user_input()で設定ファイルの値にする。
+default_book_backend = BOOK_BACKEND_DICT
+
+class BookStripe:
+    """
+    Bookのlockの1区画。keyのhashがこの区画になる局面の読み書きと、探索中の管理をこのlockで行う。
+    """
+    def __init__(self):
+        self.lock : Lock = Lock()
+
+        # 各スレッドが探索中である局面のkey(canonical_sfen())
+        self.searching_sfens : set[Sfen] = set()
+
+        # 探索中の局面の探索が終わったときに呼び出すcallback。keyはsearching_sfensのkey。
+        self.search_waiters : dict[Sfen, list[Callable[[], None]]] = {}
+
+
+class BookLock:
+    """
+    Bookの全stripeのlockを、番号順にまとめて取るlock。`with book.lock:` で使う。
+    定跡全体を読み込む・列挙する・差し替えるときに用いる。
+    """
+    def __init__(self, stripes:list[BookStripe]):
+        self.stripes = stripes
+
+    def __enter__(self):
+        acquired = 0
+        try:
+            for stripe in self.stripes:
+                stripe.lock.acquire()
+                acquired += 1
+        except BaseException:
+            for stripe in reversed(self.stripes[:acquired]):
+                stripe.lock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for stripe in reversed(self.stripes):
+            stripe.lock.release()
+        return False
+
+
 # 定跡本体
 class Book:
-    def __init__(self):
+    """
+    lockは、局面のkeyのhashでBOOK_LOCK_STRIPES個のstripeに分けてある。次の約束で使う。
+
+    - 1局面のfind()/store()/update()と、探索中の管理(is_searching()など)は、その局面のstripeのlock
+      (stripe(key).lock か position_lock(sfen))を持って行う。`with book.lock:`(全stripe)でも良い。
+    - 定跡全体の読み込み・列挙・clear、snapshotsの追加・削除、peta_dirty_keysの差し替えは `with book.lock:` で行う。
+    - stripeのlockを持ったまま、別のstripeのlockや `book.lock` を取らない。
+      複数のstripeのlockを取るのは BookLock だけで、番号順に取るのでデッドロックしない。
+    - stripeのlockだけを持つスレッドは、自分のkeyについてだけ body・snapshotのpreserved・peta_dirty_keys に書き込む。
+      (dictとsetの1操作、PackedBookStoreの1操作はそれぞれスレッド安全)
+    - revisionはmark_modified()でrevision_lockを取って増やす。
+    """
+    def __init__(self, backend:str|None = None, stripes:int = BOOK_LOCK_STRIPES):
 
         # 定跡本体
-        self.body : dict[Sfen,PositionInfo] = {}
+        # keyは先手番の局面のsfen(canonical_sfen())なので、局面とそれをflipした局面は同じentryになる。
+        # 局面を探すときはfind()、登録するときはstore()を用いる。
+        # 格納されているposition_infoは直接書き換えず、copy_position_info()したものを書き換えて、
+        # backendによらず update() で書き戻すこと。
+        self.backend = default_book_backend if backend is None else backend
+        if self.backend == BOOK_BACKEND_DICT:
+            self.body : MutableMapping[Sfen,PositionInfo] = {}
+        elif self.backend == BOOK_BACKEND_PACKED:
+            self.body = PackedBookBody()
+        else:
+            raise Exception(f"unknown book backend : {self.backend}")
 
-        # 各スレッドが探索中である局面のsfen文字列
-        self.searching_sfens : set[Sfen] = set()
+        # 局面のkeyのhashで分けたlockと、探索中の局面の集合。
+        self.stripes : list[BookStripe] = [BookStripe() for _ in range(stripes)]
 
-        # このメンバーを操作するときのlock object
-        self.lock : Lock = Lock()
+        # 全stripeのlock。定跡全体を操作するときに用いる。
+        self.lock : BookLock = BookLock(self.stripes)
 
         # 最後に読み込み/保存した通常book。bookが変更されていなければpeta_shock入力に再利用する。
         self.clean_source_path : str | None = None
         self.clean_revision : int = 0
         self.revision : int = 0
+        self.revision_lock : Lock = Lock()
+
+        # 思考結果を追記するジャーナル。Noneならジャーナルを使わない。
+        self.journal : BookJournal | None = None
+
+        # 書き出し中のsnapshot
+        self.snapshots : list[BookSnapshot] = []
+
+        # 前回のpeta shock化のあとにstore()/update()された局面のkey。Noneなら記録しない。
+        self.peta_dirty_keys : set[Sfen] | None = None
+
+    def stripe(self, key:Sfen)->BookStripe:
+        """keyの局面(canonical_sfen())のstripe"""
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def position_lock(self, sfen:Sfen)->Lock:
+        """sfenの局面を読み書きするときのlock"""
+        return self.stripe(canonical_sfen(sfen)[0]).lock
+
+    def find(self, sfen:Sfen)->tuple[PositionInfo|None, bool]:
+        """
+        sfenの局面を探す。lockは呼び出し元で行う。
+        戻り値は(局面情報, 局面情報の指し手がsfenをflipした局面の向きか)。見つからなければ(None, False)。
+        """
+        key, flipped = canonical_sfen(sfen)
+        return self.find_key(key, flipped)
+
+    def find_key(self, key:Sfen, flipped:bool)->tuple[PositionInfo|None, bool]:
+        """
+        canonical_sfen()が(key, flipped)になる局面を探す。戻り値はfind()と同じ。lockは呼び出し元で行う。
+        """
+        position_info = self.body.get(key)
+        if position_info is None:
+            return None, False
+        return position_info, flipped != position_info.flipped
+
+    def store(self, sfen:Sfen, position_info:PositionInfo):
+        """
+        position_infoを、指し手がsfenの局面の向きであるものとして登録する。lockは呼び出し元で行う。
+        """
+        key, flipped = canonical_sfen(sfen)
+        self.store_key(key, flipped, position_info)
+
+    def store_key(self, key:Sfen, flipped:bool, position_info:PositionInfo):
+        """
+        canonical_sfen()が(key, flipped)になる局面として、store()と同じように登録する。lockは呼び出し元で行う。
+        """
+        position_info.flipped = flipped
+        self.update_key(key, position_info)
+
+    def update(self, sfen:Sfen, position_info:PositionInfo):
+        """
+        find(sfen)で得た局面情報を書き換えたあとに書き戻す。(向きは変えない) lockは呼び出し元で行う。
+        """
+        self.update_key(canonical_sfen(sfen)[0], position_info)
+
+    def update_key(self, key:Sfen, position_info:PositionInfo):
+        """
+        keyの局面に、update()と同じように書き戻す。lockは呼び出し元で行う。
+        """
+        self.preserve_for_snapshots(key)
+        self.body[key] = position_info
+        if self.peta_dirty_keys is not None:
+            self.peta_dirty_keys.add(key)
+
+    def snapshot_keys(self)->Iterable[Sfen]:
+        """
+        いまのbodyのkeyの一覧。lockは呼び出し元で行う。
+        packed backendではkeyの数だけを覚えておき、sfenへの変換は列挙するときに行う。(lockは不要)
+        """
+        if isinstance(self.body, PackedBookStore):
+            return self.body.iter_keys(self.body.entry_count())
+        return list(self.body)
+
+    def preserve_for_snapshots(self, key:Sfen):
+        """
+        書き出し中のsnapshotがあれば、keyの局面を書き換える前の局面情報をsnapshotに残しておく。lockは呼び出し元で行う。
+        """
+        for snapshot in self.snapshots:
+            if key not in snapshot.preserved:
+                position_info = self.body.get(key)
+                if position_info is not None:
+                    snapshot.preserved[key] = position_info
+
+    def write_journal(self, sfen:Sfen, position_info:PositionInfo):
+        """
+        store()/update()した局面の内容をジャーナルに追記する。sfenは局面情報の指し手の向きの局面。
+        lockは呼び出し元で行う。(同じ局面のrecordの順番がbookの更新順と一致するように)
+        """
+        if self.journal is not None:
+            self.journal.append(
+                sfen,
+                position_info.ply,
+                [(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in position_info.moveinfos],
+            )
+
+    def is_searching(self, key:Sfen)->bool:
+        """keyの局面を他のスレッドが探索中か。lockは呼び出し元で行う。"""
+        return key in self.stripe(key).searching_sfens
+
+    def start_search(self, key:Sfen):
+        """keyの局面の探索を始める。lockは呼び出し元で行う。"""
+        self.stripe(key).searching_sfens.add(key)
+
+    def wait_search(self, key:Sfen, callback:Callable[[], None])->bool:
+        """
+        keyの局面が探索中なら、探索が終わったときにcallbackを呼び出すようにしてTrueを返す。
+        探索中でなければFalseを返す。lockは呼び出し元で行う。
+        """
+        stripe = self.stripe(key)
+        if key not in stripe.searching_sfens:
+            return False
+        stripe.search_waiters.setdefault(key, []).append(callback)
+        return True
+
+    def end_search(self, key:Sfen)->list[Callable[[], None]]:
+        """
+        keyの局面の探索を終える。lockは呼び出し元で行う。
+        探索が終わるのを待っていたcallbackを返すので、lockを解放してから呼び出すこと。
+        """
+        stripe = self.stripe(key)
+        stripe.searching_sfens.discard(key)
+        return stripe.search_waiters.pop(key, [])
+
+    def stored_sfen(self, key:Sfen, position_info:PositionInfo)->Sfen:
+        """bodyのkeyと局面情報から、局面情報の指し手の向きの局面のsfenを返す。"""
+        return flipped_sfen(key) if position_info.flipped else key
 
     def mark_modified(self):
-        self.revision += 1
+        # stripeのlockだけを持って呼び出されることがあるので、revision_lockで増やす。
+        with self.revision_lock:
+            self.revision += 1
 
     def mark_clean(self, path:str, revision:int|None = None):
         self.clean_source_path = path
@@ -184,6 +471,79 @@ class Book:
         return None
 
 
+@dataclass
+class BookSnapshot:
+    """
+    定跡を書き出すときの、ある時点の定跡の内容。take_book_snapshot()で作り、release_book_snapshot()で解放する。
+
+    局面のkeyの一覧だけをcopyしておき、snapshotを取ったあとに書き換えられた局面だけ、
+    書き換える前の局面情報をpreservedに残す。(copy-on-write)
+    局面情報は book_snapshot_position_info() でlockなしに読める。
+    """
+
+    # 書き出す局面のsfen(登録したときの向き)。sort済み。
+    sfens : list[Sfen]
+
+    # snapshotを取ったときのBook.revision
+    revision : int
+
+    # snapshotを取ったあとに書き換えられた局面の、書き換える前の局面情報。keyはBook.bodyのkey。
+    preserved : dict[Sfen, PositionInfo] = field(default_factory=dict)
+
+
+@dataclass
+class PositionChain:
+    """
+    `startpos moves ...` の1行を、局面のkeyと指し手の列にしたもの。
+    put_position_commands()で読み込むときに1回だけ辿って作り、掘るときはboardで辿り直さずにこれを用いる。
+    i番目の局面は、開始局面からi手指した局面。(0 <= i <= 指し手の数)
+
+    queueに残っている間はずっと持っているので、局面のkeyはsfen文字列ではなくPackedSfenで持つ。
+    掘るときは、keys()で1回だけsfen文字列に戻して用いる。
+    """
+    # 各局面のkey(canonical_sfen())をPackedSfen(PACKED_SFEN_SIZE byte)にして並べたもの
+    packed_keys : bytes
+
+    # 開始局面が後手番か。(keyをflipした局面か) i番目の局面はiが奇数なら逆になる。
+    start_flipped : bool
+
+    # 開始局面の手数
+    start_ply : int
+
+    # i番目の局面で指す指し手のMove16。(その局面の向きの指し手)
+    move16s : array
+
+    # 同じ局面が2回目に出てくるindex。無ければlen(keys)。このindexの局面からは辿らない。
+    end : int
+
+    def flipped(self, i:int)->bool:
+        return self.start_flipped != bool(i & 1)
+
+    def key(self, i:int)->Sfen:
+        """i番目の局面のkey(canonical_sfen())"""
+        return unpack_sfen(self.packed_keys[i * PACKED_SFEN_SIZE : (i + 1) * PACKED_SFEN_SIZE])
+
+    def keys(self)->list[Sfen]:
+        """全局面のkey(canonical_sfen())"""
+        return [self.key(i) for i in range(len(self.packed_keys) // PACKED_SFEN_SIZE)]
+
+    def sfen(self, i:int, key:Sfen|None = None)->Sfen:
+        """i番目の局面のsfen(手数なし)。keyはkeys()で戻したi番目のkey。(省略したらここで戻す)"""
+        if key is None:
+            key = self.key(i)
+        return flipped_sfen(key) if self.flipped(i) else key
+
+    def ply(self, i:int)->int:
+        return self.start_ply + i
+
+    def move(self, i:int)->MoveStr:
+        return MOVE16_TO_USI[self.move16s[i]]
+
+    def leaf(self)->int:
+        """棋譜末端の局面のindex"""
+        return len(self.move16s)
+
+
 @dataclass
 class Task:
     # 定跡を掘る探索開始sfen
@@ -201,9 +561,12 @@ class Task:
     # `e`コマンドで積まれたタスクの進捗表示用。
     job_id : int = 0
 
-    # 他workerが同じ局面を探索中だったためにqueue末尾へ戻した回数。
+    # 他workerが同じ局面を探索中だったために、その探索が終わるまで待たせた回数。
     defer_count : int = 0
 
+    # TASK_RESULT_DEFERREDで終わったとき、探索中だった局面のkey(canonical_sfen())。
+    blocked_key : Sfen | None = None
+
     # TaskQueueProgressに計上済みか。
     progress_reported : bool = False
 
@@ -213,6 +576,13 @@ class Task:
     # 棋譜末端からbest lineを延長して掘る手数。
     book_extend_ply : int = DEFAULT_BOOK_EXTEND_PLY
 
+    # position_cmdを辿った局面の列。Noneなら掘るときにposition_cmdから作る。
+    # taskの優先度には、この棋譜末端の局面と手数を使う。
+    chain : PositionChain | None = None
+
+    # queueに積むときに、同じ局面を掘るtaskとしてこのtaskにまとめたtask。このtaskと一緒に完了扱いにする。
+    merged_tasks : list["Task"] = field(default_factory=list)
+
 
 @dataclass
 class TaskQueueJobProgress:
@@ -237,7 +607,7 @@ class TaskQueueJobProgress:
     # 最後にTaskQueueProgressへ出力した完了数。
     last_reported_taken : int = 0
 
-    # このjobで、他workerが探索中の局面に当たりqueue末尾へ戻した累計回数。
+    # このjobで、他workerが探索中の局面に当たり、その探索が終わるまで待たせた累計回数。
     deferred : int = 0
 
     # 最後にTaskQueueProgressへ出力したdeferred数。
@@ -272,6 +642,27 @@ class BookMinerSettings:
     # peta_nextで辿り始める開始局面集合ファイル。
     peta_next_start_sfens_path : str = PETA_NEXT_START_SFENS_PATH
 
+    # エンジンが落ちたときの差し替え用の予備エンジンの数(エンジンのpathごと)
+    spare_engines : int = SPARE_ENGINES
+
+    # メモリ上の定跡の持ち方。BOOK_BACKENDSのいずれか。
+    book_backend : str = BOOK_BACKEND_DICT
+
+    # ジャーナルがこのサイズ[MB]を超えたら、自動保存のときに定跡DB全体を書き出す。0ならジャーナルを使わない。
+    journal_snapshot_mb : int = JOURNAL_SNAPSHOT_MB
+
+    # ジャーナルをfsyncする間隔 [s]
+    journal_sync_interval_seconds : int = JOURNAL_SYNC_INTERVAL
+
+    # peta shock化の方法。PETA_SHOCK_BACKENDSのいずれか。
+    peta_shock_backend : str = PETA_SHOCK_BACKEND_ENGINE
+
+    # nativeのpeta shock化を差分で行うか
+    peta_shock_incremental : bool = PETA_SHOCK_INCREMENTAL
+
+    # MultiPVを広げて再探索する方法。MULTIPV_WIDENINGSのいずれか。
+    multipv_widening : str = MULTIPV_WIDENING_FULL
+
 # ============================================================
 
 T = TypeVar("T")
@@ -352,79 +743,155 @@ class ListRingQueue(Generic[T]):
             self._head = self._tail = self._count = 0
 
 
-class JobRoundRobinQueue(Generic[T]):
-    """job_idごとに公平に取り出すqueue。
+class PriorityTaskQueue(Generic[T]):
+    """jobごとに、優先度の高いものから取り出すqueue。
 
-    eコマンドはjobごとに大量のtaskを投入するため、単一FIFOだと後続jobが長時間
-    進まない。worker側はこのqueueからjobをround-robinで取り出す。
+    eコマンドはjobごとに大量のtaskを投入するため、単一のqueueだと後続jobが長時間
+    進まない。worker側はこのqueueから、jobの重みに比例した回数ずつjobを取り出す。
+    (stride scheduling。重みがすべて同じならround-robin)
+
+    - job内では、put()したときのpriority(item)の小さいものから取り出す。
+    - key(item)が同じitemがqueueに残っていれば、新しく積まずに merge(queueにあるitem, 新しいitem) する。
     """
 
-    def __init__(self):
-        self._jobs: dict[int, deque[T]] = {}
-        self._job_order: deque[int] = deque()
+    def __init__(
+        self,
+        priority: Callable[[T], float],
+        key: Callable[[T], Any] | None = None,
+        merge: Callable[[T, T], None] | None = None,
+    ):
+        self._priority = priority
+        self._key = key
+        self._merge = merge
+        # job_id → (priority, 積んだ順番, key, item)のheap
+        self._jobs: dict[int, list[tuple[float, int, Any, T]]] = {}
+        self._job_weights: dict[int, float] = {}
+        # jobごとの、次に取り出すときの仮想時刻。取り出すたびに 1 / 重み だけ進める。
+        self._job_passes: dict[int, float] = {}
+        # (仮想時刻, 積んだ順番, job_id)のheap。itemのあるjobだけが入っている。
+        self._job_heap: list[tuple[float, int, int]] = []
+        self._virtual_time = 0.0
+        # queueにあるitem。keyはkey(item)。
+        self._queued: dict[Any, T] = {}
+        self._sequence = 0
         self._count = 0
         self._condition = Condition()
 
     def _job_id(self, item: T) -> int:
         return int(getattr(item, "job_id", 0) or 0)
 
-    def put(self, item: T) -> None:
+    def set_job_weight(self, job_id: int, weight: float) -> None:
+        if weight <= 0:
+            raise ValueError(f"job weight must be positive. weight = {weight}")
+        with self._condition:
+            self._job_weights[job_id] = weight
+
+    def put(self, item: T) -> bool:
+        """itemを積む。同じkeyのitemにmergeしたときはFalseを返す。"""
+        # priority()はbookを参照することがあるので、lockの外で求めておく。
+        priority = self._priority(item)
+        key = None if self._key is None else self._key(item)
         with self._condition:
+            if key is not None:
+                queued = self._queued.get(key)
+                if queued is not None:
+                    if self._merge is not None:
+                        self._merge(queued, item)
+                    return False
+                self._queued[key] = item
+
             job_id = self._job_id(item)
             queue = self._jobs.get(job_id)
             if queue is None:
-                queue = deque()
+                queue = []
                 self._jobs[job_id] = queue
-                self._job_order.append(job_id)
-            queue.append(item)
+                # 空だったjobは、いまの仮想時刻から再開する。(空だった間の分をまとめて取り出さない)
+                job_pass = max(self._job_passes.get(job_id, 0.0), self._virtual_time)
+                self._job_passes[job_id] = job_pass
+                heapq.heappush(self._job_heap, (job_pass, self._next_sequence(), job_id))
+            heapq.heappush(queue, (priority, self._next_sequence(), key, item))
             self._count += 1
             self._condition.notify()
-
-    def put_deferred(self, item: T) -> None:
-        self.put(item)
+            return True
 
     def get(self) -> T:
         with self._condition:
             while self._count == 0:
                 self._condition.wait()
 
-            job_id = self._job_order.popleft()
+            job_pass, _, job_id = heapq.heappop(self._job_heap)
             queue = self._jobs[job_id]
-            item = queue.popleft()
+            _, _, key, item = heapq.heappop(queue)
             self._count -= 1
+            if key is not None and self._queued.get(key) is item:
+                del self._queued[key]
 
+            self._virtual_time = job_pass
+            job_pass += 1.0 / self._job_weights.get(job_id, DEFAULT_JOB_WEIGHT)
+            self._job_passes[job_id] = job_pass
             if queue:
-                self._job_order.append(job_id)
+                heapq.heappush(self._job_heap, (job_pass, self._next_sequence(), job_id))
             else:
                 del self._jobs[job_id]
 
             return item
 
+    def _next_sequence(self) -> int:
+        self._sequence += 1
+        return self._sequence
+
     def qsize(self) -> int:
         with self._condition:
             return self._count
 
 # CLI表示用の10分間探索呼び出し回数
 CALL_COUNT : int = 0
+CALL_COUNT_LOCK = Lock()
 LAST_REPORT = time.time()
 
 # ============================================================
 #                     load/save
 # ============================================================
 
-def collect_yaneuraou_book_sfens(book:Book, ply_limit:int|None)->list[Sfen]:
+def take_book_snapshot(book:Book, ply_limit:int|None)->BookSnapshot:
+    """
+    snapshotを作り、書き出す局面のsfenを登録したときの向きで集める。
+    lockを取るのはkeyの一覧をcopyする間だけ。書き出しが終わったら release_book_snapshot() すること。
+    """
     with book.lock:
-        if ply_limit is None:
-            sfens = list(book.body.keys())
-        else:
-            sfens = [
-                sfen
-                for sfen, position_info in book.body.items()
-                if position_info.ply <= ply_limit
-            ]
+        snapshot = BookSnapshot([], book.revision)
+        book.snapshots.append(snapshot)
+        keys = book.snapshot_keys()
+
+    try:
+        sfens : list[Sfen] = []
+        for key in keys:
+            position_info = book_snapshot_position_info(book, snapshot, key)
+            if position_info is None:
+                raise Exception(f"position not found in book: {key}")
+            if ply_limit is None or position_info.ply <= ply_limit:
+                sfens.append(book.stored_sfen(key, position_info))
+        sfens.sort()
+    except Exception:
+        release_book_snapshot(book, snapshot)
+        raise
 
-    sfens.sort()
-    return sfens
+    snapshot.sfens = sfens
+    return snapshot
+
+
+def book_snapshot_position_info(book:Book, snapshot:BookSnapshot, key:Sfen)->PositionInfo|None:
+    """
+    snapshotを取った時点の、keyの局面情報。book.lockは取らない。
+    """
+    # bodyから読んだあとにpreservedを見る。(この間に書き換えられても、preservedに書き換える前のものが入っている)
+    position_info = book.body.get(key)
+    return snapshot.preserved.get(key, position_info)
+
+
+def release_book_snapshot(book:Book, snapshot:BookSnapshot):
+    with book.lock:
+        book.snapshots.remove(snapshot)
 
 
 def temp_book_path(path:str)->str:
@@ -452,20 +919,34 @@ def print_book_write_done(path:str, count:int, total:int):
     print(f"[BookWriteDone] {count}/{total} path={path}")
 
 
-def snapshot_book_position_for_write(book:Book, sfen:Sfen)->tuple[str, list[MoveInfo]]:
-    with book.lock:
-        position_info = book.body[sfen]
-        ply = position_info.ply
-        moveinfos = [
-            MoveInfo(move_info.move, move_info.eval, move_info.depth)
-            for move_info in position_info.moveinfos
-        ]
-        if not moveinfos or any(move_info.eval is None for move_info in moveinfos):
-            raise Exception(f"unconsidered position in book: {sfen}")
+def read_book_snapshot_position(book:Book, snapshot:BookSnapshot, sfen:Sfen, keep_evals:bool = False)->tuple[str, list[MoveInfo]]:
+    """
+    sfenはsnapshot.sfensの、登録したときの向きのsfen。snapshotを取った時点の局面情報を
+    book_position_for_write()で書き出す内容にして返す。book.lockは取らない。
+    """
+    key = canonical_sfen(sfen)[0]
+    position_info = book_snapshot_position_info(book, snapshot, key)
+    if position_info is None or book.stored_sfen(key, position_info) != sfen:
+        raise Exception(f"position not found in book: {sfen}")
+    return book_position_for_write(sfen, position_info, keep_evals)
+
+
+def book_position_for_write(sfen:Sfen, position_info:PositionInfo, keep_evals:bool = False)->tuple[str, list[MoveInfo]]:
+    """
+    sfenの局面のposition_infoを、定跡ファイルに書き出す内容にして返す。(評価値順に並べる)
+    keep_evalsがFalseなら、bestと同じ評価値の指し手の評価値を1ずつ下げる。(peta bookはTrueで書き出す)
+    """
+    ply = position_info.ply
+    moveinfos = [
+        MoveInfo(move_info.move, move_info.eval, move_info.depth)
+        for move_info in position_info.moveinfos
+    ]
+    if not moveinfos or any(move_info.eval is None for move_info in moveinfos):
+        raise Exception(f"unconsidered position in book: {sfen}")
 
     moveinfos.sort(key=lambda x: x.eval, reverse=True) # type:ignore
 
-    if len(moveinfos) >= 2 and moveinfos[0].eval == moveinfos[1].eval:
+    if not keep_evals and len(moveinfos) >= 2 and moveinfos[0].eval == moveinfos[1].eval:
         besteval = moveinfos[0].eval
         for i in range(1, len(moveinfos)):
             if besteval == moveinfos[i].eval:
@@ -476,9 +957,8 @@ def snapshot_book_position_for_write(book:Book, sfen:Sfen)->tuple[str, list[Move
     return f"{sfen} {ply}", moveinfos
 
 
-def write_ybb_book_records(book:Book, path:str, ply_limit:int|None, sfens:list[Sfen]|None = None)->int:
-    if sfens is None:
-        sfens = collect_yaneuraou_book_sfens(book, ply_limit)
+def write_ybb_book_records(book:Book, path:str, snapshot:BookSnapshot, keep_evals:bool = False)->int:
+    sfens = snapshot.sfens
 
     dirpath = os.path.dirname(path)
     if dirpath:
@@ -490,7 +970,7 @@ def write_ybb_book_records(book:Book, path:str, ply_limit:int|None, sfens:list[S
     try:
         book_for_write : dict[str, list[BookLib.BookMove]] = {}
         for count, sfen in enumerate(sfens, 1):
-            sfen_with_ply, moveinfos = snapshot_book_position_for_write(book, sfen)
+            sfen_with_ply, moveinfos = read_book_snapshot_position(book, snapshot, sfen, keep_evals)
             book_for_write[sfen_with_ply] = [
                 BookLib.BookMove(move_info.move, "none", move_info.eval, move_info.depth, 1) # type:ignore[arg-type]
                 for move_info in moveinfos
@@ -513,12 +993,27 @@ def write_ybb_book_records(book:Book, path:str, ply_limit:int|None, sfens:list[S
     return len(sfens)
 
 
-def write_yaneuraou_book_records(book:Book, path:str, ply_limit:int|None, sfens:list[Sfen]|None = None)->int:
+def write_yaneuraou_book_records(
+    book:Book,
+    path:str,
+    ply_limit:int|None,
+    snapshot:BookSnapshot|None = None,
+    keep_evals:bool = False,
+)->int:
+    """
+    snapshotを省略したときは、ここでsnapshotを取って書き出す。
+    """
+    if snapshot is None:
+        snapshot = take_book_snapshot(book, ply_limit)
+        try:
+            return write_yaneuraou_book_records(book, path, ply_limit, snapshot, keep_evals)
+        finally:
+            release_book_snapshot(book, snapshot)
+
     if BookLib.is_ybb_path(path):
-        return write_ybb_book_records(book, path, ply_limit, sfens)
+        return write_ybb_book_records(book, path, snapshot, keep_evals)
 
-    if sfens is None:
-        sfens = collect_yaneuraou_book_sfens(book, ply_limit)
+    sfens = snapshot.sfens
 
     dirpath = os.path.dirname(path)
     if dirpath:
@@ -532,7 +1027,7 @@ def write_yaneuraou_book_records(book:Book, path:str, ply_limit:int|None, sfens:
             w.write(YANEURAOU_BOOK_HEADER_V1 + '\n')
             w.write(f"# NOE:{total}\n")
             for count, sfen in enumerate(sfens, 1):
-                sfen_with_ply, moveinfos = snapshot_book_position_for_write(book, sfen)
+                sfen_with_ply, moveinfos = read_book_snapshot_position(book, snapshot, sfen, keep_evals)
 
                 w.write(f'sfen {sfen_with_ply}\n')
 
@@ -568,21 +1063,35 @@ def save_book(book:Book, filepath:str):
 
 
 def save_book_backup(book:Book, save_dir:str, ply_limit:int|None = None)->str:
-    with book.lock:
-        saved_revision = book.revision
-    sfens = collect_yaneuraou_book_sfens(book, ply_limit)
-    ply_suffix = "" if ply_limit is None else f"_ply{ply_limit}"
-    path = os.path.join(
-        save_dir,
-        f"{BOOK_DB_NAME}-{make_time_stamp()}_{len(sfens)}{ply_suffix}{BOOK_BACKUP_EXTENSION}"
-    )
-    print(f"start save_book_backup , path = {path}")
-    write_yaneuraou_book_records(book, path, ply_limit, sfens)
-    print(f"..save_book_backup has done, {len(sfens)} positions.")
+    time_stamp = make_time_stamp()
+
+    # 全体を書き出すときは、局面を集める前にジャーナルを新しいsegmentに切り替える。
+    # 切り替えたあとの更新は新しいsegmentに書かれるので、書き出しに含まれなくても失われない。
+    journal_seq = None
+    if ply_limit is None and book.journal is not None:
+        journal_seq = book.journal.rotate(time_stamp)
+
+    # 書き出している間も探索workerは止めない。
+    snapshot = take_book_snapshot(book, ply_limit)
+    try:
+        ply_suffix = "" if ply_limit is None else f"_ply{ply_limit}"
+        path = os.path.join(
+            save_dir,
+            f"{BOOK_DB_NAME}-{time_stamp}_{len(snapshot.sfens)}{ply_suffix}{BOOK_BACKUP_EXTENSION}"
+        )
+        print(f"start save_book_backup , path = {path}")
+        write_yaneuraou_book_records(book, path, ply_limit, snapshot)
+        print(f"..save_book_backup has done, {len(snapshot.sfens)} positions.")
+    finally:
+        release_book_snapshot(book, snapshot)
     if ply_limit is None:
         with book.lock:
-            if book.revision == saved_revision:
-                book.mark_clean(path, saved_revision)
+            if book.revision == snapshot.revision:
+                book.mark_clean(path, snapshot.revision)
+    if journal_seq is not None:
+        # 書き出したDBに含まれたので、切り替える前のsegmentは不要。
+        book.journal.remove_segments_before(journal_seq) # type:ignore[union-attr]
+        print(f"[JournalCompacted] size={book.journal.size_bytes()}") # type:ignore[union-attr]
     return path
 
 
@@ -599,6 +1108,8 @@ def load_book(book:Book, filepath:str, *, fast:bool = False):
         book.revision = 0
         book.clean_revision = 0
         book.clean_source_path = None
+        # 中身を入れ替えるので、前回のpeta shock化の結果は使えなくなる。
+        book.peta_dirty_keys = None
 
     if fast:
         read_bookminer_backup(book, filepath)
@@ -631,6 +1142,18 @@ def load_book_miner_settings(path:str = BOOK_MINER_SETTINGS_JSON_PATH)->BookMine
             raise Exception(f"invalid BookMiner setting. {name} must be positive integer. value = {value}")
         return value
 
+    def read_non_negative_int(name:str, current_value:int)->int:
+        value = raw_settings.get(name, current_value)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise Exception(f"invalid BookMiner setting. {name} must be non-negative integer. value = {value}")
+        return value
+
+    def read_bool(name:str, current_value:bool)->bool:
+        value = raw_settings.get(name, current_value)
+        if not isinstance(value, bool):
+            raise Exception(f"invalid BookMiner setting. {name} must be true or false. value = {value}")
+        return value
+
     def read_non_empty_str(name:str, current_value:str)->str:
         value = raw_settings.get(name, current_value)
         if not isinstance(value, str) or not value.strip():
@@ -649,12 +1172,53 @@ def load_book_miner_settings(path:str = BOOK_MINER_SETTINGS_JSON_PATH)->BookMine
         "peta_next_start_sfens_path",
         settings.peta_next_start_sfens_path,
     )
+    settings.spare_engines = read_non_negative_int(
+        "spare_engines",
+        settings.spare_engines,
+    )
+    settings.book_backend = read_non_empty_str(
+        "book_backend",
+        settings.book_backend,
+    )
+    if settings.book_backend not in BOOK_BACKENDS:
+        raise Exception(f"invalid BookMiner setting. book_backend must be one of {BOOK_BACKENDS}. value = {settings.book_backend}")
+    settings.journal_snapshot_mb = read_non_negative_int(
+        "journal_snapshot_mb",
+        settings.journal_snapshot_mb,
+    )
+    settings.journal_sync_interval_seconds = read_positive_int(
+        "journal_sync_interval_seconds",
+        settings.journal_sync_interval_seconds,
+    )
+    settings.peta_shock_backend = read_non_empty_str(
+        "peta_shock_backend",
+        settings.peta_shock_backend,
+    )
+    if settings.peta_shock_backend not in PETA_SHOCK_BACKENDS:
+        raise Exception(f"invalid BookMiner setting. peta_shock_backend must be one of {PETA_SHOCK_BACKENDS}. value = {settings.peta_shock_backend}")
+    settings.peta_shock_incremental = read_bool(
+        "peta_shock_incremental",
+        settings.peta_shock_incremental,
+    )
+    settings.multipv_widening = read_non_empty_str(
+        "multipv_widening",
+        settings.multipv_widening,
+    )
+    if settings.multipv_widening not in MULTIPV_WIDENINGS:
+        raise Exception(f"invalid BookMiner setting. multipv_widening must be one of {MULTIPV_WIDENINGS}. value = {settings.multipv_widening}")
 
     print(
         "BookMiner settings : "
         f"auto_save_interval_seconds = {settings.auto_save_interval_seconds}, "
         f"max_book_ply = {settings.max_book_ply}, "
-        f"peta_next_start_sfens_path = {settings.peta_next_start_sfens_path}"
+        f"peta_next_start_sfens_path = {settings.peta_next_start_sfens_path}, "
+        f"spare_engines = {settings.spare_engines}, "
+        f"book_backend = {settings.book_backend}, "
+        f"journal_snapshot_mb = {settings.journal_snapshot_mb}, "
+        f"journal_sync_interval_seconds = {settings.journal_sync_interval_seconds}, "
+        f"peta_shock_backend = {settings.peta_shock_backend}, "
+        f"peta_shock_incremental = {settings.peta_shock_incremental}, "
+        f"multipv_widening = {settings.multipv_widening}"
     )
     return settings
 
@@ -684,7 +1248,7 @@ def dump_book(book:Book):
     定跡をdumpする。
     """
     with book.lock:
-        items = list(book.body.items())
+        items = [(book.stored_sfen(key, position_info), position_info) for key, position_info in book.body.items()]
     for sfen, position_info in items:
         dump_position(sfen, position_info)
 
@@ -790,6 +1354,51 @@ def decode_position_string(s : PositionStr)->Sfen:
     return board.sfen()
 
 
+def make_position_chain(position_cmd:PositionStr)->PositionChain:
+    """
+    position_cmdを辿ってPositionChainを作る。非合法手があれば例外を投げる。
+    """
+    sfen, moves = parse_position_string(position_cmd)
+    board = cshogi.Board(sfen) # type:ignore
+
+    packed_keys = bytearray()
+    move16s = array("H")
+    visited : set[Sfen] = set()
+    end = -1
+    start_flipped = False
+    start_ply = 0
+    for i in range(len(moves) + 1):
+        current_sfen, ply = trim_sfen_ply(board.sfen())
+        key, flipped = canonical_sfen(current_sfen)
+        packed_keys += pack_sfen(key)
+        if i == 0:
+            start_flipped, start_ply = flipped, ply
+        if end < 0:
+            if current_sfen in visited:
+                end = i
+            visited.add(current_sfen)
+        if i == len(moves):
+            break
+        checked_push_usi(board, moves[i], context=position_cmd)
+        move16s.append(usi_to_packed_move16(cshogi.move_to_usi(board.peek()))) # type:ignore
+
+    count = len(moves) + 1
+    return PositionChain(bytes(packed_keys), start_flipped, start_ply, move16s, count if end < 0 else end)
+
+
+def legal_moves_for_position(s:PositionStr)->list[MoveStr]:
+    """
+    positionコマンドで指定できる局面を展開し、その局面の合法手をUSI形式で返す。
+    """
+    sfen, moves = parse_position_string(s)
+
+    board = cshogi.Board(sfen) # type:ignore
+    for move in moves:
+        checked_push_usi(board, move, context=s)
+
+    return [cshogi.move_to_usi(move) for move in board.legal_moves] # type:ignore
+
+
 def legal_move_count_for_position(s:PositionStr)->int:
     """
     positionコマンドで指定できる局面を展開し、その局面の合法手数を返す。
@@ -978,6 +1587,9 @@ class GlobalSettings:
     # GUI経由で起動されているか。
     from_gui : bool = False
 
+    # MultiPVを広げて再探索する方法。MULTIPV_WIDENINGSのいずれか。
+    multipv_widening : str = MULTIPV_WIDENING_FULL
+
 @dataclass
 class ThreadSettings:
     '''探索スレッド固有の設定を集めた構造体'''
@@ -1000,10 +1612,11 @@ class ThreadSettings:
 
 class Engine:
     '''エンジン操作クラス'''
-    def __init__(self, global_settings:GlobalSettings, thread_settings:ThreadSettings):
+    def __init__(self, global_settings:GlobalSettings, thread_settings:ThreadSettings, process:Any = None):
         '''
         global_settings : 全体設定
         thread_settings : スレッド設定
+        process : 指定したら、エンジンを起動せずにこれをエンジンのprocessとして使う。(benchmark用)
         '''
         self.global_settings = global_settings
         self.thread_settings = thread_settings
@@ -1012,11 +1625,29 @@ class Engine:
         self.search_sfen = ""
         self.last_go_searched_nodes = 0
 
+        # 直前のgo()で、MultiPVを広げたときに探索済みの指し手を探索し直さずに済んだnode数
+        self.last_go_saved_nodes = 0
+
+        # 送信済みのsetoption。エンジンを差し替えたときに同じ設定を送り直すために保持する。
+        self.usi_options : dict[str, str] = {}
+
+        # エンジン起動からreadyokまでにかかった時間(評価関数の読み込み時間)
+        self.launch_time = time.time()
+        self.eval_load_seconds : float | None = None
+
         path : str = thread_settings.engine_path
 
+        if process is not None:
+            self.engine = process
+            return
+
         # 思考エンジンのprocessの起動。
         # sshしたいなら、pathに"ssh 2698a suisho6"のようなsshコマンドを書いておけば良い。
-        if path.startswith("ssh"):
+        # "mux "から始まるpathなら、リモート側のagentとの1本の接続を複数のエンジンで共有する。(RemoteEngineLib.py参照)
+        if is_mux_path(path):
+            self.engine = open_remote_engine(path)
+
+        elif path.startswith("ssh"):
             # この場合、コマンドはlistで渡してやらないといけないらしい。
             self.engine = subprocess.Popen(path.split(), stdin=subprocess.PIPE,
                                                 stdout=subprocess.PIPE,
@@ -1051,6 +1682,8 @@ class Engine:
         # 別スレッドで実行して待機する
         def wait_readyok():
             self.wait_usi("readyok") # readyokを待つ
+            if self.eval_load_seconds is None:
+                self.eval_load_seconds = time.time() - self.launch_time
             self.thread_settings.readyok = True
 
         Thread(target=wait_readyok, daemon=True).start()
@@ -1074,8 +1707,34 @@ class Engine:
         self.engine.stdin.write(command+"\n") # type:ignore
         self.engine.stdin.flush()             # type:ignore
 
+        record_usi_option(self.usi_options, command)
+
         # print_log(f"{self.thread_settings.thread_id} < {command}")
 
+    def wait_ready(self):
+        ''' isreadyを送信して、readyokが返ってくるまで待つ。 '''
+        self.send_usi("isready")
+        self.wait_usi("readyok")
+        if self.eval_load_seconds is None:
+            self.eval_load_seconds = time.time() - self.launch_time
+        self.thread_settings.readyok = True
+
+    def apply_usi_options(self, usi_options:dict[str, str]):
+        ''' 別のエンジンに送信済みだったsetoptionをすべて送り直す。 '''
+        for command in usi_options.values():
+            self.send_usi(command)
+
+    def close(self):
+        ''' エンジンにquitを送って終了させる。終了しなければkillする。 '''
+        try:
+            if self.is_process_alive():
+                self.send_usi("quit")
+                self.engine.wait(timeout=5)
+        except Exception:
+            pass
+        if self.is_process_alive():
+            self.engine.kill()
+
     def receive_usi(self)->str:
         ''' 思考エンジンから1行もらう。改行は取り除いて返す。'''
         mes = self.engine.stdout.readline().strip() # type:ignore
@@ -1109,6 +1768,18 @@ class Engine:
             if mes==wait_text:
                 break
 
+    def finish_go(self, node:list[MoveInfo], searched_nodes:int, widening_count:int, saved_nodes:int)->list[MoveInfo]:
+        ''' go()の結果を記録して返す。 '''
+        self.last_go_searched_nodes = searched_nodes
+        self.last_go_saved_nodes = saved_nodes
+        if saved_nodes > 0:
+            # MultiPVを広げたときに、探索済みの指し手を探索し直さずに済んだnode数を局面ごとに出力する。
+            print(
+                f"[MultiPVWidening] thread={self.thread_settings.thread_id} moves={len(node)} "
+                f"widening={widening_count} searched_nodes={searched_nodes} saved_nodes={saved_nodes}"
+            )
+        return node
+
     def go(self, sfen:Sfen, node_ratio:float )->list[MoveInfo]:
         '''
         思考エンジンに探索させる。
@@ -1135,6 +1806,7 @@ class Engine:
             この形式に対応する。
         '''
         self.last_go_searched_nodes = 0
+        self.last_go_saved_nodes = 0
         multipv_step = max(1, self.global_settings.multipv)
         multipv_limit = max(1, legal_move_count_for_position(sfen))
 
@@ -1156,10 +1828,14 @@ class Engine:
         current_go_requested_nodes = nodes
 
         # "go"コマンドを思考エンジンに送信する。
-        def send_go(search_nodes:int):
+        # searchmovesはそれ以降のtokenをすべて指し手として読むエンジンがあるので、最後に付ける。
+        def send_go(search_nodes:int, searchmoves:list[MoveStr]|None = None):
             nonlocal current_go_requested_nodes
             current_go_requested_nodes = max(1, search_nodes)
-            self.send_usi(f"go nodes {current_go_requested_nodes}")
+            if searchmoves:
+                self.send_usi(f"go nodes {current_go_requested_nodes} searchmoves {' '.join(searchmoves)}")
+            else:
+                self.send_usi(f"go nodes {current_go_requested_nodes}")
 
         send_go(nodes)
 
@@ -1168,6 +1844,12 @@ class Engine:
 
         moves : dict[int,MoveInfo] = {}
 
+        # multipv_widening = "searchmoves" のとき、これまでのgoで順位のついた指し手。(評価値の降順)
+        searchmoves_mode = self.global_settings.multipv_widening == MULTIPV_WIDENING_SEARCHMOVES
+        ranked : list[MoveInfo] = []
+        widening_count = 0
+        saved_nodes = 0
+
         while True:
             ret = self.receive_usi()
             rets = ret.split()
@@ -1182,13 +1864,40 @@ class Engine:
                         break
                     node += moves[i],
                 
+                # 今回のgoで得られた候補手の数
+                node_count = len(node)
+                if searchmoves_mode:
+                    # 今回探索した指し手を、これまでの順位にマージする。
+                    # (searchmovesに対応していないエンジンで、探索済みの指し手が返ってきたものは除く)
+                    ranked_moves = {moveinfo.move for moveinfo in ranked}
+                    node = [moveinfo for moveinfo in node if moveinfo.move not in ranked_moves]
+                    node_count = len(node)
+                    node = sorted(ranked + node, key=lambda x: x.eval, reverse=True) # type:ignore
+
                 # 再探索条件を満たしているなら、再度思考コマンドを送って探索を継続
                 # 候補手がmultipvの個数だけあって、1番目と末尾の指して手の評価値の差がδ以内であるなら、multipvの範囲を少しずつ増やす。
                 # nodesは初期値の半分にする。
-                if len(node) == multipv and abs(node[0].eval - node[-1].eval) <= multipv_delta: # type:ignore
-                    if multipv >= multipv_limit:
-                        self.last_go_searched_nodes = searched_nodes
-                        return node
+                if node_count == multipv and abs(node[0].eval - node[-1].eval) <= multipv_delta: # type:ignore
+                    if len(node) >= multipv_limit:
+                        return self.finish_go(node, searched_nodes, widening_count, saved_nodes)
+
+                    widening_count += 1
+                    if searchmoves_mode:
+                        # まだ順位のついていない指し手だけを探索する。
+                        # nodesは、全部の指し手を探索し直す場合にそれらの指し手に割り当たる分だけにする。
+                        ranked = node
+                        ranked_moves = {moveinfo.move for moveinfo in ranked}
+                        searchmoves = [move for move in legal_moves_for_position(sfen) if move not in ranked_moves]
+                        if not searchmoves:
+                            return self.finish_go(node, searched_nodes, widening_count, saved_nodes)
+                        multipv = min(multipv_step, len(searchmoves))
+                        widened_multipv = len(ranked) + multipv
+                        nodes = max(1, half_nodes * multipv // widened_multipv)
+                        saved_nodes += half_nodes - nodes
+                        moves.clear()
+                        self.send_usi(f"multipv {multipv}")
+                        send_go(nodes, searchmoves)
+                        continue
 
                     # multipvの範囲を広げて再度"go"コマンドを思考エンジンに送信する。
                     multipv = min(multipv + multipv_step, multipv_limit)
@@ -1197,8 +1906,7 @@ class Engine:
                     send_go(nodes)
                     continue
 
-                self.last_go_searched_nodes = searched_nodes
-                return node
+                return self.finish_go(node, searched_nodes, widening_count, saved_nodes)
 
             else:
                 # 読み筋に対して、そのpvの初手を蓄積していく。
@@ -1260,6 +1968,7 @@ class EngineManager:
             quit                  = False,
             debug_engine          = False,
             from_gui              = from_gui,
+            multipv_widening      = book_miner_settings.multipv_widening,
         )
         self.global_settings = global_settings
         self.task_progress_lock = Lock()
@@ -1333,10 +2042,69 @@ class EngineManager:
         print("all engines are ready.")
 
         self.engines = engines
+
+        # エンジンが落ちたときに差し替える予備エンジンの管理。
+        # 初期エンジンの評価関数の読み込み時間もここに記録しておく。
+        self.engine_supervisor = EngineSupervisor(self.launch_spare_engine, book_miner_settings.spare_engines)
+        for engine in engines:
+            if engine.eval_load_seconds is not None:
+                self.engine_supervisor.record_eval_load(engine.eval_load_seconds)
+        for engine_setting in engine_settings:
+            self.engine_supervisor.prepare(engine_setting["path"])
+        self.engine_supervisor_last_reported = ""
+
         print(f"[EngineAlive] {total_engines}/{total_engines}")
         self.engine_alive_monitor_thread = Thread(target=self.engine_alive_monitor, daemon=True)
         self.engine_alive_monitor_thread.start()
 
+    def launch_spare_engine(self, engine_path:str)->Engine:
+        '''予備エンジンを起動してreadyokまで待つ。thread_settingsは差し替え時に置き換える。'''
+        thread_settings = ThreadSettings(
+            thread_id              = -1,
+            engine_path            = engine_path,
+            engine_nodes           = 0,
+            readyok                = False
+        )
+        engine = Engine(self.global_settings, thread_settings)
+        try:
+            engine.wait_ready()
+        except Exception:
+            engine.close()
+            raise
+        return engine
+
+    def replace_dead_engine(self, engine:Engine)->Engine:
+        '''
+        落ちたエンジンを予備エンジンと差し替える。
+        thread_settings(スレッドID、探索node数など)と送信済みのsetoptionを引き継ぐ。
+        '''
+        thread_settings = engine.thread_settings
+        new_engine = self.engine_supervisor.acquire(thread_settings.engine_path)
+        new_engine.thread_settings = thread_settings
+        new_engine.apply_usi_options(engine.usi_options)
+        new_engine.wait_ready()
+
+        with self.engine_alive_lock:
+            for i, e in enumerate(self.engines):
+                if e is engine:
+                    self.engines[i] = new_engine
+                    break
+            thread_settings.alive = True
+
+        print(
+            f"[EngineRestart] thread_id={thread_settings.thread_id} "
+            f"return_code={engine.return_code()} {self.engine_supervisor.stats_text()}"
+        )
+        self.report_engine_alive()
+        return new_engine
+
+    def report_engine_supervisor(self):
+        stats_text = self.engine_supervisor.stats_text()
+        if self.engine_supervisor.restart_count == 0 or stats_text == self.engine_supervisor_last_reported:
+            return
+        self.engine_supervisor_last_reported = stats_text
+        print(f"[EngineSupervisor] {stats_text}")
+
     def engine_alive_count(self)->int:
         return sum(1 for engine in self.engines if engine.thread_settings.alive)
 
@@ -1367,6 +2135,7 @@ class EngineManager:
     def engine_alive_monitor(self):
         while not self.global_settings.quit:
             self.report_engine_alive()
+            self.report_engine_supervisor()
             time.sleep(ENGINE_ALIVE_CHECK_INTERVAL)
 
     def reached_max_book_ply(self, ply:int, max_book_ply:int|None = None)->bool:
@@ -1392,38 +2161,51 @@ class EngineManager:
         dump_position(SFEN_START, position_info)
 
 
-    def think_sfen_once(self, book:Book, engine:Engine, sfen:Sfen, ply:int, last_thinking_ply:int, visited:set[Sfen], max_book_ply:int|None = None):
+    def think_sfen_once(
+        self,
+        book:Book,
+        engine:Engine,
+        sfen:Sfen,
+        ply:int,
+        last_thinking_ply:int,
+        visited:set[Sfen],
+        max_book_ply:int|None = None,
+        canonical:tuple[Sfen, bool]|None = None,
+    ):
         """
         1局面について、未思考なら思考してbookにマージする。
+        canonicalは呼び出し元で求めてあるcanonical_sfen(sfen)。(省略したらここで求める)
         """
         global CALL_COUNT, LAST_REPORT
 
         current_sfen = sfen
-        current_sfen_f = flipped_sfen(current_sfen)
+        # visited, searching_sfens, book.bodyはいずれもこのkeyで調べる。
+        # keyは1局面につき1回だけ求めて、以降はbook.find_key()などにそのまま渡す。
+        current_key, current_flipped = canonical_sfen(current_sfen) if canonical is None else canonical
         limit = self.book_miner_settings.max_book_ply if max_book_ply is None else max_book_ply
 
         if self.reached_max_book_ply(ply, limit):
             self.print_reached_max_book_ply(current_sfen, ply, limit)
             return None, current_sfen, last_thinking_ply, TASK_RESULT_DONE
 
-        with book.lock:
-            if current_sfen in visited or current_sfen_f in visited:
+        # この局面の読み書きは、この局面のstripeのlockで行う。
+        lock = book.stripe(current_key).lock
+        with lock:
+            if current_key in visited:
                 return None, current_sfen, last_thinking_ply, TASK_RESULT_DONE
 
-            if current_sfen in book.searching_sfens or current_sfen_f in book.searching_sfens:
-                # 他のスレッドが探索中なので、このtaskはqueue末尾へ戻して後で再試行する。
+            if book.is_searching(current_key):
+                # 他のスレッドが探索中なので、このtaskはその探索が終わってから再試行する。
                 return None, current_sfen, last_thinking_ply, TASK_RESULT_DEFERRED
 
-            if current_sfen in book.body:
-                position_info = book.body[current_sfen]
-            elif current_sfen_f in book.body:
-                position_info = book.body[current_sfen_f]
-                current_sfen = current_sfen_f
-            else:
-                position_info = None
+            position_info = book.body.get(current_key)
+            if position_info is not None:
+                # 定跡に登録されている向きの局面で思考・マージする。
+                current_sfen = book.stored_sfen(current_key, position_info)
+                current_flipped = position_info.flipped
 
-            book.searching_sfens.add(current_sfen)
-            visited.add(current_sfen)
+            book.start_search(current_key)
+            visited.add(current_key)
 
         try:
             if not position_info or not has_considered(position_info):
@@ -1439,36 +2221,15 @@ class EngineManager:
                 last_thinking_ply = ply # この局面で思考したので更新する。
                 book_position_count = None
 
-                with book.lock:
-                    changed = False
-                    if position_info:
-                        # 新規局面ではないので、マージ。
-                        for moveinfo_new in position_info_new:
-                            for moveinfo in position_info.moveinfos:
-                                if moveinfo_new.move == moveinfo.move:
-                                    if moveinfo.eval != moveinfo_new.eval or moveinfo.depth != moveinfo_new.depth:
-                                        moveinfo.eval = moveinfo_new.eval
-                                        moveinfo.depth = moveinfo_new.depth
-                                        changed = True
-                                    break
-                            else:
-                                position_info.moveinfos.append(moveinfo_new)
-                                changed = True
-                    else:
-                        # 新規局面なので定跡にそのまま追加
-                        position_info = PositionInfo(position_info_new, ply)
-                        book.body[current_sfen] = position_info
-                        changed = True
-
-                    # できればbestな順で掘りたいので、evalで降順に並び替える。
-                    # valueがないところは、VALUE_MIN扱い。
-                    position_info.moveinfos.sort(key=lambda x: x.eval if x.eval is not None else VALUE_MIN, reverse=True)
-                    if changed:
-                        book.mark_modified()
+                with lock:
+                    position_info = merge_search_result(book, current_sfen, ply, position_info_new, (current_key, current_flipped))
+                    # 思考中に逆向きで登録し直されていたら、登録されている向きにそろえる。
+                    current_sfen = book.stored_sfen(current_key, position_info)
                     book_position_count = len(book.body)
 
-                    if not self.global_settings.from_gui:
-                        # CLIでは従来通り、探索呼び出し回数を10分ごとに出力する。
+                if not self.global_settings.from_gui:
+                    # CLIでは従来通り、探索呼び出し回数を10分ごとに出力する。
+                    with CALL_COUNT_LOCK:
                         CALL_COUNT += 1
                         now = time.time()
                         if now - LAST_REPORT >= 600:
@@ -1482,29 +2243,34 @@ class EngineManager:
             return position_info, current_sfen, last_thinking_ply, TASK_RESULT_DONE
 
         finally:
-            with book.lock:
-                book.searching_sfens.discard(current_sfen)
+            with lock:
+                waiters = book.end_search(current_key)
+            # この局面の探索が終わるのを待っていたtaskをqueueに戻す。
+            for waiter in waiters:
+                waiter()
 
     def get_book_position_info(self, book:Book, sfen:Sfen)->tuple[PositionInfo | None, bool]:
         """
         book上の局面情報を返す。flip側でhitしたときは第2戻り値をTrueにする。
         """
-        sfen_f = flipped_sfen(sfen)
+        with book.position_lock(sfen):
+            return book.find(sfen)
 
-        with book.lock:
-            if sfen in book.body:
-                return book.body[sfen], False
-            if sfen_f in book.body:
-                return book.body[sfen_f], True
-
-        return None, False
+    def get_chain_position_info(self, book:Book, chain:PositionChain, keys:list[Sfen], i:int)->tuple[PositionInfo | None, bool]:
+        """
+        chainのi番目の局面のbook上の局面情報を返す。keysはchain.keys()。戻り値はget_book_position_info()と同じ。
+        """
+        key = keys[i]
+        with book.stripe(key).lock:
+            return book.find_key(key, chain.flipped(i))
 
-    def get_book_move_eval(self, book:Book, sfen:Sfen, move:MoveStr)->Eval:
+    def get_chain_move_eval(self, book:Book, chain:PositionChain, keys:list[Sfen], i:int)->Eval:
         """
-        book上でsfenからmoveを指したときの評価値を返す。
+        book上でchainのi番目の局面からi番目の指し手を指したときの評価値を返す。keysはchain.keys()。
         moveがbookに無い、または評価値が無い場合はNoneを返す。
         """
-        position_info, flipped_bookhit = self.get_book_position_info(book, sfen)
+        move = chain.move(i)
+        position_info, flipped_bookhit = self.get_chain_position_info(book, chain, keys, i)
         if position_info is None:
             return None
 
@@ -1515,37 +2281,21 @@ class EngineManager:
 
         return None
 
-    def position_command_hits_searching_sfen(self, book:Book, position_cmd:PositionStr, max_book_ply:int)->bool:
+    def position_command_searching_key(self, book:Book, chain:PositionChain, keys:list[Sfen], max_book_ply:int)->Sfen | None:
         """
-        `startpos moves ...` の明示手順上に、他workerが探索中の局面があるかを先読みする。
+        `startpos moves ...` の明示手順上に、他workerが探索中の局面があるかを先読みする。keysはchain.keys()。
+        あればその局面のkey(canonical_sfen())を返す。なければNone。
         ここで検出できてもraceは残るので、到達時の探索中判定も残す。
         """
-        sfen, moves = parse_position_string(position_cmd)
-        board = cshogi.Board(sfen) # type:ignore
-        sfens : list[Sfen] = []
-        path_visited : set[Sfen] = set()
-
-        for move in moves:
-            current_sfen, ply = trim_sfen_ply(board.sfen())
-            if current_sfen in path_visited:
-                break
-            path_visited.add(current_sfen)
-            if self.reached_max_book_ply(ply, max_book_ply):
+        for i in range(min(chain.end, chain.leaf() + 1)):
+            if self.reached_max_book_ply(chain.ply(i), max_book_ply):
                 break
-            sfens.append(current_sfen)
-            checked_push_usi(board, move, context=position_cmd)
-        else:
-            leaf_sfen, leaf_ply = trim_sfen_ply(board.sfen())
-            if leaf_sfen not in path_visited and not self.reached_max_book_ply(leaf_ply, max_book_ply):
-                sfens.append(leaf_sfen)
-
-        with book.lock:
-            for current_sfen in sfens:
-                current_sfen_f = flipped_sfen(current_sfen)
-                if current_sfen in book.searching_sfens or current_sfen_f in book.searching_sfens:
-                    return True
+            key = keys[i]
+            with book.stripe(key).lock:
+                if book.is_searching(key):
+                    return key
 
-        return False
+        return None
 
     def start_thinking(self, book:Book, engine:Engine, task:Task):
         """
@@ -1579,6 +2329,7 @@ class EngineManager:
             # 現局面を必要なら思考する。
             position_info, current_sfen, last_thinking_ply, status = self.think_sfen_once(book, engine, current_sfen, ply, last_thinking_ply, visited, max_book_ply)
             if status == TASK_RESULT_DEFERRED:
+                task.blocked_key = canonical_sfen(current_sfen)[0]
                 return TASK_RESULT_DEFERRED
             if position_info is None:
                 return TASK_RESULT_DONE
@@ -1627,68 +2378,66 @@ class EngineManager:
         """
         if task.position_cmd is None:
             return TASK_RESULT_DONE
+        if task.chain is None:
+            task.chain = make_position_chain(task.position_cmd)
+        chain = task.chain
+        # 局面のkeyは、このtaskを掘っている間だけsfen文字列に戻して持つ。
+        keys = chain.keys()
 
         eval_limit = task.eval_limit
         max_book_ply = task.max_book_ply
-        if self.position_command_hits_searching_sfen(book, task.position_cmd, max_book_ply):
+        task.blocked_key = self.position_command_searching_key(book, chain, keys, max_book_ply)
+        if task.blocked_key is not None:
             return TASK_RESULT_DEFERRED
 
-        sfen, moves = parse_position_string(task.position_cmd)
-        board = cshogi.Board(sfen) # type:ignore
-
         engine.send_newgame()
 
         visited : set[Sfen] = set()
-        path_visited : set[Sfen] = set()
         last_thinking_ply = PLY_MIN
 
-        for move in moves:
-            current_sfen, ply = trim_sfen_ply(board.sfen())
-            if current_sfen in path_visited:
+        leaf = chain.leaf()
+        for i in range(leaf):
+            # 同じ局面に戻ってきたら、そこで終わる。
+            if i >= chain.end:
                 return TASK_RESULT_DONE
-            path_visited.add(current_sfen)
 
+            ply = chain.ply(i)
             if self.reached_max_book_ply(ply, max_book_ply):
-                self.print_reached_max_book_ply(current_sfen, ply, max_book_ply)
+                self.print_reached_max_book_ply(chain.sfen(i, keys[i]), ply, max_book_ply)
                 return TASK_RESULT_DONE
 
             # 現局面が未思考なら、棋譜上の局面としてbookに取り込む。
-            position_info, _ = self.get_book_position_info(book, current_sfen)
+            position_info, _ = self.get_chain_position_info(book, chain, keys, i)
             if position_info is None or not has_considered(position_info):
-                position_info, _, last_thinking_ply, status = self.think_sfen_once(book, engine, current_sfen, ply, last_thinking_ply, visited, max_book_ply)
+                position_info, _, last_thinking_ply, status = self.think_sfen_once(
+                    book, engine, chain.sfen(i, keys[i]), ply, last_thinking_ply, visited, max_book_ply, (keys[i], chain.flipped(i)))
                 if status == TASK_RESULT_DEFERRED:
+                    task.blocked_key = keys[i]
                     return TASK_RESULT_DEFERRED
                 if position_info is None:
                     return TASK_RESULT_DONE
 
-            lookahead_board = cshogi.Board(board.sfen()) # type:ignore
-            checked_push_usi(lookahead_board, move, context=task.position_cmd)
-            next_sfen = trim_sfen(lookahead_board.sfen())
-            next_position_info, _ = self.get_book_position_info(book, next_sfen)
+            next_position_info, _ = self.get_chain_position_info(book, chain, keys, i + 1)
 
             # 次局面がbook上の思考済みノードでないなら、この手は定跡木から外へ出る枝。
             # その枝の評価値がeval_limitを超えている場合は、棋譜末端までは辿らずに止める。
             if next_position_info is None or not has_considered(next_position_info):
-                move_eval = self.get_book_move_eval(book, current_sfen, move)
+                move_eval = self.get_chain_move_eval(book, chain, keys, i)
                 if isinstance(move_eval, int) and abs(move_eval) > eval_limit:
                     return TASK_RESULT_DONE
 
-            checked_push_usi(board, move, context=task.position_cmd)
-
-        leaf_sfen, leaf_ply = trim_sfen_ply(board.sfen())
-        if leaf_sfen in path_visited:
+        if leaf >= chain.end:
             return TASK_RESULT_DONE
-        return self.start_thinking(
-            book,
-            engine,
-            Task(
-                leaf_sfen,
-                leaf_ply,
-                eval_limit,
-                max_book_ply=max_book_ply,
-                book_extend_ply=task.book_extend_ply,
-            ),
+        leaf_task = Task(
+            chain.sfen(leaf, keys[leaf]),
+            chain.ply(leaf),
+            eval_limit,
+            max_book_ply=max_book_ply,
+            book_extend_ply=task.book_extend_ply,
         )
+        result = self.start_thinking(book, engine, leaf_task)
+        task.blocked_key = leaf_task.blocked_key
+        return result
 
     """
     def parallel_think(self, book:Book, think_sfens:list[Sfen]):
@@ -1738,7 +2487,12 @@ class EngineManager:
 
     def start_task_workers(self, book:Book):
         # このqueueにtaskを積むとそれが処理されていく。
-        self.task_queue : JobRoundRobinQueue[Task] = JobRoundRobinQueue()
+        # 優先度順に取り出し、同じ局面を掘るtaskは1つにまとめる。
+        self.task_queue : PriorityTaskQueue[Task] = PriorityTaskQueue(
+            lambda task: task_priority(book, task),
+            task_queue_key,
+            merge_queued_task,
+        )
 
         threads : list[Thread] = []
         for engine in self.engines:
@@ -1762,7 +2516,7 @@ class EngineManager:
                     result = self.start_thinking(book, engine, task)
 
                 if result == TASK_RESULT_DEFERRED:
-                    self.defer_task(task)
+                    self.defer_task(book, task)
                     continue
 
                 self.report_task_queue_progress(task)
@@ -1770,18 +2524,42 @@ class EngineManager:
             except Exception as e:
                 print(f"Exception :{type(e).__name__}{e}\n{traceback.format_exc()}")
                 engine_dead = not engine.is_process_alive()
+                if engine_dead and not self.global_settings.quit:
+                    self.report_engine_alive(engine)
+
+                    # 予備エンジンと差し替えて、処理中だったtaskはqueueに積み直す。
+                    # 思考済みの局面はbookに反映されているので、積み直したtaskではskipされる。
+                    try:
+                        engine = self.replace_dead_engine(engine)
+                    except Exception as e2:
+                        print(f"Exception in replacing engine :{type(e2).__name__}{e2}")
+                        if task is not None:
+                            self.report_task_queue_progress(task)
+                        break
+
+                    if task is not None:
+                        self.task_queue.put(task)
+                    continue
+
                 if task is not None:
                     self.report_task_queue_progress(task)
                 if engine_dead:
-                    self.report_engine_alive(engine)
                     break
 
 
-    def put_task(self, task:Task):
-        # (taskがなければ)taskを積む
-        self.task_queue.put(task)  # 満杯ならここでブロック
+    def put_task(self, task:Task)->bool:
+        # taskを積む。同じ局面を掘るtaskがqueueにあれば、それにまとめてFalseを返す。
+        return self.task_queue.put(task)
 
-    def defer_task(self, task:Task):
+    def set_task_job_weight(self, job_id:int, weight:float):
+        # job_idのtaskを取り出す頻度の重み
+        self.task_queue.set_job_weight(job_id, weight)
+
+    def defer_task(self, book:Book, task:Task):
+        """
+        他workerが探索中の局面に当たったtaskを、その探索が終わったときにqueueに戻す。
+        workerはその間、queueの他のtaskを処理する。
+        """
         task.defer_count += 1
         with self.task_progress_lock:
             job_progress = self.task_progress_jobs.get(task.job_id)
@@ -1796,8 +2574,15 @@ class EngineManager:
             self.report_task_queue_progress(task)
             return
 
-        time.sleep(TASK_DEFER_SLEEP_SECONDS)
-        self.task_queue.put_deferred(task)
+        blocked_key = task.blocked_key
+        task.blocked_key = None
+        waiting = False
+        if blocked_key is not None:
+            with book.stripe(blocked_key).lock:
+                waiting = book.wait_search(blocked_key, lambda: self.task_queue.put(task))
+        if not waiting:
+            # もう探索が終わっていたので、すぐにqueueに戻す。
+            self.task_queue.put(task)
 
     def join_task(self):
         # 全task queueのjoin待ち
@@ -1851,6 +2636,10 @@ class EngineManager:
             )
 
     def report_task_queue_progress(self, task:Task):
+        # queueに積むときにこのtaskにまとめたtaskも、一緒に完了扱いにする。
+        for merged_task in task.merged_tasks:
+            self.report_task_queue_progress(merged_task)
+
         if task.job_id <= 0:
             return
         if task.progress_reported:
@@ -2036,6 +2825,103 @@ def has_considered(infos:PositionInfo)->bool:
     """
     return get_best(infos)[0] is not None
 
+
+def merge_search_result(
+    book:Book,
+    sfen:Sfen,
+    ply:int,
+    moveinfos_new:list[MoveInfo],
+    canonical:tuple[Sfen, bool]|None = None,
+)->PositionInfo:
+    """
+    sfenの局面をエンジンで思考した結果をbookにマージして書き込み、書き込んだ局面情報を返す。
+    canonicalは呼び出し元で求めてあるcanonical_sfen(sfen)。(省略したらここで求める)
+    sfenの局面のstripeのlock(book.position_lock(sfen))は呼び出し元で行う。
+    """
+    key, flipped = canonical_sfen(sfen) if canonical is None else canonical
+
+    # 思考している間に書き換えられていることがあるので、lockを取ってから読み直す。
+    position_info, flipped_bookhit = book.find_key(key, flipped)
+    changed = False
+    if position_info:
+        # 新規局面ではないので、マージ。(bodyに入っているものは書き換えないのでcopyする)
+        position_info = copy_position_info(position_info)
+        for moveinfo_new in moveinfos_new:
+            move_new = flipped_move(moveinfo_new.move) if flipped_bookhit else moveinfo_new.move
+            for moveinfo in position_info.moveinfos:
+                if move_new == moveinfo.move:
+                    if moveinfo.eval != moveinfo_new.eval or moveinfo.depth != moveinfo_new.depth:
+                        moveinfo.eval = moveinfo_new.eval
+                        moveinfo.depth = moveinfo_new.depth
+                        changed = True
+                    break
+            else:
+                position_info.moveinfos.append(MoveInfo(move_new, moveinfo_new.eval, moveinfo_new.depth))
+                changed = True
+    else:
+        # 新規局面なので定跡にそのまま追加(下で書き込む)
+        position_info = PositionInfo(moveinfos_new, ply)
+        changed = True
+
+    # できればbestな順で掘りたいので、evalで降順に並び替える。
+    # valueがないところは、VALUE_MIN扱い。
+    position_info.moveinfos.sort(key=lambda x: x.eval if x.eval is not None else VALUE_MIN, reverse=True)
+    # 並び替えた結果も含めて書き込む。(packed backendでは書き戻さないと反映されない)
+    if flipped_bookhit:
+        book.update_key(key, position_info)
+    else:
+        book.store_key(key, flipped, position_info)
+    if changed:
+        book.mark_modified()
+        book.write_journal(book.stored_sfen(key, position_info), position_info)
+    return position_info
+
+
+def task_priority(book:Book, task:Task)->float:
+    """
+    taskをqueueから取り出す優先度。小さいほど先に取り出す。
+    棋譜末端の局面のbestの評価値が互角に近く、手数が浅いものを優先する。
+    """
+    chain = task.chain
+    if chain is None:
+        ply = task.ply
+        with book.position_lock(task.sfen):
+            position_info, _ = book.find(task.sfen)
+    else:
+        leaf = chain.leaf()
+        ply = chain.ply(leaf)
+        key = chain.key(leaf)
+        with book.stripe(key).lock:
+            position_info, _ = book.find_key(key, chain.flipped(leaf))
+    best_eval = None if position_info is None else get_best(position_info)[0]
+    eval_priority = 0 if best_eval is None else abs(best_eval)
+    return TASK_PRIORITY_EVAL_WEIGHT * eval_priority + TASK_PRIORITY_PLY_WEIGHT * ply
+
+
+def task_queue_key(task:Task)->Any:
+    """
+    同じ局面を掘るtaskであるかを判定するためのkey。
+    `e`コマンドのtaskは、棋譜上の局面の列(各局面のcanonical_sfen())をkeyにする。
+    position文字列の書き方(sfenかstartposか、空白など)が違っても、同じ局面を辿る棋譜なら1つにまとめる。
+    途中の局面も掘るので、棋譜末端の局面が同じでも途中の局面が違う棋譜はまとめない。
+    """
+    if task.position_cmd is not None:
+        if task.chain is None:
+            task.chain = make_position_chain(task.position_cmd)
+        return task.chain.packed_keys
+    return canonical_sfen(task.sfen)[0]
+
+
+def merge_queued_task(queued:Task, task:Task)->None:
+    """
+    queueに残っているtaskと同じ局面を掘るtaskを、queued側にまとめる。
+    掘る条件は、緩い(深く掘る)ほうに合わせる。
+    """
+    queued.eval_limit = max(queued.eval_limit, task.eval_limit)
+    queued.max_book_ply = max(queued.max_book_ply, task.max_book_ply)
+    queued.book_extend_ply = max(queued.book_extend_ply, task.book_extend_ply)
+    queued.merged_tasks.append(task)
+
 def write_to_yaneuraou_book(book:Book, save_dir:str, ply_limit:int|None = None)->str:
     """
     やねうら王 定跡形式で書き出す。
@@ -2063,30 +2949,35 @@ def bfs_for_ply(book:Book):
     """
     print("bfs for ply")
 
+    # 訪問済みの局面のkey(canonical_sfen())
     visited : set[Sfen] = set()
-    next_queue : list[Sfen] = [SFEN_START]
+    # key → 辿るsfen
+    next_queue : dict[Sfen, Sfen] = {canonical_sfen(SFEN_START)[0]: SFEN_START}
 
     ply = 1
     # 書き出した局面数
     c = 0
 
     while next_queue:
-        # 訪問済みの局面を除外して重複を除去しておく。
-        next_queue = list(set([sfen for sfen in next_queue if sfen not in visited and flipped_sfen(sfen) not in visited]))
+        # 訪問済みの局面を除外しておく。(keyで重複は除去されている)
+        sfen_queue = [(key, sfen) for key, sfen in next_queue.items() if key not in visited]
 
-        print(f"bfs ply = {ply} , num = {len(next_queue)}")
-        c += len(next_queue)
+        print(f"bfs ply = {ply} , num = {len(sfen_queue)}")
+        c += len(sfen_queue)
 
-        sfen_queue = next_queue
-        next_queue = []
+        next_queue = {}
 
-        for sfen in sfen_queue:
+        for key, sfen in sfen_queue:
             # この局面はbookに存在するはずで…。(初期局面のことは知らんが…)
-            visited.add(sfen)
+            visited.add(key)
 
-            position_info = book.body[sfen]
+            position_info = book.body[key]
             # 手数を記録する。
-            position_info.ply = ply
+            if position_info.ply != ply:
+                position_info = copy_position_info(position_info)
+                position_info.ply = ply
+                book.update(key, position_info)
+                book.write_journal(book.stored_sfen(key, position_info), position_info)
 
             # 指し手を辿る。
             board = cshogi.Board(sfen)
@@ -2098,13 +2989,10 @@ def bfs_for_ply(book:Book):
 
                 # 1手進めた局面が定跡本体に存在しないなら駄目っぽ。
                 next_sfen = trim_sfen(board.sfen())
+                next_key, _ = canonical_sfen(next_sfen)
 
-                if next_sfen in book.body and next_sfen not in visited:
-                    next_queue.append(next_sfen)
-                else:
-                    next_sfen_f = flipped_sfen(next_sfen)
-                    if next_sfen_f in book.body and next_sfen_f not in visited:
-                        next_queue.append(next_sfen_f)
+                if next_key not in visited and next_key in book.body:
+                    next_queue[next_key] = next_sfen
                 board.pop()
 
         ply += 1
@@ -2325,18 +3213,18 @@ def read_yaneuraou_book(book:Book, path:str):
     print(f"read yaneuraou book , path = {path}")
 
     def append_position(sfen:Sfen, ply:int, moveinfos:list[MoveInfo]):
-        if sfen in book.body:
+        # flipした局面も同じkeyで見つかる。
+        position_info, flipped_bookhit = book.find(sfen)
+        if position_info is not None:
             # 定跡本体に見つかったので、指し手のみ追加登録する。
-            merge_moveinfos(book.body[sfen], moveinfos)
+            if flipped_bookhit:
+                moveinfos = [MoveInfo(flipped_move(moveinfo.move), moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos]
+            position_info = copy_position_info(position_info)
+            merge_moveinfos(position_info, moveinfos)
+            book.update(sfen, position_info)
         else:
-            # flipped sfenのほうも調べる。
-            sfen_f = flipped_sfen(sfen)
-            if sfen_f in book.body:
-                moveinfos_f = [MoveInfo(flipped_move(moveinfo.move), moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos]
-                merge_moveinfos(book.body[sfen_f], moveinfos_f)
-            else:
-                # 定跡本体に見つからなかったので、新規局面として登録する。
-                book.body[sfen] = PositionInfo([MoveInfo(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos], ply)
+            # 定跡本体に見つからなかったので、新規局面として登録する。
+            book.store(sfen, PositionInfo([MoveInfo(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos], ply))
 
     with book.lock:
         read_yaneuraou_book_file(path, append_position)
@@ -2360,7 +3248,17 @@ def read_regular_book_fast(book:Book, path:str, label:str):
     print(f"read {label} , path = {path}")
 
     def append_position(sfen:Sfen, ply:int, moveinfos:list[MoveInfo]):
-        book.body[sfen] = PositionInfo(moveinfos, ply)
+        position_info = PositionInfo(moveinfos, ply)
+        key, position_info.flipped = canonical_sfen(sfen)
+        existing = book.body.setdefault(key, position_info)
+        if existing is not position_info:
+            # flipした局面が別の局面として書き出されていた。(通常はない) 指し手をmergeしておく。
+            if existing.flipped != position_info.flipped:
+                moveinfos = [MoveInfo(flipped_move(moveinfo.move), moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos]
+            existing = copy_position_info(existing)
+            merge_moveinfos(existing, moveinfos)
+            book.preserve_for_snapshots(key)
+            book.body[key] = existing
 
     with book.lock:
         read_yaneuraou_book_file(
@@ -2377,6 +3275,10 @@ def read_regular_book_fast(book:Book, path:str, label:str):
 peta_book = Book()
 peta_book_probe_path : str | None = None
 
+# peta shock化の方法。user_input()で設定ファイルの値にする。
+peta_shock_backend = PETA_SHOCK_BACKEND_ENGINE
+peta_shock_incremental = PETA_SHOCK_INCREMENTAL
+
 
 def collect_book_backup_paths()->list[str]:
     paths : list[str] = []
@@ -2460,13 +3362,51 @@ def ensure_supported_peta_book_path(path:str, label:str):
         raise Exception(f"{label} must be .db or .ybb : {path}")
 
 
-def load_latest_book_backup(book:Book):
+def load_latest_book_backup(book:Book)->str|None:
+    """
+    最新の通常バックアップを読み込んで、そのpathを返す。無ければ空の定跡のままでNoneを返す。
+    """
     path = get_latest_book_backup_or_none()
     if path is None:
         print(f"book backup file not found. start with empty book. dir = {BOOK_BACKUP_DIR}")
-        return
+        return None
 
     load_book(book, path, fast=True)
+    return path
+
+
+def journal_snapshot_name(path:str|None)->str:
+    """
+    ジャーナルのsegmentに書く、元になる定跡DBの名前。save_book_backup()で書き出したDBならそのtimestamp。
+    book_miner.db(旧形式の名前)や、定跡DBが無いときは空文字列。
+    """
+    if path is None:
+        return ""
+    parsed = parse_regular_book_backup_name(path)
+    return parsed[0] if parsed is not None else ""
+
+
+def replay_book_journal(book:Book, journal:BookJournal, snapshot_name:str):
+    """
+    読み込んだ定跡DB(snapshot_name)のあとに書かれたジャーナルを、bookに適用する。
+    """
+    paths = journal.replay_paths(snapshot_name)
+    all_paths = journal.segment_paths()
+    if len(paths) < len(all_paths):
+        print(f"Warning : skip {len(all_paths) - len(paths)} journal segments for other book. snapshot = {snapshot_name!r}")
+    if not paths:
+        return
+
+    print(f"[JournalReplayStart] segments={len(paths)}")
+    count = 0
+    with book.lock:
+        for sfen, ply, moves in journal.iter_records(paths):
+            book.store(sfen, PositionInfo([MoveInfo(move, eval, depth) for move, eval, depth in moves], ply))
+            count += 1
+        if count:
+            book.mark_modified()
+        position_count = len(book.body)
+    print(f"[JournalReplayDone] records={count} positions={position_count}")
 
 
 def resolve_peta_source_book_path(path:str|None)->str:
@@ -2678,11 +3618,172 @@ def read_peta_book(peta_book_path:str|None = None):
     print("reading the peta_book has done.")
 
 
+@dataclass
+class PetaShockState:
+    """
+    nativeのpeta shock化の結果。peta_shock_incrementalのときは残しておき、
+    次回はそのあとにbookでstore()/update()された局面(book.peta_dirty_keys)だけをgraphに反映する。
+    """
+    # 変換元の定跡
+    book : Book
+    graph : PetaShockGraph
+    # nodeの局面(graphに渡したときの向き)と手数
+    sfens : list[Sfen]
+    plies : list[int]
+    # 変換結果
+    peta_book : Book
+
+
+# 前回のpeta shock化の結果。peta_shock_incrementalのときだけ残す。
+peta_shock_state : PetaShockState | None = None
+
+
+def store_peta_shock_position(state:PetaShockState, node:int):
+    """graphのnodeの変換結果をstate.peta_bookに登録する。lockは呼び出し元で行う。"""
+    state.peta_book.store(
+        state.sfens[node],
+        PositionInfo([MoveInfo(move, eval, depth) for move, eval, depth in state.graph.moves(node)], state.plies[node]),
+    )
+
+
+def peta_shock_book_full(book:Book, keep_state:bool)->PetaShockState:
+    """
+    bookの全体をpeta shock化する。やねうら王の makebook peta_shock と同じ変換をメモリ上で行う。
+    変換の入力は、bookを通常bookとして書き出したときと同じ内容にする。
+    keep_stateなら、このあとの変更をbook.peta_dirty_keysに記録させる。
+    """
+    start_time = time.time()
+    if keep_state:
+        # snapshotを取る前に記録を始める。snapshotにも含まれる変更が記録されることがあるが、
+        # 同じ内容を反映し直しても結果は変わらない。
+        with book.lock:
+            book.peta_dirty_keys = set()
+
+    snapshot = take_book_snapshot(book, None)
+    try:
+        print(f"[PetaShockNative] stage=build positions={len(snapshot.sfens)}")
+        graph = PetaShockGraph()
+        plies : list[int] = []
+        for count, sfen in enumerate(snapshot.sfens, 1):
+            sfen_with_ply, moveinfos = read_book_snapshot_position(book, snapshot, sfen)
+            plies.append(trim_sfen_ply(sfen_with_ply)[1])
+            graph.add_position(sfen, [(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos]) # type:ignore[misc]
+            if count % BOOK_READ_PROGRESS_INTERVAL == 0:
+                print(f"[PetaShockNativeProgress] stage=build {count}/{len(snapshot.sfens)}")
+    finally:
+        release_book_snapshot(book, snapshot)
+
+    print("[PetaShockNative] stage=propagate")
+    graph.peta_shock()
+    print(f"[PetaShockNative] stage=propagate_done loop_nodes={graph.loop_nodes}")
+
+    state = PetaShockState(book, graph, snapshot.sfens, plies, Book())
+    with state.peta_book.lock:
+        for node in range(len(graph)):
+            store_peta_shock_position(state, node)
+    print(f"[PetaShockNative] stage=done positions={len(state.peta_book.body)} elapsed={time.time() - start_time:.1f}s")
+    return state
+
+
+def peta_shock_book_incremental(state:PetaShockState):
+    """
+    前回のpeta shock化のあとにstate.bookで変更された局面だけをgraphに反映し、
+    評価値が変わった局面だけstate.peta_bookを書き換える。
+    """
+    start_time = time.time()
+    book = state.book
+    with book.lock:
+        keys = book.peta_dirty_keys or set()
+        book.peta_dirty_keys = set()
+        # Book.bodyのPositionInfoは書き換えられないので、参照だけ持ってlockの外で読む。
+        dirty_positions = []
+        for key in keys:
+            position_info = book.body.get(key)
+            if position_info is not None:
+                dirty_positions.append((book.stored_sfen(key, position_info), position_info))
+
+    positions : list[tuple[Sfen, list[tuple[MoveStr, int, int]]]] = []
+    plies : list[int] = []
+    for sfen, position_info in dirty_positions:
+        _, moveinfos = book_position_for_write(sfen, position_info)
+        positions.append((sfen, [(moveinfo.move, moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos])) # type:ignore[misc]
+        plies.append(position_info.ply)
+
+    graph = state.graph
+    nodes, changed = graph.update(positions)
+    for (sfen, _), ply, node in zip(positions, plies, nodes):
+        if node == len(state.sfens):
+            state.sfens.append(sfen)
+            state.plies.append(ply)
+        else:
+            state.sfens[node] = sfen
+            state.plies[node] = ply
+
+    with state.peta_book.lock:
+        for node in changed:
+            store_peta_shock_position(state, node)
+    print(
+        f"[PetaShockNative] stage=incremental dirty={len(positions)} changed={len(changed)} "
+        f"loop_recomputed={graph.loop_dirty} loop_nodes={graph.loop_nodes} "
+        f"positions={len(state.peta_book.body)} elapsed={time.time() - start_time:.1f}s"
+    )
+
+
+def peta_shock_book(book:Book, incremental:bool = False)->Book:
+    """
+    bookをpeta shock化したBookを返す。
+    incrementalなら、前回のpeta shock化の結果から、変更された局面の影響のあるところだけを計算し直す。
+    前回の結果がない、そのあとにbookを読み込み直した、置き換えた指し手が溜まった、のいずれかなら全体を計算し直す。
+    """
+    global peta_shock_state
+    state = peta_shock_state
+    if (
+        incremental and state is not None and state.book is book
+        and book.peta_dirty_keys is not None and not state.graph.should_rebuild()
+    ):
+        peta_shock_book_incremental(state)
+        return state.peta_book
+
+    if incremental:
+        if state is None:
+            reason = "first"
+        elif state.book is not book or book.peta_dirty_keys is None:
+            reason = "book_changed"
+        else:
+            reason = "rebuild"
+        print(f"[PetaShockNative] stage=full reason={reason}")
+    # 作り直す前に古いgraphを解放しておく。
+    peta_shock_state = None
+    state = peta_shock_book_full(book, incremental)
+    if incremental:
+        peta_shock_state = state
+    return state.peta_book
+
+
+def make_and_read_peta_book_native(book:Book, peta_path:str, incremental:bool = False):
+    """
+    bookをメモリ上でpeta_shock化してpeta_bookにし、peta_pathにも書き出す。
+    """
+    global peta_book, peta_book_probe_path
+    shocked = peta_shock_book(book, incremental)
+    print(f"start write peta book , path = {peta_path}")
+    write_yaneuraou_book_records(shocked, peta_path, None, keep_evals=True)
+    peta_book = shocked
+    peta_book_probe_path = peta_path
+    print(f"..peta_shock native has done, path = {peta_path}")
+
+
 def make_and_read_peta_book(source_book_path:str|None = None):
     """
     最新または指定された通常定跡DBをpeta_shock化し、生成されたpeta_bookを読み込む。
     """
     source_book_path = resolve_peta_source_book_path(source_book_path)
+    if peta_shock_backend == PETA_SHOCK_BACKEND_NATIVE:
+        source_book = Book()
+        load_book(source_book, source_book_path, fast=True)
+        make_and_read_peta_book_native(source_book, peta_book_backup_path_from_source(source_book_path))
+        return
+
     peta_path = run_peta_shock_makebook(source_book_path)
     read_peta_book(peta_path)
 
@@ -2692,6 +3793,20 @@ def write_and_read_peta_book(book:Book, reset_auto_backup_timer:Callable[[], Non
     現在の定跡DBを書き出し、その書き出したファイルをpeta_shock化して読み込む。
     周回作業で現在のDBをpeta_bookへ反映するための一括コマンド。
     """
+    if peta_shock_backend == PETA_SHOCK_BACKEND_NATIVE:
+        # メモリ上の定跡から直接変換するので、通常bookは書き出さない。
+        print("start p command : peta_shock the current book, and read peta book.")
+        with book.lock:
+            position_count = len(book.body)
+        peta_path = os.path.join(
+            BOOK_BACKUP_DIR,
+            f"{PETA_BOOK_DB_NAME}-{make_time_stamp()}_{position_count}{BOOK_BACKUP_EXTENSION}",
+        )
+        make_and_read_peta_book_native(book, peta_path, peta_shock_incremental)
+        print("..p command has done.")
+        print("[PetaCommandDone]")
+        return
+
     print("start p command : write backup, peta_shock, and read peta book.")
     with book.lock:
         clean_source_path = book.clean_source()
@@ -2820,12 +3935,8 @@ def peta_next(
             if ply >= max_book_ply:
                 continue
 
-            sfen_f = flipped_sfen(sfen)
-            if sfen in peta_book.body:
-                position_info = peta_book.body[sfen]
-            elif sfen_f in peta_book.body:
-                position_info = peta_book.body[sfen_f]
-            else:
+            position_info, _ = find_book_position_with_flip(peta_book, sfen)
+            if position_info is None:
                 add_position_command_entry(think_sfens, position_cmd, book_extend_ply, eval_limit, max_book_ply)
                 continue
 
@@ -2856,24 +3967,17 @@ def peta_next(
                 if ply >= max_book_ply:
                     continue
 
-                sfen_f = flipped_sfen(sfen)
+                key, _ = canonical_sfen(sfen)
 
                 # 訪問済みならskip
-                if sfen in visited or sfen_f in visited:
+                if key in visited:
                     continue
 
-                visited.add(sfen)
+                visited.add(key)
 
                 # 定跡DB上のsfenは、flipしたものがhitしているのか？
-                flipped_bookhit : bool
-                
-                if sfen in peta_book.body:
-                    position_info = peta_book.body[sfen]
-                    flipped_bookhit = False
-                elif sfen_f in peta_book.body:
-                    position_info = peta_book.body[sfen_f]
-                    flipped_bookhit = True
-                else:
+                position_info, flipped_bookhit = find_book_position_with_flip(peta_book, sfen)
+                if position_info is None:
                     # 元の定跡ツリーに存在しない局面なので定跡ツリーが出たということで
                     # ここを思考対象局面に追加してやる。
                     if refutation_book is None:
@@ -2975,14 +4079,8 @@ def peta_next(
 
 
 def find_book_position_with_flip(book:Book, sfen:Sfen)->tuple[PositionInfo|None, bool]:
-    if sfen in book.body:
-        return book.body[sfen], False
-
-    sfen_f = flipped_sfen(sfen)
-    if sfen_f in book.body:
-        return book.body[sfen_f], True
-
-    return None, False
+    with book.position_lock(sfen):
+        return book.find(sfen)
 
 
 def moveinfo_move_in_sfen_orientation(moveinfo:MoveInfo, flipped_bookhit:bool)->MoveStr:
@@ -3129,10 +4227,11 @@ def peta_rejoin(
                 if ply >= max_book_ply:
                     continue
 
-                if sfen in visited or flipped_sfen(sfen) in visited:
+                key, _ = canonical_sfen(sfen)
+                if key in visited:
                     continue
 
-                visited.add(sfen)
+                visited.add(key)
 
                 position_info, flipped_bookhit = find_book_position_with_flip(peta_book, sfen)
                 if position_info is None or not position_info.moveinfos:
@@ -3233,10 +4332,10 @@ def peta_pv_leaf_position_cmd(
         if current_ply >= max_book_ply:
             return None
 
-        current_sfen_f = flipped_sfen(current_sfen)
-        if current_sfen in visited or current_sfen_f in visited:
+        current_key, _ = canonical_sfen(current_sfen)
+        if current_key in visited:
             return None
-        visited.add(current_sfen)
+        visited.add(current_key)
 
         position_info, flipped_bookhit = find_book_position_with_flip(peta_book, current_sfen)
         if position_info is None or not position_info.moveinfos:
@@ -3652,13 +4751,13 @@ def scheduled_time_text(timestamp:float)->str:
     return datetime.datetime.fromtimestamp(timestamp).strftime("%Y/%m/%d_%H:%M:%S")
 
 
-def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eval_limit:int, max_book_ply:int, book_extend_ply:int):
+def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eval_limit:int, max_book_ply:int, book_extend_ply:int, job_weight:float = DEFAULT_JOB_WEIGHT):
     job_counter_local = get_job_counter()
 
     print(
         f"({job_counter_local}) put position commands , path = {path} , "
         f"eval_limit = {eval_limit}, max_book_ply = {max_book_ply}, "
-        f"book_extend_ply = {book_extend_ply}"
+        f"book_extend_ply = {book_extend_ply}, job_weight = {job_weight}"
     )
     if not os.path.exists(path):
         print(f"({job_counter_local}) put position commands Error : file not found, path = {path}")
@@ -3672,11 +4771,14 @@ def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eva
         ]
 
     entries : dict[PositionStr, PositionCommandEntry] = {}
+    # 各行を辿った局面の列。掘るときはこれを用いて、棋譜を辿り直さない。
+    chains : dict[PositionStr, PositionChain] = {}
     skipped = 0
     for line_number, line in raw_lines:
         try:
             entry = parse_position_command_entry(line)
-            decode_position_string(entry.position_cmd)
+            if entry.position_cmd not in chains:
+                chains[entry.position_cmd] = make_position_chain(entry.position_cmd)
         except Exception as exc:
             skipped += 1
             print(f"({job_counter_local}) skip illegal position command line {line_number}: {line} : {exc}")
@@ -3728,11 +4830,14 @@ def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eva
         job_book_extend_ply,
     )
 
+    engine_manager.set_task_job_weight(job_counter_local, job_weight)
+    merged = 0
     for entry in entries.values():
         task_eval_limit = eval_limit if entry.eval_limit is None else entry.eval_limit
         task_max_book_ply = max_book_ply if entry.max_book_ply is None else entry.max_book_ply
         task_book_extend_ply = book_extend_ply if entry.book_extend_ply is None else entry.book_extend_ply
-        engine_manager.put_task(
+        chain = chains[entry.position_cmd]
+        if not engine_manager.put_task(
             Task(
                 SFEN_START,
                 1,
@@ -3741,8 +4846,13 @@ def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eva
                 job_counter_local,
                 max_book_ply=task_max_book_ply,
                 book_extend_ply=task_book_extend_ply,
+                chain=chain,
             )
-        )
+        ):
+            merged += 1
+
+    if merged:
+        print(f"({job_counter_local}) merged {merged} position commands into the queued tasks.")
 
     print(f"({job_counter_local}) put position commands , done.")
 
@@ -3750,59 +4860,14 @@ def put_position_commands(book:Book, path:str, engine_manager:EngineManager, eva
 def merge_flipped_positions(book:Book):
     """
     flipした局面を削除する。
-    後手の局面が削除される。
-    """
-
-    try:
-
-        print("merge_flipped_positions start.")
-
-        with book.lock:
-
-            c = 0
-            keys : list[Sfen] = list(book.body.keys())
-
-            for sfen in keys:
-
-                # 削除済みkeyであるならskipする。
-                if sfen not in book.body:
-                    continue
-
-                sfen_f = flipped_sfen(sfen)
-                if sfen_f in book.body:
-
-                    # 反転させた局面が定跡本体に存在する。このレコードをmergeする必要がある。
-                    position   = book.body[sfen]
 
-                    print(f"merge : {sfen} {position.ply}")
-
-                    # このタイミングでpop()することでflipさせたsfenのほうは定跡から削除しておく。
-                    position_f = book.body.pop(sfen_f)
-
-                    for moveinfo_f in position_f.moveinfos:
-                        move = flipped_move(moveinfo_f.move)
-                        eval = moveinfo_f.eval
-                        # これをmergeする。
-                        for moveinfo in position.moveinfos:
-                            if moveinfo.move == move:
-                                # 見つかった
-                                if moveinfo.eval is None:
-                                    # evalは、Noneのときだけ上書き
-                                    moveinfo.eval = eval
-                                break
-                        else:
-                            # 見つからなかったのでレコード丸ごと追加。
-                            position.moveinfos.append(MoveInfo(move, eval))
-
-                    c += 1
-
-            if c:
-                book.mark_modified()
-
-        print(f"merge flipped positions done, merged {c} positions")
-
-    except Exception as e:
-        print(f"Exception :{type(e).__name__}{e}\n{traceback.format_exc()}")
+    book.bodyのkeyは先手番の局面(canonical_sfen())なので、局面とそれをflipした局面が
+    両方登録されることはない。(定跡DBの読み込み時にmergeされる)
+    以前の`m`コマンドとの互換性のために残してある。
+    """
+    with book.lock:
+        count = len(book.body)
+    print(f"merge flipped positions done, merged 0 positions. flipped positions share one entry in the book ({count} positions).")
 
 
 def dump_sfen(book:Book, sfen:Sfen, move : MoveStr|None):
@@ -3812,17 +4877,11 @@ def dump_sfen(book:Book, sfen:Sfen, move : MoveStr|None):
     board = cshogi.Board(sfen)
     sfen = trim_sfen(board.sfen())
 
-    if sfen in book.body:
-        position_info = book.body[sfen]
-    else:
-        sfen_f = flipped_sfen(sfen)
-        if sfen_f in book.body:
-            # print("found a flipped sfen in the book")
-            position_info = book.body[sfen_f]
-            if move:
-                move = flipped_move(move)
-        else:
-            position_info = None
+    with book.position_lock(sfen):
+        position_info, flipped_bookhit = book.find(sfen)
+    if position_info and flipped_bookhit and move:
+        # print("found a flipped sfen in the book")
+        move = flipped_move(move)
 
     if position_info:
         dump_position(sfen, position_info, move)
@@ -3869,11 +4928,26 @@ def user_input(from_gui:bool = False):
     """
     ユーザーからの入力受付。
     """
-    book : Book = Book()
+    global default_book_backend, peta_shock_backend, peta_shock_incremental
     book_miner_settings = load_book_miner_settings()
+    default_book_backend = book_miner_settings.book_backend
+    peta_shock_backend = book_miner_settings.peta_shock_backend
+    peta_shock_incremental = book_miner_settings.peta_shock_incremental
+    if peta_shock_backend == PETA_SHOCK_BACKEND_NATIVE:
+        print("[PetaShockNative] peta_shock_backend = native is experimental. the result may differ from YO-MATERIAL.exe.")
+    book : Book = Book()
     command_defaults = CommandDefaults(game_ply_limit=book_miner_settings.max_book_ply)
     print("[StartupStage] stage=book_read message=定跡DBを読み込み中")
-    load_latest_book_backup(book)
+    book_path = load_latest_book_backup(book)
+    journal = BookJournal(BOOK_BACKUP_DIR, BOOK_JOURNAL_NAME)
+    if book_miner_settings.journal_snapshot_mb > 0:
+        # 前回終了時(あるいは異常終了時)までの思考結果をジャーナルから復元して、続きを新しいsegmentに書く。
+        snapshot_name = journal_snapshot_name(book_path)
+        replay_book_journal(book, journal, snapshot_name)
+        journal.open(snapshot_name)
+        book.journal = journal
+    elif journal.segment_paths():
+        print(f"Warning : journal_snapshot_mb = 0, journal files in {BOOK_BACKUP_DIR} are ignored.")
     print("[StartupStage] stage=book_read_done message=定跡DB読み込み完了")
 
     engine_manager = EngineManager(book_miner_settings, from_gui=from_gui)
@@ -3886,10 +4960,22 @@ def user_input(from_gui:bool = False):
     engine_manager.start_task_workers(book)
     print("[StartupStage] stage=task_worker_done message=探索worker起動完了")
 
+    journal_snapshot_bytes = book_miner_settings.journal_snapshot_mb * 1024 * 1024
+
+    def needs_snapshot()->bool:
+        # ジャーナルを使っているときは、ジャーナルが大きくなったときだけ定跡DB全体を書き出す。
+        return book.journal is None or book.journal.size_bytes() >= journal_snapshot_bytes
+
     def save_book_main():
         # lockは呼び出し元で行っているものとする。
         nonlocal book
-        save_book_backup(book, BOOK_BACKUP_DIR)
+        if needs_snapshot():
+            save_book_backup(book, BOOK_BACKUP_DIR)
+        else:
+            print(f"[BackupSkip] journal={book.journal.size_bytes()} threshold={journal_snapshot_bytes}") # type:ignore[union-attr]
+        if book.journal is not None:
+            # 終了直前まで他のthreadが追記することがあるので、閉じずにfsyncだけしておく。
+            book.journal.sync()
 
     backup_condition = Condition()
     next_backup_timestamp = time.time() + book_miner_settings.auto_save_interval_seconds
@@ -3921,15 +5007,26 @@ def user_input(from_gui:bool = False):
                 if next_backup_timestamp != next_backup_snapshot:
                     continue
 
-            print("[BackupStart]")
-            save_book_backup(book, BOOK_BACKUP_DIR)
-            print("[BackupDone]")
+            if needs_snapshot():
+                print("[BackupStart]")
+                save_book_backup(book, BOOK_BACKUP_DIR)
+                print("[BackupDone]")
+            else:
+                print(f"[BackupSkip] journal={book.journal.size_bytes()} threshold={journal_snapshot_bytes}") # type:ignore[union-attr]
             reset_auto_backup_timer()
 
+    def journal_sync_worker(journal:BookJournal):
+        # ジャーナルへの追記は、ここでまとめてfsyncする。
+        while True:
+            time.sleep(book_miner_settings.journal_sync_interval_seconds)
+            journal.sync()
+
     # backup用のタスクを開始。
     next_backup_time = scheduled_time_text(next_backup_timestamp)
     print("[StartupStage] stage=backup_service message=自動保存サービス起動中")
     Thread(target=backup_worker, daemon=True).start()
+    if book.journal is not None:
+        Thread(target=journal_sync_worker, args=(book.journal,), daemon=True).start()
     print(
         f"[BackupServiceStarted] next={next_backup_time} "
         f"interval={book_miner_settings.auto_save_interval_seconds}"
@@ -3976,12 +5073,14 @@ def user_input(from_gui:bool = False):
             elif i == 'q':
                 print("quit")
                 engine_manager.global_settings.quit = True
+                engine_manager.engine_supervisor.close()
                 save_book_main()
                 break
 
             elif i == '!':
                 print("quit without saving")
                 engine_manager.global_settings.quit = True
+                engine_manager.engine_supervisor.close()
                 break
 
             elif i == 'w':
@@ -4035,20 +5134,30 @@ def user_input(from_gui:bool = False):
                 max_book_ply = command_defaults.game_ply_limit
                 book_extend_ply = command_defaults.book_extend_ply
 
-                if len(inp) > 1:
-                    print("Usage : e")
-                else:
-                    Thread(
-                        target=lambda: put_position_commands(
-                            book,
-                            path,
-                            engine_manager,
-                            eval_limit,
-                            max_book_ply,
-                            book_extend_ply,
-                        ),
-                        daemon=True,
-                    ).start()
+                job_weight = DEFAULT_JOB_WEIGHT
+                try:
+                    if len(inp) > 2:
+                        raise ValueError
+                    if len(inp) == 2:
+                        job_weight = float(inp[1])
+                        if not job_weight > 0:
+                            raise ValueError
+                except ValueError:
+                    print("Usage : e [job_weight]  (job_weight is a positive number)")
+                    continue
+
+                Thread(
+                    target=lambda: put_position_commands(
+                        book,
+                        path,
+                        engine_manager,
+                        eval_limit,
+                        max_book_ply,
+                        book_extend_ply,
+                        job_weight,
+                    ),
+                    daemon=True,
+                ).start()
 
             elif i == 'i':
                 if len(inp) < 2:
@@ -0,0 +1,670 @@
+"""
+BookMiner.pyの定跡backend・思考部まわりのbenchmarkと動作確認用のスクリプト。
+
+BookMiner.pyと同じフォルダで実行する。どれも実行し終わったら終了する。
+
+    python bench_book_miner.py --bench_book_backend 100000
+    python bench_book_miner.py --stress_book_lock 64
+    python bench_book_miner.py --bench_multipv_widening 3000
+    python bench_book_miner.py --check_peta_incremental book/backup/book_miner-XXXXXXXX.db
+    python bench_book_miner.py --check_peta_shock_fixture
+    python bench_book_miner.py --make_peta_shock_fixture   ※ YO-MATERIAL.exe が必要
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import deque
+from threading import Thread
+
+import cshogi
+
+from BookMiner import (
+    BOOK_BACKENDS, BOOK_BACKUP_DIR, MAX_BOOK_PLY, MULTIPV_WIDENINGS, SFEN_START,
+    Book, Engine, Eval, GlobalSettings, MoveInfo, MoveStr, PositionInfo, Sfen, ThreadSettings,
+    copy_position_info, legal_moves_for_position, load_book, merge_search_result, book_position_for_write,
+    peta_shock_book_full, peta_shock_book_incremental,
+    read_book_snapshot_position, release_book_snapshot, take_book_snapshot,
+    read_regular_book_fast, run_peta_shock_makebook,
+)
+from YaneShogiLib import trim_sfen, flipped_sfen, flipped_move, canonical_sfen, print_log
+
+print = print_log
+
+# peta shock化のfixture。source_book.db を YO-MATERIAL.exe の makebook peta_shock で変換したものが expected_peta_book.db。
+PETA_SHOCK_FIXTURE_DIR      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "peta_shock")
+PETA_SHOCK_FIXTURE_SOURCE   = os.path.join(PETA_SHOCK_FIXTURE_DIR, "source_book.db")
+PETA_SHOCK_FIXTURE_EXPECTED = os.path.join(PETA_SHOCK_FIXTURE_DIR, "expected_peta_book.db")
+
+# ============================================================
+#                  book backendのbenchmark
+# ============================================================
+
+def make_bench_book_positions(position_count:int, seed:int = 1)->list[tuple[Sfen, PositionInfo]]:
+    """
+    初期局面からランダムに指し進めて、benchmark用の局面と候補手(1～8手、評価値はランダム)を作る。
+    """
+    rng = random.Random(seed)
+    positions : dict[Sfen, PositionInfo] = {}
+    while len(positions) < position_count:
+        board = cshogi.Board()
+        for ply in range(1, MAX_BOOK_PLY):
+            moves = list(board.legal_moves)
+            if not moves or len(positions) >= position_count:
+                break
+            sfen = trim_sfen(board.sfen())
+            if sfen not in positions:
+                moveinfos = [
+                    MoveInfo(cshogi.move_to_usi(move), rng.randint(-3000, 3000), rng.randint(0, 40))
+                    for move in rng.sample(moves, min(len(moves), rng.randint(1, 8)))
+                ]
+                positions[sfen] = PositionInfo(moveinfos, ply)
+            board.push(rng.choice(moves))
+    return list(positions.items())
+
+
+def bench_book_backend(backend:str, positions:list[tuple[Sfen, PositionInfo]])->None:
+    """
+    1つのbackendについて、メモリ使用量と、登録・参照・更新・書き出し用snapshotの速度を計測して出力する。
+    """
+    # メモリ使用量。tracemallocは遅いので、時間の計測とは別に1回作る。
+    tracemalloc.start()
+    book = Book(backend)
+    for sfen, position_info in positions:
+        book.store(sfen, PositionInfo([MoveInfo(m.move, m.eval, m.depth) for m in position_info.moveinfos], position_info.ply))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del book
+
+    # 登録
+    copies = [
+        (sfen, PositionInfo([MoveInfo(m.move, m.eval, m.depth) for m in position_info.moveinfos], position_info.ply))
+        for sfen, position_info in positions
+    ]
+    book = Book(backend)
+    start = time.perf_counter()
+    for sfen, position_info in copies:
+        book.store(sfen, position_info)
+    insert_time = time.perf_counter() - start
+    del copies
+
+    # 参照 (flipした局面でも同じentryが見つかる)
+    flipped = [flipped_sfen(sfen) for sfen, _ in positions]
+    start = time.perf_counter()
+    for (sfen, _), sfen_f in zip(positions, flipped):
+        book.find(sfen)
+        book.find(sfen_f)
+    lookup_time = time.perf_counter() - start
+
+    # 更新 (読み出して評価値を書き換え、書き戻す)
+    start = time.perf_counter()
+    for sfen, _ in positions:
+        position_info, _ = book.find(sfen)
+        position_info = copy_position_info(position_info) # type:ignore[arg-type]
+        position_info.moveinfos[0].eval = (position_info.moveinfos[0].eval or 0) + 1 # type:ignore
+        book.update(sfen, position_info)
+    update_time = time.perf_counter() - start
+
+    # 定跡書き出し前の列挙とsnapshot
+    start = time.perf_counter()
+    snapshot = take_book_snapshot(book, None)
+    for sfen in snapshot.sfens:
+        read_book_snapshot_position(book, snapshot, sfen)
+    release_book_snapshot(book, snapshot)
+    snapshot_time = time.perf_counter() - start
+
+    n = len(positions)
+    moves = sum(len(position_info.moveinfos) for _, position_info in positions)
+    def rate(seconds:float)->str:
+        return f"{n / seconds / 1000:.1f}k/s" if seconds > 0 else "-"
+    print(
+        f"[BookBackendBench] backend={backend}, positions={n}, moves={moves}, "
+        f"memory={memory / 1024 / 1024:.1f}MB ({memory / n:.0f}B/position), "
+        f"insert={rate(insert_time)}, lookup={rate(lookup_time)} (x2), update={rate(update_time)}, snapshot={rate(snapshot_time)}"
+    )
+
+
+def bench_book_backends(position_count:int)->None:
+    print(f"[BookBackendBench] make {position_count} positions..")
+    positions = make_bench_book_positions(position_count)
+    for backend in BOOK_BACKENDS:
+        bench_book_backend(backend, positions)
+
+
+class StressMockEngine:
+    """
+    stress_book_lock()用の、エンジンの代わり。
+    担当する(局面, 指し手)について、思考するたびに評価値が1ずつ増える結果を返す。
+    """
+    def __init__(self, thread_id:int):
+        self.thread_id = thread_id
+        # (局面, 指し手) → 思考した回数
+        self.counts : dict[tuple[Sfen, MoveStr], int] = {}
+
+    def go(self, sfen:Sfen, move:MoveStr)->list[MoveInfo]:
+        count = self.counts.get((sfen, move), 0) + 1
+        self.counts[(sfen, move)] = count
+        return [MoveInfo(move, count, self.thread_id)]
+
+
+def stress_book_backend(backend:str, threads:int, updates:int, positions:list[tuple[Sfen, int]], seed:int = 1)->int:
+    """
+    threads個のmock engineのスレッドから、共有する局面にmerge_search_result()で思考結果を書き込み続け、
+    失われた更新の数を返す。同時に、定跡全体のlock(book.lock)とsnapshotを取るスレッドも動かす。
+    """
+    book = Book(backend)
+    with book.lock:
+        book.peta_dirty_keys = set()
+
+    # 各局面の(指し手)を、どれか1つのスレッドの担当にする。1つの局面には多数のスレッドが書き込む。
+    owned : list[list[tuple[Sfen, int, MoveStr]]] = [[] for _ in range(threads)]
+    for i, (sfen, ply) in enumerate(positions):
+        for j, move in enumerate(cshogi.Board(sfen).legal_moves): # type:ignore
+            owned[(i + j) % threads].append((sfen, ply, cshogi.move_to_usi(move)))
+    engines = [StressMockEngine(thread_id) for thread_id in range(threads)]
+    errors : list[str] = []
+
+    def worker(engine:StressMockEngine):
+        rng = random.Random(seed * 1000 + engine.thread_id)
+        pairs = owned[engine.thread_id]
+        if not pairs:
+            return
+        try:
+            for _ in range(updates):
+                sfen, ply, move = rng.choice(pairs)
+                moveinfos = engine.go(sfen, move)
+                if rng.random() < 0.5:
+                    # 逆向きの局面として書き込む。
+                    sfen = flipped_sfen(sfen)
+                    moveinfos = [MoveInfo(flipped_move(moveinfo.move), moveinfo.eval, moveinfo.depth) for moveinfo in moveinfos]
+                with book.position_lock(sfen):
+                    merge_search_result(book, sfen, ply, moveinfos)
+        except Exception as e:
+            errors.append(f"{type(e).__name__}{e}")
+
+    done = False
+    bulk_count = 0
+    def bulk_worker():
+        # 定跡の保存やpeta shock化と同じように、全体のlockとsnapshotを繰り返し取る。
+        nonlocal bulk_count
+        try:
+            while not done:
+                snapshot = take_book_snapshot(book, None)
+                try:
+                    for sfen in snapshot.sfens:
+                        read_book_snapshot_position(book, snapshot, sfen)
+                finally:
+                    release_book_snapshot(book, snapshot)
+                with book.lock:
+                    len(book.body)
+                bulk_count += 1
+        except Exception as e:
+            errors.append(f"{type(e).__name__}{e}")
+
+    switch_interval = sys.getswitchinterval()
+    # スレッドの切り替えを増やして、競合が起きやすくする。
+    sys.setswitchinterval(1e-5)
+    start = time.perf_counter()
+    try:
+        workers = [Thread(target=worker, args=(engine,)) for engine in engines]
+        bulk = Thread(target=bulk_worker)
+        for thread in workers:
+            thread.start()
+        bulk.start()
+        for thread in workers:
+            thread.join()
+        done = True
+        bulk.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+    elapsed = time.perf_counter() - start
+
+    # 各スレッドが最後に書き込んだ評価値が残っているか。
+    lost = 0
+    merges = 0
+    keys : set[Sfen] = set()
+    for engine in engines:
+        for (sfen, move), count in engine.counts.items():
+            merges += count
+            keys.add(canonical_sfen(sfen)[0])
+            position_info, flipped_bookhit = book.find(sfen)
+            moveinfo = None
+            if position_info is not None:
+                book_move = flipped_move(move) if flipped_bookhit else move
+                moveinfo = next((m for m in position_info.moveinfos if m.move == book_move), None)
+            if moveinfo is None or moveinfo.eval != count or moveinfo.depth != engine.thread_id:
+                lost += 1
+                if lost <= 5:
+                    print(f"[BookLockStressLost] {sfen} {move} expected={count} actual={None if moveinfo is None else moveinfo.eval}")
+
+    failures = lost + len(errors)
+    if book.revision != merges:
+        print(f"[BookLockStressError] revision={book.revision} merges={merges}")
+        failures += 1
+    if book.peta_dirty_keys != keys:
+        print(f"[BookLockStressError] peta_dirty_keys={len(book.peta_dirty_keys or ())} keys={len(keys)}")
+        failures += 1
+    if any(stripe.searching_sfens or stripe.search_waiters for stripe in book.stripes):
+        print("[BookLockStressError] searching_sfens is not empty.")
+        failures += 1
+    for error in errors[:5]:
+        print(f"[BookLockStressError] {error}")
+
+    print(
+        f"[BookLockStress] backend={backend}, threads={threads}, stripes={len(book.stripes)}, "
+        f"positions={len(keys)}, merges={merges}, lost={lost}, errors={len(errors)}, "
+        f"snapshots={bulk_count}, elapsed={elapsed:.2f}s"
+    )
+    return failures
+
+
+def stress_book_lock(threads:int, updates:int = 2000, position_count:int = 64)->int:
+    """
+    Bookのstripeごとのlockで、多数のスレッドから同じ局面に書き込んでも更新が失われないかを、
+    それぞれのbackendについて調べる。失われた更新とエラーの数の合計を返す。
+    """
+    positions = [
+        (sfen, position_info.ply)
+        for sfen, position_info in make_bench_book_positions(position_count)
+    ]
+    failures = 0
+    for backend in BOOK_BACKENDS:
+        failures += stress_book_backend(backend, threads, updates, positions)
+    print(f"[BookLockStress] done. failures={failures}")
+    return failures
+
+
+class ScriptedEngineProcess:
+    """
+    bench_multipv_widening()用の、思考エンジンのprocessの代わり。Engine(process=...)に渡して使う。
+    USIコマンドをstdinで受け取り、応答をstdoutのreadline()で返す。
+
+    指し手の真の評価値は局面と指し手から決まる値で、局面ごとに指し手の間の差(広さ)が違う。
+    go nodes N では、1つのPVあたりのnode数が少ないほど大きな誤差を乗せた評価値を、MultiPVの数だけ返す。
+    searchmovesが指定されていれば、その指し手だけから選ぶ。
+    """
+    def __init__(self, seed:int = 1):
+        self.seed = seed
+        self.stdin = self
+        self.stdout = self
+        self.lines : deque[str] = deque()
+        self.multipv = 1
+        self.sfen = SFEN_START
+        self.go_count = 0
+
+    # ---- stdin ----
+    def write(self, text:str):
+        for command in text.splitlines():
+            self.command(command.split())
+
+    def flush(self):
+        pass
+
+    # ---- stdout ----
+    def readline(self)->str:
+        return self.lines.popleft() + "\n" if self.lines else "\n"
+
+    # ---- process ----
+    def poll(self):
+        return None
+
+    def wait(self, timeout:float|None = None):
+        return 0
+
+    def kill(self):
+        pass
+
+    def true_eval(self, sfen:Sfen, move:MoveStr)->int:
+        """局面と指し手から決まる真の評価値"""
+        # 局面ごとの、指し手の間の評価値の差。小さいほど候補手の多い広い局面。
+        spread = 5 + zlib.crc32(f"{self.seed} {sfen}".encode()) % 100
+        rank = zlib.crc32(f"{self.seed} {sfen} {move}".encode()) % 64
+        return 200 - rank * spread
+
+    def command(self, tokens:list[str]):
+        if not tokens:
+            return
+        if tokens[0] == "isready":
+            self.lines.append("readyok")
+        elif tokens[0] == "multipv":
+            self.multipv = int(tokens[1])
+        elif tokens[:4] == ["setoption", "name", "MultiPV", "value"]:
+            self.multipv = int(tokens[4])
+        elif tokens[0] == "position":
+            self.sfen = " ".join(tokens[1:])
+        elif tokens[0] == "go":
+            nodes = int(tokens[tokens.index("nodes") + 1])
+            legal_moves = legal_moves_for_position(self.sfen)
+            candidates = legal_moves
+            if "searchmoves" in tokens:
+                candidates = [move for move in tokens[tokens.index("searchmoves") + 1:] if move in legal_moves]
+            lines = min(self.multipv, len(candidates))
+            # 1つのPVあたりのnode数が少ないほど、評価値の誤差が大きい。
+            sigma = 3000 / max(1.0, (nodes / max(1, lines))) ** 0.5
+            self.go_count += 1
+            rng = random.Random(f"{self.seed} {self.go_count}")
+            evals = sorted(
+                ((self.true_eval(self.sfen, move) + int(rng.gauss(0, sigma)), move) for move in candidates),
+                reverse=True,
+            )
+            for i, (eval, move) in enumerate(evals[:lines], 1):
+                self.lines.append(f"info depth 10 multipv {i} score cp {eval} nodes {nodes} pv {move}")
+            self.lines.append(f"bestmove {evals[0][1] if evals else 'resign'}")
+
+
+def bench_multipv_widening(position_count:int, nodes:int = 100000)->None:
+    """
+    ScriptedEngineProcessを相手に、multipv_wideningの方法ごとに、探索したnode数、探索し直さずに済んだnode数、
+    順位のついた指し手の数と、bestの指し手が真のbestと一致した割合を比べる。
+    """
+    positions = [sfen for sfen, _ in make_bench_book_positions(position_count)]
+    for widening in MULTIPV_WIDENINGS:
+        global_settings = GlobalSettings(
+            engine_settings  = [],
+            debug_engine     = False,
+            multipv          = 4,
+            multipv_delta    = 100,
+            quit             = False,
+            multipv_widening = widening,
+        )
+        process = ScriptedEngineProcess()
+        engine = Engine(global_settings, ThreadSettings(0, "scripted", nodes, True), process)
+        searched_nodes = 0
+        saved_nodes = 0
+        ranked_moves = 0
+        best_matches = 0
+        start = time.perf_counter()
+        for sfen in positions:
+            node = engine.go(sfen, 1.0)
+            searched_nodes += engine.last_go_searched_nodes
+            saved_nodes += engine.last_go_saved_nodes
+            ranked_moves += len(node)
+            legal_moves = legal_moves_for_position(sfen)
+            true_best = max(legal_moves, key=lambda move: process.true_eval(sfen, move))
+            best = max(node, key=lambda moveinfo: moveinfo.eval) # type:ignore
+            if process.true_eval(sfen, best.move) == process.true_eval(sfen, true_best):
+                best_matches += 1
+        n = len(positions)
+        print(
+            f"[MultiPVWideningBench] widening={widening}, positions={n}, nodes={nodes}, "
+            f"searched_nodes={searched_nodes / n:.0f}/position, saved_nodes={saved_nodes / n:.0f}/position, "
+            f"moves={ranked_moves / n:.1f}/position, best_match={best_matches * 100 / n:.1f}%, "
+            f"elapsed={time.perf_counter() - start:.1f}s"
+        )
+
+
+def peta_book_mismatches(expected:Book, actual:Book, label:str = "PetaIncrementalMismatch")->int:
+    """
+    2つのpeta bookで、局面の有無か指し手の(value, depth)が異なる局面の数を返す。
+    局面をどちらの手番の向きで持っているかは問わない。
+    """
+    def moves_of(position_info:PositionInfo|None)->list[tuple[MoveStr, Eval, int]]|None:
+        if position_info is None:
+            return None
+        # keyの向きに揃えて比べる。
+        return sorted(
+            (flipped_move(moveinfo.move) if position_info.flipped else moveinfo.move, moveinfo.eval, moveinfo.depth) # type:ignore[misc]
+            for moveinfo in position_info.moveinfos
+        )
+
+    mismatches = 0
+    for key in set(expected.body) | set(actual.body):
+        expected_info = expected.body.get(key)
+        actual_info = actual.body.get(key)
+        if (
+            expected_info is None or actual_info is None
+            or expected_info.ply != actual_info.ply
+            or moves_of(expected_info) != moves_of(actual_info)
+        ):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"[{label}] {key} expected={moves_of(expected_info)} actual={moves_of(actual_info)}")
+    return mismatches
+
+
+def check_peta_incremental(path:str, rounds:int = 3, ratio:float = 0.05, seed:int = 1)->int:
+    """
+    pathの定跡で、差分でのpeta shock化の結果が、全体を計算し直した結果と一致するかを調べる。
+    一部の局面を除いた定跡をpeta shock化したあと、除いた局面の追加と評価値の変更をrounds回に分けて行い、
+    そのたびに差分で計算した結果と、全体を計算し直した結果を比べる。一致しなかった局面の数の合計を返す。
+    """
+    source = Book()
+    load_book(source, path, fast=True)
+    with source.lock:
+        positions = [(source.stored_sfen(key, position_info), position_info) for key, position_info in source.body.items()]
+    del source
+
+    rng = random.Random(seed)
+    rng.shuffle(positions)
+    held_count = int(len(positions) * ratio)
+    held, stored = positions[:held_count], positions[held_count:]
+
+    book = Book()
+    with book.lock:
+        for sfen, position_info in stored:
+            book.store(sfen, copy_position_info(position_info))
+    state = peta_shock_book_full(book, True)
+
+    total_mismatches = 0
+    for round in range(rounds):
+        with book.lock:
+            # 除いておいた局面の追加
+            for sfen, position_info in held[round::rounds]:
+                book.store(sfen, copy_position_info(position_info))
+            # 評価値の変更
+            for sfen, _ in rng.sample(stored, min(len(stored), max(1, held_count // rounds))):
+                position_info = copy_position_info(book.find(sfen)[0]) # type:ignore[arg-type]
+                for moveinfo in position_info.moveinfos:
+                    if moveinfo.eval is not None:
+                        moveinfo.eval += rng.randint(-300, 300)
+                        moveinfo.depth += rng.randint(0, 3)
+                book.update(sfen, position_info)
+
+        start = time.perf_counter()
+        peta_shock_book_incremental(state)
+        incremental_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = peta_shock_book_full(book, False)
+        full_time = time.perf_counter() - start
+
+        mismatches = peta_book_mismatches(expected.peta_book, state.peta_book)
+        total_mismatches += mismatches
+        print(
+            f"[PetaIncrementalCheck] round={round + 1}/{rounds}, positions={len(expected.peta_book.body)}, "
+            f"mismatches={mismatches}, incremental={incremental_time:.2f}s, full={full_time:.2f}s"
+        )
+
+    print(f"[PetaIncrementalCheck] done. mismatches={total_mismatches}")
+    return total_mismatches
+
+
+def make_peta_shock_fixture():
+    """
+    fixtureのsource_book.dbを YO-MATERIAL.exe の makebook peta_shock で変換して、expected_peta_book.db を作る。
+    makebook は BookDir 配下のファイルしか読めないので、book/backup/ にcopyしてから変換する。
+    """
+    source_path = os.path.join(BOOK_BACKUP_DIR, "peta_shock_fixture_source.db")
+    os.makedirs(BOOK_BACKUP_DIR, exist_ok=True)
+    shutil.copyfile(PETA_SHOCK_FIXTURE_SOURCE, source_path)
+    try:
+        peta_path = run_peta_shock_makebook(source_path)
+    finally:
+        os.remove(source_path)
+    os.replace(peta_path, PETA_SHOCK_FIXTURE_EXPECTED)
+    print(f"[PetaShockFixture] expected peta book is written. path = {PETA_SHOCK_FIXTURE_EXPECTED}")
+
+
+def peta_rule_mismatches(source:Book, actual:Book)->tuple[int, int]:
+    """
+    actual(sourceをpeta shock化したもの)のうち、定跡内のループに依存しない局面が、
+    docs/10-peta-shock.md に書いた makebook peta_shock の規則どおりになっているかを調べる。
+    (調べた局面の数, 一致しなかった局面の数)を返す。
+
+    - 子局面が定跡内にある指し手は (-子局面のbestのvalue, min(子局面のbestのdepth + 1, 9999))
+    - 子局面が定跡内にない指し手は、通常bookとして書き出したときの (value, depth) のまま
+    - bestと同じvalueでdepthが異なるbest以外の指し手は value - 1
+    """
+    # key → [(指し手, value, depth, 子局面のkey)]  指し手はkeyの向き。
+    edges : dict[Sfen, list[tuple[MoveStr, int, int, Sfen|None]]] = {}
+    board = cshogi.Board()
+    for key, position_info in source.body.items():
+        sfen, moveinfos = book_position_for_write(key, copy_position_info(position_info))
+        board.set_sfen(sfen)
+        moves = []
+        for moveinfo in moveinfos:
+            move = moveinfo.move
+            if position_info.flipped:
+                move = flipped_move(move)
+            child = None
+            board_move = board.move_from_usi(move)
+            if board_move and board.is_legal(board_move):
+                board.push(board_move)
+                child_key = canonical_sfen(trim_sfen(board.sfen()))[0]
+                board.pop()
+                if child_key in source.body:
+                    child = child_key
+            moves.append((move, moveinfo.eval, moveinfo.depth, child)) # type:ignore[arg-type]
+        edges[key] = moves
+
+    # 子局面から順に、bestを決めていく。ループに依存する局面は最後まで決まらない。
+    parents : dict[Sfen, list[Sfen]] = {}
+    out_counts : dict[Sfen, int] = {}
+    for key, moves in edges.items():
+        children = {child for _, _, _, child in moves if child is not None}
+        out_counts[key] = len(children)
+        for child in children:
+            parents.setdefault(child, []).append(key)
+    queue = [key for key, count in out_counts.items() if count == 0]
+    bests : dict[Sfen, tuple[int, int]] = {}
+    expected_moves : dict[Sfen, list[tuple[MoveStr, int, int]]] = {}
+    while queue:
+        key = queue.pop()
+        raw = []
+        for move, value, depth, child in edges[key]:
+            if child is not None:
+                child_value, child_depth = bests[child]
+                value, depth = -child_value, min(child_depth + 1, 9999)
+            raw.append((move, value, depth))
+        best_move, best_value, best_depth = max(raw, key=lambda x: (x[1], x[2]))
+        bests[key] = (best_value, best_depth)
+        expected_moves[key] = sorted(
+            (move, value - 1 if move != best_move and value == best_value and depth != best_depth else value, depth)
+            for move, value, depth in raw
+        )
+        for parent in parents.get(key, []):
+            out_counts[parent] -= 1
+            if out_counts[parent] == 0:
+                queue.append(parent)
+
+    mismatches = 0
+    for key, moves in expected_moves.items():
+        position_info = actual.body.get(key)
+        actual_moves = None if position_info is None else sorted(
+            (flipped_move(moveinfo.move) if position_info.flipped else moveinfo.move, moveinfo.eval, moveinfo.depth) # type:ignore[misc]
+            for moveinfo in position_info.moveinfos
+        )
+        if actual_moves != moves:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"[PetaShockRuleMismatch] {key} expected={moves} actual={actual_moves}")
+    return len(expected_moves), mismatches
+
+
+def check_peta_shock_fixture()->int:
+    """
+    fixtureのsource_book.dbを native の peta shock化で変換して、expected_peta_book.db と比べる。
+    `pl` と同じく、通常bookを読み込んでから変換する。一致しなかった局面の数を返す。
+    ループに依存しない局面は、makebook peta_shock の規則どおりかも調べる。
+    expected_peta_book.db がなければ、規則どおりでも 1 を返す。
+    """
+    source = Book()
+    load_book(source, PETA_SHOCK_FIXTURE_SOURCE, fast=True)
+    actual = peta_shock_book_full(source, False).peta_book
+
+    checked, rule_mismatches = peta_rule_mismatches(source, actual)
+    print(f"[PetaShockFixture] rule check: positions={checked}, mismatches={rule_mismatches}")
+
+    if not os.path.isfile(PETA_SHOCK_FIXTURE_EXPECTED):
+        print(
+            f"[PetaShockFixture] expected peta book is not found. path = {PETA_SHOCK_FIXTURE_EXPECTED}\n"
+            "YO-MATERIAL.exe を置いた環境で --make_peta_shock_fixture を実行して作ってください。"
+        )
+        return rule_mismatches + 1
+
+    expected = Book()
+    read_regular_book_fast(expected, PETA_SHOCK_FIXTURE_EXPECTED, "expected peta book")
+
+    mismatches = peta_book_mismatches(expected, actual, "PetaShockFixtureMismatch")
+    print(f"[PetaShockFixture] positions={len(expected.body)}, mismatches={mismatches}")
+    return rule_mismatches + mismatches
+
+
+def parse_args()->argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument(
+        "--bench_book_backend",
+        type=int,
+        metavar="POSITIONS",
+        default=None,
+        help="compare memory and speed of the book backends with POSITIONS random positions",
+    )
+    group.add_argument(
+        "--bench_multipv_widening",
+        type=int,
+        metavar="POSITIONS",
+        default=None,
+        help="compare the multipv_widening modes against a scripted stand-in engine on POSITIONS random positions",
+    )
+    group.add_argument(
+        "--stress_book_lock",
+        type=int,
+        metavar="THREADS",
+        default=None,
+        help="write to shared book positions from THREADS mock engines and check that no update is lost",
+    )
+    group.add_argument(
+        "--check_peta_incremental",
+        metavar="BOOK_PATH",
+        default=None,
+        help="check that the incremental native peta_shock matches a full recompute on BOOK_PATH",
+    )
+    group.add_argument(
+        "--check_peta_shock_fixture",
+        action="store_true",
+        help="check that the native peta_shock matches the YO-MATERIAL makebook peta_shock output of the fixture book",
+    )
+    group.add_argument(
+        "--make_peta_shock_fixture",
+        action="store_true",
+        help="write the expected output of the fixture book with YO-MATERIAL makebook peta_shock",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.bench_book_backend is not None:
+        bench_book_backends(args.bench_book_backend)
+    elif args.bench_multipv_widening is not None:
+        bench_multipv_widening(args.bench_multipv_widening)
+    elif args.stress_book_lock is not None:
+        if stress_book_lock(args.stress_book_lock) != 0:
+            sys.exit(1)
+    elif args.check_peta_incremental is not None:
+        if check_peta_incremental(args.check_peta_incremental) != 0:
+            sys.exit(1)
+    elif args.check_peta_shock_fixture:
+        if check_peta_shock_fixture() != 0:
+            sys.exit(1)
+    elif args.make_peta_shock_fixture:
+        make_peta_shock_fixture()
+
+if __name__ == '__main__':
+    main()
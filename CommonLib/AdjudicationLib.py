@@ -0,0 +1,206 @@
+"""
+自己対局の終局判定(adjudication)を行うライブラリ。
+
+勝敗が決まった局面や、引き分けになりそうな局面を最後まで指し続けるのはエンジンの時間の無駄なので、
+評価値を見て早めに対局を打ち切る。
+
+判定規則 :
+    resign : 連続するN手で、両エンジンの評価値が同じ側に閾値以上傾いていたら、傾いている側の勝ち。
+             連続する手は先手・後手のエンジンが交互に探索しているので、N >= 2なら両エンジンが合意していることになる。
+    draw   : 一定の手数以降、連続するN手で評価値の絶対値が小さな値以下なら引き分け。
+    mate   : 評価値の絶対値が指定した値(詰みを見つけたときの評価値)以上なら、その時点で決着。
+
+評価値は、手番側から見た値を渡すこと。
+"""
+
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any
+
+# 手番。cshogiのBLACK, WHITEと同じ値。
+BLACK = 0
+WHITE = 1
+
+# 判定理由
+ADJUDICATE_RESIGN = "resign"
+ADJUDICATE_DRAW   = "draw"
+ADJUDICATE_MATE   = "mate"
+
+# pack形式の終局理由(1byte)。README.mdの「pack形式データフォーマット」参照。
+PACK_REASON_ADJUDICATE_RESIGN = 20
+PACK_REASON_ADJUDICATE_DRAW   = 21
+PACK_REASON_ADJUDICATE_MATE   = 22
+
+PACK_REASONS = {
+    ADJUDICATE_RESIGN : PACK_REASON_ADJUDICATE_RESIGN,
+    ADJUDICATE_DRAW   : PACK_REASON_ADJUDICATE_DRAW,
+    ADJUDICATE_MATE   : PACK_REASON_ADJUDICATE_MATE,
+}
+
+
+@dataclass
+class AdjudicationSettings:
+    # resign判定の評価値の閾値。Noneなら判定しない。
+    resign_eval : int | None = None
+    # resign判定に必要な連続手数
+    resign_plies : int = 4
+
+    # draw判定の評価値の絶対値の上限。Noneなら判定しない。
+    draw_eval : int | None = None
+    # draw判定に必要な連続手数
+    draw_plies : int = 20
+    # この手数以降でだけdraw判定を行う。
+    draw_min_ply : int = 100
+
+    # 評価値の絶対値がこの値以上なら決着とする。Noneなら判定しない。
+    mate_score : int | None = None
+
+    @staticmethod
+    def from_settings(settings:dict[str, Any])->"AdjudicationSettings":
+        '''設定ファイルのADJUDICATION_*から読み込む。'''
+        def optional_int(name:str)->int | None:
+            value = settings.get(name, None)
+            return None if value is None else int(value)
+
+        s = AdjudicationSettings()
+        s.resign_eval  = optional_int("ADJUDICATION_RESIGN_EVAL")
+        s.resign_plies = max(1, int(settings.get("ADJUDICATION_RESIGN_PLIES", s.resign_plies)))
+        s.draw_eval    = optional_int("ADJUDICATION_DRAW_EVAL")
+        s.draw_plies   = max(1, int(settings.get("ADJUDICATION_DRAW_PLIES", s.draw_plies)))
+        s.draw_min_ply = int(settings.get("ADJUDICATION_DRAW_MIN_PLY", s.draw_min_ply))
+        s.mate_score   = optional_int("ADJUDICATION_MATE_SCORE")
+        return s
+
+    def enabled(self)->bool:
+        return self.resign_eval is not None or self.draw_eval is not None or self.mate_score is not None
+
+    def __str__(self)->str:
+        return (f"resign_eval = {self.resign_eval}, resign_plies = {self.resign_plies}, "
+                f"draw_eval = {self.draw_eval}, draw_plies = {self.draw_plies}, draw_min_ply = {self.draw_min_ply}, "
+                f"mate_score = {self.mate_score}")
+
+
+@dataclass
+class Adjudication:
+    # 判定理由。ADJUDICATE_*
+    reason : str
+    # 勝った側。BLACK/WHITE。引き分けならNone。
+    winner : int | None
+
+
+class GameAdjudicator:
+    '''1局分の終局判定。1手指すごとにupdate()を呼び出す。'''
+
+    def __init__(self, settings:AdjudicationSettings):
+        self.settings = settings
+
+        # 先手から見た評価値が閾値以上(正)/閾値以下(負)で連続している手数
+        self.resign_streak = 0
+        self.resign_sign = 0
+        # 優勢側が決まった(resignの条件を満たし始めた)手数
+        self.decided_ply : int | None = None
+
+        # 評価値の絶対値が小さいまま連続している手数
+        self.draw_streak = 0
+
+    def update(self, ply:int, turn:int, eval:int)->Adjudication | None:
+        '''
+        ply  : 探索した局面の手数
+        turn : 探索した局面の手番
+        eval : 手番側から見た評価値
+        返し値 : 対局を打ち切るならその判定。続けるならNone。
+        '''
+        s = self.settings
+        black_eval = eval if turn == BLACK else -eval
+
+        if s.mate_score is not None and abs(eval) >= s.mate_score:
+            return Adjudication(ADJUDICATE_MATE, BLACK if black_eval > 0 else WHITE)
+
+        if s.resign_eval is not None:
+            sign = 1 if black_eval >= s.resign_eval else -1 if black_eval <= -s.resign_eval else 0
+            if sign != 0 and sign == self.resign_sign:
+                self.resign_streak += 1
+            else:
+                self.resign_streak = 1 if sign != 0 else 0
+                self.decided_ply = ply if sign != 0 else None
+            self.resign_sign = sign
+
+            if sign != 0 and self.resign_streak >= s.resign_plies:
+                return Adjudication(ADJUDICATE_RESIGN, BLACK if sign > 0 else WHITE)
+
+        if s.draw_eval is not None:
+            if ply >= s.draw_min_ply and abs(eval) <= s.draw_eval:
+                self.draw_streak += 1
+            else:
+                self.draw_streak = 0
+
+            if self.draw_streak >= s.draw_plies:
+                return Adjudication(ADJUDICATE_DRAW, None)
+
+        return None
+
+
+class AdjudicationStats:
+    '''
+    終局判定の集計。複数の対局スレッドから呼び出される。
+
+    打ち切ったことで節約できたエンジンの時間は、次の手数に1手あたりの平均探索時間を掛けて見積もる。
+        draw        : 最大手数までの残り手数。(上限の見積もり)
+        resign/mate : 打ち切らずに投了まで指した対局で、優勢側が決まってから投了までにかかった手数の平均。
+    '''
+
+    def __init__(self, max_game_ply:int):
+        self.max_game_ply = max_game_ply
+        self.lock = Lock()
+
+        self.games = 0
+        self.counts = {ADJUDICATE_RESIGN : 0, ADJUDICATE_DRAW : 0, ADJUDICATE_MATE : 0}
+        self.draw_saved_plies = 0
+
+        # 1手あたりの探索時間
+        self.plies = 0
+        self.engine_seconds = 0.0
+
+        # 打ち切らずに投了まで指した対局の、優勢側が決まってから投了までの手数
+        self.decided_tail_games = 0
+        self.decided_tail_plies = 0
+
+    def record_ply(self, seconds:float):
+        with self.lock:
+            self.plies += 1
+            self.engine_seconds += seconds
+
+    def record_game(self, adjudicator:GameAdjudicator, adjudication:Adjudication | None, end_ply:int, resigned:bool):
+        '''
+        1局終わるごとに呼び出す。
+        end_ply  : 終局した手数
+        resigned : 打ち切らずに投了(または宣言勝ち)で終わったか。
+        '''
+        with self.lock:
+            self.games += 1
+            if adjudication is not None:
+                self.counts[adjudication.reason] += 1
+                if adjudication.reason == ADJUDICATE_DRAW:
+                    self.draw_saved_plies += max(0, self.max_game_ply - end_ply)
+            elif resigned and adjudicator.decided_ply is not None:
+                self.decided_tail_games += 1
+                self.decided_tail_plies += end_ply - adjudicator.decided_ply
+
+    def saved_plies(self)->float:
+        decided = self.counts[ADJUDICATE_RESIGN] + self.counts[ADJUDICATE_MATE]
+        average_tail = self.decided_tail_plies / self.decided_tail_games if self.decided_tail_games else 0.0
+        return self.draw_saved_plies + decided * average_tail
+
+    def seconds_per_ply(self)->float:
+        '''エンジンの1手あたりの平均探索時間[s]'''
+        return self.engine_seconds / self.plies if self.plies else 0.0
+
+    def summary_text(self)->str:
+        with self.lock:
+            seconds_per_ply = self.seconds_per_ply()
+            saved_plies = self.saved_plies()
+            adjudicated = sum(self.counts.values())
+            return (f"games = {self.games}, adjudicated = {adjudicated} "
+                    f"(resign = {self.counts[ADJUDICATE_RESIGN]}, draw = {self.counts[ADJUDICATE_DRAW]}, mate = {self.counts[ADJUDICATE_MATE]}), "
+                    f"saved plies = {saved_plies:.0f}, saved engine time = {saved_plies * seconds_per_ply:.1f}s "
+                    f"({seconds_per_ply:.3f}s/ply)")
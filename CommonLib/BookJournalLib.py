@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Iterator
+
+import cshogi  # type: ignore
+import numpy as np
+
+from PackedBookLib import MOVE16_TO_USI, PACKED_SFEN_SIZE, usi_to_packed_move16
+from YaneuraOuBookLib import trim_number
+
+
+# ============================================================
+#                     Journal file
+# ============================================================
+
+# segmentファイルの先頭
+#   magic(8byte) , snapshot名の長さ(uint16) , snapshot名(utf-8)
+# snapshot名は、このsegmentを適用する元になる定跡DB(snapshot)を表す文字列。
+# その後に、recordが並ぶ。
+JOURNAL_MAGIC = b"YOBKJNL1"
+JOURNAL_HEADER = struct.Struct("<8sH")
+
+# record
+#   payloadのbyte数(uint32) , payloadのcrc32(uint32) , payload
+# payload
+#   PackedSfen(32byte) , 手数(uint16) , 指し手の数(uint16) , 指し手 × 指し手の数
+# 指し手
+#   Move16(uint16) , eval(int32) , depth(uint16)
+JOURNAL_RECORD_HEADER = struct.Struct("<II")
+JOURNAL_POSITION = struct.Struct(f"<{PACKED_SFEN_SIZE}sHH")
+JOURNAL_MOVE = struct.Struct("<HiH")
+
+# 指し手のevalが未設定(None)であることを表す値。
+JOURNAL_EVAL_NONE = -(2**31)
+
+# segmentファイルの拡張子
+JOURNAL_EXTENSION = ".journal"
+
+# 1局面の更新内容。(末尾の手数なしのsfen, 手数, [(指し手, eval, depth), ...])
+JournalRecord = tuple[str, int, list[tuple[str, "int | None", int]]]
+
+
+def read_journal_header(f) -> str:
+    '''snapshot名を返す。'''
+    header = f.read(JOURNAL_HEADER.size)
+    if len(header) != JOURNAL_HEADER.size:
+        raise ValueError("journal header is truncated.")
+    magic, name_size = JOURNAL_HEADER.unpack(header)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError(f"not a book journal file, magic = {magic!r}")
+    name = f.read(name_size)
+    if len(name) != name_size:
+        raise ValueError("journal header is truncated.")
+    return name.decode("utf-8")
+
+
+def read_journal_snapshot_name(path: str) -> str:
+    with open(path, "rb") as f:
+        return read_journal_header(f)
+
+
+def iter_journal_records(path: str) -> Iterator[JournalRecord]:
+    """
+    segmentファイルのrecordを順番に列挙する。
+    書き込み途中で落ちたときの末尾の壊れたrecordは無視して、そこで終わる。
+    """
+    board = cshogi.Board()
+    with open(path, "rb") as f:
+        read_journal_header(f)
+        while True:
+            header = f.read(JOURNAL_RECORD_HEADER.size)
+            if len(header) != JOURNAL_RECORD_HEADER.size:
+                return
+            size, crc = JOURNAL_RECORD_HEADER.unpack(header)
+            payload = f.read(size)
+            if len(payload) != size or zlib.crc32(payload) != crc:
+                return
+            packed_sfen, ply, count = JOURNAL_POSITION.unpack_from(payload)
+            board.set_psfen(np.frombuffer(packed_sfen, dtype=cshogi.PackedSfen, count=1))
+            moves = [
+                (MOVE16_TO_USI[move16], None if eval == JOURNAL_EVAL_NONE else eval, depth)
+                for move16, eval, depth in JOURNAL_MOVE.iter_unpack(payload[JOURNAL_POSITION.size:])
+            ]
+            if len(moves) != count:
+                return
+            yield trim_number(board.sfen()), ply, moves
+
+
+class BookJournal:
+    """
+    定跡の局面の更新を追記していくジャーナル(write-ahead log)。
+
+    directory/{name}-{連番6桁}.journal というsegmentファイルに分けて書く。
+    各segmentのheaderには、そのsegmentを適用する元になるsnapshot名を書いておく。
+
+    1 recordは1局面の更新後の内容そのものなので、同じ局面のrecordは後のもので上書きすれば良い。
+    (snapshotに含まれている更新をもう一度適用しても結果は変わらない)
+
+    snapshot(定跡DBの全体の書き出し)を始める前に rotate() で新しいsegmentに切り替え、
+    snapshotが書き終わったら remove_segments_before() でそれより前のsegmentを消す。
+    起動時は、読み込んだsnapshotの名前がheaderに書かれている最初のsegmentから最後までを適用する。
+
+    append()ではOSに渡すところ(flush)までを行い、fsyncはsync()でまとめて行う。
+    """
+
+    def __init__(self, directory: str, name: str):
+        self.directory = directory
+        self.name = name
+        self.lock = threading.Lock()
+        self.board = cshogi.Board()
+        self.psfen = np.empty(1, dtype=cshogi.PackedSfen)
+        self.f = None
+        self.seq = 0
+        self.pending = 0
+        self.total_size = 0
+
+    # --------------------------------------------------------
+    #                       segment
+    # --------------------------------------------------------
+
+    def segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{self.name}-{seq:06d}{JOURNAL_EXTENSION}")
+
+    def segment_seqs(self) -> list[int]:
+        """存在するsegmentの連番を昇順で返す。"""
+        if not os.path.isdir(self.directory):
+            return []
+        pattern = re.compile(rf"{re.escape(self.name)}-(\d{{6}}){re.escape(JOURNAL_EXTENSION)}")
+        seqs = []
+        for filename in os.listdir(self.directory):
+            match = pattern.fullmatch(filename)
+            if match is not None:
+                seqs.append(int(match.group(1)))
+        seqs.sort()
+        return seqs
+
+    def segment_paths(self) -> list[str]:
+        return [self.segment_path(seq) for seq in self.segment_seqs()]
+
+    def replay_paths(self, snapshot_name: str) -> list[str]:
+        """
+        snapshot_nameのsnapshotに適用するsegmentを、適用する順に返す。
+        snapshot_nameのsegmentが1つも無ければ空。(別のsnapshotに対するsegmentは適用しない)
+        """
+        paths = self.segment_paths()
+        for i, path in enumerate(paths):
+            if read_journal_snapshot_name(path) == snapshot_name:
+                return paths[i:]
+        return []
+
+    def iter_records(self, paths: list[str]) -> Iterator[JournalRecord]:
+        for path in paths:
+            yield from iter_journal_records(path)
+
+    # --------------------------------------------------------
+    #                       書き込み
+    # --------------------------------------------------------
+
+    def open(self, snapshot_name: str) -> None:
+        """snapshot_nameのsnapshotに対する新しいsegmentを作って、書き込みを開始する。"""
+        with self.lock:
+            self.open_segment(snapshot_name)
+            self.total_size = sum(os.path.getsize(path) for path in self.segment_paths())
+
+    def open_segment(self, snapshot_name: str) -> None:
+        seqs = self.segment_seqs()
+        self.seq = max(seqs[-1] if seqs else 0, self.seq) + 1
+        os.makedirs(self.directory, exist_ok=True)
+        name_bytes = snapshot_name.encode("utf-8")
+        self.f = open(self.segment_path(self.seq), "wb")
+        self.f.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, len(name_bytes)) + name_bytes)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.total_size += JOURNAL_HEADER.size + len(name_bytes)
+        self.pending = 0
+
+    def append(self, sfen: str, ply: int, moves: list[tuple[str, int | None, int]]) -> None:
+        """局面の更新後の内容を追記する。sfenは末尾の手数なし。"""
+        with self.lock:
+            if self.f is None:
+                raise Exception("book journal is not opened.")
+            self.board.set_sfen(sfen)
+            self.board.to_psfen(self.psfen)
+            payload = bytearray(JOURNAL_POSITION.pack(self.psfen.tobytes(), ply, len(moves)))
+            for move, eval, depth in moves:
+                payload += JOURNAL_MOVE.pack(
+                    usi_to_packed_move16(move), JOURNAL_EVAL_NONE if eval is None else eval, depth
+                )
+            self.f.write(JOURNAL_RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.f.write(payload)
+            # プロセスが落ちても失われないようにOSには渡しておく。
+            self.f.flush()
+            self.pending += 1
+            self.total_size += JOURNAL_RECORD_HEADER.size + len(payload)
+
+    def sync(self) -> None:
+        """追記したrecordをまとめてfsyncする。"""
+        with self.lock:
+            if self.f is not None and self.pending > 0:
+                os.fsync(self.f.fileno())
+                self.pending = 0
+
+    def rotate(self, snapshot_name: str) -> int:
+        """
+        いまのsegmentを閉じて、snapshot_nameのsnapshotに対する新しいsegmentに切り替える。
+        新しいsegmentの連番を返す。
+        """
+        with self.lock:
+            self.close_segment()
+            self.open_segment(snapshot_name)
+            return self.seq
+
+    def remove_segments_before(self, seq: int) -> None:
+        """連番がseqより前のsegmentを削除する。(snapshotに含まれたので不要になった)"""
+        with self.lock:
+            for old_seq in self.segment_seqs():
+                if old_seq < seq:
+                    os.remove(self.segment_path(old_seq))
+            self.total_size = sum(os.path.getsize(path) for path in self.segment_paths())
+
+    def size_bytes(self) -> int:
+        """segmentファイルの合計byte数"""
+        with self.lock:
+            return self.total_size
+
+    def close_segment(self) -> None:
+        if self.f is not None:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.f.close()
+            self.f = None
+            self.pending = 0
+
+    def close(self) -> None:
+        with self.lock:
+            self.close_segment()
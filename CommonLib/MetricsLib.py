@@ -0,0 +1,375 @@
+"""
+スループットや待ち時間を計測するための軽量なmetricsライブラリ。
+
+カウンター(count)と、時間のヒストグラム(observe/timer)を記録する。
+記録はスレッドごとの領域に対して行うのでlockを取らない。読み出すとき(snapshot)に全スレッド分を合算する。
+labelsを指定すると、全体の集計に加えてlabel(エンジンなど)ごとにも集計する。
+
+    METRICS.configure(enabled=True)
+    METRICS.count("games")
+    with METRICS.timer("engine.go", ("suisho#0",)):
+        ...
+    with METRICS.locked(lock, "idle.write_lock"):
+        ...
+
+METRICS.start_reporter()で、一定間隔ごとと終了時(close)にJSON Linesで書き出す。
+METRICS.start_trace()で、指定した時間帯のtimerの区間をChromeのtrace event形式(chrome://tracing, Perfettoで開ける)で書き出す。
+
+無効(既定)のときは、count/observe/timerは何もしない。
+"""
+
+import json
+import os
+import time
+from threading import Event, Lock, Thread, current_thread, get_ident, local
+from typing import Any
+
+# ヒストグラムのbucket数。bucket iには[2^(i-1), 2^i)マイクロ秒の値が入る。
+HISTOGRAM_BUCKETS = 40
+
+
+class Histogram:
+    '''時間[s]のヒストグラム。bucketは2のべき乗[us]ごと。'''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+
+    def add(self, seconds:float):
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1_000_000).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def merge(self, other:"Histogram"):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def percentile(self, p:float)->float:
+        '''p(0～1)分位点の近似値[s]。値が入っているbucketの上端を返す。'''
+        if self.count == 0:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min((1 << i) / 1_000_000, self.max)
+        return self.max
+
+    def summary(self)->dict:
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "sum": round(self.total, 6),
+            "mean": round(self.total / self.count, 6),
+            "min": round(self.min, 6),
+            "max": round(self.max, 6),
+            "p50": round(self.percentile(0.50), 6),
+            "p90": round(self.percentile(0.90), 6),
+            "p99": round(self.percentile(0.99), 6),
+        }
+
+
+def add_counter(counters:dict[str, float], name:str, value:float):
+    counters[name] = counters.get(name, 0) + value
+
+
+def add_histogram(histograms:dict[str, Histogram], name:str, seconds:float):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.add(seconds)
+
+
+def merge_counters(total:dict[str, float], counters:dict[str, float]):
+    # 書き込み中のスレッドがdictに要素を追加することがあるので、先にcopyしておく。
+    for name, value in list(counters.items()):
+        add_counter(total, name, value)
+
+
+def merge_histograms(total:dict[str, Histogram], histograms:dict[str, Histogram]):
+    for name, histogram in list(histograms.items()):
+        if name not in total:
+            total[name] = Histogram()
+        total[name].merge(histogram)
+
+
+def counter_rates(counters:dict[str, float], last_counters:dict[str, float], elapsed:float)->dict[str, float]:
+    '''前回の値からの増加量を、秒あたりにして返す。'''
+    return {
+        name: round((value - last_counters.get(name, 0)) / elapsed, 3) if elapsed > 0 else 0.0
+        for name, value in counters.items()
+    }
+
+
+class ThreadMetrics:
+    '''1スレッド分の記録。そのスレッドからしか書き込まない。'''
+
+    def __init__(self):
+        self.thread_name = current_thread().name
+        self.thread_id = get_ident()
+        self.counters : dict[str, float] = {}
+        self.histograms : dict[str, Histogram] = {}
+        # label → そのlabelをつけて記録したcounters/histograms
+        self.labeled_counters : dict[str, dict[str, float]] = {}
+        self.labeled_histograms : dict[str, dict[str, Histogram]] = {}
+        self.trace_events : list[tuple[str, float, float]] = []
+
+
+class Timer:
+    '''MetricsRegistry.timer()が返すcontext manager。'''
+
+    def __init__(self, registry:"MetricsRegistry", name:str, labels:tuple[str, ...]):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.registry.observe(self.name, time.perf_counter() - self.start, self.start, self.labels)
+
+
+class LockTimer:
+    '''MetricsRegistry.locked()が返すcontext manager。lockを取るまでの待ち時間を記録する。'''
+
+    def __init__(self, registry:"MetricsRegistry", lock:Any, name:str, labels:tuple[str, ...]):
+        self.registry = registry
+        self.lock = lock
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        if not self.registry.enabled:
+            self.lock.acquire()
+            return self
+        start = time.perf_counter()
+        self.lock.acquire()
+        self.registry.observe(self.name, time.perf_counter() - start, start, self.labels)
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.enabled = False
+
+        self.local = local()
+        self.threads : list[ThreadMetrics] = []
+        self.lock = Lock()
+
+        # 計測開始時刻。trace eventの時刻はここからの経過時間にする。
+        self.start_time = time.perf_counter()
+
+        # JSON Linesの書き出し
+        self.metrics_path : str | None = None
+        self.interval = 60.0
+        self.reporter_thread : Thread | None = None
+        self.quit_event = Event()
+        self.last_counters : dict[str, float] = {}
+        self.last_labeled_counters : dict[str, dict[str, float]] = {}
+        self.last_report_time = self.start_time
+
+        # trace event
+        self.trace_path : str | None = None
+        self.trace_begin = 0.0
+        self.trace_end = 0.0
+        self.trace_written = False
+
+    def configure(self, enabled:bool = True):
+        self.enabled = enabled
+
+    def thread_metrics(self)->ThreadMetrics:
+        '''呼び出したスレッドの記録領域を返す。初回だけlockを取って登録する。'''
+        metrics = getattr(self.local, "metrics", None)
+        if metrics is None:
+            metrics = ThreadMetrics()
+            self.local.metrics = metrics
+            with self.lock:
+                self.threads.append(metrics)
+        return metrics
+
+    def count(self, name:str, value:float = 1, labels:tuple[str, ...] = ()):
+        '''
+        カウンターを増やす。
+        labels : 全体に加えて、これらのlabelごとの集計にも加える。
+        '''
+        if not self.enabled:
+            return
+        metrics = self.thread_metrics()
+        add_counter(metrics.counters, name, value)
+        for label in labels:
+            counters = metrics.labeled_counters.get(label)
+            if counters is None:
+                counters = metrics.labeled_counters[label] = {}
+            add_counter(counters, name, value)
+
+    def observe(self, name:str, seconds:float, start:float | None = None, labels:tuple[str, ...] = ()):
+        '''
+        時間[s]を記録する。
+        start : 区間の開始時刻(time.perf_counter()の値)。指定するとtraceの区間としても記録する。
+        labels : 全体に加えて、これらのlabelごとの集計にも加える。
+        '''
+        if not self.enabled:
+            return
+        metrics = self.thread_metrics()
+        add_histogram(metrics.histograms, name, seconds)
+        for label in labels:
+            histograms = metrics.labeled_histograms.get(label)
+            if histograms is None:
+                histograms = metrics.labeled_histograms[label] = {}
+            add_histogram(histograms, name, seconds)
+
+        if start is not None and self.trace_begin <= start < self.trace_end:
+            trace_name = f"{name} {' '.join(labels)}" if labels else name
+            metrics.trace_events.append((trace_name, start, seconds))
+
+    def timer(self, name:str, labels:tuple[str, ...] = ())->Timer:
+        return Timer(self, name, labels)
+
+    def locked(self, lock:Any, name:str, labels:tuple[str, ...] = ())->LockTimer:
+        '''lockを取るwith文の代わりに使う。lockを取るまで待たされた時間をnameで記録する。'''
+        return LockTimer(self, lock, name, labels)
+
+    def snapshot(self)->dict:
+        '''
+        全スレッドの記録を合算して返す。
+        "labels"には、label → そのlabelの{"counters", "histograms"}が入る。
+        '''
+        with self.lock:
+            threads = list(self.threads)
+
+        counters : dict[str, float] = {}
+        histograms : dict[str, Histogram] = {}
+        labels : dict[str, dict[str, Any]] = {}
+        for metrics in threads:
+            merge_counters(counters, metrics.counters)
+            merge_histograms(histograms, metrics.histograms)
+            # 書き込み中のスレッドがdictに要素を追加することがあるので、先にcopyしておく。
+            for label, label_counters in list(metrics.labeled_counters.items()):
+                merge_counters(labels.setdefault(label, {"counters": {}, "histograms": {}})["counters"], label_counters)
+            for label, label_histograms in list(metrics.labeled_histograms.items()):
+                merge_histograms(labels.setdefault(label, {"counters": {}, "histograms": {}})["histograms"], label_histograms)
+
+        return {"counters": counters, "histograms": histograms, "labels": dict(sorted(labels.items()))}
+
+    # ------------------------------------------------------------
+    #                    JSON Linesの書き出し
+    # ------------------------------------------------------------
+
+    def start_reporter(self, metrics_path:str, interval:float):
+        '''interval[s]ごとにmetrics_pathにJSON Linesで1行追記する。'''
+        self.metrics_path = metrics_path
+        self.interval = interval
+        self.reporter_thread = Thread(target=self.reporter_worker, daemon=True)
+        self.reporter_thread.start()
+
+    def reporter_worker(self):
+        while not self.quit_event.wait(self.interval):
+            self.write_report()
+            self.write_trace_if_finished()
+
+    def write_report(self, final:bool = False):
+        if self.metrics_path is None:
+            return
+
+        now = time.perf_counter()
+        snapshot = self.snapshot()
+        counters = snapshot["counters"]
+        elapsed = now - self.last_report_time
+
+        # 前回の書き出しからの増加量を秒あたりにしたもの
+        rates = counter_rates(counters, self.last_counters, elapsed)
+        labels = {
+            label: {
+                "counters": values["counters"],
+                "rates": counter_rates(values["counters"], self.last_labeled_counters.get(label, {}), elapsed),
+                "histograms": {name: h.summary() for name, h in values["histograms"].items()},
+            }
+            for label, values in snapshot["labels"].items()
+        }
+        self.last_counters = counters
+        self.last_labeled_counters = {label: values["counters"] for label, values in snapshot["labels"].items()}
+        self.last_report_time = now
+
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "pid": os.getpid(),
+            "elapsed": round(now - self.start_time, 3),
+            "final": final,
+            "counters": counters,
+            "rates": rates,
+            "histograms": {name: h.summary() for name, h in snapshot["histograms"].items()},
+            "labels": labels,
+        }
+
+        # 複数processから同じファイルに追記することがあるので、1行を1回のwriteで書く。
+        with open(self.metrics_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    # ------------------------------------------------------------
+    #                    trace eventの書き出し
+    # ------------------------------------------------------------
+
+    def start_trace(self, trace_path:str, delay:float, duration:float):
+        '''今からdelay[s]後からduration[s]の間のtimerの区間を記録して、trace_pathに書き出す。'''
+        self.trace_path = trace_path
+        self.trace_begin = time.perf_counter() + delay
+        self.trace_end = self.trace_begin + duration
+
+    def write_trace_if_finished(self):
+        if self.trace_path is not None and not self.trace_written and time.perf_counter() >= self.trace_end:
+            self.write_trace()
+
+    def write_trace(self):
+        if self.trace_path is None or self.trace_written:
+            return
+        self.trace_written = True
+
+        with self.lock:
+            threads = list(self.threads)
+
+        pid = os.getpid()
+        events = []
+        for metrics in threads:
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": metrics.thread_id,
+                           "args": {"name": metrics.thread_name}})
+            for name, start, seconds in list(metrics.trace_events):
+                events.append({"name": name, "ph": "X", "pid": pid, "tid": metrics.thread_id,
+                               "ts": round((start - self.start_time) * 1_000_000, 1),
+                               "dur": round(seconds * 1_000_000, 1)})
+            metrics.trace_events = []
+
+        with open(self.trace_path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def close(self):
+        '''reporterを止めて、最後の記録とtraceを書き出す。'''
+        if self.reporter_thread is not None:
+            self.quit_event.set()
+            self.reporter_thread.join()
+            self.reporter_thread = None
+        self.write_report(final=True)
+        self.write_trace()
+
+
+# スクリプト全体で共有するregistry。configure()で有効にするまでは何も記録しない。
+METRICS = MetricsRegistry()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+動作確認用の簡易USIエンジン。
+
+評価関数を持たず、合法手に対して局面と指し手から決まる擬似的な評価値を返すだけのエンジン。
+同じ局面・同じ指し手なら常に同じ評価値を返すので、スクリプト側の処理を変更したときに
+結果が変わっていないかを確認するのに使える。
+
+    python MockUsiEngine.py [--ready-delay 秒] [--go-delay 秒] [--crash-rate 確率] [--seed N]
+
+Linuxでは実行属性をつけておけば、エンジンのpathとしてこのファイルを直接指定できる。
+Windowsでは`python MockUsiEngine.py`を書いたbatファイルを用意してそれを指定する。
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import zlib
+
+import cshogi
+
+
+def mock_eval(sfen:str, move:str, seed:int)->int:
+    ''' 局面と指し手から決まる擬似的な評価値。[-300, 300] '''
+    return zlib.crc32(f"{seed} {sfen} {move}".encode("utf-8")) % 601 - 300
+
+
+def parse_position(tokens:list[str])->cshogi.Board: # type:ignore
+    ''' "position"コマンドのtoken列(先頭の"position"は除く)から局面を作る。 '''
+    board = cshogi.Board() # type:ignore
+    if not tokens:
+        return board
+
+    # やねうら王と同じく、"sfen"は省略されていても良い。
+    moves_index = tokens.index("moves") if "moves" in tokens else len(tokens)
+    if tokens[0] == "sfen":
+        board.set_sfen(" ".join(tokens[1:moves_index]))
+    elif tokens[0] != "startpos":
+        board.set_sfen(" ".join(tokens[:moves_index]))
+    for move in tokens[moves_index + 1:]:
+        board.push_usi(move)
+    return board
+
+
+def main():
+    parser = argparse.ArgumentParser(description="動作確認用の簡易USIエンジン")
+    parser.add_argument("--ready-delay", type=float, default=0.0, help="isreadyからreadyokまでの時間[s]。評価関数の読み込み時間の代わり。")
+    parser.add_argument("--go-delay", type=float, default=0.0, help="goからbestmoveまでの時間[s]")
+    parser.add_argument("--crash-rate", type=float, default=0.0, help="goを受け取ったときにprocessを異常終了させる確率")
+    parser.add_argument("--seed", type=int, default=0, help="評価値の生成に使うseed")
+    args = parser.parse_args()
+
+    options : dict[str, str] = {}
+    board = cshogi.Board() # type:ignore
+    multipv = 1
+
+    def send(message:str):
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
+
+    for line in sys.stdin:
+        tokens = line.split()
+        if not tokens:
+            continue
+        command = tokens[0]
+
+        if command == "usi":
+            send("id name MockUsiEngine")
+            send("id author YaneuraOu-ScriptCollection")
+            send("option name MultiPV type spin default 1 min 1 max 800")
+            send("usiok")
+
+        elif command == "isready":
+            time.sleep(args.ready_delay)
+            send("readyok")
+
+        elif command == "setoption" and len(tokens) >= 3:
+            value_index = tokens.index("value") if "value" in tokens else len(tokens)
+            name = " ".join(tokens[2:value_index])
+            options[name] = " ".join(tokens[value_index + 1:])
+            if name == "MultiPV":
+                multipv = max(1, int(options[name]))
+
+        elif command == "multipv" and len(tokens) >= 2:
+            # BookMinerが送る独自コマンド。
+            multipv = max(1, int(tokens[1]))
+
+        elif command == "position":
+            board = parse_position(tokens[1:])
+
+        elif command == "go":
+            if args.crash_rate > 0 and random.random() < args.crash_rate:
+                os._exit(3)
+            time.sleep(args.go_delay)
+
+            nodes = int(tokens[tokens.index("nodes") + 1]) if "nodes" in tokens else 1000
+            moves = [cshogi.move_to_usi(m) for m in board.legal_moves] # type:ignore
+            if "searchmoves" in tokens:
+                searchmoves = set(tokens[tokens.index("searchmoves") + 1:])
+                moves = [m for m in moves if m in searchmoves]
+            if not moves:
+                # やねうら王と同じく、詰みの局面では評価値を出してから投了する。
+                send("info depth 0 score mate -0")
+                send("bestmove resign")
+                continue
+
+            sfen = board.sfen()
+            scored = sorted(((mock_eval(sfen, m, args.seed), m) for m in moves), reverse=True)
+            for i, (score, move) in enumerate(scored[:multipv], 1):
+                send(f"info depth 1 seldepth 1 multipv {i} score cp {score} nodes {nodes} pv {move}")
+            send(f"bestmove {scored[0][1]}")
+
+        elif command == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
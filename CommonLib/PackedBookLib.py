@@ -0,0 +1,460 @@
+from __future__ import annotations
+
+import threading
+from array import array
+from collections.abc import MutableMapping
+from typing import Iterator
+
+import cshogi  # type: ignore
+import numpy as np
+
+from YaneuraOuBookLib import MOVE_NONE, MOVE_NULL, MOVE_RESIGN, MOVE_WIN, trim_number
+
+
+# .ybbのkeyと同じPackedSfenのbyte数
+PACKED_SFEN_SIZE = 32
+
+
+# 指し手のevalが未設定(None)であることを表す値。int16の最小値。
+PACKED_EVAL_NONE = -32768
+
+# 指し手1つのeval/depthとして格納できる範囲
+PACKED_EVAL_MIN = -32767
+PACKED_EVAL_MAX = 32767
+PACKED_DEPTH_MAX = 65535
+PACKED_PLY_MAX = 65535
+PACKED_MOVE_COUNT_MAX = 65535
+
+# open addressingのslotの値。0以上ならentryのindex。
+SLOT_EMPTY = -1
+SLOT_DELETED = -2
+
+# やねうら王のMove16の形式
+#   bit 0..6  : 移動先の升
+#   bit 7..13 : 移動元の升。駒打ちなら打つ駒の種類
+#   bit 14    : 駒打ちフラグ
+#   bit 15    : 成りフラグ
+MOVE16_DROP = 1 << 14
+MOVE16_PROMOTE = 1 << 15
+MOVE16_DROP_PIECES = "PLNSBRG"
+
+# USIの特殊な指し手とMove16の対応。
+SPECIAL_MOVE16 = {
+    "none": MOVE_NONE,
+    "None": MOVE_NONE,
+    "null": MOVE_NULL,
+    "resign": MOVE_RESIGN,
+    "win": MOVE_WIN,
+}
+SPECIAL_MOVE16_USI = {
+    MOVE_NONE: "none",
+    MOVE_NULL: "null",
+    MOVE_RESIGN: "resign",
+    MOVE_WIN: "win",
+}
+
+
+def build_move16_tables() -> tuple[dict[str, int], dict[int, str]]:
+    """
+    盤面なしでUSI指し手文字列とMove16を相互変換するための表を作る。
+    升は1一を0として、筋*9 + 段の順。(やねうら王のSquareと同じ)
+    """
+    squares = [f"{file}{chr(ord('a') + rank)}" for file in range(1, 10) for rank in range(9)]
+    usi_to_move: dict[str, int] = {}
+    for to, to_text in enumerate(squares):
+        for from_, from_text in enumerate(squares):
+            if from_ == to:
+                continue
+            usi_to_move[from_text + to_text] = (from_ << 7) | to
+            usi_to_move[from_text + to_text + "+"] = (from_ << 7) | to | MOVE16_PROMOTE
+        for piece_type, piece in enumerate(MOVE16_DROP_PIECES, 1):
+            usi_to_move[f"{piece}*{to_text}"] = (piece_type << 7) | to | MOVE16_DROP
+    move_to_usi = {move16: usi for usi, move16 in usi_to_move.items()}
+    usi_to_move.update(SPECIAL_MOVE16)
+    move_to_usi.update(SPECIAL_MOVE16_USI)
+    return usi_to_move, move_to_usi
+
+
+USI_TO_MOVE16, MOVE16_TO_USI = build_move16_tables()
+
+
+def usi_to_packed_move16(usi: str) -> int:
+    """USI指し手文字列をMove16にする。YaneuraOuBookLib.usi_to_move16()と違い、局面を必要としない。"""
+    move16 = USI_TO_MOVE16.get(usi)
+    if move16 is None:
+        raise ValueError(f"invalid usi move: {usi}")
+    return move16
+
+
+def packed_move16_to_usi(move16: int) -> str:
+    usi = MOVE16_TO_USI.get(move16)
+    if usi is None:
+        raise ValueError(f"invalid move16: {move16}")
+    return usi
+
+
+# pack_sfen()/unpack_sfen()で使い回す、threadごとのcshogi.Board
+_local = threading.local()
+
+
+def _local_board() -> tuple[cshogi.Board, np.ndarray]:
+    board = getattr(_local, "board", None)
+    if board is None:
+        board = _local.board = cshogi.Board()
+        _local.psfen = np.empty(1, dtype=cshogi.PackedSfen)
+    return board, _local.psfen
+
+
+def pack_sfen(sfen: str) -> bytes:
+    """sfen(末尾の手数はあってもなくても良い)を、.ybbのkeyと同じPACKED_SFEN_SIZE byteのPackedSfenにする。"""
+    board, psfen = _local_board()
+    board.set_sfen(sfen)
+    board.to_psfen(psfen)
+    return psfen.tobytes()
+
+
+def unpack_sfen(packed_sfen: bytes) -> str:
+    """pack_sfen()の逆。cshogiで正規化した、末尾の手数なしのsfenを返す。"""
+    board, _psfen = _local_board()
+    board.set_psfen(np.frombuffer(packed_sfen, dtype=cshogi.PackedSfen, count=1))
+    return trim_number(board.sfen())
+
+
+# 1局面の内容。(手数, [(指し手, eval, depth), ...], flags)
+# flagsは利用側で自由に使える8bitの値。
+PackedRecord = tuple[int, list[tuple[str, "int | None", int]], int]
+
+
+class PackedBookStore(MutableMapping):
+    """
+    sfen(末尾の手数なし)をkeyとする定跡のオンメモリ格納庫。
+
+    dict[sfen, 局面情報]と同じように使えるが、中身は次のように連続した配列に詰めて持つ。
+    - key : .ybbと同じ32byteのPackedSfen
+    - 索引 : PackedSfenのhashによるopen addressing(線形探索)の表
+    - 指し手 : (Move16 uint16, eval int16, depth uint16)の3本の配列
+    - 手数(uint16)とflags(uint8) : 局面ごとの配列
+
+    keyはPackedSfenに変換してから探すので、同じ局面なら手駒の表記順などが違うsfenでも同じentryになる。
+    列挙したときのkeyは cshogi で正規化したsfenになる。
+
+    値はget_record()/set_record()では PackedRecord で読み書きする。
+    []で読み書きする値の型は、派生classで record_to_value()/value_to_record() を定義して変える。
+    []で読み出した値は毎回作り直したものなので、値を書き換えたときは[]で代入し直す必要がある。
+
+    局面を更新して指し手の数が変わったときは、指し手の配列の末尾に書き直す。
+    使われなくなった領域が半分を超えたら詰め直す。
+    """
+
+    INITIAL_SLOTS = 1 << 10
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.clear()
+
+    # --------------------------------------------------------
+    #                  値の変換(派生classで定義)
+    # --------------------------------------------------------
+
+    def record_to_value(self, record: PackedRecord):
+        return record
+
+    def value_to_record(self, value) -> PackedRecord:
+        return value
+
+    # --------------------------------------------------------
+    #                       key
+    # --------------------------------------------------------
+
+    def board(self) -> cshogi.Board:
+        # cshogi.Boardはthreadごとに1つ使い回す。
+        board = getattr(self.local, "board", None)
+        if board is None:
+            board = self.local.board = cshogi.Board()
+            self.local.psfen = np.empty(1, dtype=cshogi.PackedSfen)
+            self.local.last_sfen = None
+            self.local.last_packed_sfen = b""
+        return board
+
+    def pack_key(self, sfen: str) -> bytes:
+        board = self.board()
+        # `sfen in body`のあとに`body[sfen]`と続けることが多いので、直前の変換結果を使い回す。
+        local = self.local
+        if sfen == local.last_sfen:
+            return local.last_packed_sfen
+        board.set_sfen(sfen)
+        board.to_psfen(local.psfen)
+        local.last_sfen = sfen
+        local.last_packed_sfen = local.psfen.tobytes()
+        return local.last_packed_sfen
+
+    def unpack_key(self, packed_sfen: bytes) -> str:
+        board = self.board()
+        board.set_psfen(np.frombuffer(packed_sfen, dtype=cshogi.PackedSfen, count=1))
+        return trim_number(board.sfen())
+
+    def key_at(self, entry: int) -> bytes:
+        return bytes(self.keys_blob[entry * PACKED_SFEN_SIZE : (entry + 1) * PACKED_SFEN_SIZE])
+
+    # --------------------------------------------------------
+    #                       索引
+    # --------------------------------------------------------
+
+    def find_slot(self, packed_sfen: bytes) -> tuple[int, int]:
+        """(entryのindex, slotのindex)を返す。見つからなければentryは-1で、slotは挿入先。"""
+        mask = len(self.slots) - 1
+        i = hash(packed_sfen) & mask
+        insert_slot = -1
+        keys_blob = self.keys_blob
+        while True:
+            entry = self.slots[i]
+            if entry == SLOT_EMPTY:
+                return -1, i if insert_slot < 0 else insert_slot
+            if entry == SLOT_DELETED:
+                if insert_slot < 0:
+                    insert_slot = i
+            elif keys_blob[entry * PACKED_SFEN_SIZE : (entry + 1) * PACKED_SFEN_SIZE] == packed_sfen:
+                return entry, i
+            i = (i + 1) & mask
+
+    def rebuild_slots(self, slot_count: int) -> None:
+        slots = array("q", [SLOT_EMPTY]) * slot_count
+        mask = slot_count - 1
+        for entry in range(len(self.plies)):
+            if not self.alive[entry]:
+                continue
+            i = hash(self.key_at(entry)) & mask
+            while slots[i] != SLOT_EMPTY:
+                i = (i + 1) & mask
+            slots[i] = entry
+        self.slots = slots
+        self.used_slots = self.count
+
+    # --------------------------------------------------------
+    #                       指し手
+    # --------------------------------------------------------
+
+    def write_moves(self, entry: int, moves: list[tuple[str, int | None, int]]) -> None:
+        if len(moves) > PACKED_MOVE_COUNT_MAX:
+            raise ValueError(f"too many moves in one position: {len(moves)}")
+
+        move16s = array("H")
+        evals = array("h")
+        depths = array("H")
+        for move, eval, depth in moves:
+            if eval is None:
+                eval = PACKED_EVAL_NONE
+            elif eval < PACKED_EVAL_MIN or eval > PACKED_EVAL_MAX:
+                raise ValueError(f"eval is out of int16 range: {eval}")
+            if depth < 0 or depth > PACKED_DEPTH_MAX:
+                raise ValueError(f"depth is out of uint16 range: {depth}")
+            move16s.append(usi_to_packed_move16(move))
+            evals.append(eval)
+            depths.append(depth)
+
+        offset = self.move_offsets[entry]
+        count = self.move_counts[entry]
+        if len(moves) == count and count > 0:
+            # 同じ数なら上書きする。
+            self.move16s[offset : offset + count] = move16s
+            self.evals[offset : offset + count] = evals
+            self.depths[offset : offset + count] = depths
+            return
+
+        # 数が変わったので末尾に書き直す。
+        self.garbage_moves += count
+        self.move_offsets[entry] = len(self.move16s)
+        self.move_counts[entry] = len(moves)
+        self.move16s.extend(move16s)
+        self.evals.extend(evals)
+        self.depths.extend(depths)
+
+        if self.garbage_moves > 1024 and self.garbage_moves * 2 > len(self.move16s):
+            self.compact_moves()
+
+    def read_moves(self, entry: int) -> list[tuple[str, int | None, int]]:
+        offset = self.move_offsets[entry]
+        end = offset + self.move_counts[entry]
+        return [
+            (MOVE16_TO_USI[move16], None if eval == PACKED_EVAL_NONE else eval, depth)
+            for move16, eval, depth in zip(
+                self.move16s[offset:end], self.evals[offset:end], self.depths[offset:end]
+            )
+        ]
+
+    def compact_moves(self) -> None:
+        """使われなくなった指し手の領域を詰める。"""
+        move16s = array("H")
+        evals = array("h")
+        depths = array("H")
+        for entry in range(len(self.plies)):
+            offset = self.move_offsets[entry]
+            count = self.move_counts[entry]
+            self.move_offsets[entry] = len(move16s)
+            if not self.alive[entry] or count == 0:
+                self.move_counts[entry] = 0
+                continue
+            move16s.extend(self.move16s[offset : offset + count])
+            evals.extend(self.evals[offset : offset + count])
+            depths.extend(self.depths[offset : offset + count])
+        self.move16s, self.evals, self.depths = move16s, evals, depths
+        self.garbage_moves = 0
+
+    # --------------------------------------------------------
+    #                  PackedRecordでの読み書き
+    # --------------------------------------------------------
+
+    def get_record(self, sfen: str) -> PackedRecord | None:
+        packed_sfen = self.pack_key(sfen)
+        with self.lock:
+            entry, _slot = self.find_slot(packed_sfen)
+            if entry < 0:
+                return None
+            return self.plies[entry], self.read_moves(entry), self.flags[entry]
+
+    def set_record(self, sfen: str, ply: int, moves: list[tuple[str, int | None, int]], flags: int = 0) -> None:
+        if ply < 0 or ply > PACKED_PLY_MAX:
+            raise ValueError(f"ply is out of uint16 range: {ply}")
+        if flags < 0 or flags > 255:
+            raise ValueError(f"flags is out of uint8 range: {flags}")
+        packed_sfen = self.pack_key(sfen)
+        with self.lock:
+            entry, slot = self.find_slot(packed_sfen)
+            if entry < 0:
+                entry = len(self.plies)
+                self.keys_blob += packed_sfen
+                self.plies.append(ply)
+                self.flags.append(flags)
+                self.move_offsets.append(len(self.move16s))
+                self.move_counts.append(0)
+                self.alive.append(1)
+                if self.slots[slot] == SLOT_EMPTY:
+                    self.used_slots += 1
+                self.slots[slot] = entry
+                self.count += 1
+                try:
+                    self.write_moves(entry, moves)
+                except Exception:
+                    self.remove_entry(entry, slot)
+                    raise
+                # 削除済みslotも含めて2/3を超えたら作り直す。
+                if self.used_slots * 3 > len(self.slots) * 2:
+                    slot_count = len(self.slots)
+                    while self.count * 3 > slot_count:
+                        slot_count *= 2
+                    self.rebuild_slots(slot_count)
+            else:
+                self.write_moves(entry, moves)
+                self.plies[entry] = ply
+                self.flags[entry] = flags
+
+    def remove_entry(self, entry: int, slot: int) -> None:
+        self.slots[slot] = SLOT_DELETED
+        self.alive[entry] = 0
+        self.garbage_moves += self.move_counts[entry]
+        self.move_counts[entry] = 0
+        self.count -= 1
+
+    def entry_count(self) -> int:
+        """これまでに登録したentryの数。(削除したものも含む) iter_keys()に渡すと、その時点のkeyだけを列挙できる。"""
+        with self.lock:
+            return len(self.plies)
+
+    def iter_keys(self, entry_end: int | None = None) -> Iterator[str]:
+        """
+        sfenを登録順に列挙する。
+        entry_endを指定したら、entry_count()がその値だった時点までに登録された局面だけを列挙する。
+        """
+        entry = 0
+        while True:
+            with self.lock:
+                if entry >= (len(self.plies) if entry_end is None else min(entry_end, len(self.plies))):
+                    return
+                if not self.alive[entry]:
+                    entry += 1
+                    continue
+                packed_sfen = self.key_at(entry)
+            entry += 1
+            yield self.unpack_key(packed_sfen)
+
+    def iter_records(self) -> Iterator[tuple[str, PackedRecord]]:
+        """(sfen, PackedRecord)を登録順に列挙する。列挙中に追加された局面も列挙される。"""
+        entry = 0
+        while True:
+            with self.lock:
+                if entry >= len(self.plies):
+                    return
+                if not self.alive[entry]:
+                    entry += 1
+                    continue
+                packed_sfen = self.key_at(entry)
+                record = self.plies[entry], self.read_moves(entry), self.flags[entry]
+            entry += 1
+            yield self.unpack_key(packed_sfen), record
+
+    # --------------------------------------------------------
+    #                    MutableMapping
+    # --------------------------------------------------------
+
+    def __getitem__(self, sfen: str):
+        record = self.get_record(sfen)
+        if record is None:
+            raise KeyError(sfen)
+        return self.record_to_value(record)
+
+    def __setitem__(self, sfen: str, value) -> None:
+        self.set_record(sfen, *self.value_to_record(value))
+
+    def __delitem__(self, sfen: str) -> None:
+        packed_sfen = self.pack_key(sfen)
+        with self.lock:
+            entry, slot = self.find_slot(packed_sfen)
+            if entry < 0:
+                raise KeyError(sfen)
+            self.remove_entry(entry, slot)
+
+    def __contains__(self, sfen) -> bool:
+        packed_sfen = self.pack_key(sfen)
+        with self.lock:
+            return self.find_slot(packed_sfen)[0] >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_keys()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def items(self):
+        # 既定のItemsViewだと1局面ごとに2回探すことになるので、直接列挙する。
+        return [(sfen, self.record_to_value(record)) for sfen, record in self.iter_records()]
+
+    def clear(self) -> None:
+        with self.lock:
+            self.slots = array("q", [SLOT_EMPTY]) * self.INITIAL_SLOTS
+            self.used_slots = 0
+            self.count = 0
+
+            self.keys_blob = bytearray()
+            self.plies = array("H")
+            self.flags = bytearray()
+            self.move_offsets = array("Q")
+            self.move_counts = array("H")
+            self.alive = bytearray()
+
+            self.move16s = array("H")
+            self.evals = array("h")
+            self.depths = array("H")
+            self.garbage_moves = 0
+
+    def memory_bytes(self) -> int:
+        """配列が確保しているおおよそのbyte数"""
+        with self.lock:
+            arrays = (
+                self.slots, self.plies, self.move_offsets, self.move_counts,
+                self.move16s, self.evals, self.depths,
+            )
+            return (
+                sum(a.itemsize * len(a) for a in arrays)
+                + len(self.keys_blob) + len(self.flags) + len(self.alive)
+            )
@@ -0,0 +1,611 @@
+from __future__ import annotations
+
+import heapq
+from array import array
+
+import cshogi  # type: ignore
+import numpy as np
+
+from PackedBookLib import MOVE16_TO_USI, PACKED_SFEN_SIZE, usi_to_packed_move16
+from YaneShogiLib import flipped_sfen
+
+
+# peta shock後のdepthの上限。(やねうら王のmakebook peta_shockと同じ)
+PETA_DEPTH_MAX = 9999
+
+# 千日手(定跡内のループ)の評価値
+PETA_DRAW_VALUE = 0
+
+# 子局面が定跡内にない指し手(leaf)のchild
+PETA_CHILD_NONE = -1
+
+# 局面が決まっていないときの評価値
+PETA_VALUE_NONE = -(2**31)
+
+# 定跡内のループに依存して決まったnode(ループ上のnodeと、その祖先)のlevel
+PETA_LEVEL_LOOP = -1
+
+# 削除された指し手のowner
+PETA_EDGE_DEAD = -1
+
+# 削除された指し手がこの割合を超えたら、graphを作り直したほうが良い。
+PETA_REBUILD_DEAD_RATIO = 0.5
+
+
+def array_from_numpy(typecode: str, a: np.ndarray) -> array:
+    # 1要素ずつ読み書きするところはnumpyよりarrayのほうが速い。
+    result = array(typecode)
+    result.frombytes(a.astype(np.dtype(typecode)).tobytes())
+    return result
+
+
+class PetaShockGraph:
+    """
+    定跡の局面をnode、指し手をedgeとするgraphで、leafの評価値をrootへmin-max伝播させる。(peta shock化)
+    やねうら王の makebook peta_shock (FlippedBook = true) と同じ結果になるようにしてある。
+
+    使い方
+        graph = PetaShockGraph()
+        for sfen, moves in ...:
+            graph.add_position(sfen, moves)   # 追加した順の番号がnodeの番号になる
+        graph.peta_shock()
+        for node in range(len(graph)):
+            graph.moves(node)
+
+        # 定跡が変わったら、変わった局面だけ渡して計算し直す。
+        nodes, changed = graph.update([(sfen, moves), ...])
+        for node in changed:
+            graph.moves(node)
+
+    - 子局面は局面のhash(cshogiのzobrist hash)で引き、PackedSfenを比べて同じ局面か確かめる。
+      (hashが衝突しても別の局面につながない) flipした局面も同じ局面として扱う。
+    - 子局面が定跡内にある指し手は (value, depth) = (-子局面のbestのvalue, min(子局面のbestのdepth + 1, 9999))。
+      子局面が定跡内にない指し手は、入力の (value, depth) のまま。
+    - bestは、valueが最大の指し手。valueが同じならdepthが大きいほう。
+    - 出力時、bestと同じvalueでdepthが異なるbest以外の指し手は value - 1 する。(迂回手順を選び続けないように)
+
+    定跡内のループ(千日手)は次のように扱う。
+    1. 子局面がすべて確定したnodeから順に確定させる。(後退解析)
+    2. 確定できるnodeがなくなったら、残ったnodeのうち、ループの外へ出る指し手
+       (leaf、または確定した子局面への指し手)の評価値が一番高いnodeを、その評価値で確定させて1.に戻る。
+       ループ内の子局面への指し手は、その時点では千日手(PETA_DRAW_VALUE)として扱う。
+       同じ評価値のnodeが複数あれば、局面のhashの小さいほうから確定させる。
+    3. ループの外へ出る指し手の評価値がすべて千日手より悪ければ、残ったnodeはすべて千日手とする。
+
+    update()では、1.で確定したnodeには子局面より大きいlevelを付けておき、変更されたnodeから
+    levelの小さい順に、bestが変わらなくなるところまでだけ親へ伝播させる。
+    2.以降で確定したnode(PETA_LEVEL_LOOP)まで変更が届いたときは、それらのnodeだけ2.からやり直す。
+    """
+
+    def __init__(self):
+        self.board = cshogi.Board()
+        self.psfen = np.empty(1, dtype=cshogi.PackedSfen)
+
+        # nodeごと
+        self.node_hashes = array("Q")
+        self.flipped_hashes = array("Q")
+        # 局面と、flipした局面のPackedSfen。PACKED_SFEN_SIZE byteずつ。
+        self.node_keys = bytearray()
+        self.flipped_keys = bytearray()
+        self.move_starts = array("q")
+        self.move_ends = array("q")
+        self.levels = array("i")
+        self.best_values = array("i")
+        self.best_depths = array("i")
+
+        # edgeごと
+        self.move16s = array("H")
+        self.values = array("i")
+        self.depths = array("i")
+        self.child_hashes = array("Q")
+        # 合法手でない指し手(resignなど)は子局面を持たない。
+        self.child_valid = bytearray()
+        self.children = array("q")
+        # update()で置き換えられた指し手はPETA_EDGE_DEAD
+        self.edge_owners = array("q")
+        self.dead_edges = 0
+
+        # peta_shock()で作る索引。update()で追加した分はdictに持つ。
+        # 局面のhash(flipしたものも) → node
+        self.index_keys = np.empty(0, dtype=np.uint64)
+        self.index_nodes = np.empty(0, dtype=np.int64)
+        self.extra_nodes : dict[int, list[int]] = {}
+        # 定跡内にない子局面のhash → その子局面への指し手
+        self.leaf_keys = np.empty(0, dtype=np.uint64)
+        self.leaf_edges = np.empty(0, dtype=np.int64)
+        self.extra_leaves : dict[int, list[int]] = {}
+        # 子局面 → 親局面のedge
+        self.parent_starts = array("q", [0])
+        self.parent_edges = array("q")
+        self.extra_parents : dict[int, list[int]] = {}
+
+        self.shocked = False
+        self.loop_dirty = False
+
+    def __len__(self) -> int:
+        return len(self.node_hashes)
+
+    @property
+    def loop_nodes(self) -> int:
+        """ループに依存して決まったnodeの数"""
+        return int(np.count_nonzero(np.frombuffer(self.levels, dtype=np.int32) == PETA_LEVEL_LOOP))
+
+    def should_rebuild(self) -> bool:
+        """update()で置き換えた指し手が溜まったので、graphを作り直したほうが良いか。"""
+        return self.dead_edges > len(self.move16s) * PETA_REBUILD_DEAD_RATIO
+
+    def add_position(self, sfen: str, moves: list[tuple[str, int, int]]) -> int:
+        """局面(末尾の手数なし)と、その指し手の(USI指し手, value, depth)を追加して、nodeの番号を返す。"""
+        node = self.append_node(sfen)
+        self.append_edges(node, moves)
+        return node
+
+    def packed_key(self) -> bytes:
+        """self.boardの局面のPackedSfen"""
+        self.board.to_psfen(self.psfen)
+        return self.psfen.tobytes()
+
+    def append_node(self, sfen: str) -> int:
+        board = self.board
+        board.set_sfen(flipped_sfen(sfen))
+        self.flipped_hashes.append(board.zobrist_hash())
+        self.flipped_keys += self.packed_key()
+        board.set_sfen(sfen)
+        self.node_hashes.append(board.zobrist_hash())
+        self.node_keys += self.packed_key()
+        self.move_starts.append(len(self.move16s))
+        self.move_ends.append(len(self.move16s))
+        self.levels.append(0)
+        self.best_values.append(PETA_VALUE_NONE)
+        self.best_depths.append(0)
+        return len(self.node_hashes) - 1
+
+    def append_edges(self, node: int, moves: list[tuple[str, int, int]]) -> None:
+        """self.boardがnodeの局面になっているときに、nodeの指し手を末尾に追加する。"""
+        board = self.board
+        self.move_starts[node] = len(self.move16s)
+        for move, value, depth in moves:
+            self.move16s.append(usi_to_packed_move16(move))
+            self.values.append(value)
+            self.depths.append(depth)
+            self.children.append(PETA_CHILD_NONE)
+            self.edge_owners.append(node)
+            board_move = board.move_from_usi(move)
+            if board_move and board.is_legal(board_move):
+                board.push(board_move)
+                self.child_hashes.append(board.zobrist_hash())
+                self.child_valid.append(1)
+                board.pop()
+            else:
+                self.child_hashes.append(0)
+                self.child_valid.append(0)
+        self.move_ends[node] = len(self.move16s)
+
+    # --------------------------------------------------------
+    #                       索引
+    # --------------------------------------------------------
+
+    def build_index(self) -> None:
+        """各指し手の子局面のnodeを、局面のhashで引いて求め、子局面から親局面への逆引きを作る。"""
+        node_count = len(self)
+        keys = np.concatenate([
+            np.frombuffer(self.node_hashes, dtype=np.uint64),
+            np.frombuffer(self.flipped_hashes, dtype=np.uint64),
+        ])
+        nodes = np.concatenate([np.arange(node_count, dtype=np.int64)] * 2)
+        order = np.argsort(keys, kind="stable")
+        self.index_keys = keys[order]
+        self.index_nodes = nodes[order]
+        self.extra_nodes = {}
+
+        child_hashes = np.frombuffer(self.child_hashes, dtype=np.uint64)
+        live = (np.frombuffer(self.child_valid, dtype=np.uint8) != 0) & (np.frombuffer(self.edge_owners, dtype=np.int64) >= 0)
+        children = np.full(len(child_hashes), PETA_CHILD_NONE, dtype=np.int64)
+        if len(self.index_keys) > 0 and len(child_hashes) > 0:
+            index = np.minimum(np.searchsorted(self.index_keys, child_hashes), len(self.index_keys) - 1)
+            found = (self.index_keys[index] == child_hashes) & live
+            children[found] = self.index_nodes[index[found]]
+        self.children = array_from_numpy("q", children)
+
+        # hashが一致した指し手は、子局面のPackedSfenを比べて確かめる。
+        # 衝突していたら、同じhashの別のnodeを探す。なければleafにする。
+        for edge in np.flatnonzero(children >= 0).tolist():
+            key = self.child_key(edge)
+            if not self.is_node_key(self.children[edge], key):
+                self.children[edge] = self.find_node(self.child_hashes[edge], key)
+        children = np.frombuffer(self.children, dtype=np.int64)
+
+        leaf_edges = np.flatnonzero(live & (children < 0))
+        order = np.argsort(child_hashes[leaf_edges], kind="stable")
+        self.leaf_edges = leaf_edges[order]
+        self.leaf_keys = child_hashes[self.leaf_edges]
+        self.extra_leaves = {}
+
+        parent_edges = np.flatnonzero(children >= 0)
+        parent_edges = parent_edges[np.argsort(children[parent_edges], kind="stable")]
+        parent_starts = np.zeros(node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(children[parent_edges], minlength=node_count), out=parent_starts[1:])
+        self.parent_edges = array_from_numpy("q", parent_edges)
+        self.parent_starts = array_from_numpy("q", parent_starts)
+        self.extra_parents = {}
+
+    def find_node(self, key: int, packed_key: bytes) -> int:
+        """局面のhashとPackedSfenからnodeを引く。なければPETA_CHILD_NONE。"""
+        i = int(np.searchsorted(self.index_keys, np.uint64(key)))
+        while i < len(self.index_keys) and int(self.index_keys[i]) == key:
+            node = int(self.index_nodes[i])
+            if self.is_node_key(node, packed_key):
+                return node
+            i += 1
+        for node in self.extra_nodes.get(key, ()):
+            if self.is_node_key(node, packed_key):
+                return node
+        return PETA_CHILD_NONE
+
+    def is_node_key(self, node: int, packed_key: bytes) -> bool:
+        """packed_keyがnodeの局面(flipしたものも)のPackedSfenか。"""
+        start = node * PACKED_SFEN_SIZE
+        end = start + PACKED_SFEN_SIZE
+        return self.node_keys[start:end] == packed_key or self.flipped_keys[start:end] == packed_key
+
+    def child_key(self, edge: int) -> bytes:
+        """edgeの指し手で進めた子局面のPackedSfen。edgeは合法手であること。"""
+        board = self.board
+        start = self.edge_owners[edge] * PACKED_SFEN_SIZE
+        board.set_psfen(np.frombuffer(self.node_keys, dtype=cshogi.PackedSfen, count=1, offset=start))
+        board.push(board.move_from_usi(MOVE16_TO_USI[self.move16s[edge]]))
+        return self.packed_key()
+
+    def parent_edges_of(self, node: int) -> list[int]:
+        """nodeを子局面とする指し手。置き換えられた指し手も含むので、edge_ownersを見ること。"""
+        edges = []
+        if node + 1 < len(self.parent_starts):
+            edges = self.parent_edges[self.parent_starts[node]:self.parent_starts[node + 1]].tolist()
+        extra = self.extra_parents.get(node)
+        if extra:
+            edges.extend(extra)
+        return edges
+
+    def canonical_hash(self, node: int) -> int:
+        return min(self.node_hashes[node], self.flipped_hashes[node])
+
+    # --------------------------------------------------------
+    #                       peta shock
+    # --------------------------------------------------------
+
+    def best_of(self, node: int) -> tuple[int, int]:
+        best_value = PETA_VALUE_NONE
+        best_depth = 0
+        values, depths = self.values, self.depths
+        for edge in range(self.move_starts[node], self.move_ends[node]):
+            value = values[edge]
+            if value > best_value or (value == best_value and depths[edge] > best_depth):
+                best_value = value
+                best_depth = depths[edge]
+        return best_value, best_depth
+
+    def edge_value(self, child: int) -> tuple[int, int]:
+        """子局面childへの指し手の(value, depth)。指し手のない子局面への指し手は千日手扱いのまま。"""
+        best_value = self.best_values[child]
+        if best_value == PETA_VALUE_NONE:
+            return PETA_DRAW_VALUE, 0
+        return -best_value, min(self.best_depths[child] + 1, PETA_DEPTH_MAX)
+
+    def peta_shock(self) -> None:
+        """leafの評価値をrootへ伝播させて、各指し手の(value, depth)を書き換える。"""
+        self.build_index()
+        self.propagate(range(len(self)))
+        self.shocked = True
+
+    def propagate(self, nodes) -> None:
+        """
+        nodesの局面を確定させて、親局面への指し手に伝播させる。nodes以外の局面は確定しているものとして扱う。
+        nodesは、その親局面をすべて含んでいること。
+        """
+        values, depths = self.values, self.depths
+        children, edge_owners = self.children, self.edge_owners
+        move_starts, move_ends = self.move_starts, self.move_ends
+        levels, best_values, best_depths = self.levels, self.best_values, self.best_depths
+        node_count = len(self)
+
+        determined = bytearray(b"\x01") * node_count
+        for node in nodes:
+            determined[node] = 0
+
+        # まだ確定していない子局面の数
+        out_counts = array("i", [0]) * node_count
+        # ループの外へ出る指し手のうち一番良いもの。(value, depth)
+        exit_values = array("i", [PETA_VALUE_NONE]) * node_count
+        exit_depths = array("i", [0]) * node_count
+        exit_heap : list[tuple[int, int, int, int]] = []
+
+        def update_exit(node: int, value: int, depth: int) -> None:
+            if value > exit_values[node] or (value == exit_values[node] and depth > exit_depths[node]):
+                exit_values[node] = value
+                exit_depths[node] = depth
+                heapq.heappush(exit_heap, (-value, -depth, self.canonical_hash(node), node))
+
+        # 確定していない子局面への指し手は、子局面が確定するまで千日手扱い。
+        queue : list[int] = []
+        remaining = 0
+        for node in nodes:
+            remaining += 1
+            level = 0
+            count = 0
+            for edge in range(move_starts[node], move_ends[node]):
+                child = children[edge]
+                if child < 0:
+                    update_exit(node, values[edge], depths[edge])
+                elif not determined[child]:
+                    values[edge] = PETA_DRAW_VALUE
+                    depths[edge] = 0
+                    count += 1
+                else:
+                    level = max(level, levels[child] + 1)
+                    values[edge], depths[edge] = self.edge_value(child)
+                    update_exit(node, values[edge], depths[edge])
+            levels[node] = level
+            out_counts[node] = count
+            if count == 0:
+                queue.append(node)
+
+        # 最初にループの規則で確定させてから後に確定したnodeは、ループに依存している。
+        loop_phase = False
+
+        def determine(node: int, best: tuple[int, int] | None = None) -> None:
+            determined[node] = 1
+            if loop_phase:
+                levels[node] = PETA_LEVEL_LOOP
+            if move_starts[node] == move_ends[node]:
+                # 指し手のない局面は親へ伝播させない。
+                best_values[node] = PETA_VALUE_NONE
+                best_depths[node] = 0
+                return
+            best_values[node], best_depths[node] = self.best_of(node) if best is None else best
+            value, depth = self.edge_value(node)
+            level = levels[node]
+            for edge in self.parent_edges_of(node):
+                parent = edge_owners[edge]
+                if parent < 0:
+                    continue
+                values[edge] = value
+                depths[edge] = depth
+                if determined[parent]:
+                    continue
+                if level >= 0 and levels[parent] <= level:
+                    levels[parent] = level + 1
+                out_counts[parent] -= 1
+                if out_counts[parent] == 0:
+                    queue.append(parent)
+                else:
+                    update_exit(parent, value, depth)
+
+        while True:
+            while queue:
+                node = queue.pop()
+                if not determined[node]:
+                    determine(node)
+                    remaining -= 1
+
+            if remaining == 0:
+                break
+
+            loop_phase = True
+
+            # ループが残っている。ループの外へ出る指し手の評価値が一番高いnodeを確定させる。
+            while exit_heap:
+                value, depth, _, node = exit_heap[0]
+                if determined[node] or -value != exit_values[node] or -depth != exit_depths[node]:
+                    heapq.heappop(exit_heap)
+                    continue
+                break
+
+            if exit_heap and -exit_heap[0][0] >= PETA_DRAW_VALUE:
+                node = heapq.heappop(exit_heap)[3]
+                determine(node)
+                remaining -= 1
+                continue
+
+            # ループの外へ出ても千日手より悪いので、残りはすべて千日手。
+            # 残りのnode同士の指し手は千日手のままbestを求めてから、まとめて伝播させる。
+            rest = [node for node in nodes if not determined[node]]
+            bests = [self.best_of(node) for node in rest]
+            for node in rest:
+                determined[node] = 1
+            for node, best in zip(rest, bests):
+                determine(node, best)
+            remaining = 0
+
+    # --------------------------------------------------------
+    #                       差分更新
+    # --------------------------------------------------------
+
+    def update(self, positions: list[tuple[str, list[tuple[str, int, int]]]]) -> tuple[list[int], list[int]]:
+        """
+        peta_shock()のあとで、局面の追加と指し手の変更を反映し、影響のあるところだけ計算し直す。
+        positionsは(局面, 指し手)。graphにない局面なら追加し、ある局面なら指し手を置き換える。
+        (positionsの各局面のnode, 指し手の(value, depth)が変わったかもしれないnode)を返す。
+        追加した局面のnodeは、positionsの順に末尾から振られる。
+        """
+        if not self.shocked:
+            raise Exception("peta_shock() must be called before update().")
+
+        self.loop_dirty = False
+        dirty : set[int] = set()
+        nodes = [self.update_position(sfen, moves, dirty) for sfen, moves in positions]
+
+        # ループに依存しないnodeは、levelの小さい順にbestが変わらなくなるまで親へ伝播させる。
+        changed = set(dirty)
+        values, depths, edge_owners, levels = self.values, self.depths, self.edge_owners, self.levels
+        heap = [(levels[node], node) for node in dirty if levels[node] != PETA_LEVEL_LOOP]
+        heapq.heapify(heap)
+        done : set[int] = set()
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in done:
+                continue
+            done.add(node)
+            if self.move_starts[node] == self.move_ends[node]:
+                best = (PETA_VALUE_NONE, 0)
+            else:
+                best = self.best_of(node)
+            if best == (self.best_values[node], self.best_depths[node]):
+                continue
+            self.best_values[node], self.best_depths[node] = best
+            value, depth = self.edge_value(node)
+            for edge in self.parent_edges_of(node):
+                parent = edge_owners[edge]
+                if parent < 0 or (values[edge] == value and depths[edge] == depth):
+                    continue
+                values[edge] = value
+                depths[edge] = depth
+                changed.add(parent)
+                if levels[parent] == PETA_LEVEL_LOOP:
+                    self.loop_dirty = True
+                elif parent not in done:
+                    heapq.heappush(heap, (levels[parent], parent))
+
+        # ループに依存するnodeまで変更が届いたら、それらのnodeだけ確定させ直す。
+        if self.loop_dirty:
+            loop_nodes = np.flatnonzero(np.frombuffer(levels, dtype=np.int32) == PETA_LEVEL_LOOP).tolist()
+            self.propagate(loop_nodes)
+            changed.update(loop_nodes)
+
+        return nodes, sorted(changed)
+
+    def update_position(self, sfen: str, moves: list[tuple[str, int, int]], dirty: set[int]) -> int:
+        board = self.board
+        board.set_sfen(sfen)
+        key = board.zobrist_hash()
+        packed_key = self.packed_key()
+        node = self.find_node(key, packed_key)
+        if node == PETA_CHILD_NONE:
+            node = self.append_node(sfen)
+            self.extra_nodes.setdefault(self.node_hashes[node], []).append(node)
+            self.extra_nodes.setdefault(self.flipped_hashes[node], []).append(node)
+            new_node = True
+        else:
+            # 登録したときと逆の向きで渡されることもある。
+            start = node * PACKED_SFEN_SIZE
+            if self.node_keys[start:start + PACKED_SFEN_SIZE] != packed_key:
+                self.node_hashes[node], self.flipped_hashes[node] = self.flipped_hashes[node], self.node_hashes[node]
+                self.node_keys[start:start + PACKED_SFEN_SIZE], self.flipped_keys[start:start + PACKED_SFEN_SIZE] = (
+                    self.flipped_keys[start:start + PACKED_SFEN_SIZE], self.node_keys[start:start + PACKED_SFEN_SIZE])
+            board.set_sfen(sfen)
+            for edge in range(self.move_starts[node], self.move_ends[node]):
+                self.edge_owners[edge] = PETA_EDGE_DEAD
+                self.dead_edges += 1
+            new_node = False
+        dirty.add(node)
+
+        self.append_edges(node, moves)
+        targets : set[int] = set()
+        for edge in range(self.move_starts[node], self.move_ends[node]):
+            if not self.child_valid[edge]:
+                continue
+            child = self.find_node(self.child_hashes[edge], self.child_key(edge))
+            if child == PETA_CHILD_NONE:
+                self.extra_leaves.setdefault(self.child_hashes[edge], []).append(edge)
+            else:
+                self.link_edge(edge, child)
+                targets.add(child)
+        self.fix_level(node, targets)
+
+        if new_node:
+            # 定跡内にない子局面として、この局面を指していた指し手をつなぐ。
+            for key in (self.node_hashes[node], self.flipped_hashes[node]):
+                for edge in self.leaf_edges_of(key):
+                    parent = self.edge_owners[edge]
+                    if parent < 0 or self.children[edge] != PETA_CHILD_NONE:
+                        continue
+                    if not self.is_node_key(node, self.child_key(edge)):
+                        # hashが衝突しただけの別の局面なので、leafのまま。
+                        continue
+                    self.link_edge(edge, node)
+                    dirty.add(parent)
+                    self.fix_level(parent, {node})
+                extra = self.extra_leaves.pop(key, None)
+                if extra:
+                    extra = [edge for edge in extra if self.edge_owners[edge] >= 0 and self.children[edge] == PETA_CHILD_NONE]
+                    if extra:
+                        self.extra_leaves[key] = extra
+        return node
+
+    def leaf_edges_of(self, key: int) -> list[int]:
+        start = int(np.searchsorted(self.leaf_keys, np.uint64(key), side="left"))
+        end = int(np.searchsorted(self.leaf_keys, np.uint64(key), side="right"))
+        edges = self.leaf_edges[start:end].tolist()
+        edges.extend(self.extra_leaves.get(key, ()))
+        return edges
+
+    def link_edge(self, edge: int, child: int) -> None:
+        self.children[edge] = child
+        self.extra_parents.setdefault(child, []).append(edge)
+        self.values[edge], self.depths[edge] = self.edge_value(child)
+
+    def fix_level(self, node: int, targets: set[int]) -> None:
+        """nodeのlevelを子局面のtargetsより大きくする。ループができたり、ループに依存したりしたらPETA_LEVEL_LOOPにする。"""
+        if self.levels[node] == PETA_LEVEL_LOOP:
+            self.loop_dirty = True
+            return
+        level = 0
+        for child in targets:
+            if child == node or self.levels[child] == PETA_LEVEL_LOOP:
+                self.mark_loop(node)
+                return
+            level = max(level, self.levels[child] + 1)
+        if not self.raise_level(node, level, targets):
+            self.mark_loop(node)
+
+    def raise_level(self, node: int, level: int, targets: set[int]) -> bool:
+        """nodeとその祖先のlevelを上げる。targetsが祖先にあれば(ループができたら)Falseを返す。"""
+        stack = [(node, level)]
+        while stack:
+            current, level = stack.pop()
+            if current in targets:
+                return False
+            if self.levels[current] == PETA_LEVEL_LOOP or level <= self.levels[current]:
+                continue
+            self.levels[current] = level
+            for edge in self.parent_edges_of(current):
+                parent = self.edge_owners[edge]
+                if parent >= 0:
+                    stack.append((parent, level + 1))
+        return True
+
+    def mark_loop(self, node: int) -> None:
+        """nodeとその祖先を、ループに依存するnodeにする。"""
+        self.loop_dirty = True
+        stack = [node]
+        while stack:
+            current = stack.pop()
+            if self.levels[current] == PETA_LEVEL_LOOP:
+                continue
+            self.levels[current] = PETA_LEVEL_LOOP
+            for edge in self.parent_edges_of(current):
+                parent = self.edge_owners[edge]
+                if parent >= 0 and self.levels[parent] != PETA_LEVEL_LOOP:
+                    stack.append(parent)
+
+    # --------------------------------------------------------
+    #                       出力
+    # --------------------------------------------------------
+
+    def moves(self, node: int) -> list[tuple[str, int, int]]:
+        """nodeの指し手の(USI指し手, value, depth)。bestと同じvalueでdepthが異なる指し手はvalue - 1してある。"""
+        start, end = self.move_starts[node], self.move_ends[node]
+        best_value = PETA_VALUE_NONE
+        best_depth = 0
+        best_edge = -1
+        for edge in range(start, end):
+            value = self.values[edge]
+            if value > best_value or (value == best_value and self.depths[edge] > best_depth):
+                best_value, best_depth, best_edge = value, self.depths[edge], edge
+        result = []
+        for edge in range(start, end):
+            value = self.values[edge]
+            depth = self.depths[edge]
+            if edge != best_edge and value == best_value and depth != best_depth:
+                value -= 1
+            result.append((MOVE16_TO_USI[self.move16s[edge]], value, depth))
+        return result
@@ -0,0 +1,178 @@
+"""
+生成した局面の重複を判定するためのBloom filter。
+
+GenSfenを開始局面の重なる複数の局面集合から何度も実行すると、序盤の同じ局面を何度も探索して書き出すことになる。
+書き出した局面のhash(cshogiのzobrist hash)をBloom filterに登録しておき、ファイルに保存して次回の実行に引き継ぐ。
+
+Bloom filterなので、登録していない局面を登録済みと判定する(false positive)ことがある。
+その確率は、登録数がcapacity以下ならfalse_positive_rate程度に収まる。登録済みの局面を未登録と判定することはない。
+
+ファイルフォーマット :
+    header : magic(8byte) "YOBLOOM1", bit数(uint64), hash関数の数(uint64), 登録数の推定値(uint64)
+    本体   : bit列(bit数 / 8 byte)
+"""
+
+import math
+import os
+import struct
+from multiprocessing import shared_memory
+from threading import Lock
+
+import numpy as np
+
+BLOOM_FILTER_MAGIC = b"YOBLOOM1"
+BLOOM_FILTER_HEADER = struct.Struct("<8sQQQ")
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(x:int)->int:
+    '''64bit整数をかき混ぜる。(SplitMix64の出力関数)'''
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def bloom_filter_size(capacity:int, false_positive_rate:float)->tuple[int, int]:
+    '''capacity個登録したときにfalse positiveの確率がfalse_positive_rateになる(bit数, hash関数の数)を返す。'''
+    capacity = max(1, capacity)
+    false_positive_rate = min(max(false_positive_rate, 1e-12), 0.5)
+    num_bits = math.ceil(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+    num_bits = (num_bits + 63) // 64 * 64
+    num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+    return num_bits, num_hashes
+
+
+class PositionBloomFilter:
+    '''
+    局面のhashを登録するBloom filter。
+
+    shared = Trueで生成すると、bit列を共有メモリに置く。pickleして別processに渡すと、
+    渡した先では同じ共有メモリを参照する。(複数processから同じbitを立てるとき、まれに書き込みが失われることがあるが、
+    その局面が重複と判定されないだけなので問題にしない)
+    '''
+
+    def __init__(self, num_bits:int, num_hashes:int, shared:bool = False):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+
+        # 共有メモリを作ったprocessのpid。このprocessだけがclose()で共有メモリを削除する。
+        # (forkで起動したprocessには、このobjectがそのまま引き継がれるので、フラグではなくpidで判定する)
+        self.shm : shared_memory.SharedMemory | None = None
+        self.shm_owner_pid : int | None = None
+        if shared:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.num_bytes())
+            self.shm_owner_pid = os.getpid()
+            self.bits = np.ndarray((self.num_bytes(),), dtype=np.uint8, buffer=self.shm.buf)
+            self.bits[:] = 0
+        else:
+            self.bits = np.zeros(self.num_bytes(), dtype=np.uint8)
+
+        self.lock = Lock()
+
+        # このprocessでの問い合わせ回数と、登録済みと判定された回数
+        self.lookups = 0
+        self.hits = 0
+
+    def num_bytes(self)->int:
+        return self.num_bits // 8
+
+    @staticmethod
+    def create(capacity:int, false_positive_rate:float, shared:bool = False)->"PositionBloomFilter":
+        num_bits, num_hashes = bloom_filter_size(capacity, false_positive_rate)
+        return PositionBloomFilter(num_bits, num_hashes, shared=shared)
+
+    @staticmethod
+    def load(path:str, shared:bool = False)->"PositionBloomFilter":
+        with open(path, "rb") as f:
+            magic, num_bits, num_hashes, _ = BLOOM_FILTER_HEADER.unpack(f.read(BLOOM_FILTER_HEADER.size))
+            if magic != BLOOM_FILTER_MAGIC:
+                raise ValueError(f"{path} is not a position filter file.")
+            bloom_filter = PositionBloomFilter(num_bits, num_hashes, shared=shared)
+            f.readinto(memoryview(bloom_filter.bits)) # type:ignore
+        return bloom_filter
+
+    @staticmethod
+    def load_or_create(path:str, capacity:int, false_positive_rate:float, shared:bool = False)->"PositionBloomFilter":
+        '''pathのファイルがあれば読み込む。なければ新しく作る。(sizeはファイルに保存されているものが優先される)'''
+        if os.path.exists(path):
+            return PositionBloomFilter.load(path, shared)
+        return PositionBloomFilter.create(capacity, false_positive_rate, shared)
+
+    def save(self, path:str):
+        '''一時ファイルに書いてから置き換えるので、保存中に落ちても元のファイルは壊れない。'''
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(BLOOM_FILTER_HEADER.pack(BLOOM_FILTER_MAGIC, self.num_bits, self.num_hashes, self.estimated_count()))
+            f.write(memoryview(self.bits)) # type:ignore
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def bit_indices(self, key:int)->list[int]:
+        # double hashing。h2は奇数にしておく。
+        h1 = mix64(key)
+        h2 = mix64(key ^ 0x5851F42D4C957F2D) | 1
+        return [((h1 + i * h2) & MASK64) % self.num_bits for i in range(self.num_hashes)]
+
+    def contains(self, key:int)->bool:
+        bits = self.bits
+        return all(bits[i >> 3] & (1 << (i & 7)) for i in self.bit_indices(key))
+
+    def check_and_add(self, key:int)->bool:
+        '''keyを登録する。登録済みだったならTrueを返す。'''
+        indices = self.bit_indices(key)
+        bits = self.bits
+        with self.lock:
+            self.lookups += 1
+            if all(bits[i >> 3] & (1 << (i & 7)) for i in indices):
+                self.hits += 1
+                return True
+            for i in indices:
+                bits[i >> 3] |= 1 << (i & 7)
+            return False
+
+    def fill_ratio(self)->float:
+        '''立っているbitの割合'''
+        return int(np.unpackbits(self.bits).sum()) / self.num_bits
+
+    def estimated_count(self, fill:float | None = None)->int:
+        '''
+        立っているbitの割合から登録数を推定する。
+        (複数processから登録したときも正しく数えられるように、登録数は数えずに推定する)
+        '''
+        if fill is None:
+            fill = self.fill_ratio()
+        if fill >= 1.0:
+            return self.num_bits
+        return round(-self.num_bits / self.num_hashes * math.log(1.0 - fill))
+
+    def stats_text(self)->str:
+        fill = self.fill_ratio()
+        hit_rate = self.hits / self.lookups if self.lookups else 0.0
+        return (f"lookups = {self.lookups}, hits = {self.hits} ({hit_rate:.1%}), "
+                f"positions = {self.estimated_count(fill)}, memory = {self.num_bytes() / (1024 * 1024):.1f}MiB, hashes = {self.num_hashes}, "
+                f"fill = {fill:.1%}, false positive rate = {fill ** self.num_hashes:.2e}")
+
+    def close(self):
+        '''共有メモリを解放する。'''
+        if self.shm is not None:
+            del self.bits
+            self.shm.close()
+            if self.shm_owner_pid == os.getpid():
+                self.shm.unlink()
+            self.shm = None
+
+    def __getstate__(self):
+        if self.shm is None:
+            raise ValueError("only a shared PositionBloomFilter can be passed to another process.")
+        return (self.num_bits, self.num_hashes, self.shm.name, self.shm_owner_pid)
+
+    def __setstate__(self, state):
+        self.num_bits, self.num_hashes, shm_name, self.shm_owner_pid = state
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.bits = np.ndarray((self.num_bytes(),), dtype=np.uint8, buffer=self.shm.buf)
+        self.lock = Lock()
+        self.lookups = 0
+        self.hits = 0
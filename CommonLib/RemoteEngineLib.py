@@ -0,0 +1,457 @@
+"""
+リモートPC上の複数のUSIエンジンを、1本のSSH接続(またはTCP接続)に多重化して使うためのライブラリ。
+
+エンジンのpathに"ssh host engine.bat"と書くと、エンジン1つごとにsshのprocessが起動する。
+1台のPCで32個エンジンを動かすと32本のSSHセッションになり、暗号化とスケジューリングの
+負荷が馬鹿にならない。そこで、リモート側ではagentを1つだけ起動して、そこから必要な数のエンジンを起動し、
+それぞれのUSIの入出力をフレームに包んで1本の入出力に多重化する。
+
+リモート側 :
+    python RemoteEngineLib.py agent [--listen PORT] engine_path [engine_args...]
+
+    --listenを指定しなければ標準入出力で、指定すればTCPで通信する。
+
+ローカル側 :
+    エンジンのpathに"mux "から始まる文字列を書く。"mux "のあとはagentを起動するコマンドか、
+    "tcp://host:port"。同じ文字列のエンジンはすべて1本の接続を共有する。
+
+    "mux ssh -o ServerAliveInterval=15 9950b python RemoteEngineLib.py agent suisho10.bat"
+    "mux tcp://9950b:4091"
+
+フレーム形式 :
+    header(7 bytes) = type(uint8) channel(uint16) length(uint32)  ※ little endian
+    そのあとにlength bytesのpayloadが続く。
+
+    FRAME_OPEN  ローカル → agent : channelのエンジンを起動する。payloadなし。
+    FRAME_DATA  双方向          : USIの入出力。payloadはUTF-8の文字列(改行込み)
+    FRAME_CLOSE ローカル → agent : channelのエンジンを終了させる。payloadなし。
+    FRAME_EXIT  agent → ローカル : channelのエンジンが終了した。payloadは終了コード(10進文字列)
+
+    channelはローカル側が割り当てる。EXITを受け取ったchannelは、次のOPENで使い回す。
+"""
+
+import argparse
+import os
+import queue
+import socket
+import struct
+import subprocess
+import sys
+import time
+from threading import Event, Lock, Thread
+from typing import BinaryIO
+
+# ============================================================
+#                         定数
+# ============================================================
+
+FRAME_OPEN  = 1
+FRAME_DATA  = 2
+FRAME_CLOSE = 3
+FRAME_EXIT  = 4
+
+FRAME_HEADER = struct.Struct("<BHI")
+
+# channelはuint16なので、同時に使えるchannelはこの数まで。
+MUX_CHANNEL_COUNT = 1 << 16
+
+# engineのpathがこのprefixで始まるなら、多重化された接続を使う。
+MUX_PATH_PREFIX = "mux "
+
+# 接続が切れたときのchannelの終了コード
+MUX_DISCONNECTED_RETURN_CODE = -1
+
+# ============================================================
+#                         frame
+# ============================================================
+
+def read_exact(reader:BinaryIO, size:int)->bytes|None:
+    ''' size bytes読む。途中でEOFになったらNoneを返す。 '''
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = reader.read(size - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(reader:BinaryIO)->tuple[int, int, bytes]|None:
+    ''' 1フレーム読む。EOFならNoneを返す。 '''
+    header = read_exact(reader, FRAME_HEADER.size)
+    if header is None:
+        return None
+    frame_type, channel, length = FRAME_HEADER.unpack(header)
+    payload = read_exact(reader, length) if length else b""
+    if payload is None:
+        return None
+    return frame_type, channel, payload
+
+
+class FrameWriter:
+    ''' 複数スレッドからフレームを書き出すためのwriter。 '''
+
+    def __init__(self, writer:BinaryIO):
+        self.writer = writer
+        self.lock = Lock()
+
+    def write(self, frame_type:int, channel:int, payload:bytes = b""):
+        with self.lock:
+            self.writer.write(FRAME_HEADER.pack(frame_type, channel, len(payload)) + payload)
+            self.writer.flush()
+
+
+# ============================================================
+#                      agent(リモート側)
+# ============================================================
+
+def start_engine_process(engine_command:list[str])->subprocess.Popen:
+    ''' エンジンを起動する。実行ファイルのあるフォルダをworking directoryにする。 '''
+    path = engine_command[0]
+    working_directory = None
+    if os.path.isfile(path):
+        path = os.path.abspath(os.path.normpath(path))
+        working_directory = os.path.dirname(path)
+
+    return subprocess.Popen([path] + engine_command[1:], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        cwd=working_directory)
+
+
+def run_agent(engine_command:list[str], reader:BinaryIO, writer:BinaryIO):
+    '''
+    readerからフレームを読み、channelごとにエンジンを起動してUSIの入出力を中継する。
+    readerがEOFになったら、起動したエンジンをすべて終了させて返る。
+    '''
+    frame_writer = FrameWriter(writer)
+    engines : dict[int, subprocess.Popen] = {}
+
+    def relay_output(channel:int, engine:subprocess.Popen):
+        # エンジンの出力は1行ずつDATAフレームにして送る。
+        try:
+            for line in engine.stdout: # type:ignore
+                frame_writer.write(FRAME_DATA, channel, line)
+        except Exception:
+            pass
+        return_code = engine.wait()
+        try:
+            frame_writer.write(FRAME_EXIT, channel, str(return_code).encode("ascii"))
+        except Exception:
+            pass
+
+    try:
+        while True:
+            frame = read_frame(reader)
+            if frame is None:
+                break
+            frame_type, channel, payload = frame
+
+            if frame_type == FRAME_OPEN:
+                try:
+                    engine = start_engine_process(engine_command)
+                except Exception as e:
+                    print(f"failed to start engine : {type(e).__name__}{e}", file=sys.stderr)
+                    frame_writer.write(FRAME_EXIT, channel, str(MUX_DISCONNECTED_RETURN_CODE).encode("ascii"))
+                    continue
+                engines[channel] = engine
+                Thread(target=relay_output, args=(channel, engine), daemon=True).start()
+
+            elif frame_type == FRAME_DATA:
+                engine = engines.get(channel)
+                if engine is None or engine.poll() is not None:
+                    continue
+                try:
+                    engine.stdin.write(payload) # type:ignore
+                    engine.stdin.flush()        # type:ignore
+                except OSError:
+                    # エンジンが落ちている。EXITはrelay_output側で送られる。
+                    pass
+
+            elif frame_type == FRAME_CLOSE:
+                engine = engines.pop(channel, None)
+                if engine is not None and engine.poll() is None:
+                    engine.kill()
+    finally:
+        for engine in engines.values():
+            if engine.poll() is None:
+                engine.kill()
+
+
+def agent_main(args:argparse.Namespace):
+    if not args.engine:
+        raise SystemExit("engine path is required.")
+
+    if args.listen is None:
+        run_agent(args.engine, sys.stdin.buffer, sys.stdout.buffer)
+        return
+
+    # TCPで待ち受ける。接続が切れたら、次の接続を待つ。
+    with socket.create_server(("", args.listen)) as server:
+        print(f"RemoteEngine agent is listening on port {args.listen}", file=sys.stderr)
+        while True:
+            conn, addr = server.accept()
+            print(f"connected from {addr}", file=sys.stderr)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with conn, conn.makefile("rb") as reader, conn.makefile("wb") as writer:
+                run_agent(args.engine, reader, writer) # type:ignore
+            print(f"disconnected from {addr}", file=sys.stderr)
+
+
+# ============================================================
+#                      proxy(ローカル側)
+# ============================================================
+
+class RemoteEngineStdin:
+    ''' subprocess.Popen.stdinの代わり。flush()でDATAフレームとして送る。 '''
+
+    def __init__(self, process:"RemoteEngineProcess"):
+        self.process = process
+        self.buffer : list[str] = []
+
+    def write(self, text:str):
+        self.buffer.append(text)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        text = "".join(self.buffer)
+        self.buffer.clear()
+        self.process.send_data(text.encode("utf-8"))
+
+
+class RemoteEngineStdout:
+    ''' subprocess.Popen.stdoutの代わり。エンジンが終了したあとは空文字列を返す。 '''
+
+    def __init__(self):
+        self.lines : queue.Queue[str|None] = queue.Queue()
+        self.pending = ""
+        self.eof = False
+
+    def feed(self, text:str):
+        self.pending += text
+        while True:
+            pos = self.pending.find("\n")
+            if pos == -1:
+                break
+            self.lines.put(self.pending[:pos + 1])
+            self.pending = self.pending[pos + 1:]
+
+    def feed_eof(self):
+        if self.pending:
+            self.lines.put(self.pending)
+            self.pending = ""
+        self.lines.put(None)
+
+    def readline(self)->str:
+        if self.eof:
+            return ""
+        line = self.lines.get()
+        if line is None:
+            self.eof = True
+            return ""
+        return line
+
+
+class RemoteEngineProcess:
+    '''
+    多重化された接続上の1エンジン。
+    Engineクラスから使う範囲で、subprocess.Popenと同じように振る舞う。
+    '''
+
+    def __init__(self, mux:"RemoteEngineMux", channel:int):
+        self.mux = mux
+        self.channel = channel
+        self.stdin = RemoteEngineStdin(self)
+        self.stdout = RemoteEngineStdout()
+        self.returncode : int|None = None
+        self.exited = Event()
+
+    def send_data(self, payload:bytes):
+        if self.returncode is not None:
+            raise BrokenPipeError(f"remote engine is terminated. channel = {self.channel}")
+        self.mux.send(FRAME_DATA, self.channel, payload)
+
+    def on_exit(self, return_code:int):
+        if self.returncode is not None:
+            return
+        self.returncode = return_code
+        self.stdout.feed_eof()
+        self.exited.set()
+
+    def poll(self)->int|None:
+        return self.returncode
+
+    def wait(self, timeout:float|None = None)->int:
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(f"remote engine channel {self.channel}", timeout) # type:ignore
+        return self.returncode # type:ignore
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                self.mux.send(FRAME_CLOSE, self.channel)
+            except Exception:
+                self.on_exit(MUX_DISCONNECTED_RETURN_CODE)
+
+    terminate = kill
+
+
+class RemoteEngineMux:
+    '''
+    agentとの1本の接続。open()するたびにagent側でエンジンを1つ起動する。
+    command : agentを起動するコマンド、または"tcp://host:port"
+    '''
+
+    def __init__(self, command:str):
+        self.command = command
+        self.lock = Lock()
+        self.channels : dict[int, RemoteEngineProcess] = {}
+        self.next_channel = 0
+        # EXITを受け取って空いたchannel
+        self.free_channels : list[int] = []
+        self.closed = False
+        self.process : subprocess.Popen|None = None
+
+        if command.startswith("tcp://"):
+            host, port = command[len("tcp://"):].rsplit(":", 1)
+            self.socket = socket.create_connection((host, int(port)))
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader : BinaryIO = self.socket.makefile("rb") # type:ignore
+            writer : BinaryIO = self.socket.makefile("wb") # type:ignore
+        else:
+            # sshの時と同じく、コマンドはlistで渡す。
+            self.process = subprocess.Popen(command.split(), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            reader = self.process.stdout # type:ignore
+            writer = self.process.stdin  # type:ignore
+
+        self.reader = reader
+        self.writer = FrameWriter(writer)
+        Thread(target=self.receive_worker, daemon=True).start()
+
+    def open(self)->RemoteEngineProcess:
+        ''' agent側でエンジンを1つ起動して、そのprocessの代わりになるobjectを返す。 '''
+        with self.lock:
+            if self.closed:
+                raise Exception(f"remote engine connection is closed. command = {self.command}")
+            if self.free_channels:
+                channel = self.free_channels.pop()
+            elif self.next_channel < MUX_CHANNEL_COUNT:
+                channel = self.next_channel
+                self.next_channel += 1
+            else:
+                raise Exception(f"no free remote engine channel. {MUX_CHANNEL_COUNT} engines are running. command = {self.command}")
+            process = RemoteEngineProcess(self, channel)
+            self.channels[channel] = process
+        self.send(FRAME_OPEN, channel)
+        return process
+
+    def send(self, frame_type:int, channel:int, payload:bytes = b""):
+        self.writer.write(frame_type, channel, payload)
+
+    def receive_worker(self):
+        try:
+            while True:
+                frame = read_frame(self.reader)
+                if frame is None:
+                    break
+                frame_type, channel, payload = frame
+                with self.lock:
+                    process = self.channels.get(channel)
+                if process is None:
+                    continue
+
+                if frame_type == FRAME_DATA:
+                    process.stdout.feed(payload.decode("utf-8", errors="replace"))
+                elif frame_type == FRAME_EXIT:
+                    # agent側ではこのchannelのエンジンはもう終了しているので、使い回してよい。
+                    with self.lock:
+                        self.channels.pop(channel, None)
+                        self.free_channels.append(channel)
+                    process.on_exit(int(payload.decode("ascii")))
+        except Exception:
+            pass
+
+        # 接続が切れたので、すべてのchannelを終了扱いにする。
+        with self.lock:
+            self.closed = True
+            processes = list(self.channels.values())
+            self.channels.clear()
+        for process in processes:
+            process.on_exit(MUX_DISCONNECTED_RETURN_CODE)
+        with MUX_LOCK:
+            if MUXES.get(self.command) is self:
+                del MUXES[self.command]
+
+
+# command → 接続
+MUXES : dict[str, RemoteEngineMux] = {}
+MUX_LOCK = Lock()
+
+def is_mux_path(path:str)->bool:
+    return path.startswith(MUX_PATH_PREFIX)
+
+def open_remote_engine(path:str)->RemoteEngineProcess:
+    '''
+    "mux ..."形式のエンジンのpathから、agent上のエンジンを1つ起動する。
+    同じpathなら1本の接続を共有する。接続が切れていたら接続し直す。
+    '''
+    command = path[len(MUX_PATH_PREFIX):].strip()
+    with MUX_LOCK:
+        mux = MUXES.get(command)
+        if mux is None or mux.closed:
+            mux = RemoteEngineMux(command)
+            MUXES[command] = mux
+    return mux.open()
+
+
+# ============================================================
+#                         main
+# ============================================================
+
+def bench_main(args:argparse.Namespace):
+    '''
+    ローカルでagentをsubprocessとして起動し、N個のエンジンにisreadyを往復させて時間を計る。
+    動作確認用。
+    '''
+    path = MUX_PATH_PREFIX + f"{sys.executable} {os.path.abspath(__file__)} agent " + " ".join(args.engine)
+    start_time = time.time()
+    engines = [open_remote_engine(path) for _ in range(args.n)]
+    for i in range(args.round):
+        for engine in engines:
+            engine.stdin.write("isready\n")
+            engine.stdin.flush()
+        for engine in engines:
+            while engine.stdout.readline().strip() != "readyok":
+                if engine.poll() is not None:
+                    raise Exception(f"engine is terminated. channel = {engine.channel}")
+    elapsed = time.time() - start_time
+    print(f"engines = {args.n}, round = {args.round}, elapsed = {elapsed:.3f}s")
+    for engine in engines:
+        engine.stdin.write("quit\n")
+        engine.stdin.flush()
+    for engine in engines:
+        engine.wait(timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="USIエンジンの入出力を1本の接続に多重化する")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    agent = sub.add_parser("agent", help="リモート側でエンジンを起動して中継する")
+    agent.add_argument("--listen", type=int, default=None, help="TCPで待ち受けるport。省略時は標準入出力。")
+    agent.add_argument("engine", nargs=argparse.REMAINDER, help="起動するエンジンのpathと引数")
+
+    bench = sub.add_parser("bench", help="ローカルでagentを起動して、多重化した接続の動作確認をする")
+    bench.add_argument("-n", type=int, default=32, help="起動するエンジンの数")
+    bench.add_argument("--round", type=int, default=100, help="isreadyを往復させる回数")
+    bench.add_argument("engine", nargs=argparse.REMAINDER, help="起動するエンジンのpathと引数")
+
+    args = parser.parse_args()
+    if args.command == "agent":
+        agent_main(args)
+    else:
+        bench_main(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,17 @@
 import os
+import re
 import random
 import datetime
 import math
-from threading import Lock
+import time
+from threading import Condition, Lock, Thread
 import subprocess
 
 import numpy as np
-from typing import Any
+from typing import Any, Callable
+
+from RemoteEngineLib import is_mux_path, open_remote_engine
+from MetricsLib import METRICS
 
 # ============================================================
 #                         type alias
@@ -156,6 +161,12 @@ def flipped_move(move:Move)->Move:
         return f"{move[0]}*{FLIP[move[2]]}{FLIP[move[3]]}{move[4:]}"
     return f"{FLIP[move[0]]}{FLIP[move[1]]}{FLIP[move[2]]}{FLIP[move[3]]}{move[4:]}"
 
+# flipped_sfen()で、手駒の末尾から後手の手駒として読み飛ばす文字
+WHITE_HAND_CHARS = "0123456789plnsgbr"
+
+# flipped_sfen()で、盤面を逆順にしたときに駒名のあとに来てしまった成りの'+'
+PROMOTED_PIECE_AFTER_FLIP = re.compile(r'(.)\+')
+
 def flipped_sfen(sfen:str)->Sfen:
     """
     与えられたsfen文字列をflipしたsfen文字列にする。
@@ -164,26 +175,44 @@ def flipped_sfen(sfen:str)->Sfen:
     """
 
     # 余分なものを除去
-    sfen = trim_sfen(sfen)
     # 手数は含まれていない。手駒はなしなら"-"だから、常にあるはず。
-    sfen_board, turn, hands= sfen.split()
+    sfen_board, turn, hands = trim_sfen(sfen).split()
+    return flipped_sfen_fields(sfen_board, turn, hands)
+
+def flipped_sfen_fields(sfen_board:str, turn:str, hands:str)->Sfen:
+    """
+    sfenの盤面、手番、手駒の3つの文字列から、flipしたsfen文字列を作る。
+    定跡の局面を探すたびに呼び出されるので、文字単位のloopを用いずにstrのmethodだけで行う。
+    """
     # 逆順にして大文字小文字を入れ替えるだけ。
-    # ただし成り駒は'+'が駒名の前につく。逆順にしているので、'+b' になるべきところが 'b+'になってしまう。
-    # そこで、逆順にしたあと、"b+"を"+b"に修正する。
-    # 逆順にする前にやるとboard[i]を見てboard[i+1]とswapすると、次のループでまたそれがswapされてまずい。
-    l = list(sfen_board[::-1].swapcase())
-    for i in range(1, len(l)):
-        if l[i] == '+':
-            l[i], l[i - 1] = l[i - 1], l[i]
-    sfen_board = ''.join(l)
-    # 手駒は後ろから見ていき、最初に大文字になるところをmとして、そこで区切って入れ替えてswapcase
-    # Finding the index 'm' from the end where the first uppercase letter appears
-    m = next((i for i in range(len(hands) - 1, -1, -1) if hands[i].isupper()), -1)
-    hands = (hands[m+1:] + hands[:m+1]).swapcase()
+    # ただし成り駒は'+'が駒名の前につく。逆順にしているので、'+b' になるべきところが 'B+'になってしまう。
+    # そこで、逆順にしたあと、"B+"を"+B"に修正する。
+    sfen_board = sfen_board[::-1].swapcase()
+    if '+' in sfen_board:
+        sfen_board = PROMOTED_PIECE_AFTER_FLIP.sub(r'+\1', sfen_board)
+    # 手駒は先手の分(大文字)のあとに後手の分(小文字)が並んでいるので、末尾の後手の分を先頭に移してswapcase
+    black_hands = hands.rstrip(WHITE_HAND_CHARS)
+    hands = (hands[len(black_hands):] + black_hands).swapcase()
     # 手番は反転
     turn = 'w' if turn == 'b' else 'b'
 
-    return f"{sfen_board} {turn} {hands}" 
+    return f"{sfen_board} {turn} {hands}"
+
+def canonical_sfen(sfen:str)->tuple[Sfen, bool]:
+    """
+    局面と、それをflipした局面で共通のkeyにするsfenを返す。
+    flipすると手番が入れ替わるので、先手番のほうをkeyにする。
+    戻り値は(key, sfenが後手番でflipしたか)。
+    定跡の局面を探すたびに呼び出されるので、trim_sfen()を経由せずにsplit()1回で済ませる。
+    """
+    s = sfen.split()
+    if s[0] == 'sfen':
+        del s[0]
+    sfen_board, turn, hands = s[0], s[1], s[2]
+    if turn == 'b':
+        return f"{sfen_board} b {hands}", False
+    return flipped_sfen_fields(sfen_board, turn, hands), True
+
 
 def is_black_sfen(sfen:Sfen)->bool:
     """
@@ -317,6 +346,9 @@ class Engine:
         # スレッドID
         self.thread_id = thread_id
 
+        # METRICSにエンジンごとの集計として記録するときのlabel。Noneならエンジンごとには集計しない。
+        self.metrics_label : str | None = None
+
         # 異常時に原因調査できるよう、直近のUSI入出力だけを保持する。
         self.engine_path = engine_path
         self.engine_io_log : list[str] = []
@@ -328,9 +360,17 @@ class Engine:
         # 現在探索中のsfen
         self.search_sfen = ""
 
+        # 送信済みのsetoption。エンジンを差し替えたときに同じ設定を送り直すために保持する。
+        # option名 → setoptionコマンド
+        self.usi_options : dict[str, str] = {}
+
         # 思考エンジンのprocessの起動。
         # sshしたいなら、pathに"ssh 2698a suisho6"のようなsshコマンドを書いておけば良い。
-        if path.startswith("ssh"):
+        # "mux "から始まるpathなら、リモート側のagentとの1本の接続を複数のエンジンで共有する。(RemoteEngineLib.py参照)
+        if is_mux_path(path):
+            self.engine = open_remote_engine(path)
+
+        elif path.startswith("ssh"):
             # この場合、コマンドはlistで渡してやらないといけないらしい。
             self.engine = subprocess.Popen(path.split(), stdin=subprocess.PIPE,
                                                 stdout=subprocess.PIPE,
@@ -378,6 +418,28 @@ class Engine:
         self.engine.stdin.write(command+"\n") # type:ignore
         self.engine.stdin.flush()             # type:ignore
 
+        record_usi_option(self.usi_options, command)
+
+    def apply_usi_options(self, usi_options:dict[str, str]):
+        ''' 別のエンジンに送信済みだったsetoptionをすべて送り直す。isreadyは呼び出し元で行う。 '''
+        for command in usi_options.values():
+            self.send_usi(command)
+
+    def is_process_alive(self)->bool:
+        ''' エンジンのprocessが生きているか。 '''
+        return self.engine.poll() is None
+
+    def close(self):
+        ''' エンジンにquitを送って終了させる。終了しなければkillする。 '''
+        try:
+            if self.is_process_alive():
+                self.send_usi("quit")
+                self.engine.wait(timeout=5)
+        except Exception:
+            pass
+        if self.is_process_alive():
+            self.engine.kill()
+
     def receive_usi(self)->str:
         ''' 思考エンジンから1行もらう。改行は取り除いて返す。'''
         mes = self.engine.stdout.readline().strip() # type:ignore
@@ -446,11 +508,13 @@ class Engine:
         '''
 
         # "position"コマンドを思考エンジンに送信する。
+        go_start = time.perf_counter()
         self.search_sfen = sfen
         self.send_usi(f"position {sfen}")
 
         # "go"コマンドを思考エンジンに送信する。
         self.send_usi(f"go nodes {nodes}")
+        searched_nodes = 0
 
         # "bestmove"は必ず返ってくるはずなのでそれを待つ。
         # 読み筋(PV)の初手と最終的な評価値とbestmoveをparseして返す。
@@ -474,6 +538,7 @@ class Engine:
                     log_path = self.dump_engine_io_log("bestmove_before_eval")
                     suffix = f" Engine log saved: {log_path}" if log_path else ""
                     raise Exception(f"Error! : bestmove received before eval.{suffix}")
+                self.record_go_metrics(go_start, searched_nodes)
                 return bestmove , besteval
             else:
                 # 読み筋に対して、そのpvの初手を蓄積していく。
@@ -485,9 +550,8 @@ class Engine:
                     continue
 
                 idx = index_of(rets,"nodes")
-                nodes = 0
                 if idx != -1:
-                    nodes = int(rets[idx+1])
+                    searched_nodes = int(rets[idx+1])
 
                 idx = index_of(rets,'score')
                 if idx != -1:
@@ -515,6 +579,7 @@ class Engine:
         評価値は手番側から見たもの。score mate Nはmate_score - Nへ写像する。
         '''
 
+        go_start = time.perf_counter()
         self.search_sfen = sfen
         self.send_usi(f"position {sfen}")
         self.send_usi(f"go nodes {nodes}")
@@ -522,6 +587,7 @@ class Engine:
         bestmove : Move = ""
         besteval : Eval | None = None
         multipv_infos : dict[int, tuple[Move, Eval]] = {}
+        searched_nodes = 0
 
         while True:
             ret = self.receive_usi()
@@ -539,11 +605,16 @@ class Engine:
                     suffix = f" Engine log saved: {log_path}" if log_path else ""
                     raise Exception(f"Error! : bestmove received before eval.{suffix}")
                 candidates = [multipv_infos[k] for k in sorted(multipv_infos)]
+                self.record_go_metrics(go_start, searched_nodes)
                 return bestmove, besteval, candidates
 
             if not rets or rets[0] != 'info':
                 continue
 
+            nodes_idx = index_of(rets, 'nodes')
+            if nodes_idx != -1 and nodes_idx + 1 < len(rets) and rets[nodes_idx + 1].isdigit():
+                searched_nodes = int(rets[nodes_idx + 1])
+
             score_idx = index_of(rets, 'score')
             if score_idx != -1 and score_idx + 2 < len(rets):
                 score = evalstr_to_int(rets[score_idx + 1], rets[score_idx + 2], mate_score)
@@ -562,10 +633,163 @@ class Engine:
                     first_move = rets[pv_idx + 1]
                     multipv_infos[multipv] = (first_move, score)
     
+    def record_go_metrics(self, go_start:float, searched_nodes:int):
+        '''
+        1回の探索の時間(positionを送ってからbestmoveを受け取るまで)と探索ノード数をMETRICSに記録する。
+        engine.nodesの秒あたりの増加量が、全エンジンを合わせたnpsになる。
+        metrics_labelが設定されていれば、そのエンジンごとにも集計する。
+        '''
+        labels = () if self.metrics_label is None else (self.metrics_label,)
+        METRICS.observe("engine.go", time.perf_counter() - go_start, go_start, labels)
+        METRICS.count("engine.nodes", searched_nodes, labels)
+
     def raise_exception(self, error_message:str):
         ''' 例外を発生させる。エンジンの詳細を出力する。'''
         raise Exception(f"{error_message} , search_sfen : {self.search_sfen}")
 
+def record_usi_option(usi_options:dict[str, str], command:str):
+    """
+    "setoption name X value Y"を送信したときに、option名Xをkeyとしてコマンドを記録する。
+    エンジンを差し替えたときに同じsetoptionを送り直すために用いる。
+    """
+    tokens = command.split()
+    if len(tokens) < 3 or tokens[0] != "setoption" or tokens[1] != "name":
+        return
+    name_end = index_of(tokens, "value")
+    if name_end == -1:
+        name_end = len(tokens)
+    name = " ".join(tokens[2:name_end])
+    if name:
+        usi_options[name] = command
+
+
+class EngineSupervisor:
+    """
+    エンジンのprocessが落ちたときの差し替え用に、readyokまで済ませた(評価関数読み込み済みの)
+    予備エンジンをkeyごとにspare_count個ずつ起動しておく。
+
+    launcher(key)は、readyokまで待ったエンジンを返す関数。keyは通常、エンジンのpath。
+    予備エンジンを1つ取り出すと、バックグラウンドで1つ補充する。
+    spare_count == 0 なら予備は持たず、acquire()の時にその場で起動する。
+    """
+
+    def __init__(self, launcher:Callable[[str], Any], spare_count:int):
+        self.launcher = launcher
+        self.spare_count = max(0, spare_count)
+
+        # key → 起動済みの予備エンジン
+        self.spares : dict[str, list[Any]] = {}
+        # key → 起動中の予備エンジンの数
+        self.pending : dict[str, int] = {}
+        self.condition = Condition()
+        self.quit = False
+
+        # 統計情報
+        self.restart_count = 0
+        self.launch_count = 0
+        self.launch_failures = 0
+        self.eval_load_seconds = 0.0
+
+    def record_eval_load(self, seconds:float):
+        ''' エンジン起動からreadyokまでにかかった時間を記録する。 '''
+        with self.condition:
+            self.launch_count += 1
+            self.eval_load_seconds += seconds
+
+    def launch(self, key:str)->Any:
+        ''' エンジンを1つ起動してreadyokまで待つ。かかった時間を評価関数の読み込み時間として記録する。 '''
+        start_time = time.time()
+        try:
+            engine = self.launcher(key)
+        except Exception:
+            with self.condition:
+                self.launch_failures += 1
+            raise
+        self.record_eval_load(time.time() - start_time)
+        return engine
+
+    def prepare(self, key:str):
+        ''' keyの予備エンジンがspare_count個になるように、足りない分の起動を開始する。 '''
+        with self.condition:
+            if self.quit:
+                return
+            shortage = self.spare_count - len(self.spares.get(key, [])) - self.pending.get(key, 0)
+            if shortage <= 0:
+                return
+            self.pending[key] = self.pending.get(key, 0) + shortage
+
+        for _ in range(shortage):
+            Thread(target=self._launch_spare, args=(key,), daemon=True).start()
+
+    def _launch_spare(self, key:str):
+        engine = None
+        try:
+            engine = self.launch(key)
+        except Exception as e:
+            print_log(f"[EngineSupervisor] failed to launch a spare engine, key = {key} : {type(e).__name__}{e}")
+        with self.condition:
+            self.pending[key] -= 1
+            if engine is not None and not self.quit:
+                self.spares.setdefault(key, []).append(engine)
+                engine = None
+            self.condition.notify_all()
+        # 終了処理が始まっていたら、起動したエンジンは使わないので終了させる。
+        if engine is not None:
+            engine.close()
+
+    def acquire(self, key:str)->Any:
+        '''
+        死んだエンジンの代わりとなるエンジンを返す。
+        予備エンジンがあればそれを返す。なければ起動中の予備を待つか、その場で起動する。
+        '''
+        engine = None
+        with self.condition:
+            while not self.quit:
+                spares = self.spares.get(key)
+                if spares:
+                    engine = spares.pop()
+                    break
+                if self.pending.get(key, 0) == 0:
+                    break
+                self.condition.wait()
+            self.restart_count += 1
+
+        if engine is None:
+            engine = self.launch(key)
+
+        # 使った分を補充しておく。
+        self.prepare(key)
+        return engine
+
+    def stats(self)->dict[str, Any]:
+        with self.condition:
+            return {
+                "restarts"          : self.restart_count,
+                "spares"            : sum(len(x) for x in self.spares.values()),
+                "pending"           : sum(self.pending.values()),
+                "launches"          : self.launch_count,
+                "launch_failures"   : self.launch_failures,
+                "eval_load_seconds" : self.eval_load_seconds,
+            }
+
+    def stats_text(self)->str:
+        s = self.stats()
+        average = s["eval_load_seconds"] / s["launches"] if s["launches"] else 0.0
+        return (f"restarts = {s['restarts']}, spares = {s['spares']}, pending = {s['pending']}, "
+                f"launches = {s['launches']}, launch_failures = {s['launch_failures']}, "
+                f"eval_load = {s['eval_load_seconds']:.1f}s (avg {average:.1f}s)")
+
+    def close(self):
+        ''' 予備エンジンをすべて終了させる。 '''
+        with self.condition:
+            self.quit = True
+            engines = [engine for spares in self.spares.values() for engine in spares]
+            self.spares.clear()
+            self.condition.notify_all()
+        for engine in engines:
+            engine.close()
+
+
 # ============================================================
 #                      cshogi wrapper
 # ============================================================
@@ -899,8 +1123,9 @@ class KifWriter:
         """
         1つの対局棋譜を書き出す。
         📝 GameDataEncoder.get_bytes()で得られたbytearrayを渡す。
+        他のスレッドの書き出しを待った時間は、METRICSにidle.write_lockとして記録する。
         """
-        with self.lock:
+        with METRICS.locked(self.lock, "idle.write_lock"):
             self.kif_file.write(game_data.data)
             self.kif_file.flush()
 
@@ -919,6 +1144,7 @@ class Hcpe3Writer:
     HCPE3保存用クラス。
 
     複数の対局スレッドから呼ばれるので、1局分の書き出し全体をlockで保護する。
+    lockを待った時間は、METRICSにidle.write_lockとして記録する。
     """
     def __init__(self, nodes:int):
         self.hcpe3_filename = f'hcpe3/hcpe3_{make_time_stamp()}_{nodes}.hcpe3'
@@ -935,7 +1161,7 @@ class Hcpe3Writer:
         if not game_data.is_valid():
             return
 
-        with self.lock:
+        with METRICS.locked(self.lock, "idle.write_lock"):
             start_hcp = game_data.start_hcp
             if start_hcp is None:
                 return
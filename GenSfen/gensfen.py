@@ -2,8 +2,15 @@ import time
 import json5
 import traceback
 import random
+import math
 import threading
+import multiprocessing
+import queue
 import sys
+import json
+import mmap
+import struct
+import numpy as np
 from pathlib import Path
 from tqdm import tqdm
 import cshogi
@@ -14,6 +21,10 @@ COMMON_LIB_DIR = Path(__file__).resolve().parents[1] / "CommonLib"
 sys.path.insert(0, str(COMMON_LIB_DIR))
 
 from YaneShogiLib import *
+from AdjudicationLib import *
+from PositionFilterLib import PositionBloomFilter
+from MetricsLib import METRICS
+from YaneuraOuBookLib import BookProbe, open_book_probe
 
 # ============================================================
 #                             定数
@@ -28,8 +39,293 @@ SETTING_JSON_PATH          = "settings/gensfen-settings.json5"
 # プログレスバーのフォーマット
 BAR_FORMAT = "{desc:<15}: {percentage:3.0f}%|{bar:40}| {n_fmt}/{total_fmt}"
 
+# 対局processから開始局面を取り出すときのtimeout[s]。この間隔で終了要求を確認する。
+PROCESS_QUEUE_TIMEOUT      = 1.0
+
+# 開始局面ファイルの行offsetのindex(sidecar file)
+STARTPOS_INDEX_EXTENSION   = ".idx"
+STARTPOS_INDEX_MAGIC       = b"SFENIDX1"
+# magic, 開始局面ファイルのsize, 開始局面ファイルの更新時刻[ns], 行数
+STARTPOS_INDEX_HEADER      = struct.Struct("<8sQQQ")
+# indexを作るときに一度に読み込むbyte数
+STARTPOS_INDEX_CHUNK_SIZE  = 64 * 1024 * 1024
+
+# 開始局面をいくつ取り出すごとにcheckpointを保存するか。
+STARTPOS_CHECKPOINT_INTERVAL = 1000
+
+# 何局ごとに終局判定(adjudication)の集計を出力するか。
+ADJUDICATION_REPORT_INTERVAL = 1000
+
+# 開始局面をいくつ取り出すごとに、局面の重複判定用のfilterを保存するか。
+POSITION_FILTER_SAVE_INTERVAL = 1000
+
 # ============================================================
 
+# ============================================================
+#                     開始局面のsampling
+# ============================================================
+
+def build_startpos_index(file_path:str, index_path:str):
+    '''
+    開始局面ファイルの空行以外の行の先頭offsetを列挙して、index_pathに書き出す。
+    index = header + uint64のoffset × 行数
+    '''
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    temp_path = index_path + ".tmp"
+
+    print_log(f"\nbuilding startpos index, PATH = {index_path}")
+
+    line_count = 0
+    with open(file_path, "rb") as fb, open(temp_path, "wb") as fw:
+        # 行数は最後に書き直す。
+        fw.write(STARTPOS_INDEX_HEADER.pack(STARTPOS_INDEX_MAGIC, file_size, stat.st_mtime_ns, 0))
+
+        pbar = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"{'Index Sfens':<12}", ncols=80, bar_format=BAR_FORMAT)
+
+        # 次に読むchunkの先頭の、ファイル先頭からのoffset
+        base = 0
+        # 前のchunkから続いている行の先頭offset
+        line_start = 0
+        # 前のchunkの最後の1文字
+        prev_last_byte = 0
+
+        while True:
+            chunk = fb.read(STARTPOS_INDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            data = np.frombuffer(chunk, dtype=np.uint8)
+
+            # 行末(改行)の位置と、それぞれの行の先頭offset
+            ends = np.flatnonzero(data == 0x0a).astype(np.uint64) + np.uint64(base)
+            starts = np.concatenate(([np.uint64(line_start)], ends[:-1] + np.uint64(1))).astype(np.uint64) if len(ends) else np.empty(0, dtype=np.uint64)
+
+            # 空行("\n"か"\r\n"だけの行)は除く。
+            lengths = ends - starts
+            keep = lengths > 1
+            cr_only = (lengths == 1)
+            if cr_only.any():
+                # 1文字だけの行の、その文字のchunk内での位置。
+                # -1なら前のchunkの最後の1文字。
+                cr_positions = starts[cr_only].astype(np.int64) - base
+                cr_bytes = np.where(cr_positions >= 0, data[np.maximum(cr_positions, 0)], prev_last_byte)
+                keep[np.flatnonzero(cr_only)] = cr_bytes != 0x0d
+            starts[keep].tofile(fw)
+            line_count += int(keep.sum())
+
+            if len(ends):
+                line_start = int(ends[-1]) + 1
+            base += len(chunk)
+            prev_last_byte = chunk[-1]
+            pbar.update(len(chunk))
+
+        # 改行で終わっていない最後の行
+        if line_start < file_size:
+            fb.seek(line_start)
+            if fb.read().strip():
+                np.array([line_start], dtype=np.uint64).tofile(fw)
+                line_count += 1
+
+        pbar.close()
+
+        fw.seek(0)
+        fw.write(STARTPOS_INDEX_HEADER.pack(STARTPOS_INDEX_MAGIC, file_size, stat.st_mtime_ns, line_count))
+
+    os.replace(temp_path, index_path)
+    print_log(f"..indexed {line_count} startpos sfens.")
+
+
+def read_startpos_index_header(index_path:str)->tuple[int, int, int] | None:
+    '''indexのheaderを読んで(ファイルsize, 更新時刻, 行数)を返す。indexとして読めなければNone。'''
+    try:
+        with open(index_path, "rb") as f:
+            header = f.read(STARTPOS_INDEX_HEADER.size)
+    except OSError:
+        return None
+    if len(header) != STARTPOS_INDEX_HEADER.size:
+        return None
+    magic, file_size, mtime_ns, line_count = STARTPOS_INDEX_HEADER.unpack(header)
+    if magic != STARTPOS_INDEX_MAGIC:
+        return None
+    if os.path.getsize(index_path) != STARTPOS_INDEX_HEADER.size + line_count * 8:
+        return None
+    return file_size, mtime_ns, line_count
+
+
+def splitmix64(x:int)->int:
+    x = (x + 0x9e3779b97f4a7c15) & 0xffffffffffffffff
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return x ^ (x >> 31)
+
+
+class QuitRequested(Exception):
+    """終了が要求されたので、対局を中断するときの例外"""
+
+
+class FeistelPermutation:
+    '''
+    [0, n)の上の、keyで決まる疑似ランダムな置換。
+    置換表を持たずに、i番目の値をO(1)で求める。(Feistel構造 + cycle walking)
+    '''
+    ROUNDS = 4
+
+    def __init__(self, n:int, key:int):
+        self.n = n
+        # 2^(2*half_bits) >= n となる最小のhalf_bits
+        half_bits = 1
+        while (1 << (2 * half_bits)) < n:
+            half_bits += 1
+        self.half_bits = half_bits
+        self.mask = (1 << half_bits) - 1
+        self.round_keys = [splitmix64(key * self.ROUNDS + r) for r in range(self.ROUNDS)]
+
+    def encrypt(self, x:int)->int:
+        left, right = x >> self.half_bits, x & self.mask
+        for round_key in self.round_keys:
+            left, right = right, left ^ (splitmix64(right ^ round_key) & self.mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, i:int)->int:
+        # 値域は4^half_bits < 4n なので、範囲外になったら範囲内に入るまで置換を繰り返す。
+        x = self.encrypt(i)
+        while x >= self.n:
+            x = self.encrypt(x)
+        return x
+
+
+class StartposSampler:
+    '''
+    開始局面ファイルから、ランダムな順番で開始局面を取り出す。
+
+    ファイル全体を読み込んでshuffleする代わりに、
+      - 空行以外の行の先頭offsetのindexをsidecar file(開始局面ファイル + ".idx")として一度だけ作る。
+      - 開始局面ファイルとindexはmmapして、取り出すときにその1行だけを読む。
+      - 順番は(seed, epoch)から決まる置換で決める。1周(epoch)ごとに異なる順番になる。
+    (seed, epoch, position)をcheckpointに保存しておけば、再起動しても続きから取り出せる。
+    '''
+
+    def __init__(self, file_path:str, checkpoint_path:str, seed:int | None):
+        self.file_path = file_path
+        self.checkpoint_path = checkpoint_path
+        index_path = file_path + STARTPOS_INDEX_EXTENSION
+
+        stat = os.stat(file_path)
+        header = read_startpos_index_header(index_path)
+        if header is None or header[0] != stat.st_size or header[1] != stat.st_mtime_ns:
+            build_startpos_index(file_path, index_path)
+            header = read_startpos_index_header(index_path)
+            if header is None:
+                raise Exception(f"failed to build startpos index. PATH = {index_path}")
+
+        self.line_count = header[2]
+        if self.line_count == 0:
+            raise Exception("No startpos sfens loaded.")
+
+        self.offsets = np.memmap(index_path, dtype=np.uint64, mode="r", offset=STARTPOS_INDEX_HEADER.size, shape=(self.line_count,))
+        self.file = open(file_path, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # checkpointがあれば、その続きから。
+        self.seed = seed if seed is not None else random.getrandbits(63)
+        self.epoch = 0
+        self.position = 0
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("file_size") == stat.st_size and checkpoint.get("line_count") == self.line_count:
+                self.seed     = int(checkpoint["seed"])
+                self.epoch    = int(checkpoint["epoch"])
+                self.position = int(checkpoint["position"])
+                print_log(f"resume startpos sampling from checkpoint, epoch = {self.epoch}, position = {self.position}/{self.line_count}")
+            else:
+                print_log(f"startpos file has changed. checkpoint is ignored. PATH = {checkpoint_path}")
+
+        self.permutation = FeistelPermutation(self.line_count, splitmix64(self.seed) ^ self.epoch)
+
+        # エンジンが落ちて、対局し直す開始局面
+        self.requeued : list[str] = []
+
+        # 最後にcheckpointを保存してから取り出した数
+        self.count_since_checkpoint = 0
+
+        print_log(f"..{self.line_count} startpos sfens, seed = {self.seed}")
+
+    def read_line(self, line_no:int)->str:
+        start = int(self.offsets[line_no])
+        end = self.mm.find(b"\n", start)
+        if end == -1:
+            end = len(self.mm)
+        return self.mm[start:end].decode("utf-8").strip()
+
+    def next(self)->str:
+        if self.requeued:
+            return self.requeued.pop()
+
+        if self.position >= self.line_count:
+            # 1周したので、次のepochの置換にする。
+            self.epoch += 1
+            self.position = 0
+            self.permutation = FeistelPermutation(self.line_count, splitmix64(self.seed) ^ self.epoch)
+
+        line_no = self.permutation[self.position]
+        self.position += 1
+
+        self.count_since_checkpoint += 1
+        if self.count_since_checkpoint >= STARTPOS_CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+
+        return self.read_line(line_no)
+
+    def requeue(self, sfen:str):
+        self.requeued.append(sfen)
+
+    def save_checkpoint(self):
+        '''現在のepochとpositionを保存する。'''
+        self.count_since_checkpoint = 0
+        checkpoint = {
+            "seed"       : self.seed,
+            "epoch"      : self.epoch,
+            "position"   : self.position,
+            "file_size"  : os.path.getsize(self.file_path),
+            "line_count" : self.line_count,
+        }
+        mkdir(self.checkpoint_path)
+        temp_path = self.checkpoint_path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+# ============================================================
+
+class BookStats:
+    '''定跡で探索を省略した集計。複数の対局スレッドから呼び出される。'''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.probes = 0
+        self.hits = 0
+
+    def record_probe(self, hit:bool):
+        with self.lock:
+            self.probes += 1
+            if hit:
+                self.hits += 1
+
+    def summary_text(self, seconds_per_ply:float)->str:
+        '''seconds_per_ply : エンジンの1手あたりの平均探索時間。省略できた時間の見積もりに用いる。'''
+        with self.lock:
+            hit_rate = self.hits / self.probes if self.probes else 0.0
+            return (f"probes = {self.probes}, hits = {self.hits} ({hit_rate:.1%}), "
+                    f"saved engine time = {self.hits * seconds_per_ply:.1f}s ({seconds_per_ply:.3f}s/ply)")
+
+
+def make_teacher_writer(output_format:str, nodes:int):
+    '''出力形式に応じた教師の書き出しclassを生成する。'''
+    if output_format == "hcpe3":
+        return Hcpe3Writer(nodes)
+    return KifWriter(nodes)
+
 # 全対局スレッドが共通で(同じものを参照で)持っている構造体
 class SharedState:
     def __init__(self, settings):
@@ -61,11 +357,19 @@ class SharedState:
         if self.hcpe3_resign_eval is not None:
             self.hcpe3_resign_eval = int(self.hcpe3_resign_eval)
 
+        # 評価値による終局判定(adjudication)
+        self.adjudication_settings = AdjudicationSettings.from_settings(settings)
+        self.adjudication_stats = AdjudicationStats(self.max_game_ply)
+
+        # 対局を行うprocessの数。1なら従来どおり、このprocess内でスレッドを用いて対局する。
+        self.process_count = max(1, int(settings.get("PROCESS_COUNT", 1)))
+
         # 教師保存用
-        if self.output_format == "hcpe3":
-            self.teacher_writer = Hcpe3Writer(self.nodes)
+        # 複数processで対局するときは、教師はwriter processが書き出す。
+        if self.process_count > 1:
+            self.teacher_writer = None
         else:
-            self.teacher_writer = KifWriter(self.nodes)
+            self.teacher_writer = make_teacher_writer(self.output_format, self.nodes)
         self.kif_writer = self.teacher_writer
         
         # # 対局開始局面(互角局面集から読み込む)
@@ -74,50 +378,117 @@ class SharedState:
         # エンジン設定
         self.engine_settings = settings["ENGINE_SETTING"]
 
-        # 対局開始局面の集合
-        self.startpos_sfens : list[str] = []
+        # エンジンが落ちたときの差し替え用に、エンジンのpathごとに起動しておく予備エンジンの数。
+        self.spare_engines = max(0, int(settings.get("SPARE_ENGINES", 0)))
+        self.engine_supervisor = EngineSupervisor(lambda path: Engine(path, -1), self.spare_engines)
+
+        # 対局開始局面のsampler。最初に開始局面を取り出すときに生成する。
+        self.startpos_sampler : StartposSampler | None = None
         self.startpos_lock = Lock()
 
+        # 開始局面を取り出す順番を決めるseedと、その続きを保存しておくcheckpointのpath。
+        self.startpos_seed = settings.get("START_SFENS_SEED", None)
+        self.startpos_checkpoint_path = settings.get("START_SFENS_CHECKPOINT_PATH", settings["START_SFENS_PATH"] + ".checkpoint.json")
+
+        # 書き出した局面の重複判定用のBloom filter。POSITION_FILTER_PATHを指定したときだけ用いる。
+        # 対局開始前にopen_position_filter()で読み込む。
+        self.position_filter_path = settings.get("POSITION_FILTER_PATH", None)
+        self.position_filter_capacity = int(settings.get("POSITION_FILTER_CAPACITY", 10_000_000))
+        self.position_filter_false_positive_rate = float(settings.get("POSITION_FILTER_FALSE_POSITIVE_RATE", 0.001))
+        self.position_filter_max_skip_plies = max(0, int(settings.get("POSITION_FILTER_MAX_SKIP_PLIES", 16)))
+        self.position_filter : PositionBloomFilter | None = None
+        self.position_filter_save_count = 0
+        # 開始局面が生成済みだったので、ランダムな指し手で進めた手数
+        self.skipped_plies = 0
+
+        # 定跡(.ybb/.db)。序盤は定跡にある局面ならエンジンで探索せずに定跡の指し手を指す。
+        #   BOOK_RECORD = "eval" : 定跡の指し手と評価値を教師として記録する。
+        #   BOOK_RECORD = "skip" : 定跡の指し手は記録せず、定跡を抜けた局面から対局を始める。
+        self.book_path = settings.get("BOOK_PATH", None)
+        self.book_max_ply = int(settings.get("BOOK_MAX_PLY", 0))
+        self.book_temperature = float(settings.get("BOOK_TEMPERATURE", 100.0))
+        self.book_eval_drop_threshold = int(settings.get("BOOK_EVAL_DROP_THRESHOLD", 100))
+        self.book_record = str(settings.get("BOOK_RECORD", "eval")).lower()
+        if self.book_record not in ["eval", "skip"]:
+            raise Exception(f"Unknown BOOK_RECORD: {self.book_record}")
+        self.book_stats = BookStats()
+
+        # 計測(metrics)の書き出し先。METRICS_PATHもTRACE_PATHも指定しなければ計測しない。
+        self.metrics_path = settings.get("METRICS_PATH", None)
+        self.metrics_interval = float(settings.get("METRICS_INTERVAL", 60))
+        self.trace_path = settings.get("TRACE_PATH", None)
+        self.trace_delay = float(settings.get("TRACE_DELAY", 60))
+        self.trace_duration = float(settings.get("TRACE_DURATION", 10))
+
         # pauseの設定
         # これがTrueだと生成を一時的にpauseする。
         self.pause_event = threading.Event()
         self.pause_event.set()
 
-    def read_startpos_sfens(self)->list[str]:
-        # 対局開始局面を読み込む。
+    def start_metrics(self, trace_path_with_pid:bool = False):
+        """
+        計測を開始する。METRICS_INTERVAL秒ごとにMETRICS_PATHへJSON Linesで書き出す。
+        trace_path_with_pid : 複数processで対局するとき、processごとにtraceのファイル名にpidをつける。
+        """
 
-        file_path = self.settings["START_SFENS_PATH"]
+        if self.metrics_path is None and self.trace_path is None:
+            return
 
-        # 対局開始局面の読み込み
-        print_log(f"\nloading startpos sfens, PATH = {file_path}")
+        METRICS.configure(enabled=True)
+        if self.metrics_path is not None:
+            METRICS.start_reporter(self.metrics_path, self.metrics_interval)
+        if self.trace_path is not None:
+            trace_path = self.trace_path
+            if trace_path_with_pid:
+                root, ext = os.path.splitext(trace_path)
+                trace_path = f"{root}.{os.getpid()}{ext}"
+            METRICS.start_trace(trace_path, self.trace_delay, self.trace_duration)
 
-        # ファイルサイズを取得して、進捗を出力する。
-        file_size = os.path.getsize(file_path)
-        startpos_sfens = []
+    def open_position_filter(self, shared_memory:bool = False):
+        """
+        局面の重複判定用のfilterを読み込む。ファイルがなければ新しく作る。
+        shared_memory : 複数processで対局するときはTrue。filterを共有メモリに置く。
+        """
 
-        # ★ 進捗の出力のためにtell()を使いたいので、テキストではなくバイナリで開く
-        with open(file_path, "rb") as fb:
-            pbar = tqdm(total=file_size, unit='B', unit_scale=True, desc=f"{'Read Sfens':<12}", ncols=80, bar_format=BAR_FORMAT)
+        if self.position_filter_path is None or self.position_filter is not None:
+            return
 
-            for raw_line in fb:  # raw_line は bytes
-                pos = fb.tell()
-                pbar.update(pos - pbar.n)
+        self.position_filter = PositionBloomFilter.load_or_create(
+            self.position_filter_path,
+            self.position_filter_capacity,
+            self.position_filter_false_positive_rate,
+            shared_memory,
+        )
+        print_log(f"[PositionFilter] PATH = {self.position_filter_path}, {self.position_filter.stats_text()}")
 
-                line = raw_line.decode("utf-8").strip()
-                if line:
-                    startpos_sfens.append(line)
+    def save_position_filter(self):
+        """局面の重複判定用のfilterを保存する。"""
 
-            pbar.close()
+        if self.position_filter is None:
+            return
+        self.position_filter.save(self.position_filter_path) # type:ignore
+        print_log(f"[PositionFilter] saved, skipped plies = {self.skipped_plies}, {self.position_filter.stats_text()}")
 
-        print_log("\n..random shuffling")
-        random.shuffle(startpos_sfens)
+    def close_position_filter(self):
+        """filterを保存して、共有メモリを解放する。"""
 
-        print_log(f"..loaded {len(startpos_sfens)} startpos sfens.")
-        if not startpos_sfens:
-            raise Exception("No startpos sfens loaded.")
+        if self.position_filter is None:
+            return
+        self.save_position_filter()
+        self.position_filter.close()
+        self.position_filter = None
 
-        return startpos_sfens
+    def open_startpos_sampler(self)->StartposSampler:
+        """
+        開始局面のsamplerを生成する。(初回はindexを作るので時間がかかる)
+        startpos_lockを取得してから呼び出すこと。
+        """
 
+        if self.startpos_sampler is None:
+            file_path = self.settings["START_SFENS_PATH"]
+            print_log(f"\nloading startpos sfens, PATH = {file_path}")
+            self.startpos_sampler = StartposSampler(file_path, self.startpos_checkpoint_path, self.startpos_seed)
+        return self.startpos_sampler
 
     def get_next_startpos_sfen(self) -> str:
         """
@@ -125,14 +496,32 @@ class SharedState:
         position文字列が返る。
         """
 
+        # 他の対局スレッドが開始局面を取り出し終えるのを待った時間を記録する。
+        with METRICS.locked(self.startpos_lock, "idle.startpos_lock"):
+            sfen = self.open_startpos_sampler().next()
+            self.position_filter_save_count += 1
+            save_position_filter = self.position_filter_save_count % POSITION_FILTER_SAVE_INTERVAL == 0
+
+        # 保存は開始局面のlockの外で行う。
+        if save_position_filter:
+            self.save_position_filter()
+        return sfen
+
+    def requeue_startpos_sfen(self, sfen:str):
+        """
+        エンジンが落ちて対局が中断された開始局面を戻す。
+        次にget_next_startpos_sfen()を呼び出したときに、この局面から対局し直す。
+        """
+
         with self.startpos_lock:
-            if not self.startpos_sfens:
-                self.startpos_sfens = self.read_startpos_sfens()
+            self.open_startpos_sampler().requeue(sfen)
 
-            # ひとつpopして返す。
-            sfen = self.startpos_sfens.pop()
+    def save_startpos_checkpoint(self):
+        """開始局面をどこまで取り出したかを保存する。"""
 
-            return sfen
+        with self.startpos_lock:
+            if self.startpos_sampler is not None:
+                self.startpos_sampler.save_checkpoint()
 
 
 class EngineSettings:
@@ -152,6 +541,10 @@ class EngineSettings:
         # スレッドid
         self.thread_id : int = 0
 
+    def metrics_label(self)->str:
+        """METRICSでエンジンごとに集計するときのlabel。同じ名前のエンジンを複数起動しても区別できるようにthread_idをつける。"""
+        return f"{self.engine_name}#{self.thread_id}"
+
 
 class ShogiMatch:
     """
@@ -161,17 +554,67 @@ class ShogiMatch:
 
         self.engine_settings = [engine1, engine2]
         self.shared  = shared
-        self.engines = [Engine(engine1.engine_path,engine1.thread_id), Engine(engine2.engine_path,engine2.thread_id)] 
+        self.engines = [self.launch_engine(engine1), self.launch_engine(engine2)]
 
         for engine in self.engines:
             engine.send_usi(f"setoption name MultiPV value {self.shared.multipv}")
             engine.isready()
 
+        # 対局中の開始局面。エンジンが落ちたときに、この局面から対局し直すために保持する。
+        self.startpos_sfen : str | None = None
+
+        # 直前の探索でbestmoveを受け取った時刻。次の探索までのPython側の処理時間の計測用。
+        self.last_bestmove_time : float | None = None
+
+        # 各エンジンが直前の探索でbestmoveを受け取った時刻。次の探索までそのエンジンが遊んでいた時間の計測用。
+        self.engine_idle_start : list[float | None] = [None, None]
+
+        # METRICSに記録するときのlabel。対局全体の計測は両方のエンジンのlabelで記録する。
+        # (同じエンジン設定同士の対局ならlabelは1つ)
+        self.metrics_labels = tuple(dict.fromkeys(engine_setting.metrics_label() for engine_setting in self.engine_settings))
+
+        # 定跡。ファイルの読み込み位置を持つので、対局スレッドごとに開く。
+        self.book_probe : BookProbe | None = open_book_probe(shared.book_path) if shared.book_path else None
+
         self.quit = False
 
         # 対局スレッド
         self.match_thread = None
 
+    def launch_engine(self, engine_setting:EngineSettings)->Engine:
+        """エンジンを起動する。評価関数の読み込み時間はsupervisorに記録される。"""
+
+        engine = self.shared.engine_supervisor.launch(engine_setting.engine_path)
+        engine.thread_id = engine_setting.thread_id
+        engine.metrics_label = engine_setting.metrics_label()
+        return engine
+
+    def replace_dead_engines(self)->bool:
+        """
+        落ちているエンジンを予備エンジンと差し替える。
+        差し替えたエンジンには、落ちたエンジンに送っていたsetoptionを送り直す。
+        落ちているエンジンがなければFalseを返す。
+        """
+
+        replaced = False
+        for i, engine in enumerate(self.engines):
+            if engine.is_process_alive():
+                continue
+
+            engine_setting = self.engine_settings[i]
+            new_engine = self.shared.engine_supervisor.acquire(engine_setting.engine_path)
+            new_engine.thread_id = engine_setting.thread_id
+            new_engine.metrics_label = engine_setting.metrics_label()
+            new_engine.apply_usi_options(engine.usi_options)
+            new_engine.isready()
+            self.engines[i] = new_engine
+            replaced = True
+
+            print_log(f"[EngineSupervisor] engine restarted, name = {engine_setting.engine_name}, thread_id = {engine_setting.thread_id}, "
+                      f"return code = {engine.engine.poll()}, {self.shared.engine_supervisor.stats_text()}")
+
+        return replaced
+
     def start(self):
         """対局スレッドを開始させる"""
 
@@ -184,16 +627,37 @@ class ShogiMatch:
         # 対局開始
         # print_log(f"Game start between {self.engine_settings[0].engine_name} and {self.engine_settings[1].engine_name}")
 
-        try:
-            while True:
+        while not self.quit:
+            try:
                 # 対局処理1回分。
-                kif = self.start_game()
-                self.shared.teacher_writer.write_game(kif)
+                with METRICS.timer("match.game", self.metrics_labels):
+                    kif = self.start_game()
+
+                # 書き出し(他のスレッドの書き出しのlock待ちを含む。lock待ちだけはidle.write_lockにも記録される)
+                with METRICS.timer("match.write_game", self.metrics_labels):
+                    self.shared.teacher_writer.write_game(kif)
+                METRICS.count("games", 1, self.metrics_labels)
+                METRICS.count("positions", kif.position_num, self.metrics_labels)
+                self.startpos_sfen = None
+
+            except Exception as e:
+                # quitするときの例外ではないならそれを出力する。
+                if self.quit or isinstance(e, QuitRequested):
+                    break
+
+                # エンジンが落ちたのであれば、予備エンジンと差し替えて、
+                # 中断した対局はその開始局面から対局し直す。(途中までの棋譜は捨てる)
+                try:
+                    if self.replace_dead_engines():
+                        if self.startpos_sfen is not None:
+                            self.shared.requeue_startpos_sfen(self.startpos_sfen)
+                            self.startpos_sfen = None
+                        continue
+                except Exception as e2:
+                    print_log(f"Exception in replacing engines : {type(e2).__name__}{e2}")
 
-        except Exception as e:
-            # quitするときの例外ではないならそれを出力する。
-            if not self.quit:
                 print_log(f"Exception in game between {self.engine_settings[0].engine_name} and {self.engine_settings[1].engine_name} : {type(e).__name__}{e}\n{traceback.format_exc()}")
+                break
 
         # print_log(f"Game end between {self.engine1.engine_name} and {self.engine2.engine_name}")
 
@@ -209,10 +673,22 @@ class ShogiMatch:
 
         # 対局開始局面を取得
         try:
-            startpos_sfen = self.shared.get_next_startpos_sfen()
+            with METRICS.timer("match.startpos_wait", self.metrics_labels):
+                startpos_sfen = self.shared.get_next_startpos_sfen()
+            self.startpos_sfen = startpos_sfen
+
+            # 定跡の指し手を記録しないなら、定跡を抜けた局面から対局を始める。
+            # 生成済みの局面なら、ランダムな指し手で進めた局面から対局を始める。
+            board = board_from_position_string(startpos_sfen)
+            if self.skip_book_moves(board) + self.skip_covered_positions(board):
+                startpos_sfen = board.sfen()
+
             game_data.set_startsfen(startpos_sfen)
             board = game_data.board
 
+        except QuitRequested:
+            # 空の棋譜を返すと書き出してしまうので、そのまま対局スレッドを終了させる。
+            raise
         except Exception as e:
             print_log(f"Exception : {e}")
             return game_data
@@ -220,11 +696,20 @@ class ShogiMatch:
         # 対局前の初期化
         for engine in self.engines:
             engine.send_usi('usinewgame')
+        self.reset_idle_time()
+
+        # 評価値による終局判定
+        adjudicator = GameAdjudicator(self.shared.adjudication_settings)
+        adjudication : Adjudication | None = None
+        resigned = False
+
+        # 定跡を抜けるまではTrue。一度抜けたら定跡は調べない。
+        in_book = self.shared.book_record == "eval"
 
         while board.move_number <= self.shared.max_game_ply:
 
             # pauseの処理(手抜き)
-            self.shared.pause_event.wait()
+            self.wait_if_paused()
 
             if board.is_draw() == cshogi.REPETITION_DRAW: # type: ignore
                 # 千日手引き分け
@@ -236,13 +721,25 @@ class ShogiMatch:
             sfen = board.sfen()
 
             engine = self.engines[board.turn]  # 手番側のエンジンを取得
-            usi_move, eval_int = engine.go(sfen, self.shared.nodes)
+
+            # 定跡にある局面なら、探索せずに定跡の指し手を指す。
+            book_result = self.probe_book(board) if in_book else None
+            if book_result is not None:
+                usi_move, eval_int, _ = book_result
+            else:
+                in_book = False
+                start_time = time.time()
+                self.record_idle_time(board.turn)
+                usi_move, eval_int = engine.go(sfen, self.shared.nodes)
+                self.record_bestmove_time(board.turn)
+                self.shared.adjudication_stats.record_ply(time.time() - start_time)
 
             if usi_move == "resign":
                 # 投了
                 winner = board.turn ^ 1  # 非手番側の勝ち black=0, white=1
                 game_data.write_game_result(winner + 1)
                 game_data.write_uint8(0) # 終局理由: resign
+                resigned = True
                 break
 
             if usi_move == "win":
@@ -250,28 +747,169 @@ class ShogiMatch:
                 winner = board.turn  # 手番側の勝ち black=0, white=1
                 game_data.write_game_result(winner + 1)
                 game_data.write_uint8(10) # 終局理由: win by csa_rule24
+                resigned = True
                 break
 
             # 指し手文字列をAperyのmove16形式に変換
             move = board.move_from_usi(usi_move) & 0xffff
 
             # 棋譜データに追加
+            # (pack形式では途中の局面だけ書き出さないことはできないので、重複していても書き出す)
+            self.is_duplicate_position(board)
             game_data.write_uint16(move)
             game_data.write_eval(eval_int)
 
+            # 評価値による終局判定。この手は記録してから打ち切る。
+            adjudication = adjudicator.update(board.move_number, board.turn, eval_int)
+
             # エンジンの指し手で局面を進める
             board.push_usi(usi_move)
 
+            if adjudication is not None:
+                game_data.write_game_result(0 if adjudication.winner is None else adjudication.winner + 1)
+                game_data.write_uint8(PACK_REASONS[adjudication.reason]) # 終局理由: adjudication
+                break
+
             if self.quit:
-                raise Exception("quit requested")
+                raise QuitRequested("quit requested")
 
         else:
             # 千日手引き分け
             game_data.write_game_result(0)
             game_data.write_uint8(2) # 終局理由: draw by max moves
 
+        self.record_adjudication(adjudicator, adjudication, board.move_number, resigned)
         return game_data
 
+    def wait_if_paused(self):
+        """pause中なら再開されるまで待つ。待った時間を記録する。"""
+
+        if self.shared.pause_event.is_set():
+            return
+        with METRICS.timer("match.pause_wait", self.metrics_labels):
+            self.shared.pause_event.wait()
+        # pauseしていた時間はPython側の処理時間にもエンジンの遊んでいた時間にも含めない。
+        self.reset_idle_time()
+
+    def reset_idle_time(self):
+        """対局開始時とpause明けに、bestmoveを受け取った時刻を忘れる。"""
+
+        self.last_bestmove_time = None
+        self.engine_idle_start = [None, None]
+
+    def record_bestmove_time(self, turn:int):
+        """手番側のエンジンからbestmoveを受け取った時刻を覚えておく。"""
+
+        self.last_bestmove_time = self.engine_idle_start[turn] = time.perf_counter()
+
+    def record_idle_time(self, turn:int):
+        """
+        手番側のエンジンに次の探索を始めさせる直前に呼び出して、以下を記録する。
+        match.python : 直前の探索(どちらのエンジンでもよい)のbestmoveを受け取ってからのPython側の処理時間。
+        idle.engine  : このエンジンが前回bestmoveを返してから遊んでいた時間。相手の探索時間と定跡の指し手を含む。
+        """
+
+        now = time.perf_counter()
+        labels = (self.engine_settings[turn].metrics_label(),)
+        if self.last_bestmove_time is not None:
+            METRICS.observe("match.python", now - self.last_bestmove_time, self.last_bestmove_time, labels)
+        idle_start = self.engine_idle_start[turn]
+        if idle_start is not None:
+            METRICS.observe("idle.engine", now - idle_start, idle_start, labels)
+
+    def probe_book(self, board:cshogi.Board)->tuple[Move, Eval, list[tuple[Move, Eval]]] | None: # type:ignore
+        """
+        定跡を調べて、定跡にある局面なら(指し手, 評価値, 候補手[(指し手, 評価値), ...])を返す。なければNone。
+        指し手は、最善の評価値からBOOK_EVAL_DROP_THRESHOLD以内の候補手から、評価値をsoftmaxした確率で選ぶ。
+        """
+
+        if self.book_probe is None:
+            return None
+        if self.shared.book_max_ply > 0 and board.move_number > self.shared.book_max_ply:
+            return None
+
+        candidates : list[tuple[Move, Eval]] = []
+        for book_move in self.book_probe.probe(board.sfen()) or []:
+            try:
+                move = board.move_from_usi(book_move.move)
+            except Exception:
+                continue
+            if move and board.is_legal(move):
+                candidates.append((book_move.move, book_move.value))
+
+        self.shared.book_stats.record_probe(bool(candidates))
+        # 定跡で探索を省略できたのは手番側のエンジン
+        labels = (self.engine_settings[board.turn].metrics_label(),)
+        METRICS.count("book.probes", 1, labels)
+        if not candidates:
+            return None
+        METRICS.count("book.hits", 1, labels)
+
+        best_eval = max(value for _move, value in candidates)
+        candidates = [(move, value) for move, value in candidates if best_eval - value <= self.shared.book_eval_drop_threshold]
+
+        temperature = self.shared.book_temperature
+        if temperature <= 0:
+            usi_move, eval_int = max(candidates, key=lambda c: c[1])
+        else:
+            weights = [math.exp((value - best_eval) / temperature) for _move, value in candidates]
+            usi_move, eval_int = random.choices(candidates, weights)[0]
+        return usi_move, eval_int, candidates
+
+    def skip_book_moves(self, board:cshogi.Board)->int: # type:ignore
+        """
+        BOOK_RECORD = "skip"のとき、定跡を抜けるまで定跡の指し手で局面を進める。進めた手数を返す。
+        """
+
+        if self.shared.book_record != "skip":
+            return 0
+
+        skipped = 0
+        while board.move_number <= self.shared.max_game_ply and board.is_draw() != cshogi.REPETITION_DRAW: # type:ignore
+            book_result = self.probe_book(board)
+            if book_result is None:
+                break
+            board.push_usi(book_result[0])
+            skipped += 1
+        return skipped
+
+    def skip_covered_positions(self, board:cshogi.Board)->int: # type:ignore
+        """
+        開始局面が重複判定用のfilterに登録済み(生成済み)なら、ランダムな指し手で局面を進める。
+        進めるのは最大でPOSITION_FILTER_MAX_SKIP_PLIES手まで。進めた手数を返す。
+        """
+
+        position_filter = self.shared.position_filter
+        if position_filter is None:
+            return 0
+
+        skipped = 0
+        while skipped < self.shared.position_filter_max_skip_plies and position_filter.contains(board.zobrist_hash()):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            board.push(random.choice(moves))
+            skipped += 1
+
+        if skipped:
+            with self.shared.startpos_lock:
+                self.shared.skipped_plies += skipped
+        return skipped
+
+    def is_duplicate_position(self, board:cshogi.Board)->bool: # type:ignore
+        """局面を重複判定用のfilterに登録する。登録済みだったならTrueを返す。"""
+
+        position_filter = self.shared.position_filter
+        return position_filter is not None and position_filter.check_and_add(board.zobrist_hash())
+
+    def record_adjudication(self, adjudicator:GameAdjudicator, adjudication:Adjudication | None, end_ply:int, resigned:bool):
+        """終局判定の集計を行う。一定局数ごとに集計結果を出力する。"""
+
+        stats = self.shared.adjudication_stats
+        stats.record_game(adjudicator, adjudication, end_ply, resigned)
+        if self.shared.adjudication_settings.enabled() and stats.games % ADJUDICATION_REPORT_INTERVAL == 0:
+            print_log(f"[Adjudication] {stats.summary_text()}")
+
     def hcpe3_result_from_winner(self, winner:int)->int:
         if winner == cshogi.BLACK:
             return HCPE3_BLACK_WIN
@@ -348,20 +986,32 @@ class ShogiMatch:
         game_data = Hcpe3GameData()
 
         try:
-            startpos_sfen = self.shared.get_next_startpos_sfen()
+            with METRICS.timer("match.startpos_wait", self.metrics_labels):
+                startpos_sfen = self.shared.get_next_startpos_sfen()
+            self.startpos_sfen = startpos_sfen
             board = board_from_position_string(startpos_sfen)
+            self.skip_book_moves(board)
+            self.skip_covered_positions(board)
             game_data = Hcpe3GameData(board_to_hcp_bytes(board))
 
+        except QuitRequested:
+            raise
         except Exception as e:
             print_log(f"Exception : {e}")
             return game_data
 
         for engine in self.engines:
             engine.send_usi('usinewgame')
+        self.reset_idle_time()
+
+        adjudicator = GameAdjudicator(self.shared.adjudication_settings)
+        adjudication : Adjudication | None = None
+        resigned = False
+        in_book = self.shared.book_record == "eval"
 
         while board.move_number <= self.shared.max_game_ply:
 
-            self.shared.pause_event.wait()
+            self.wait_if_paused()
 
             if board.is_draw() == cshogi.REPETITION_DRAW: # type: ignore
                 game_data.set_result(HCPE3_DRAW, HCPE3_RESULT_REPETITION)
@@ -369,20 +1019,33 @@ class ShogiMatch:
 
             sfen = board.sfen()
             engine = self.engines[board.turn]
-            usi_move, eval_int, multipv_candidates = engine.go_multipv(
-                sfen,
-                self.shared.nodes,
-                self.shared.hcpe3_mate_score,
-            )
+
+            # 定跡にある局面なら、定跡の候補手を探索結果の代わりに用いる。
+            book_result = self.probe_book(board) if in_book else None
+            if book_result is not None:
+                usi_move, eval_int, multipv_candidates = book_result
+            else:
+                in_book = False
+                start_time = time.time()
+                self.record_idle_time(board.turn)
+                usi_move, eval_int, multipv_candidates = engine.go_multipv(
+                    sfen,
+                    self.shared.nodes,
+                    self.shared.hcpe3_mate_score,
+                )
+                self.record_bestmove_time(board.turn)
+                self.shared.adjudication_stats.record_ply(time.time() - start_time)
 
             if usi_move == "resign":
                 winner = board.turn ^ 1
                 game_data.set_result(self.hcpe3_result_from_winner(winner))
+                resigned = True
                 break
 
             if usi_move == "win":
                 winner = board.turn
                 game_data.set_result(self.hcpe3_result_from_winner(winner), HCPE3_RESULT_NYUGYOKU)
+                resigned = True
                 break
 
             try:
@@ -403,22 +1066,36 @@ class ShogiMatch:
                 eval_int,
                 multipv_candidates,
             )
+            # 生成済みの局面は、候補手なし(学習に用いない局面)として指し手だけ記録する。
+            if self.is_duplicate_position(board):
+                candidate_visits = []
             game_data.add_record(selected_move & 0xffff, selected_eval, candidate_visits)
 
+            adjudication = adjudicator.update(board.move_number, board.turn, selected_eval)
+
             mover = board.turn
             board.push_usi(usi_move)
 
             if self.shared.hcpe3_resign_eval is not None and selected_eval <= -abs(self.shared.hcpe3_resign_eval):
                 winner = mover ^ 1
                 game_data.set_result(self.hcpe3_result_from_winner(winner))
+                adjudication = None
+                resigned = True
+                break
+
+            if adjudication is not None:
+                # HCPE3には終局理由を書くところがないので、引き分けは理由のflagなしの引き分けとする。
+                # (千日手と最大手数による引き分けにはflagがつくので区別できる)
+                game_data.set_result(self.hcpe3_result_from_winner(adjudication.winner)) # type:ignore
                 break
 
             if self.quit:
-                raise Exception("quit requested")
+                raise QuitRequested("quit requested")
 
         else:
             game_data.set_result(HCPE3_DRAW, HCPE3_RESULT_MAX_MOVES)
 
+        self.record_adjudication(adjudicator, adjudication, board.move_number, resigned)
         return game_data
 
 
@@ -429,6 +1106,9 @@ class ShogiMatch:
         if self.match_thread:
             self.match_thread.join()
             self.match_thread = None
+        if self.book_probe is not None:
+            self.book_probe.close()
+            self.book_probe = None
 
 class GameMatcher:
     """
@@ -477,6 +1157,9 @@ class GameMatcher:
         # 並列対局数
         num = len(self.engine_threads)
 
+        # 重複判定用のfilterを読み込む。
+        self.shared.open_position_filter()
+
         shogi_matches = []
 
         max_instances = len(self.engine_threads)
@@ -498,6 +1181,10 @@ class GameMatcher:
 
         self.shogi_matches = shogi_matches
 
+        # 予備エンジンの起動を開始しておく。
+        for engine_path in dict.fromkeys(t.engine_path for t in self.engine_threads):
+            self.shared.engine_supervisor.prepare(engine_path)
+
         for shogi_match in self.shogi_matches:
             shogi_match.start()
 
@@ -516,6 +1203,234 @@ class GameMatcher:
         print()
 
 
+# ============================================================
+#                        multi process
+# ============================================================
+
+# 複数processで対局するときの構成
+#
+#   main process   : 開始局面を読み込んで、startpos_queueに供給する。ユーザー入力を受け付ける。
+#   対局 process   : PROCESS_COUNT個。対局(ShogiMatch)をいくつかずつ受け持ち、1局終わるごとに
+#                    その棋譜をgame_queueに送る。
+#   writer process : game_queueから棋譜を受け取り、ファイルに書き出す。
+#
+# 1局の中身は、同じ開始局面・同じエンジンの応答であればスレッドで対局したときと同じになる。
+# (ファイル内での対局の順番は、終局した順なので異なる)
+
+def serialize_game(game_data:GameDataEncoder | Hcpe3GameData)->tuple:
+    '''processをまたいで送るために、1局分の棋譜をtupleにする。cshogi.Boardは送らない。'''
+    if isinstance(game_data, Hcpe3GameData):
+        return ("hcpe3", game_data.start_hcp, game_data.records, game_data.result, game_data.position_num)
+    return ("pack", bytes(game_data.data), game_data.position_num)
+
+
+def deserialize_game(item:tuple)->GameDataEncoder | Hcpe3GameData:
+    '''serialize_game()の逆変換。'''
+    if item[0] == "hcpe3":
+        _, start_hcp, records, result, position_num = item
+        hcpe3_data = Hcpe3GameData(start_hcp)
+        hcpe3_data.records = records
+        hcpe3_data.result = result
+        hcpe3_data.position_num = position_num
+        return hcpe3_data
+
+    _, data, position_num = item
+    game_data = GameDataEncoder()
+    game_data.data = bytearray(data)
+    game_data.position_num = position_num
+    return game_data
+
+
+class GameQueueWriter:
+    '''対局processで、書き出す代わりに棋譜をwriter processへ送る。'''
+
+    def __init__(self, game_queue):
+        self.game_queue = game_queue
+
+    def write_game(self, game_data:GameDataEncoder | Hcpe3GameData):
+        if isinstance(game_data, Hcpe3GameData) and not game_data.is_valid():
+            return
+        self.game_queue.put(serialize_game(game_data))
+
+    def close(self):
+        pass
+
+
+class ProcessSharedState(SharedState):
+    '''
+    対局processで用いるSharedState。
+    開始局面はmain processから受け取り、棋譜はwriter processへ送る。
+    '''
+    def __init__(self, settings, startpos_queue, game_queue, pause_event, quit_event, position_filter):
+        super().__init__(settings)
+
+        # 重複判定用のfilterは、main processが共有メモリに読み込んだものを用いる。
+        self.position_filter = position_filter
+
+        self.startpos_queue = startpos_queue
+        # 終了時にstartpos_queueに積み直した開始局面が残っていても、processの終了を待たせない。
+        self.startpos_queue.cancel_join_thread()
+        self.quit_event = quit_event
+        self.pause_event = pause_event
+        self.teacher_writer = GameQueueWriter(game_queue)
+        self.kif_writer = self.teacher_writer
+
+    def get_next_startpos_sfen(self) -> str:
+        while True:
+            try:
+                return self.startpos_queue.get(timeout=PROCESS_QUEUE_TIMEOUT)
+            except queue.Empty:
+                if self.quit_event.is_set():
+                    raise QuitRequested("quit requested")
+
+    def requeue_startpos_sfen(self, sfen:str):
+        self.startpos_queue.put(sfen)
+
+
+def match_process_worker(settings, engine_threads:list[EngineSettings], startpos_queue, game_queue, pause_event, quit_event, position_filter):
+    '''対局processのmain。engine_threadsの対局を行い、quit_eventがsetされたら終了する。'''
+
+    shared = ProcessSharedState(settings, startpos_queue, game_queue, pause_event, quit_event, position_filter)
+    shared.start_metrics(trace_path_with_pid=True)
+    shogi_matches : list[ShogiMatch] = []
+
+    try:
+        for t in engine_threads:
+            shogi_matches.append(ShogiMatch(t, t, shared))
+
+        for engine_path in dict.fromkeys(t.engine_path for t in engine_threads):
+            shared.engine_supervisor.prepare(engine_path)
+
+        for shogi_match in shogi_matches:
+            shogi_match.start()
+
+        quit_event.wait()
+
+    except Exception as e:
+        print_log(f"Exception in match process : {type(e).__name__}{e}\n{traceback.format_exc()}")
+
+    for shogi_match in shogi_matches:
+        shogi_match.join()
+
+    stats_text = shared.engine_supervisor.stats_text()
+    shared.engine_supervisor.close()
+    if shared.engine_supervisor.restart_count:
+        print_log(f"[EngineSupervisor] pid = {os.getpid()}, {stats_text}")
+    if shared.adjudication_settings.enabled():
+        print_log(f"[Adjudication] pid = {os.getpid()}, {shared.adjudication_stats.summary_text()}")
+    if shared.position_filter is not None:
+        print_log(f"[PositionFilter] pid = {os.getpid()}, skipped plies = {shared.skipped_plies}, {shared.position_filter.stats_text()}")
+        shared.position_filter.close()
+    if shared.book_path is not None:
+        print_log(f"[Book] pid = {os.getpid()}, {shared.book_stats.summary_text(shared.adjudication_stats.seconds_per_ply())}")
+    METRICS.close()
+
+
+def game_writer_worker(output_format:str, nodes:int, game_queue):
+    '''writer processのmain。game_queueからNoneを受け取ったら終了する。'''
+
+    teacher_writer = make_teacher_writer(output_format, nodes)
+    while True:
+        item = game_queue.get()
+        if item is None:
+            break
+        teacher_writer.write_game(deserialize_game(item)) # type:ignore
+
+    print_log(f"total games written: {teacher_writer.game_count}, position_num = {teacher_writer.position_num}")
+    teacher_writer.close()
+
+
+class ProcessGameMatcher:
+    """
+    並列対局を複数processに分けて行う。GameMatcherと同じように使える。
+    """
+    def __init__(self, shared:"SharedState"):
+
+        self.shared = shared
+        self.engine_threads = GameMatcher(shared).engine_threads
+
+        # 対局を受け持つprocessの数。対局数より多くしても意味がない。
+        self.process_count = max(1, min(shared.process_count, len(self.engine_threads)))
+
+        # processをまたぐので、pauseの状態はmultiprocessing.Eventで共有する。
+        self.shared.pause_event = multiprocessing.Event()
+        self.shared.pause_event.set()
+        self.quit_event = multiprocessing.Event()
+
+        self.startpos_queue = multiprocessing.Queue(maxsize=len(self.engine_threads) * 2)
+        self.game_queue = multiprocessing.Queue()
+
+        self.writer_process : multiprocessing.Process | None = None
+        self.match_processes : list[multiprocessing.Process] = []
+        self.feeder_thread : Thread | None = None
+
+        # user_input()で対局開始済みかの判定に用いる。
+        self.shogi_matches = self.match_processes
+
+    def feed_startpos_sfens(self):
+        '''開始局面をstartpos_queueに供給し続ける。'''
+        while not self.quit_event.is_set():
+            sfen = self.shared.get_next_startpos_sfen()
+            while not self.quit_event.is_set():
+                try:
+                    self.startpos_queue.put(sfen, timeout=PROCESS_QUEUE_TIMEOUT)
+                    break
+                except queue.Full:
+                    pass
+
+    def start_games(self):
+        """writer processと対局processを起動して、すべての並列対局を開始させる"""
+
+        settings = self.shared.settings
+
+        self.writer_process = multiprocessing.Process(
+            target=game_writer_worker,
+            args=(self.shared.output_format, self.shared.nodes, self.game_queue),
+        )
+        self.writer_process.start()
+
+        # 重複判定用のfilterは共有メモリに読み込んで、各対局processから参照する。
+        self.shared.open_position_filter(shared_memory=True)
+
+        # 開始局面はここで読み込んでおく。
+        with self.shared.startpos_lock:
+            self.shared.open_startpos_sampler()
+        self.feeder_thread = Thread(target=self.feed_startpos_sfens, daemon=True)
+        self.feeder_thread.start()
+
+        # 異なるエンジン設定が偏らないように、対局をprocessに順番に割り振る。
+        groups = [self.engine_threads[i::self.process_count] for i in range(self.process_count)]
+        for group in groups:
+            process = multiprocessing.Process(
+                target=match_process_worker,
+                args=(settings, group, self.startpos_queue, self.game_queue, self.shared.pause_event, self.quit_event, self.shared.position_filter),
+            )
+            process.start()
+            self.match_processes.append(process)
+
+        print_log(f"\nAll shogi games have started in {self.process_count} processes. Please wait.")
+
+    def wait_all_threads(self):
+        """すべての対局processとwriter processの終了を待つ。"""
+
+        print_log("\nWaiting for all processes to finish...")
+
+        self.quit_event.set()
+        with tqdm(total=len(self.match_processes), desc=f"{'Join':<12}", ncols=80, bar_format=BAR_FORMAT) as pbar:
+            for process in self.match_processes:
+                process.join()
+                pbar.update()
+
+        if self.writer_process is not None:
+            self.game_queue.put(None)
+            self.writer_process.join()
+
+        # 使われなかった開始局面は捨てる。
+        self.startpos_queue.cancel_join_thread()
+
+        print()
+
+
 # ============================================================
 #                             main
 # ============================================================
@@ -539,7 +1454,7 @@ def user_input():
     shared = SharedState(settings)
 
     # 並列対局管理用
-    matcher = GameMatcher(shared)
+    matcher = ProcessGameMatcher(shared) if shared.process_count > 1 else GameMatcher(shared)
 
     while True:
         try:
@@ -558,7 +1473,14 @@ def user_input():
             elif i == 'g':
                 # まだ対局が組まれていなければ開始する。
                 if not matcher.shogi_matches:
-                    print_log(f"Start GenSfen, OUTPUT_FORMAT = {shared.output_format}, NODES = {shared.nodes}, MAX_GAME_PLY = {shared.max_game_ply}, MULTIPV = {shared.multipv}")
+                    print_log(f"Start GenSfen, OUTPUT_FORMAT = {shared.output_format}, NODES = {shared.nodes}, MAX_GAME_PLY = {shared.max_game_ply}, MULTIPV = {shared.multipv}, PROCESS_COUNT = {shared.process_count}")
+                    if shared.adjudication_settings.enabled():
+                        print_log(f"Adjudication : {shared.adjudication_settings}")
+                    if shared.book_path is not None:
+                        print_log(f"Book : PATH = {shared.book_path}, BOOK_RECORD = {shared.book_record}, BOOK_MAX_PLY = {shared.book_max_ply}, BOOK_TEMPERATURE = {shared.book_temperature}")
+                    # 複数processで対局するときは、各対局processが計測する。
+                    if shared.process_count == 1:
+                        shared.start_metrics()
                     matcher.start_games()
 
             elif i == 'q' or i == '!':
@@ -585,8 +1507,29 @@ def user_input():
     # 全スレッドの終了を待つ..
     matcher.wait_all_threads()
 
+    # 計測結果の最後の記録とtraceを書き出す。
+    METRICS.close()
+
+    # 予備エンジンを終了させる。
+    # (複数processで対局したときは、各processが終了時に出力している)
+    if shared.process_count == 1:
+        print_log(f"[EngineSupervisor] {shared.engine_supervisor.stats_text()}")
+        if shared.adjudication_settings.enabled():
+            print_log(f"[Adjudication] {shared.adjudication_stats.summary_text()}")
+        if shared.book_path is not None:
+            print_log(f"[Book] {shared.book_stats.summary_text(shared.adjudication_stats.seconds_per_ply())}")
+    shared.engine_supervisor.close()
+
+    # 開始局面をどこまで取り出したかを保存しておく。
+    shared.save_startpos_checkpoint()
+
+    # 重複判定用のfilterを保存しておく。
+    shared.close_position_filter()
+
     # 教師ファイルをclose
-    shared.teacher_writer.close()
+    # (複数processで対局したときは、writer processがcloseしている)
+    if shared.teacher_writer is not None:
+        shared.teacher_writer.close()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,23 @@
 import os
+import argparse
+import json
 import math
 import random
 import time
 import json5
+import multiprocessing
+import numpy as np
+import queue
+import secrets
+import ipaddress
 import traceback
 import sys
+from array import array
+from fnmatch import fnmatchcase
+from multiprocessing.managers import BaseManager
 from dataclasses import dataclass, field
 from pathlib import Path
-from threading import Thread
+from threading import Event, Thread
 from typing import Any
 
 COMMON_LIB_DIR = Path(__file__).resolve().parents[1] / "CommonLib"
@@ -15,6 +25,8 @@ sys.path.insert(0, str(COMMON_LIB_DIR))
 
 from YaneShogiLib import *
 from ParamLib import *
+from SprtLib import Pentanomial, Sprt
+from TrajectoryLib import TrajectoryWriter
 
 # SPSAするための対局スクリプト
 
@@ -31,6 +43,24 @@ SETTING_PATH                 = "settings/SPSA-settings.json5"
 # レート差出力は何局に1回か
 RATE_OUTPUT_INTERVAL         = 10
 
+# 対局前のhandshake(setoption, isready)の時間の出力は何局に1回か
+HANDSHAKE_OUTPUT_INTERVAL    = 100
+
+# 2局ペア(pentanomial)のElo差とSPRTの出力は何ペアに1回か
+PENTANOMIAL_OUTPUT_INTERVAL  = 10
+
+# チェックポイント(パラメーター、node倍率のスケジュールなど)の保存とtrajectoryの記録は何ペアに1回か
+CHECKPOINT_INTERVAL          = 100
+
+# 以前の版で既定値だったauthkey。公開されているので、このauthkeyではパラメーターサーバーを起動しない。
+INSECURE_PARAM_SERVER_AUTHKEY = "yaneuraou-spsa"
+
+# 勝敗履歴のファイルへの保存は何局に1回か
+WIN_HISTORY_SAVE_INTERVAL    = 100
+
+# 勝敗履歴の累積数を何局ごとに持つか
+RESULT_CHECKPOINT_INTERVAL   = 64
+
 # 熱温度。パラメーターの移動のしやすさ。勾配を加算するときの係数。
 # 大きな値(10～200)から、徐々に1.0に近づけていく。
 # 'm'コマンドでこの値を変更できる。
@@ -53,24 +83,85 @@ RESULT_TABLE_COLS            = 4
 #                         Game Match
 # ============================================================
 
+class ResultHistory:
+    '''
+    1つの分類の勝敗履歴。
+    RESULT_CHECKPOINT_INTERVAL局ごとに先頭からの勝敗の累積数を持っているので、
+    直近n局の勝敗数は、累積数の差と端数(RESULT_CHECKPOINT_INTERVAL局未満)を数えるだけで求まる。
+    '''
+
+    def __init__(self, results:bytes = b""):
+        # 勝ったプレイヤーの履歴 0..player0の勝ち、1..player1の勝ち、2..draw。1局1byte。
+        self.results = bytearray()
+
+        # counts[winner][k] = 先頭からk * RESULT_CHECKPOINT_INTERVAL局までの、winnerの回数
+        self.counts = [array('I', [0]) for _ in range(3)]
+
+        for winner in results:
+            self.append(winner)
+
+    def __len__(self)->int:
+        return len(self.results)
+
+    def append(self, winner:int):
+        self.results.append(winner)
+        if len(self.results) % RESULT_CHECKPOINT_INTERVAL == 0:
+            block = self.results[-RESULT_CHECKPOINT_INTERVAL:]
+            for w, counts in enumerate(self.counts):
+                counts.append(counts[-1] + block.count(w))
+
+    def count_until(self, i:int, winner:int)->int:
+        '''先頭からi局目まで(i局目は含まない)のwinnerの回数'''
+        k = i // RESULT_CHECKPOINT_INTERVAL
+        return self.counts[winner][k] + self.results.count(winner, k * RESULT_CHECKPOINT_INTERVAL, i)
+
+    def last(self, n:int)->tuple[int, int, int]:
+        '''直近n局の(player1の勝ち, 引き分け, player0の勝ち)の回数'''
+        end = len(self.results)
+        start = max(0, end - n)
+        win  = self.count_until(end, 1) - self.count_until(start, 1)
+        draw = self.count_until(end, 2) - self.count_until(start, 2)
+        lose = self.count_until(end, 0) - self.count_until(start, 0)
+        return win, draw, lose
+
+
 class WinManager:
     def __init__(self):
-        # 勝ったプレイヤーの履歴 0..player0の勝ち、1..player1の勝ち、2..draw。
-        self.win_count : list[int] = []
+        # 全対局の勝敗履歴。
+        self.win_count = ResultHistory()
 
         # 基準エンジンごとの勝敗履歴。
-        self.win_count_by_opponent : dict[str, list[int]] = {}
+        self.win_count_by_opponent : dict[str, ResultHistory] = {}
 
         # node倍率ごとの勝敗履歴。
-        self.win_count_by_node_multiplier : dict[str, list[int]] = {}
+        self.win_count_by_node_multiplier : dict[str, ResultHistory] = {}
 
         # 基準エンジン × node倍率ごとの勝敗履歴。
-        self.win_count_by_opponent_and_node_multiplier : dict[str, list[int]] = {}
+        self.win_count_by_opponent_and_node_multiplier : dict[str, ResultHistory] = {}
+
+        # +C, -Cで手番を入れ替えて指した2局ペアの得点の分布。(SPSA対象エンジンから見た得点)
+        self.pentanomial = Pentanomial()
+
+        # SPRTによる打ち切り。Noneなら行わない。
+        self.sprt : Sprt | None = None
+        # SPRTでH0かH1が採択された回数。(採択されるたびにSPRTはやり直す)
+        self.sprt_conclusions = 0
 
         # ↑を書き換える時のlock
         self.lock = Lock()
 
-    def build_summary(self, results:list[int])->str:
+        # 勝敗履歴の保存先。Noneなら保存しない。
+        #   history_path            : pentanomial、SPRTの途中経過など、大きさが対局数によらないもの。(毎回書き直す)
+        #   history_path + ".games" : 1局1行の(勝者, 基準エンジン, node倍率)。前回の保存以降の対局だけを追記する。
+        self.history_path : str | None = None
+
+        # まだファイルに追記していない対局。(勝者, 基準エンジン, node倍率)
+        self.unsaved_games : list[tuple[int, str, str]] = []
+
+        # ファイルへの書き出しを直列化するlock。(追記の順番が入れ替わらないように)
+        self.write_lock = Lock()
+
+    def build_summary(self, results:ResultHistory)->str:
         summary = []
 
         # 直近nの勝率、レート差などを出力。
@@ -78,9 +169,8 @@ class WinManager:
         while len(results) >= n:
             # n が RATE_OUTPUT_INTERVAL × 2^m である
 
-            win  = results[-n:].count(1) # player 1の勝利回数
-            lose = results[-n:].count(0) # player 0の勝利回数
-            draw = results[-n:].count(2)
+            # win : player 1の勝利回数, lose : player 0の勝利回数
+            win, draw, lose = results.last(n)
 
             if win + lose == 0:
                 win_rate = "?"
@@ -107,17 +197,24 @@ class WinManager:
         summary.reverse()
         return ' | '.join(summary[:RESULT_TABLE_COLS])
 
+    def append_result(self, winner:int, opponent_name:str, node_multiplier_name:str):
+        # 1局の結果を各分類の勝敗履歴に追加する。lockを取ってから呼び出すこと。
+        self.win_count.append(winner)
+        opponent_results = self.win_count_by_opponent.setdefault(opponent_name, ResultHistory())
+        opponent_results.append(winner)
+        node_results = self.win_count_by_node_multiplier.setdefault(node_multiplier_name, ResultHistory())
+        node_results.append(winner)
+        opponent_node_name = f"{opponent_name} node x{node_multiplier_name}"
+        opponent_node_results = self.win_count_by_opponent_and_node_multiplier.setdefault(opponent_node_name, ResultHistory())
+        opponent_node_results.append(winner)
+
     def update(self, winner:int, opponent_name:str, node_multiplier:float):
+        save_history = False
         with self.lock:
-            self.win_count.append(winner)
-            opponent_results = self.win_count_by_opponent.setdefault(opponent_name, [])
-            opponent_results.append(winner)
             node_multiplier_name = format_node_multiplier(node_multiplier)
-            node_results = self.win_count_by_node_multiplier.setdefault(node_multiplier_name, [])
-            node_results.append(winner)
-            opponent_node_name = f"{opponent_name} node x{node_multiplier_name}"
-            opponent_node_results = self.win_count_by_opponent_and_node_multiplier.setdefault(opponent_node_name, [])
-            opponent_node_results.append(winner)
+            self.append_result(winner, opponent_name, node_multiplier_name)
+            if self.history_path is not None:
+                self.unsaved_games.append((winner, opponent_name, node_multiplier_name))
 
             # 途中経過の表示用に勝敗を1文字で出力してやる。
             # print("LWD"[winner], end="")
@@ -146,6 +243,251 @@ class WinManager:
                         continue
                     print_log(f"{total} : {name} : {len(results)} games : {self.build_summary(results)}")
 
+            save_history = self.history_path is not None and total % WIN_HISTORY_SAVE_INTERVAL == 0
+
+        # ファイルへの書き出しは、他の対局スレッドを待たせないようにlockの外で行う。
+        if save_history:
+            self.write_history()
+
+    def update_pair(self, winner1:int, winner2:int)->tuple[str | None, int]:
+        '''
+        2局ペアの結果を記録して、(SPRTの結果, 総ペア数)を返す。
+        SPRTでH0かH1が採択されたら"H0"/"H1"。そのときSPRTは最初からやり直す。
+        '''
+        # 勝ったプレイヤー(0, 1, 2:draw)を、SPSA対象エンジン(player 1)の得点にする。
+        winner_to_score = [0.0, 1.0, 0.5]
+        score1 = winner_to_score[winner1]
+        score2 = winner_to_score[winner2]
+
+        result = None
+        with self.lock:
+            self.pentanomial.add(score1, score2)
+            pairs = self.pentanomial.pairs()
+
+            if self.sprt is not None:
+                result = self.sprt.add(score1, score2)
+                if result is not None:
+                    print_log(f"[SPRT] {result} accepted : {self.sprt.summary_text()}")
+                    self.sprt.reset()
+                    self.sprt_conclusions += 1
+
+            if pairs % PENTANOMIAL_OUTPUT_INTERVAL == 0:
+                print_log(f"[Pentanomial] {self.pentanomial.summary_text()}")
+                if self.sprt is not None:
+                    print_log(f"[SPRT] {self.sprt.summary_text()}")
+
+        return result, pairs
+
+    def snapshot(self)->tuple[dict[str, Any], list[tuple[int, str, str]]]:
+        # 保存用に、(対局数によらない集計, 前回の保存以降の対局)を取り出す。lockを取ってから呼び出すこと。
+        games, self.unsaved_games = self.unsaved_games, []
+        summary = {
+            "games"            : len(self.win_count),
+            "pentanomial"      : self.pentanomial.counts,
+            "sprt_pentanomial" : self.sprt.pentanomial.counts if self.sprt is not None else None,
+            "sprt_conclusions" : self.sprt_conclusions,
+        }
+        return summary, games
+
+    def write_history(self):
+        # 勝敗履歴をファイルに書き出す。
+        # 対局は前回の保存以降の分だけを追記するので、書き出しにかかる時間は対局数が増えても変わらない。
+        # 集計の方は、書きかけのファイルが残らないように、一時ファイルに書いてから置き換える。
+        if self.history_path is None:
+            return
+
+        with self.write_lock:
+            with self.lock:
+                summary, games = self.snapshot()
+
+            if games:
+                with open(self.history_path + ".games", "a", encoding="utf-8") as f:
+                    f.write("".join(f"{winner}\t{opponent_name}\t{node_multiplier_name}\n"
+                                    for winner, opponent_name, node_multiplier_name in games))
+
+            tmp_path = self.history_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False)
+            os.replace(tmp_path, self.history_path)
+
+    def read_history(self, path:str, resume:bool):
+        # 勝敗履歴の保存先を設定して、前回までの勝敗履歴があれば読み込む。
+        # pentanomialとSPRTの途中経過は、resume(RESUMEでチェックポイントから再開する)のときだけ読み込む。
+        # そうでなければ0から数え直す。(学習率のスケジュールやSPRTが前回の実行の分まで進んだ状態で始まらないように)
+        self.history_path = path
+
+        games_path = path + ".games"
+        if os.path.exists(games_path):
+            with open(games_path, "r", encoding="utf-8", newline="\n") as f:
+                text = f.read()
+            # 書き出しの途中で終了していたら、書きかけの最後の行は捨てる。(続きを追記できるようにファイルからも取り除く)
+            complete = text.rfind("\n") + 1
+            if complete < len(text):
+                with open(games_path, "r+b") as f:
+                    f.truncate(len(text[:complete].encode("utf-8")))
+            with self.lock:
+                for line in text[:complete].splitlines():
+                    winner, opponent_name, node_multiplier_name = line.split("\t")
+                    self.append_result(int(winner), opponent_name, node_multiplier_name)
+
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                history = json.load(f)
+            with self.lock:
+                self.pentanomial = Pentanomial(history.get("pentanomial", None))
+                if self.sprt is not None and history.get("sprt_pentanomial", None) is not None:
+                    self.sprt.pentanomial = Pentanomial(history["sprt_pentanomial"])
+                self.sprt_conclusions = int(history.get("sprt_conclusions", 0))
+
+        if len(self.win_count) > 0:
+            print_log(f"read win history: {path}, {len(self.win_count)} games")
+
+class ParamVector:
+    '''
+    SPSAで変異させるパラメーターの値、最小値、最大値、step、deltaと、使うかどうかをnumpy配列で持つ。
+    パラメーターファイルへの書き出しは、store()でEntryのvに書き戻してから行う。
+    '''
+
+    def __init__(self, params:list[Entry]):
+        self.v     = np.array([param.v     for param in params], dtype=np.float64)
+        self.min   = np.array([param.min   for param in params], dtype=np.float64)
+        self.max   = np.array([param.max   for param in params], dtype=np.float64)
+        self.step  = np.array([param.step  for param in params], dtype=np.float64)
+        self.delta = np.array([param.delta for param in params], dtype=np.float64)
+        # 未使用パラメーターはFalse。値を変化させない。
+        self.used  = np.array([not param.not_used for param in params], dtype=bool)
+
+    def __len__(self)->int:
+        return len(self.v)
+
+    def store(self, params:list[Entry]):
+        '''現在の値をEntryのvに書き戻す。'''
+        for param, v in zip(params, self.v.tolist()):
+            param.v = v
+
+class CheckpointManager:
+    '''
+    一定ペア数ごとに、チェックポイント(パラメーター、node倍率のスケジュール、乱数の状態など)を保存して、
+    パラメーターの推移をtrajectoryファイルに追記する。
+    対局スレッドは状態を取り出すだけで、ファイルへの書き込みはbackgroundのthreadで行う。
+    '''
+
+    def __init__(self, shared:"SharedState", checkpoint_path:str | None, trajectory_path:str | None, interval:int):
+        self.shared = shared
+        self.checkpoint_path = checkpoint_path
+        self.interval = interval
+        self.trajectory = TrajectoryWriter(trajectory_path, [param.name for param in shared.parameters]) \
+            if trajectory_path else None
+
+        self.queue : queue.Queue = queue.Queue()
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def request(self):
+        '''現在の状態を取り出して、書き込みを依頼する。'''
+        self.queue.put(self.snapshot())
+
+    def snapshot(self)->dict[str, Any]:
+        shared = self.shared
+        with shared.param_lock:
+            values = shared.param_vector.v.copy()
+        win_manager = shared.win_manager
+        with win_manager.lock:
+            pairs = win_manager.pentanomial.pairs()
+            win, draw, lose = win_manager.win_count.last(len(win_manager.win_count))
+
+        # 並列対局ごとのnode倍率のスケジュールの位置と、変異の方向を生成する乱数の状態
+        # (複数processで対局するときも、対局processからペアごとにrecord_pair()で送られてくる)
+        with shared.slot_states_lock:
+            slots = dict(shared.slot_states)
+
+        return {
+            "time"             : time.time(),
+            "pairs"            : pairs,
+            "win"              : win,
+            "draw"             : draw,
+            "lose"             : lose,
+            "values"           : values,
+            "mobility"         : MOBILITY,
+            "scale"            : SCALE,
+            "node_multipliers" : shared.node_multipliers,
+            "slots"            : slots,
+        }
+
+    def worker(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                break
+            try:
+                self.write(state)
+            except Exception as e:
+                print_log(f"Exception :{type(e).__name__}{e}\n{traceback.format_exc()}")
+
+    def write(self, state:dict[str, Any]):
+        if self.trajectory is not None:
+            self.trajectory.append(state["pairs"], state["win"], state["draw"], state["lose"], state["values"], state["time"])
+
+        if self.checkpoint_path is None:
+            return
+
+        self.shared.write_parameters()
+
+        checkpoint = {key: value for key, value in state.items() if key != "values"}
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, indent=1)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    @staticmethod
+    def read_checkpoint(path:str)->dict[str, Any] | None:
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def close(self):
+        '''最後のチェックポイントを書き出してから終了する。'''
+        self.request()
+        self.queue.put(None)
+        self.thread.join()
+        if self.trajectory is not None:
+            self.trajectory.close()
+
+class HandshakeStats:
+    '''
+    対局前のhandshake(setoptionの送信とisready)にかかった時間の集計。
+    複数の対局スレッドから呼び出される。
+    '''
+    def __init__(self):
+        self.games = 0
+        self.seconds = 0.0
+        # 送信したsetoptionの数と、前回と同じ値なので送信しなかったsetoptionの数
+        self.sent_options = 0
+        self.skipped_options = 0
+        # 送ったisreadyの数と、省略したisreadyの数
+        self.isready_count = 0
+        self.skipped_isready_count = 0
+        self.lock = Lock()
+
+    def record(self, seconds:float, sent_options:int, skipped_options:int, isready_count:int, skipped_isready_count:int):
+        with self.lock:
+            self.games += 1
+            self.seconds += seconds
+            self.sent_options += sent_options
+            self.skipped_options += skipped_options
+            self.isready_count += isready_count
+            self.skipped_isready_count += skipped_isready_count
+
+            if self.games % HANDSHAKE_OUTPUT_INTERVAL == 0:
+                print_log(f"[Handshake] {self.summary_text()}")
+
+    def summary_text(self)->str:
+        average = self.seconds / self.games if self.games else 0.0
+        return (f"games = {self.games}, handshake = {self.seconds:.1f}s ({average * 1000:.1f}ms/game), "
+                f"setoption sent = {self.sent_options}, skipped = {self.skipped_options}, "
+                f"isready sent = {self.isready_count}, skipped = {self.skipped_isready_count}")
+
 def format_node_multiplier(value:float)->str:
     if float(value).is_integer():
         return str(int(value))
@@ -277,12 +619,18 @@ class GameMatcher:
             time.sleep(0.3)
 
         self.shogi_matches = shogi_matches
+        self.shared.shogi_matches = shogi_matches
 
         for shogi_match in self.shogi_matches:
             shogi_match.start()
 
         print("All shogi games have started. Please wait.")
 
+    def write_pending_kifs(self):
+        """終了時に、各対局スレッドが保持している直前の対局の棋譜を書き出す。"""
+        for shogi_match in self.shared.shogi_matches:
+            shogi_match.write_pending_kif()
+
 
 # 全対局スレッドが共通で(同じものを参照で)持っている構造体
 class SharedState:
@@ -302,22 +650,189 @@ class SharedState:
         # 対局ごとに掛けるnode倍率。未指定なら従来通り1倍固定。
         self.node_multipliers = self.read_node_multipliers(settings)
 
+        # 対局中のShogiMatch。(GameMatcher.start_games()で設定される)
+        self.shogi_matches : list[ShogiMatch] = []
+
+        # 並列対局ごとの、直近のペアを終えたときのnode倍率のスケジュールの位置と乱数の状態。チェックポイントに保存する。
+        # key は match_slot_index の文字列。
+        self.slot_states : dict[str, dict[str, Any]] = {}
+        self.slot_states_lock = Lock()
+
+        # RESUMEがtrueなら、チェックポイントからnode倍率のスケジュールなどを復元する。
+        # CHECKPOINT_PATH未指定ならパラメーターファイル名 + ".checkpoint.json"。空文字列ならチェックポイントを保存しない。
+        checkpoint_path = settings.get("CHECKPOINT_PATH", settings["PARAMETERS_PATH"] + ".checkpoint.json") or None
+        self.resume_state : dict[str, Any] | None = None
+        if settings.get("RESUME", False) and checkpoint_path is not None:
+            self.resume_state = CheckpointManager.read_checkpoint(checkpoint_path)
+            if self.resume_state is None:
+                print_log(f"checkpoint not found : {checkpoint_path}, start from the beginning.")
+            elif sorted(self.resume_state["node_multipliers"]) == sorted(self.node_multipliers):
+                self.node_multipliers = [float(x) for x in self.resume_state["node_multipliers"]]
+            else:
+                print_log("NODE_MULTIPLIERS has been changed since the checkpoint, the node multiplier schedule is not restored.")
+                self.resume_state["slots"] = {}
+            if self.resume_state is not None:
+                # まだペアを終えていない並列対局は、次のチェックポイントにも復元した状態を書き出す。
+                self.slot_states = dict(self.resume_state["slots"])
+
         # パラメーターファイル
         self.parameters : list[Entry] = read_parameters(settings["PARAMETERS_PATH"])
+        # ↑の値などをnumpy配列にしたもの。対局中はこちらのvを書き換える。
+        self.param_vector = ParamVector(self.parameters)
         # ↑のvを書き換える時用のlock object
         self.param_lock = Lock()
 
+        # 各対局スレッドは、勾配をこのペア数だけスレッド内で足し合わせてから、まとめてパラメーターに反映させる。
+        # 1なら従来どおり、ペアごとに反映させる。(大きくするとlockの競合が減る)
+        self.grad_batch_pairs = int(settings.get("GRAD_BATCH_PAIRS", 1))
+        if self.grad_batch_pairs <= 0:
+            raise ValueError(f"GRAD_BATCH_PAIRS must be positive, actual = {self.grad_batch_pairs}")
+
         self.validate_tunable_options_are_not_fixed()
 
         # 勝率マネージャー
+        # 勝敗履歴はWIN_HISTORY_PATH(未指定ならパラメーターファイル名 + ".results.json")に保存して、
+        # 再起動したときに続きから集計する。空文字列なら保存しない。
         self.win_manager = WinManager()
 
+        # SPRTによる打ち切り(省略可)
+        #   "SPRT": {"elo0": 0, "elo1": 5, "alpha": 0.05, "beta": 0.05, "action": "stop", "decay": 0.5}
+        #   action = "stop"  : H0かH1が採択されたら対局を終了して、パラメーターを保存する。
+        #   action = "decay" : H0かH1が採択されるたびに、パラメーターの移動量をdecay倍してSPRTをやり直す。
+        sprt_settings = settings.get("SPRT", None)
+        self.sprt_action = "stop"
+        self.sprt_decay = 0.5
+        if sprt_settings:
+            self.win_manager.sprt = Sprt(
+                float(sprt_settings.get("elo0", 0.0)),
+                float(sprt_settings.get("elo1", 5.0)),
+                float(sprt_settings.get("alpha", 0.05)),
+                float(sprt_settings.get("beta", 0.05)),
+            )
+            self.sprt_action = str(sprt_settings.get("action", "stop")).lower()
+            if self.sprt_action not in ["stop", "decay"]:
+                raise ValueError(f"Unknown SPRT action: {self.sprt_action}")
+            self.sprt_decay = float(sprt_settings.get("decay", 0.5))
+
+        # パラメーターの移動量のスケジュール(省略可)
+        #   "LR_SCHEDULE": {"A": 1000, "alpha": 0.602}
+        #   k ペア目の移動量を MOBILITY × ((A + 1) / (A + k + 1)) ^ alpha 倍にする。(SPSAの標準的なゲインの減衰)
+        lr_schedule = settings.get("LR_SCHEDULE", None)
+        self.lr_schedule_a = float(lr_schedule.get("A", 0.0)) if lr_schedule else 0.0
+        self.lr_schedule_alpha = float(lr_schedule.get("alpha", 0.602)) if lr_schedule else 0.0
+
+        # SPRTの打ち切りで対局を終了するときにTrueになる。
+        self.stop_games = False
+
+        # チェックポイントとtrajectory(TRAJECTORY_PATHを指定したときだけ)の保存
+        trajectory_path = settings.get("TRAJECTORY_PATH", None)
+        checkpoint_interval = int(settings.get("CHECKPOINT_INTERVAL", CHECKPOINT_INTERVAL))
+        self.checkpoint : CheckpointManager | None = None
+        if checkpoint_path is not None or trajectory_path:
+            self.checkpoint = CheckpointManager(self, checkpoint_path, trajectory_path, checkpoint_interval)
+        if self.resume_state is not None:
+            print_log(f"resume from checkpoint : {checkpoint_path}, pairs = {self.resume_state['pairs']}")
+
+        win_history_path = settings.get("WIN_HISTORY_PATH", settings["PARAMETERS_PATH"] + ".results.json")
+        if win_history_path:
+            self.win_manager.read_history(win_history_path, self.resume_state is not None)
+        if self.win_manager.sprt is not None:
+            print_log(f"SPRT : action = {self.sprt_action}, decay = {self.sprt_decay}, {self.win_manager.sprt.summary_text()}")
+
         # 標準的な将棋盤なのか
         self.standard_board = self.settings["STANDARD_BOARD"]
 
+        # 複数processでの対局
+        #   PROCESS_COUNT        : 2以上なら、対局をこの数のprocessに分けて行う。main processはパラメーターサーバーになる。
+        #   REMOTE_SLOTS         : 並列対局のうち、remote workerに割り振る数。
+        #   PARAM_SERVER_ADDRESS : パラメーターサーバーが待ち受けるaddress。remote workerを使うならportを固定する。
+        #   PARAM_SERVER_AUTHKEY : 接続に用いる共通の鍵。remote workerを使うか、loopback以外で待ち受けるなら必須。
+        self.process_count = max(1, int(settings.get("PROCESS_COUNT", 1)))
+        self.remote_slots = max(0, int(settings.get("REMOTE_SLOTS", 0)))
+        self.param_server_address = parse_address(str(settings.get("PARAM_SERVER_ADDRESS", "127.0.0.1:0")))
+        self.param_server_authkey = str(settings.get("PARAM_SERVER_AUTHKEY", ""))
+        if self.process_count > 1 or self.remote_slots > 0:
+            self.param_server_authkey = check_param_server_authkey(
+                self.param_server_address, self.param_server_authkey, self.remote_slots > 0)
+
+        # 対局前のisready
+        #   "always"    : 毎局送る。(従来どおり)
+        #   "on_change" : エンジン起動直後と、REINIT_OPTIONSに書いたoptionの値が変わったときだけ送る。
+        self.isready_policy = str(settings.get("ISREADY_POLICY", "always")).lower()
+        if self.isready_policy not in ["always", "on_change"]:
+            raise ValueError(f"Unknown ISREADY_POLICY: {self.isready_policy}")
+        # 値を変えたらisreadyで初期化し直す必要があるoption名。"conthist_bonuses_*"のようにワイルドカードが使える。
+        # (tune.pyで`%%TUNE_ISREADY%%`などisreadyのタイミングで反映されるブロックに書いたパラメーター)
+        self.reinit_options : list[str] = list(settings.get("REINIT_OPTIONS", []))
+
+        # 対局前のhandshakeの時間の集計
+        self.handshake_stats = HandshakeStats()
+
         print_log(f"Node multipliers = {', '.join(format_node_multiplier(x) for x in self.node_multipliers)}")
 
 
+    def current_param_values(self)->np.ndarray:
+        '''現在のパラメーターの値(のコピー)'''
+        with self.param_lock:
+            return self.param_vector.v.copy()
+
+    def step_scale(self)->float:
+        '''変異させる大きさ(SCALE)'''
+        return SCALE
+
+    def learning_rate(self)->float:
+        '''勾配に掛ける倍率。MOBILITYにLR_SCHEDULEとSPRTのdecayによる倍率を掛けたもの。'''
+        return MOBILITY * self.learning_rate_factor()
+
+    def apply_grad(self, grad:np.ndarray):
+        '''勾配(いくつかのペア分を足し合わせたもの)をパラメーターに反映させる。'''
+        vector = self.param_vector
+        with self.param_lock:
+            # SPRTで打ち切った後に終わったペアは、保存したパラメーターを変えないように反映しない。
+            if self.stop_games:
+                return
+
+            # min,maxで制限する。未使用パラメーターは変化させない。
+            v = np.clip(vector.v + grad, vector.min, vector.max)
+            np.copyto(vector.v, v, where=vector.used)
+
+    def learning_rate_factor(self)->float:
+        '''パラメーターの移動量に掛ける倍率。LR_SCHEDULEとSPRTのdecayによる。'''
+        factor = 1.0
+        if self.lr_schedule_alpha > 0.0:
+            pairs = self.win_manager.pentanomial.pairs()
+            factor = ((self.lr_schedule_a + 1) / (self.lr_schedule_a + pairs + 1)) ** self.lr_schedule_alpha
+        if self.sprt_action == "decay":
+            factor *= self.sprt_decay ** self.win_manager.sprt_conclusions
+        return factor
+
+    def record_pair(self, winner1:int, winner2:int, slot_state:tuple[str, dict[str, Any]] | None = None):
+        '''
+        +C, -Cの2局ペアの結果を記録して、SPRTの結果に応じて対局の終了や移動量の減衰を行う。
+        slot_stateは(match_slot_index, そのペアを終えたときの状態)。チェックポイントに保存する。
+        '''
+        if slot_state is not None:
+            with self.slot_states_lock:
+                self.slot_states[slot_state[0]] = slot_state[1]
+        result, pairs = self.win_manager.update_pair(winner1, winner2)
+        if self.checkpoint is not None and pairs % self.checkpoint.interval == 0:
+            self.checkpoint.request()
+        if result is None:
+            return
+
+        if self.sprt_action == "stop":
+            if not self.stop_games:
+                self.stop_games = True
+                print_log("SPRT finished. Games will stop after the current pairs.")
+                self.write_parameters()
+                self.win_manager.write_history()
+        else:
+            print_log(f"SPRT restarted, learning rate factor = {self.learning_rate_factor():.4f}")
+
+    def is_reinit_option(self, name:str)->bool:
+        """値を変えたらisreadyを送る必要があるoptionか。"""
+        return any(fnmatchcase(name, pattern) for pattern in self.reinit_options)
+
     def read_start_sfens(self, path:str)->list[Sfen]:
         # 対局開始局面を読み込む。
 
@@ -462,6 +977,7 @@ class SharedState:
 
         path = self.settings["PARAMETERS_PATH"]
         with self.param_lock:
+            self.param_vector.store(self.parameters)
             write_parameters(path, self.parameters)
         print_log(f"wrote parameters: {path}")
 
@@ -470,6 +986,8 @@ class SharedState:
         if self.parameters is None:
             return
 
+        with self.param_lock:
+            self.param_vector.store(self.parameters)
         for param in self.parameters:
             print_log(f"{param.name} {param.v:.5f} [{param.min}, {param.max}]")
 
@@ -518,6 +1036,36 @@ class ShogiMatch:
         self.engines = [engine1, engine2]
         self.node_multiplier_pair_index = 0
 
+        # SPSA対象エンジンに最後に送ったoptionの値。値が変わったoptionだけ送る。
+        self.sent_options : dict[str, str] = {}
+
+        # 次の対局前にisreadyを送る必要があるか。(起動直後は必ず送る)
+        self.need_isready = [True, True]
+
+        # 次の対局前のhandshakeの計測用
+        self.handshake_seconds = 0.0
+        self.handshake_sent_options = 0
+        self.handshake_skipped_options = 0
+
+        # 書き出していない直前の対局の棋譜
+        # (終了時にはユーザー入力のthreadからもwrite_pending_kif()が呼び出されるので、lockで二重に書き出さないようにする)
+        self.pending_kif : str | None = None
+        self.pending_kif_lock = Lock()
+
+        # 変異の方向を生成する乱数。(スレッドごとに持つ)
+        self.rng = np.random.default_rng()
+
+        # まだパラメーターに反映させていない勾配と、そのペア数
+        self.grad : np.ndarray | None = None
+        self.grad_pairs = 0
+
+        # チェックポイントから再開するなら、node倍率のスケジュールの位置と乱数の状態を復元する。
+        if shared.resume_state is not None:
+            slot = shared.resume_state["slots"].get(str(t1.match_slot_index))
+            if slot is not None:
+                self.node_multiplier_pair_index = int(slot["node_multiplier_pair_index"])
+                self.rng.bit_generator.state = slot["rng"]
+
         # ゲームが終了したのか？
         self.gameover = False
 
@@ -537,28 +1085,31 @@ class ShogiMatch:
             # 開始局面で先に着手するplayer(開始局面が先手の局面とは限らないのでこの書き方で)
             start_player = rand(2)
 
-            # alias of params
+            # alias of params (パラメーター名などの参照用。値はshared.param_vectorが持つ)
             params = self.shared.parameters
 
             # 試合結果に対してplayer nが勝った時の変位量(⚠ drawのときはn==2)
             winner_to_step = [-1.0 , +1.0 , 0]
 
-            # 連続対局させる。
+            # 連続対局させる。(SPRTで打ち切られたら終了)
             # SPSAのために 現在のパラメーター P に対して、微小な方向 C と その逆方向 -C で対局させる。
-            while True:
+            while not self.shared.stop_games:
 
                 # 変異させたパラメーターを取得
-                shift = self.generate_shift_params(params)
-                p_shift_plus  = self.add_params(params, shift, +SCALE)
-                p_shift_minus = self.add_params(params, shift, -SCALE)
+                shift = self.generate_shift_params()
+                p_shift_plus, p_shift_minus = self.add_params(shift, self.shared.step_scale())
                 root_sfen = self.pick_root_sfen()
                 node_multiplier = self.next_node_multiplier()
 
                 # 変異させたパラメーターを思考エンジンに設定
                 self.set_engine_options(params, p_shift_plus)
 
+                # エンジンがsetoptionを処理している間に、直前の対局の棋譜を書き出す。
+                self.write_pending_kif()
+
                 # 対局
                 winner = self.game_play(start_player, root_sfen, node_multiplier)
+                winner_plus = winner
 
                 # 勝ち数のカウント
                 self.shared.win_manager.update(winner, self.t[0].engine_name, node_multiplier)
@@ -570,6 +1121,7 @@ class ShogiMatch:
 
                 # 逆方向に変異させたパラメーターを思考エンジンに設定
                 self.set_engine_options(params, p_shift_minus)
+                self.write_pending_kif()
 
                 winner = self.game_play(start_player, root_sfen, node_multiplier)
                 self.shared.win_manager.update(winner, self.t[0].engine_name, node_multiplier)
@@ -577,16 +1129,29 @@ class ShogiMatch:
 
                 # パラメーターをshift(方角)×step分だけ変異させる。
                 # / 2は中心差分近似のときに出てくる 2。
-                self.add_grad(params, shift, step / 2)
+                self.add_grad(shift, step / 2)
 
                 # 次の対局の手番を入れ替える。
                 start_player ^= 1
                 self.node_multiplier_pair_index += 1
 
+                # 2局ペアの結果を記録する。(pentanomial, SPRT)
+                # チェックポイントのために、次のペアを始める時点のこの並列対局の状態も渡す。
+                self.shared.record_pair(winner_plus, winner, self.slot_state())
+
+            self.write_pending_kif()
+
         except Exception as e:
             print_log(f"Exception :{type(e).__name__}{e}\n{traceback.format_exc()}")
 
 
+    def slot_state(self)->tuple[str, dict[str, Any]]:
+        '''(match_slot_index, node倍率のスケジュールの位置と乱数の状態)。チェックポイントに保存する。'''
+        return str(self.t[0].match_slot_index), {
+            "node_multiplier_pair_index": self.node_multiplier_pair_index,
+            "rng": self.rng.bit_generator.state,
+        }
+
     def next_node_multiplier(self)->float:
         return scheduled_node_multiplier(
             self.shared.node_multipliers,
@@ -602,9 +1167,27 @@ class ShogiMatch:
         """ 1局だけ対局する """
 
         # 対局開始前のisready送信
-        # (パラメーターが変更になったかも知れないので毎回`isready`で初期化)
-        for engine in self.engines:
-            engine.isready()
+        # ISREADY_POLICYが"always"なら、パラメーターが変更になったかも知れないので毎回`isready`で初期化する。
+        # "on_change"なら、初期化が必要なとき(起動直後かREINIT_OPTIONSの値が変わったとき)だけ送る。
+        handshake_start = time.perf_counter()
+        isready_count = 0
+        for i, engine in enumerate(self.engines):
+            if self.shared.isready_policy == "always" or self.need_isready[i]:
+                engine.isready()
+                isready_count += 1
+                self.need_isready[i] = False
+
+        self.handshake_seconds += time.perf_counter() - handshake_start
+        self.shared.handshake_stats.record(
+            self.handshake_seconds,
+            self.handshake_sent_options,
+            self.handshake_skipped_options,
+            isready_count,
+            len(self.engines) - isready_count,
+        )
+        self.handshake_seconds = 0.0
+        self.handshake_sent_options = 0
+        self.handshake_skipped_options = 0
 
         board = Board() if self.shared.standard_board else NonStandardBoard()
 
@@ -663,30 +1246,39 @@ class ShogiMatch:
         # print_log(f"game end, winner = {winner}")
 
         # 対局棋譜は1局ずつ書き出す。
+        # 次の対局のsetoptionを送ってから書き出すので、ここでは保持しておくだけ。(write_pending_kif()で書き出す)
         # (sfen局面の方は書き出そうにも重複を除去しないといけないのでこのタイミングでは書き出さない)
-        self.shared.kif_manager.write_kif(kif)
+        self.pending_kif = kif
 
         return winner
+
+    def write_pending_kif(self):
+        """直前の対局の棋譜を書き出す。"""
+        with self.pending_kif_lock:
+            kif, self.pending_kif = self.pending_kif, None
+            if kif is not None:
+                self.shared.kif_manager.write_kif(kif)
     
-    def generate_shift_params(self, params:list[Entry]):
+    def generate_shift_params(self)->np.ndarray:
         # -1と1の二値変数を1/2の確率でとる(Rademacher分布)
         # ここに、各要素にstepを掛け算(アダマール積)した分だけパラメーターを動かして対局させる。
-        return [random.choice([param.step, -param.step]) for param in params]
-
-    def add_params(self, params:list[Entry], shift:list[float], k:float)->list[float]:
-        # params + shift * k を返す。
-        # min,maxで制限する。
-        v_result = []
-        for param,s in zip(params, shift):
-            # vにこのstep * kを加算すると、min,maxの範囲を超えてしまうなら、抑制する。
-            v = param.v + s * k
-            v = min(param.max, v)
-            v = max(param.min, v)
-            v_result.append(v)
-        return v_result
-    
+        vector = self.shared.param_vector
+        signs = self.rng.integers(0, 2, size=len(vector)) * 2 - 1
+        return signs * vector.step
+
+    def add_params(self, shift:np.ndarray, k:float)->tuple[list[float], list[float]]:
+        # params + shift * k と params - shift * k を返す。
+        # vにこのstep * kを加算すると、min,maxの範囲を超えてしまうなら、抑制する。
+        vector = self.shared.param_vector
+        v = self.shared.current_param_values()
+        v_plus  = np.clip(v + shift * k, vector.min, vector.max)
+        v_minus = np.clip(v + shift * -k, vector.min, vector.max)
+        return v_plus.tolist(), v_minus.tolist()
+
     def set_engine_options(self, params:list[Entry], p:list[float]):
         # 思考エンジンに、変異したパラメーターを設定する
+        # 前回送った値と同じ(intなら丸めた値が同じ)パラメーターは送らない。
+        start = time.perf_counter()
         for param, v in zip(params, p):
             # print(f"{param.name} = {v}")
 
@@ -697,26 +1289,387 @@ class ShogiMatch:
             if param.type == "int":
                 v = int(v + 0.5) # 丸め処理を入れておく。(±0.5増えたら隣の値になって欲しいので)
 
+            value = str(v)
+            if self.sent_options.get(param.name) == value:
+                self.handshake_skipped_options += 1
+                continue
+            self.sent_options[param.name] = value
+            self.handshake_sent_options += 1
+
             # 送信する思考エンジンは[0]は基準エンジンだから、engines[1]固定でいいや。
-            self.engines[1].send_usi(f"setoption name {param.name} value {v}")
+            self.engines[1].send_usi(f"setoption name {param.name} value {value}")
+
+            if self.shared.is_reinit_option(param.name):
+                self.need_isready[1] = True
 
-    def add_grad(self, params:list[Entry], shift:list[float], step:float):
+        self.handshake_seconds += time.perf_counter() - start
+
+    def add_grad(self, shift:np.ndarray, step:float):
         # パラメーターを勾配分だけ変異させる。
+        # 勾配はスレッド内で足し合わせておき、GRAD_BATCH_PAIRSペアごとにまとめて反映させる。
+
+        # 変異させる方向はs*step。この方向に、param.delta分だけ変異させる。
+        # sは元はparam.stepに-1か1を乗算したものだから、結局、param.step * param.delta分だけ +1 , -1倍したところに移動させる意味。
+        # LR_SCHEDULEとSPRTのdecayによる移動量の倍率も掛ける。
+        learning_rate = self.shared.learning_rate()
+        grad = shift * step * self.shared.param_vector.delta * learning_rate
+
+        if self.grad is None:
+            self.grad = grad
+        else:
+            self.grad += grad
+        self.grad_pairs += 1
+
+        if self.grad_pairs >= self.shared.grad_batch_pairs:
+            self.flush_grad()
+
+    def flush_grad(self):
+        # 足し合わせた勾配をパラメーターに反映させる。
+        grad = self.grad
+        self.grad = None
+        self.grad_pairs = 0
+        if grad is not None:
+            self.shared.apply_grad(grad)
+
+# ============================================================
+#                        multi process
+# ============================================================
+
+# 複数processで対局するときの構成
+#
+#   main process    : パラメーターサーバー。パラメーター、WinManager、棋譜の書き出し、チェックポイントを受け持つ。
+#                     ユーザー入力を受け付ける。
+#   対局 process    : PROCESS_COUNT個。対局(ShogiMatch)をいくつかずつ受け持つ。ペアごとに、現在のパラメーターを
+#                     サーバーから受け取って対局し、勝敗と勾配をサーバーに送る。
+#   remote worker   : 別のPCで `python BloodgateSPSA.py --worker HOST:PORT` として起動した対局process。
+#                     REMOTE_SLOTSの数の対局を、サーバーから受け取って行う。
+#
+# サーバーとの通信はmultiprocessing.managersによるTCP接続。
+
+class ParamServerManager(BaseManager):
+    pass
+
+def parse_address(address:str)->tuple[str, int]:
+    '''"HOST:PORT"を(HOST, PORT)にする。'''
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+def is_loopback_host(host:str)->bool:
+    '''hostがloopback(このPCの中からしか接続できないaddress)か。'''
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+def check_param_server_authkey(address:tuple[str, int], authkey:str, use_remote_workers:bool)->str:
+    '''
+    パラメーターサーバーで用いるauthkeyを返す。
+    multiprocessing.managersは受け取ったデータをunpickleするので、authkeyを知っている者はこのPCでコードを実行できる。
+    そのため、loopback以外で待ち受けるときやremote workerを使うときは、推測できないauthkeyの指定を必須とする。
+    loopbackだけで待ち受けて、このPCの対局processだけが接続するなら、指定がなければ起動ごとに乱数で生成する。
+    '''
+    if authkey == INSECURE_PARAM_SERVER_AUTHKEY:
+        raise ValueError(f"PARAM_SERVER_AUTHKEY \"{INSECURE_PARAM_SERVER_AUTHKEY}\" is publicly known. Set a random key, e.g. python -c \"import secrets; print(secrets.token_hex(16))\"")
+    if authkey:
+        return authkey
+    if not is_loopback_host(address[0]):
+        raise ValueError(f"PARAM_SERVER_AUTHKEY is required when PARAM_SERVER_ADDRESS is not loopback, address = {address[0]}")
+    if use_remote_workers:
+        raise ValueError("PARAM_SERVER_AUTHKEY is required when REMOTE_SLOTS > 0")
+    return secrets.token_hex(16)
+
+
+class ParamServer:
+    '''
+    パラメーターサーバー。対局processからの呼び出しを、main processのSharedStateに対して行う。
+    (呼び出しは対局processごとの接続のthreadから来る)
+    '''
+
+    def __init__(self, shared:"SharedState", remote_slots:list[tuple[dict, dict]]):
+        self.shared = shared
+        # remote workerに割り振る対局
+        self.remote_slots = list(remote_slots)
+        self.lock = Lock()
+
+        # qで終了するときに、対局processに直前の対局の棋譜を書き出させる。
+        #   quit_waiters : wait_quit()で終了を待っている対局processの数
+        #   quit_flushed : 棋譜を書き出し終えた対局processの数
+        self.quit_event = Event()
+        self.quit_waiters = 0
+        self.quit_flushed = 0
+
+    def worker_config(self)->dict[str, Any]:
+        '''対局processがShogiMatchを動かすのに必要な設定'''
+        shared = self.shared
+        return {
+            "parameters"       : shared.parameters,
+            "root_sfens"       : shared.root_sfens,
+            "node_multipliers" : shared.node_multipliers,
+            "standard_board"   : shared.standard_board,
+            "isready_policy"   : shared.isready_policy,
+            "reinit_options"   : shared.reinit_options,
+            "grad_batch_pairs" : shared.grad_batch_pairs,
+            # RESUMEのとき、並列対局ごとのnode倍率のスケジュールの位置と乱数の状態
+            "resume_slots"     : shared.resume_state["slots"] if shared.resume_state is not None else None,
+        }
+
+    def claim_slots(self, count:int)->list[tuple[dict, dict]]:
+        '''remote workerに、まだ割り振っていない対局を最大count個割り振る。'''
+        with self.lock:
+            slots, self.remote_slots = self.remote_slots[:count], self.remote_slots[count:]
+        return slots
+
+    def pull(self)->tuple[np.ndarray, float, float, bool]:
+        '''(現在のパラメーターの値, 勾配に掛ける倍率, SCALE, 対局を終了するか)'''
+        shared = self.shared
+        return shared.current_param_values(), shared.learning_rate(), shared.step_scale(), shared.stop_games
+
+    def record_game(self, winner:int, opponent_name:str, node_multiplier:float):
+        self.shared.win_manager.update(winner, opponent_name, node_multiplier)
+
+    def record_pair(self, winner1:int, winner2:int, slot_state:tuple[str, dict[str, Any]] | None = None):
+        self.shared.record_pair(winner1, winner2, slot_state)
+
+    def apply_grad(self, grad:np.ndarray):
+        self.shared.apply_grad(grad)
+
+    def write_kif(self, kif:str):
+        self.shared.kif_manager.write_kif(kif)
+
+    def wait_quit(self):
+        '''対局processから呼び出される。サーバーが終了するまで待つ。'''
+        with self.lock:
+            self.quit_waiters += 1
+        self.quit_event.wait()
+
+    def kif_flushed(self):
+        '''対局processから呼び出される。直前の対局の棋譜を書き出し終えた。'''
+        with self.lock:
+            self.quit_flushed += 1
+
+    def flush_kifs(self, timeout:float):
+        '''対局processに直前の対局の棋譜を書き出させて、書き出し終えるまで(最大timeout秒)待つ。'''
+        self.quit_event.set()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if self.quit_flushed >= self.quit_waiters:
+                    return
+            time.sleep(0.05)
+        print_log(f"{self.quit_waiters - self.quit_flushed} match processes did not write their last kif.")
+
+
+def start_param_server(shared:"SharedState", remote_slots:list[tuple[dict, dict]], address:tuple[str, int], authkey:bytes)->tuple[ParamServer, tuple[str, int]]:
+    '''パラメーターサーバーを起動して、(ParamServer, 待ち受けているaddress)を返す。'''
+    param_server = ParamServer(shared, remote_slots)
+    ParamServerManager.register("param_server", callable=lambda: param_server)
+    server = ParamServerManager(address=address, authkey=authkey).get_server()
+    Thread(target=server.serve_forever, daemon=True).start()
+    return param_server, server.address
+
+
+class RemoteWinManager:
+    '''対局processで、WinManagerの代わりに勝敗をサーバーに送る。'''
+    def __init__(self, shared:"RemoteSharedState"):
+        self.shared = shared
+
+    def update(self, winner:int, opponent_name:str, node_multiplier:float):
+        self.shared.call("record_game", winner, opponent_name, node_multiplier)
+
+
+class RemoteKifWriter:
+    '''対局processで、KifManagerの代わりに棋譜をサーバーに送る。'''
+    def __init__(self, shared:"RemoteSharedState"):
+        self.shared = shared
+
+    def write_kif(self, kif:str):
+        self.shared.call("write_kif", kif)
+
+
+class RemoteSharedState:
+    '''
+    対局processで用いるSharedState。ShogiMatchから使われる部分だけを持つ。
+    パラメーターはペアごとにサーバーから受け取り、勝敗・勾配・棋譜はサーバーに送る。
+    サーバーとの接続が切れたら(サーバーが終了したら)、対局を終了する。
+    '''
+
+    def __init__(self, address:tuple[str, int], authkey:bytes):
+        ParamServerManager.register("param_server")
+        manager = ParamServerManager(address=address, authkey=authkey)
+        manager.connect()
+        # proxyはthreadごとに接続を持つので、複数の対局スレッドから呼び出せる。
+        self.server = manager.param_server() # type:ignore
+
+        config = self.server.worker_config()
+        self.parameters : list[Entry] = config["parameters"]
+        self.param_vector = ParamVector(self.parameters)
+        self.root_sfens : list[Sfen] = config["root_sfens"]
+        self.node_multipliers : list[float] = config["node_multipliers"]
+        self.standard_board : bool = config["standard_board"]
+        self.isready_policy : str = config["isready_policy"]
+        self.reinit_options : list[str] = config["reinit_options"]
+        self.grad_batch_pairs : int = config["grad_batch_pairs"]
+
+        self.win_manager = RemoteWinManager(self)
+        self.kif_manager = RemoteKifWriter(self)
+        self.handshake_stats = HandshakeStats()
+        # RESUMEのときは、サーバーがチェックポイントから読み込んだ並列対局ごとの状態を受け取る。
+        resume_slots = config["resume_slots"]
+        self.resume_state : dict[str, Any] | None = {"slots": resume_slots} if resume_slots is not None else None
+
+        # 直近のpull()で受け取った値
+        self.stop_games = False
+        self.last_learning_rate = MOBILITY
+        self.last_step_scale = SCALE
+
+    def call(self, method:str, *args:Any)->Any:
+        # サーバーのmethodを呼び出す。接続が切れていたら対局を終了させる。
+        if self.stop_games:
+            return None
+        try:
+            return getattr(self.server, method)(*args)
+        except (EOFError, OSError):
+            self.stop_games = True
+            return None
+
+    def is_reinit_option(self, name:str)->bool:
+        return any(fnmatchcase(name, pattern) for pattern in self.reinit_options)
+
+    def claim_slots(self, count:int)->list[tuple[dict, dict]]:
+        return self.call("claim_slots", count) or []
+
+    def current_param_values(self)->np.ndarray:
+        result = self.call("pull")
+        if result is None:
+            return self.param_vector.v.copy()
+        values, self.last_learning_rate, self.last_step_scale, stop_games = result
+        self.stop_games = self.stop_games or stop_games
+        self.param_vector.v = values
+        return values.copy()
+
+    def step_scale(self)->float:
+        return self.last_step_scale
 
-        with self.shared.param_lock:
-            for param,s in zip(params, shift):
-                if param.not_used:
-                    continue
-
-                # 変異させる方向はs*step。この方向に、param.delta分だけ変異させる。
-                # sは元はparam.stepに-1か1を乗算したものだから、結局、param.step * param.delta分だけ +1 , -1倍したところに移動させる意味。
-                delta = s * step * param.delta * MOBILITY
-                # last_v = param.v
-                v = param.v + delta
-                v = min(param.max, v)
-                v = max(param.min, v)
-                param.v = v
-                # print(f"param {param.name} : {last_v} -> {v}")
+    def learning_rate(self)->float:
+        return self.last_learning_rate
+
+    def apply_grad(self, grad:np.ndarray):
+        self.call("apply_grad", grad)
+
+    def record_pair(self, winner1:int, winner2:int, slot_state:tuple[str, dict[str, Any]] | None = None):
+        self.call("record_pair", winner1, winner2, slot_state)
+
+
+def make_engine_settings(values:dict)->EngineSettings:
+    t = EngineSettings()
+    t.__dict__.update(values)
+    return t
+
+
+def match_process_worker(address:tuple[str, int], authkey:bytes, slots:list[tuple[dict, dict]] | None, slot_count:int):
+    '''
+    対局processのmain。slotsの対局を行う。slotsがNoneならサーバーから最大slot_count個割り振ってもらう。
+    サーバーが終了するか、SPRTで打ち切られたら終了する。
+    '''
+
+    try:
+        shared = RemoteSharedState(address, authkey)
+        if slots is None:
+            slots = shared.claim_slots(slot_count)
+            if not slots:
+                print_log(f"no slots to play, pid = {os.getpid()}")
+                return
+
+        shogi_matches : list[ShogiMatch] = []
+        for t1, t2 in slots:
+            shogi_matches.append(ShogiMatch(make_engine_settings(t1), make_engine_settings(t2), shared)) # type:ignore
+            time.sleep(0.3)
+
+        print_log(f"match process started, pid = {os.getpid()}, slots = {[t1['match_slot_index'] for t1, _ in slots]}")
+        for shogi_match in shogi_matches:
+            shogi_match.start()
+        Thread(target=flush_kifs_on_quit, args=(shared, shogi_matches), daemon=True).start()
+        for shogi_match in shogi_matches:
+            shogi_match.thread.join()
+
+        print_log(f"[Handshake] pid = {os.getpid()}, {shared.handshake_stats.summary_text()}")
+
+    except Exception as e:
+        print_log(f"Exception in match process : {type(e).__name__}{e}\n{traceback.format_exc()}")
+
+
+def flush_kifs_on_quit(shared:RemoteSharedState, shogi_matches:list["ShogiMatch"]):
+    '''対局processで、サーバーがqで終了するのを待って、各対局スレッドが保持している直前の対局の棋譜を送る。'''
+    shared.call("wait_quit")
+    for shogi_match in shogi_matches:
+        shogi_match.write_pending_kif()
+    shared.call("kif_flushed")
+
+
+def start_match_processes(address:tuple[str, int], authkey:bytes, slot_groups:list[list[tuple[dict, dict]] | None], slot_count:int = 1)->list:
+    '''対局processを起動する。Windowsと同じように動くよう、spawnで起動する。'''
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    for slots in slot_groups:
+        process = context.Process(target=match_process_worker, args=(address, authkey, slots, slot_count), daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+class ProcessGameMatcher:
+    """
+    並列対局を複数processに分けて行う。GameMatcherと同じように使える。
+    """
+    def __init__(self, shared:"SharedState"):
+
+        self.shared = shared
+        threads_all = GameMatcher(shared).threads_all
+        slots = [(vars(t1), vars(t2)) for t1, t2 in zip(threads_all[0], threads_all[1])]
+
+        # 末尾のREMOTE_SLOTS個の対局はremote workerに割り振る。
+        remote_count = min(shared.remote_slots, len(slots))
+        self.local_slots = slots[:len(slots) - remote_count]
+        self.remote_slots = slots[len(slots) - remote_count:]
+
+        # 対局を受け持つprocessの数。対局数より多くしても意味がない。
+        self.process_count = max(1, min(shared.process_count, len(self.local_slots)))
+        self.processes : list = []
+        self.param_server : ParamServer | None = None
+
+    def start_games(self):
+        """パラメーターサーバーと対局processを起動して、すべての並列対局を開始させる"""
+
+        authkey = self.shared.param_server_authkey.encode("utf-8")
+        self.param_server, address = start_param_server(self.shared, self.remote_slots, self.shared.param_server_address, authkey)
+        print_log(f"parameter server started, address = {address[0]}:{address[1]}")
+        if self.remote_slots:
+            print_log(f"waiting for remote workers, {len(self.remote_slots)} slots : python BloodgateSPSA.py --worker HOST:{address[1]} --slots N")
+
+        # 異なるエンジン設定が偏らないように、対局をprocessに順番に割り振る。
+        if self.local_slots:
+            groups : list = [self.local_slots[i::self.process_count] for i in range(self.process_count)]
+            self.processes = start_match_processes(address, authkey, groups)
+
+        print_log(f"All shogi games have started in {len(self.processes)} processes. Please wait.")
+
+
+    def write_pending_kifs(self):
+        """終了時に、対局processに直前の対局の棋譜を書き出させる。"""
+        if self.param_server is not None:
+            self.param_server.flush_kifs(timeout=10.0)
+
+
+def run_remote_worker(address:str, authkey:str, process_count:int, slot_count:int):
+    '''remote worker。サーバーからslot_count個ずつ対局を受け取るprocessをprocess_count個起動して、終了を待つ。'''
+    enable_print_log()
+    print_log(f"remote worker, server = {address}, processes = {process_count}, slots per process = {slot_count}")
+    processes = start_match_processes(parse_address(address), authkey.encode("utf-8"), [None] * process_count, slot_count)
+    for process in processes:
+        process.join()
+    print_log("remote worker finished.")
 
 # ============================================================
 #                             main
@@ -741,11 +1694,16 @@ def user_input():
     shared = SharedState(settings)
 
     # 並列対局管理用
-    matcher = GameMatcher(shared)
+    matcher = ProcessGameMatcher(shared) if shared.process_count > 1 or shared.remote_slots > 0 else GameMatcher(shared)
 
     # ログ記録を自動的に開始する。
     enable_print_log()
 
+    # チェックポイントから再開するなら、MOBILITYとSCALEも復元する。
+    if shared.resume_state is not None:
+        MOBILITY = float(shared.resume_state["mobility"])
+        SCALE = float(shared.resume_state["scale"])
+
     # このタイミングでパラメーターを一度ログに出力しておく。(あとで比較するため)
     # shared.print_parameters()
 
@@ -780,6 +1738,7 @@ def user_input():
 
             elif i == 'w':
                 shared.write_parameters()
+                shared.win_manager.write_history()
 
             elif i == 'm':
                 if len(inp) >= 2:
@@ -801,7 +1760,15 @@ def user_input():
 
             elif i == 'q':
                 # 終了時には自動セーブ
+                # 各対局スレッドは直前の対局の棋譜を次の対局の開始時に書き出すので、ここで書き出しておく。
+                matcher.write_pending_kifs()
                 shared.write_parameters()
+                shared.win_manager.write_history()
+                if shared.checkpoint is not None:
+                    shared.checkpoint.close()
+                # 複数processで対局したときは、handshakeは各対局processで集計している。
+                if shared.handshake_stats.games > 0:
+                    print_log(f"[Handshake] {shared.handshake_stats.summary_text()}")
                 print_log("quit")
                 break
             
@@ -814,7 +1781,20 @@ def user_input():
 
 
 def main():
-    user_input()
+    parser = argparse.ArgumentParser(description="SPSAするための対局スクリプト")
+    parser.add_argument("--worker", metavar="HOST:PORT", help="remote workerとして、このaddressのパラメーターサーバーに接続して対局する。")
+    parser.add_argument("--authkey", default=os.environ.get("PARAM_SERVER_AUTHKEY"),
+                        help="パラメーターサーバーのPARAM_SERVER_AUTHKEY。省略時は環境変数PARAM_SERVER_AUTHKEY。")
+    parser.add_argument("--processes", type=int, default=1, help="remote workerの対局processの数")
+    parser.add_argument("--slots", type=int, default=1, help="remote workerの1 processあたりの対局数")
+    args = parser.parse_args()
+
+    if args.worker:
+        if not args.authkey or args.authkey == INSECURE_PARAM_SERVER_AUTHKEY:
+            parser.error("--worker requires --authkey (or the environment variable PARAM_SERVER_AUTHKEY) with the server's PARAM_SERVER_AUTHKEY")
+        run_remote_worker(args.worker, args.authkey, args.processes, args.slots)
+    else:
+        user_input()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,124 @@
+# 2局ペア(pentanomial)の勝敗集計とSPRTのモジュール
+
+import math
+
+# ============================================================
+#                         Pentanomial
+# ============================================================
+
+# 95%信頼区間のz値
+Z_95 = 1.959964
+
+def score_to_elo(score:float)->float:
+    '''勝率(引き分けは0.5勝)からElo差を求める。'''
+    if score <= 0.0:
+        return -math.inf
+    if score >= 1.0:
+        return math.inf
+    return 400.0 * math.log10(score / (1.0 - score))
+
+def elo_to_score(elo:float)->float:
+    '''Elo差から期待勝率を求める。'''
+    return 1.0 / (1.0 + 10.0 ** (-elo / 400.0))
+
+class Pentanomial:
+    '''
+    同じ開始局面で手番を入れ替えて指した2局(ペア)の得点の分布。
+    counts[i] : ペアの得点(勝ち1、引き分け0.5、負け0の2局の合計)が i / 2 だったペアの数。(i = 0..4)
+
+    2局ペアの得点は、開始局面の有利不利が打ち消し合うので、1局ずつの勝敗(trinomial)より分散が小さい。
+    '''
+
+    def __init__(self, counts:list[int] | None = None):
+        self.counts = list(counts) if counts is not None else [0] * 5
+        if len(self.counts) != 5:
+            raise ValueError(f"pentanomial counts must have 5 elements, actual = {len(self.counts)}")
+
+    def add(self, score1:float, score2:float):
+        '''ペアの2局の得点(1, 0.5, 0)を追加する。'''
+        self.counts[int(round((score1 + score2) * 2))] += 1
+
+    def pairs(self)->int:
+        return sum(self.counts)
+
+    def mean_and_variance(self)->tuple[float, float]:
+        '''1局あたりの得点の平均と、ペアの平均得点(ペアの得点 / 2)の分散'''
+        n = self.pairs()
+        if n == 0:
+            return 0.5, 0.0
+        mean = sum(i / 4 * c for i, c in enumerate(self.counts)) / n
+        variance = sum((i / 4 - mean) ** 2 * c for i, c in enumerate(self.counts)) / n
+        return mean, variance
+
+    def elo(self)->tuple[float, float, float]:
+        '''(Elo差, 95%信頼区間の下限, 上限)'''
+        n = self.pairs()
+        mean, variance = self.mean_and_variance()
+        if n == 0:
+            return 0.0, -math.inf, math.inf
+        margin = Z_95 * math.sqrt(variance / n)
+        return score_to_elo(mean), score_to_elo(mean - margin), score_to_elo(mean + margin)
+
+    def llr(self, elo0:float, elo1:float)->float:
+        '''
+        H0 : Elo差 = elo0、H1 : Elo差 = elo1 の対数尤度比。
+        ペアの平均得点を正規分布で近似したGSPRTで求める。
+        '''
+        n = self.pairs()
+        mean, variance = self.mean_and_variance()
+        if n == 0 or variance <= 0.0:
+            return 0.0
+        score0 = elo_to_score(elo0)
+        score1 = elo_to_score(elo1)
+        return n * (score1 - score0) * (2 * mean - score0 - score1) / (2 * variance)
+
+    def summary_text(self)->str:
+        elo, lower, upper = self.elo()
+        return (f"pairs = {self.pairs()}, pentanomial = {self.counts}, "
+                f"Elo = {elo:+.1f} [{lower:+.1f}, {upper:+.1f}] (95%)")
+
+# ============================================================
+#                            SPRT
+# ============================================================
+
+class Sprt:
+    '''
+    Pentanomialに対するSPRT(逐次確率比検定)。
+    H0 : Elo差 = elo0 と H1 : Elo差 = elo1 のどちらかが、誤り率 alpha, beta で採択されるまで対局を続ける。
+    '''
+
+    def __init__(self, elo0:float, elo1:float, alpha:float = 0.05, beta:float = 0.05):
+        if elo0 >= elo1:
+            raise ValueError(f"SPRT elo0 must be less than elo1, elo0 = {elo0}, elo1 = {elo1}")
+        if not (0.0 < alpha < 1.0 and 0.0 < beta < 1.0):
+            raise ValueError(f"SPRT alpha and beta must be in (0, 1), alpha = {alpha}, beta = {beta}")
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+        self.lower_bound = math.log(beta / (1.0 - alpha))
+        self.upper_bound = math.log((1.0 - beta) / alpha)
+        self.pentanomial = Pentanomial()
+
+    def add(self, score1:float, score2:float)->str | None:
+        '''ペアの結果を追加する。H0かH1が採択されたら"H0"/"H1"、まだなら None を返す。'''
+        self.pentanomial.add(score1, score2)
+        return self.result()
+
+    def result(self)->str | None:
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return "H1"
+        if llr <= self.lower_bound:
+            return "H0"
+        return None
+
+    def llr(self)->float:
+        return self.pentanomial.llr(self.elo0, self.elo1)
+
+    def reset(self):
+        self.pentanomial = Pentanomial()
+
+    def summary_text(self)->str:
+        return (f"elo0 = {self.elo0}, elo1 = {self.elo1}, LLR = {self.llr():.2f} "
+                f"[{self.lower_bound:.2f}, {self.upper_bound:.2f}], {self.pentanomial.summary_text()}")
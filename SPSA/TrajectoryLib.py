@@ -0,0 +1,117 @@
+# SPSAのパラメーターの推移(trajectory)を記録するbinaryファイルの読み書きモジュール
+
+import os
+import struct
+import time
+
+import numpy as np
+
+# ============================================================
+#                      Trajectory file
+# ============================================================
+
+# ファイルの先頭
+#   magic(8byte) , パラメーター数(uint32) , パラメーター名の長さ(uint32) , パラメーター名(utf-8、"\n"区切り)
+# その後に、固定長のrecordが並ぶ。
+TRAJECTORY_MAGIC = b"YOSPSAT1"
+TRAJECTORY_HEADER = struct.Struct("<8sII")
+
+def trajectory_record_dtype(num_params:int)->np.dtype:
+    '''1 recordの型。記録した時点のペア数、時刻、SPSA対象エンジンから見た勝ち・引き分け・負けの数、全パラメーターの値。'''
+    return np.dtype([
+        ("pairs" , "<i8"),
+        ("time"  , "<f8"),
+        ("win"   , "<u4"),
+        ("draw"  , "<u4"),
+        ("lose"  , "<u4"),
+        ("values", "<f4", (num_params,)),
+    ])
+
+def read_trajectory_header(f)->tuple[list[str], int]:
+    '''(パラメーター名, headerのbyte数)を返す。'''
+    header = f.read(TRAJECTORY_HEADER.size)
+    if len(header) != TRAJECTORY_HEADER.size:
+        raise ValueError("trajectory header is truncated.")
+    magic, num_params, names_size = TRAJECTORY_HEADER.unpack(header)
+    if magic != TRAJECTORY_MAGIC:
+        raise ValueError(f"not a trajectory file, magic = {magic!r}")
+    names = f.read(names_size).decode("utf-8").split("\n") if num_params else []
+    if len(names) != num_params:
+        raise ValueError(f"trajectory header is broken, {len(names)} names for {num_params} parameters.")
+    return names, TRAJECTORY_HEADER.size + names_size
+
+
+class TrajectoryReader:
+    '''
+    trajectoryファイルをmemmapで開く。
+    column()で1つのパラメーターの推移だけを取り出せる。(ファイル全体は読み込まない)
+    '''
+
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.names, header_size = read_trajectory_header(f)
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.dtype = trajectory_record_dtype(len(self.names))
+
+        # 書き込み途中のrecordは無視する。
+        count = (os.path.getsize(path) - header_size) // self.dtype.itemsize
+        self.records = np.memmap(path, dtype=self.dtype, mode="r", offset=header_size, shape=(count,)) \
+            if count > 0 else np.zeros(0, dtype=self.dtype)
+
+    def __len__(self)->int:
+        return len(self.records)
+
+    def column(self, name:str)->np.ndarray:
+        '''パラメーターnameの推移'''
+        if name not in self.index:
+            raise KeyError(f"unknown parameter : {name}")
+        return np.array(self.records["values"][:, self.index[name]], dtype=np.float64)
+
+    def field(self, name:str)->np.ndarray:
+        '''"pairs", "time", "win", "draw", "lose"の推移'''
+        return np.array(self.records[name])
+
+
+class TrajectoryWriter:
+    '''
+    trajectoryファイルにrecordを追記する。
+    既存のファイルがあれば、パラメーター名が一致するか確認してから続きに追記する。
+    '''
+
+    def __init__(self, path:str, names:list[str]):
+        self.path = path
+        self.names = list(names)
+        self.dtype = trajectory_record_dtype(len(self.names))
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                names_in_file, header_size = read_trajectory_header(f)
+            if names_in_file != self.names:
+                raise ValueError(f"parameter names in {path} do not match the parameter file.")
+            # 書き込み途中で落ちたときの端数のrecordを切り捨てる。
+            count = (os.path.getsize(path) - header_size) // self.dtype.itemsize
+            with open(path, "r+b") as f:
+                f.truncate(header_size + count * self.dtype.itemsize)
+            self.f = open(path, "ab")
+        else:
+            names_bytes = "\n".join(self.names).encode("utf-8")
+            self.f = open(path, "wb")
+            self.f.write(TRAJECTORY_HEADER.pack(TRAJECTORY_MAGIC, len(self.names), len(names_bytes)))
+            self.f.write(names_bytes)
+            self.f.flush()
+
+    def append(self, pairs:int, win:int, draw:int, lose:int, values:np.ndarray, timestamp:float | None = None):
+        '''recordを1つ追記する。'''
+        record = np.zeros(1, dtype=self.dtype)
+        record["pairs"] = pairs
+        record["time"] = time.time() if timestamp is None else timestamp
+        record["win"] = win
+        record["draw"] = draw
+        record["lose"] = lose
+        record["values"] = values
+        self.f.write(record.tobytes())
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
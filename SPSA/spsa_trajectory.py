@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# BloodgateSPSA.pyが記録したtrajectoryファイル(パラメーターの推移)を表示・書き出し・グラフ化するスクリプト
+
+from __future__ import annotations
+
+import argparse
+import csv
+import sys
+import time
+
+from TrajectoryLib import TrajectoryReader
+
+
+def command_list(reader:TrajectoryReader, args:argparse.Namespace)->None:
+    # パラメーター名と、最初と最後の値を一覧表示する。
+    print(f"{reader.path} : {len(reader.names)} parameters, {len(reader)} records")
+    if len(reader) > 0:
+        pairs = reader.field("pairs")
+        times = reader.field("time")
+        print(f"pairs = {int(pairs[0])} .. {int(pairs[-1])}, "
+              f"time = {time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(times[0]))} .. "
+              f"{time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(times[-1]))}")
+    for name in reader.names:
+        if len(reader) > 0:
+            values = reader.column(name)
+            print(f"{name} : {values[0]:.3f} -> {values[-1]:.3f}")
+        else:
+            print(name)
+
+
+def command_export(reader:TrajectoryReader, args:argparse.Namespace)->None:
+    # 指定したパラメーターの推移をCSVで書き出す。
+    names = args.names or reader.names
+    columns = [reader.column(name) for name in names]
+    pairs = reader.field("pairs")
+    win, draw, lose = reader.field("win"), reader.field("draw"), reader.field("lose")
+
+    f = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(f)
+        writer.writerow(["pairs", "win", "draw", "lose", *names])
+        for i in range(len(reader)):
+            writer.writerow([int(pairs[i]), int(win[i]), int(draw[i]), int(lose[i]), *(f"{c[i]:g}" for c in columns)])
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+def command_plot(reader:TrajectoryReader, args:argparse.Namespace)->None:
+    # 指定したパラメーターの推移をグラフにする。(matplotlibが必要)
+    try:
+        import matplotlib
+        if args.output:
+            matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+    except ImportError:
+        raise SystemExit("matplotlib is required for plot. pip install matplotlib")
+
+    pairs = reader.field("pairs")
+    fig, ax = plt.subplots()
+    for name in args.names:
+        ax.plot(pairs, reader.column(name), label=name)
+    ax.set_xlabel("pairs")
+    ax.set_ylabel("value")
+    ax.legend()
+    if args.output:
+        fig.savefig(args.output)
+    else:
+        plt.show()
+
+
+def main()->None:
+    parser = argparse.ArgumentParser(description="BloodgateSPSA.pyのtrajectoryファイルを表示・書き出し・グラフ化する。")
+    parser.add_argument("path", help="trajectoryファイル")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("list", help="パラメーター名と最初と最後の値を表示する。")
+
+    export_parser = subparsers.add_parser("export", help="パラメーターの推移をCSVで書き出す。")
+    export_parser.add_argument("names", nargs="*", help="パラメーター名。省略したら全パラメーター。")
+    export_parser.add_argument("-o", "--output", help="書き出すCSVファイル。省略したら標準出力。")
+
+    plot_parser = subparsers.add_parser("plot", help="パラメーターの推移をグラフにする。")
+    plot_parser.add_argument("names", nargs="+", help="パラメーター名")
+    plot_parser.add_argument("-o", "--output", help="画像ファイル。省略したらwindowで表示する。")
+
+    args = parser.parse_args()
+    reader = TrajectoryReader(args.path)
+    {"list": command_list, "export": command_export, "plot": command_plot}[args.command](reader, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import sys
 import os
+import io
 import re
+import time
+import difflib
+import functools
 import traceback
 import copy
 from dataclasses import dataclass, field
@@ -227,7 +231,8 @@ def parse_content_block(block:Block, prefix:str):
     return modified_block, removed_numbers, params_name
 
 NUMBER_WITH_AT_RE = re.compile(r'-?\d+(?:\.\d+)?@[A-Za-z0-9]*')
-NUMBER_CAPTURE_RE = r'(-?\d+(?:\.\d+)?)'
+NUMBER_RE = r'-?\d+(?:\.\d+)?'
+NUMBER_CAPTURE_RE = rf'({NUMBER_RE})'
 PARAMETER_NAME_CHAR_RE = r'[A-Za-z0-9_]'
 
 
@@ -238,12 +243,13 @@ def get_target_path(filename:str)->str:
     return os.path.join(target_dir, filename)
 
 
-def make_context_pattern(context:list[str])->str:
+def make_context_pattern(context:list[str], capture:bool = True)->str:
     """
     contextから空白差分を無視する正規表現を作る。
 
     `123@`や`123@name`のように、数値の直後に`@`がついている箇所は
     ソース照合時に数値ワイルドカードとして扱う。
+    captureがFalseなら、数値をgroupにしない。(複数のcontextをまとめた正規表現に使う)
     """
 
     context_text = "".join(context)
@@ -256,7 +262,7 @@ def make_context_pattern(context:list[str])->str:
     last = 0
     for match in NUMBER_WITH_AT_RE.finditer(context_text):
         add_literal(context_text[last:match.start()])
-        tokens.append(NUMBER_CAPTURE_RE)
+        tokens.append(NUMBER_CAPTURE_RE if capture else NUMBER_RE)
         last = match.end()
     add_literal(context_text[last:])
 
@@ -287,85 +293,298 @@ def replace_parameter_names(lines:list[str], replacements:dict[str,str])->list[s
     ]
 
 
-def get_context_matches(filename:str, context:list[str]):
-    """ ファイルのなかのcontextに合致した箇所を取得する。"""
+@functools.lru_cache(maxsize=None)
+def compile_context_pattern(context:tuple[str, ...])->re.Pattern:
+    """ make_context_pattern()の正規表現をcompileする。同じcontextは1回だけcompileする。"""
+    return re.compile(make_context_pattern(list(context)), flags=re.MULTILINE | re.DOTALL)
 
-    path = get_target_path(filename)
-    # print(path)
 
-    if not os.path.exists(path):
-        raise Exception(f"file not found : {path}")
-
-    with open(path, 'r', encoding='utf-8') as f:
-        filetext = f.read()
-
-    pattern = make_context_pattern(context)
-    matches = list(re.finditer(pattern, filetext, flags=re.MULTILINE | re.DOTALL))
-
-    return path, filetext, matches
-
-
-def get_context_numbers(filename:str, context:list[str])->list[str]:
-    """ context内の`@`付き数値に対応する、現在のソースコード上の数値を取得する。"""
+@functools.lru_cache(maxsize=None)
+def compile_contexts_pattern(contexts:tuple[tuple[str, ...], ...])->re.Pattern:
+    """
+    複数のcontextのどれかに合致する正規表現をcompileする。(数値はgroupにしない)
+    contextを単純に`|`でつなぐと、ファイルの各位置ですべてのcontextを試すことになるので、
+    先頭が共通する部分をまとめたtrieの形にする。
+    """
 
-    _, _, matches = get_context_matches(filename, context)
+    # token → 続きのtrie。Noneは数値。""はそこで終わるcontextがあること。
+    trie : dict = {}
+    for context in contexts:
+        node = trie
+        for token in context_tokens(context):
+            node = node.setdefault(token, {})
+        node[""] = {}
+
+    def trie_to_pattern(node:dict)->str:
+        alternatives = []
+        for token, child in node.items():
+            if token == "":
+                continue
+            pattern = NUMBER_RE if token is None else re.escape(token)
+            if any(key != "" for key in child):
+                pattern += r'\s*' + trie_to_pattern(child)
+            alternatives.append(pattern)
+        pattern = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        return f"(?:{pattern})?" if "" in node else pattern
+
+    return re.compile(trie_to_pattern(trie), flags=re.MULTILINE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=None)
+def context_tokens(context:tuple[str, ...])->tuple[str | None, ...]:
+    """ make_context_pattern()と同じ区切り方で、contextを1文字ずつのliteralと数値(None)に分ける。"""
 
-    if len(matches) != 1:
-        print("target context : ")
-        print(context)
-        raise Exception(f"Error : matched count = {len(matches)}")
+    context_text = "".join(context)
+    tokens : list[str | None] = []
+    last = 0
+    for match in NUMBER_WITH_AT_RE.finditer(context_text):
+        tokens.extend(re.sub(r'\s+', '', context_text[last:match.start()]))
+        tokens.append(None)
+        last = match.end()
+    tokens.extend(re.sub(r'\s+', '', context_text[last:]))
+    return tuple(tokens)
 
-    return list(matches[0].groups())
 
+def number_ends(text:str, pos:int):
+    """ textのposから NUMBER_RE が合致する終わりの位置を、正規表現が試す順(長いほうから)に返す。"""
 
-def replace_context(filename:str, context:list[str], modified:list[str]):
-    """ ファイルのなかのcontextに合致したところをmodifiedに置換する。"""
+    if pos < len(text) and text[pos] == "-":
+        pos += 1
+    end = pos
+    while end < len(text) and text[end].isdecimal():
+        end += 1
+    for int_end in range(end, pos, -1):
+        if int_end < len(text) and text[int_end] == ".":
+            frac_end = int_end + 1
+            while frac_end < len(text) and text[frac_end].isdecimal():
+                frac_end += 1
+            yield from range(frac_end, int_end + 1, -1)
+        yield int_end
 
-    path, filetext, matches = get_context_matches(filename, context)
 
-    if len(matches) != 1:
-        print("target context : ")
-        print(context)
-        raise Exception(f"Error : replaced count = {len(matches)}")
+def match_context_at(text:str, pos:int, tokens:tuple[str | None, ...], i:int = 0)->int | None:
+    """
+    textのposから、tokens[i:]がmake_context_pattern()の正規表現と同じ規則で合致するかを調べて、
+    合致したら終わりの位置を返す。(正規表現をcontextごとにcompileしないで済むように)
+    """
 
-    # これに置き換える。
-    replaced = "".join(modified)
-    match = matches[0]
-    new_text = filetext[:match.start()] + replaced + filetext[match.end():]
+    while i < len(tokens):
+        if i > 0:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+        token = tokens[i]
+        if token is None:
+            for end in number_ends(text, pos):
+                result = match_context_at(text, end, tokens, i + 1)
+                if result is not None:
+                    return result
+            return None
+        if pos >= len(text) or text[pos] != token:
+            return None
+        pos += 1
+        i += 1
+    return pos
 
-    with open(path, 'w', encoding='utf-8') as f:
-        f.write(new_text)
 
-def add_content(filename:str, marker : str, lines: list[str]):
+class SourceFiles:
     """
-    ソースファイルのmarkerが書いてある行の次の行にlinesを追加する。
+    patchを当てるソースファイルの内容を保持する。
+
+    ファイルは最初に使うときに1回だけ読み込み、置換や追加はメモリ上で行って、
+    最後にwrite_all()で変更のあったファイルだけをまとめて書き出す。
+    (途中でエラーになったときは、どのファイルも書き換えない)
+    dry_runなら書き出さずに、変更内容をunified diffで表示する。
     """
-    path = get_target_path(filename)
 
-    if not os.path.exists(path):
-        raise Exception(f"file not found : {path}")
+    def __init__(self, dry_run:bool = False):
+        self.dry_run = dry_run
+
+        # path → 読み込んだときの内容 / 現在の内容
+        self.originals : dict[str, str] = {}
+        self.texts     : dict[str, str] = {}
 
-    # ファイルの内容を読み込む
-    with open(path, 'r', encoding='utf-8') as f:
-        content = f.readlines()
+        # 時間の計測用
+        self.read_seconds  = 0.0
+        self.match_seconds = 0.0
+        self.write_seconds = 0.0
+        self.match_count   = 0
 
-     # 新しい内容を格納するリスト
-    new_content = []
-    marker_found = False
+    def read(self, filename:str)->tuple[str, str]:
+        """ (path, 現在の内容)を返す。"""
+
+        path = get_target_path(filename)
+        if path not in self.texts:
+            if not os.path.exists(path):
+                raise Exception(f"file not found : {path}")
 
-    for line in content:
-        new_content.append(line)
-        if marker in line and not marker_found:
-            # マーカーが見つかった次の行にlinesを挿入
-            new_content.extend(lines)
-            marker_found = True
+            start = time.perf_counter()
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            self.read_seconds += time.perf_counter() - start
+
+            self.originals[path] = text
+            self.texts[path] = text
+        return path, self.texts[path]
+
+    def get_context_matches(self, filename:str, context:list[str]):
+        """ ファイルのなかのcontextに合致した箇所を取得する。"""
+
+        path, filetext = self.read(filename)
+
+        start = time.perf_counter()
+        matches = list(compile_context_pattern(tuple(context)).finditer(filetext))
+        self.match_seconds += time.perf_counter() - start
+        self.match_count += 1
+
+        return path, filetext, matches
+
+    def find_contexts(self, filename:str, contexts:list[list[str]]):
+        """
+        ファイルのなかの各contextに合致した箇所を、ファイルを1回走査して取得する。
+        (path, filetext, [contextごとの合致した箇所(start, end)のlist])を返す。
+        """
+
+        path, filetext = self.read(filename)
+
+        start = time.perf_counter()
+        pattern = compile_contexts_pattern(tuple(tuple(context) for context in contexts))
+
+        # どれかのcontextに合致する位置を集める。finditerは重ならない合致しか返さないので、
+        # 合致した範囲の内側から始まる合致は、その範囲のなかだけ探し直す。
+        # (範囲の外から始まる合致は、finditerがそれより前で止まるので取りこぼさない)
+        positions : list[int] = []
+        for match in pattern.finditer(filetext):
+            positions.append(match.start())
+            inner = pattern.search(filetext, match.start() + 1)
+            while inner is not None and inner.start() < match.end():
+                positions.append(inner.start())
+                inner = pattern.search(filetext, inner.start() + 1)
+
+        # 合致した位置で、どのcontextに合致したのかを調べる。同じ位置で複数のcontextに合致することもある。
+        tokens = [context_tokens(tuple(context)) for context in contexts]
+        matches : list[list[tuple[int, int]]] = [[] for _ in contexts]
+        for position in sorted(set(positions)):
+            for i, context_token in enumerate(tokens):
+                if context_token and context_token[0] not in (None, filetext[position]):
+                    continue
+                # 同じcontextの合致は、finditerと同じく重ならないものだけ数える。
+                if matches[i] and position < matches[i][-1][1]:
+                    continue
+                end = match_context_at(filetext, position, context_token)
+                if end is not None:
+                    matches[i].append((position, end))
+
+        self.match_seconds += time.perf_counter() - start
+        self.match_count += 1
+
+        return path, filetext, matches
+
+    def get_unique_match(self, filename:str, context:list[str], what:str):
+        """ contextにちょうど1箇所だけ合致したところを返す。"""
+
+        path, filetext, matches = self.get_context_matches(filename, context)
+
+        if len(matches) != 1:
+            print("target context : ")
+            print(context)
+            raise Exception(f"Error : {what} count = {len(matches)}")
+
+        return path, filetext, matches[0]
+
+    def get_context_numbers(self, filename:str, context:list[str])->list[str]:
+        """ context内の`@`付き数値に対応する、現在のソースコード上の数値を取得する。"""
+
+        _, _, match = self.get_unique_match(filename, context, "matched")
+        return list(match.groups())
+
+    def replace_context(self, filename:str, context:list[str], modified:list[str]):
+        """ ファイルのなかのcontextに合致したところをmodifiedに置換する。"""
+
+        path, filetext, match = self.get_unique_match(filename, context, "replaced")
+
+        # これに置き換える。
+        replaced = "".join(modified)
+        self.texts[path] = filetext[:match.start()] + replaced + filetext[match.end():]
+
+    def replace_contexts(self, filename:str, replacements:list[tuple[list[str], list[str]]]):
+        """
+        ファイルのなかの複数のcontextを、それぞれmodifiedに置換する。[(context, modified), ...]
+        すべてのcontextを置換前の内容から1回の走査で探して、まとめて置換する。
+        合致した箇所が重なっているか、ちょうど1箇所に合致しないcontextがあれば、従来どおり1つずつ順番に置換する。
+        """
+
+        path, filetext, matches = self.find_contexts(filename, [context for context, _ in replacements])
+
+        spans = sorted(
+            (context_matches[0][0], context_matches[0][1], "".join(modified))
+            for (_, modified), context_matches in zip(replacements, matches) if len(context_matches) == 1
+        )
+        if len(spans) != len(replacements) or any(start < last_end for (_, last_end, _), (start, _, _) in zip(spans, spans[1:])):
+            # ちょうど1箇所に合致しないcontextがあるか、合致した箇所が重なっている。
+            # 前のcontextを置換してはじめて合致するcontextもあるので、従来どおり1つずつ順番に置換する。
+            # (どこにも合致しないcontextがあれば、ここでエラーになる)
+            print(f"contexts overlap or do not match uniquely in {filename}. replace them one by one.")
+            for context, modified in replacements:
+                self.replace_context(filename, context, modified)
+            return
 
-    if not marker_found:
-        raise Exception(f"Error : marker not found, marker = {marker} , file path = {filename}")
+        pieces : list[str] = []
+        last = 0
+        for start, end, replaced in spans:
+            pieces.append(filetext[last:start])
+            pieces.append(replaced)
+            last = end
+        pieces.append(filetext[last:])
+
+        self.texts[path] = "".join(pieces)
+
+    def add_content(self, filename:str, marker : str, lines: list[str]):
+        """
+        ソースファイルのmarkerが書いてある行の次の行にlinesを追加する。
+        """
+        path, filetext = self.read(filename)
+
+         # 新しい内容を格納するリスト
+        new_content = []
+        marker_found = False
+
+        for line in io.StringIO(filetext):
+            new_content.append(line)
+            if marker in line and not marker_found:
+                # マーカーが見つかった次の行にlinesを挿入
+                new_content.extend(lines)
+                marker_found = True
+
+        if not marker_found:
+            raise Exception(f"Error : marker not found, marker = {marker} , file path = {filename}")
+
+        self.texts[path] = "".join(new_content)
+
+    def write_all(self)->int:
+        """ 変更のあったファイルを書き出す。(dry_runならdiffを表示する) 書き出したファイル数を返す。"""
+
+        start = time.perf_counter()
+        changed = 0
+        for path, text in self.texts.items():
+            original = self.originals[path]
+            if text == original:
+                continue
+            changed += 1
+
+            if self.dry_run:
+                diff = difflib.unified_diff(
+                    original.splitlines(keepends=True), text.splitlines(keepends=True),
+                    fromfile=path, tofile=f"{path} (patched)")
+                sys.stdout.writelines(diff)
+            else:
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+        self.write_seconds += time.perf_counter() - start
+        return changed
 
-    # ファイルに書き戻す
-    with open(path, 'w', encoding='utf-8') as f:
-        f.writelines(new_content)
+    def timing_text(self)->str:
+        return (f"files = {len(self.texts)}, context searches = {self.match_count}, "
+                f"read = {self.read_seconds:.3f}s, match = {self.match_seconds:.3f}s, write = {self.write_seconds:.3f}s")
 
 
 def print_block(block:list[str]):
@@ -376,15 +595,26 @@ def print_block(block:list[str]):
         print(line)
 
 
-def apply_parameters(tune_file:str , params_file : str, target_dir:str):
+def apply_parameters(tune_file:str , params_file : str, target_dir:str, dry_run:bool = False):
+
+    start_time = time.perf_counter()
 
     try:
         params = read_parameters(params_file)
     except:
         params : list[Entry] = []
 
+    # パラメーター名 → Entry
+    params_by_name : dict[str, Entry] = {}
+    for e in params:
+        params_by_name.setdefault(e.name, e)
+
     tune_blocks = read_tune_file(tune_file)
 
+    # ファイルごとの置換内容 [(context, 置換後), ...] と、そのprefix
+    replacements_by_file : dict[str, list[tuple[list[str], list[str]]]] = {}
+    prefixes_by_file : dict[str, list[str]] = {}
+
     # 変数名を列挙する。
     for tune_block in tune_blocks:
         content_block = get_context_block(tune_block)
@@ -402,10 +632,11 @@ def apply_parameters(tune_file:str , params_file : str, target_dir:str):
             replacements:dict[str,str] = {}
             for param_name in dict.fromkeys(params_name):
                 # このパラメーターの値
-                value , type = next(((e.v, e.type) for e in params if e.name == param_name), (None,None))
-                if value is None:
+                e = params_by_name.get(param_name)
+                if e is None:
                     print_block(content_block.content)
                     raise Exception(f"Error! : {param_name} not found in {params_file}.")
+                value, type = e.v, e.type
 
                 # print(f"replace : {param_name} -> {value}")
 
@@ -428,28 +659,33 @@ def apply_parameters(tune_file:str , params_file : str, target_dir:str):
                     raise Exception("置換対象となる無名addブロックが来ていない。")
 
 
-        # 前者を後者で置換する。
+        # 前者を後者で置換する。置換はファイルごとにまとめて行う。
         filename = tune_block.setblock['file']
-        print(f"file : {filename}")
+        replacements_by_file.setdefault(filename, []).append((content_block.content, context_lines))
+        prefixes_by_file.setdefault(filename, []).append(prefix)
 
-        # print("target context")
-        # print_block(block.context_lines_no_param)
-        # print("final context")
-        # print_block(context_lines)
+    sources = SourceFiles(dry_run)
+    for filename, replacements in replacements_by_file.items():
+        print(f"file : {filename}, {len(replacements)} blocks")
+        sources.replace_contexts(filename, replacements)
+        for prefix in prefixes_by_file[filename]:
+            print(f"Patch applied to {prefix} .. done.")
 
-        context  = content_block.content
-        replaced = context_lines
-        replace_context(filename, context, replaced)
+    changed = sources.write_all()
 
-        print(f"Patch applied to {prefix} .. done.")
+    print(f"{sources.timing_text()}, total = {time.perf_counter() - start_time:.3f}s")
+    if dry_run:
+        print(f"Dry run : {changed} files would be changed.")
+    else:
+        print("All patches have been applied successfully.")
 
-    print("All patches have been applied successfully.")
 
 
-
-def tune_parameters(tune_file:str, params_file : str, target_dir:str):
+def tune_parameters(tune_file:str, params_file : str, target_dir:str, dry_run:bool = False):
 
     print("start tune_parameters()")
+    start_time = time.perf_counter()
+    sources = SourceFiles(dry_run)
 
     try:
         params = read_parameters(params_file)
@@ -462,6 +698,11 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
 
     blocks = parse_tune_file(tune_file)
 
+    # パラメーター名 → Entry (paramsに追加したときは、こちらにも追加する)
+    params_by_name : dict[str, Entry] = {}
+    for p in params:
+        params_by_name.setdefault(p.name, p)
+
     # `#param`で明示された、既存USI option用のパラメーターを追加する。
     # これはソースコード上の`@`置換とは独立しており、tune対象エンジンへ
     # `setoption name ... value ...`を送るためだけに使う。
@@ -469,6 +710,7 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
         result = next((p for p in params if p.name == explicit_param.name), None)
         if result is None:
             params.append(explicit_param)
+            params_by_name.setdefault(explicit_param.name, explicit_param)
         else:
             result.type     = explicit_param.type
             result.min      = explicit_param.min
@@ -491,7 +733,7 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
             return
 
         filename = tune_block.setblock['file']
-        source_numbers = get_context_numbers(filename, block.content)
+        source_numbers = sources.get_context_numbers(filename, block.content)
 
         if len(source_numbers) != len(params_name):
             raise Exception(f"Error : parameter count mismatch, file = {filename}, prefix = {prefix}, params = {len(params_name)}, source numbers = {len(source_numbers)}")
@@ -499,7 +741,7 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
         for param_name, number in zip(params_name, source_numbers):
             try:
                 # print(f"variable {param_name}")
-                result = next((p for p in params if p.name == param_name), None)
+                result = params_by_name.get(param_name)
                 if result is None:
                     # 変数がなかったので、paramsに追加。
                     # print("..appended")
@@ -522,7 +764,9 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
                     # 整数化したものと値が異なる ⇨ 小数部分がある ⇨ float
                     type = "int" if number == int(number) else "float"
 
-                    params.append(Entry(param_name, type , number, min_, max_ , step, delta,"", False))            
+                    entry = Entry(param_name, type , number, min_, max_ , step, delta,"", False)
+                    params.append(entry)
+                    params_by_name[param_name] = entry
 
                 else:
                     # print(f"..found")
@@ -537,7 +781,10 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
         check_params(tune_block)
 
     # これでパラメーターファイルは確定したので、これを書き出す。
-    write_parameters(params_file, params)
+    if dry_run:
+        print(f"Dry run : {params_file} is not written, {len(params)} parameters.")
+    else:
+        write_parameters(params_file, params)
 
     # このあと、sourceコードにpatchを当てにいく。
 
@@ -563,19 +810,19 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
             if block_name:
                 print(f"add block, prefix = {prefix} , name = {block_name}")
                 # block_nameをマーカーとして、その次の行に追加する
-                add_content(filename, block_name, modified_block2)
+                sources.add_content(filename, block_name, modified_block2)
             else:
                 # context block名
                 prefix = content_block.params[0] if content_block.params else ""
                 print(f"replace block, prefix = {prefix}")
 
                 # contextが合致する箇所を探す。
-                replace_context(filename, context, modified_block2)
+                sources.replace_context(filename, context, modified_block2)
                 replaced = True
 
         if not replaced:
             print(f"modified block, prefix = {prefix}")
-            replace_context(filename, context, modified_block)
+            sources.replace_context(filename, context, modified_block)
 
         # あと、ここで得られた変数を追加する。
         #  "int myValue;"" みたいな文字列と、
@@ -584,7 +831,7 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
         tune_params_to_options : list[str] = []
         for param_name in params_name:
             # 同じ名前があるはず..
-            p = next((p for p in params if p.name == param_name), None)
+            p = params_by_name.get(param_name)
             if p is None:
                 raise Exception() # この可能性はないはず..
             v = int(p.v) if p.type == 'int' else p.v
@@ -597,19 +844,27 @@ def tune_parameters(tune_file:str, params_file : str, target_dir:str):
         # `#set tune`と`#set declare`で指定されたところに追加する。
 
         if 'declaration' in tune_block.setblock:
-            add_content(filename, tune_block.setblock['declaration'], tune_params_to_declare)
+            sources.add_content(filename, tune_block.setblock['declaration'], tune_params_to_declare)
         if 'options' in tune_block.setblock:
-            add_content(filename, tune_block.setblock['options']    , tune_params_to_options)
+            sources.add_content(filename, tune_block.setblock['options']    , tune_params_to_options)
+
+    # 書き換えたソースファイルをまとめて書き出す。
+    changed = sources.write_all()
 
+    print(f"{sources.timing_text()}, total = {time.perf_counter() - start_time:.3f}s")
+    if dry_run:
+        print(f"Dry run : {changed} files would be changed.")
     print("end tune_parameters()")
 
 
 if __name__ == "__main__":
 
     # 使い方
-    # python tune.py [apply|tune] patch_file target_dir
+    # python tune.py [apply|tune] patch_file target_dir [--dry-run]
+    # --dry-run : ソースファイル(とtuneならパラメーターファイル)を書き換えずに、変更内容をdiffで表示する。
 
-    args = sys.argv
+    dry_run = "--dry-run" in sys.argv
+    args = [arg for arg in sys.argv if arg != "--dry-run"]
     target_dir = args[3] if len(args) >= 4 else "source"
     tune_file  = args[2] if len(args) >= 3 else "suisho10.tune"
     command    = args[1] if len(args) >= 2 else ""
@@ -625,6 +880,8 @@ if __name__ == "__main__":
     print(f"tune_file   : {tune_file}")
     print(f"params_file : {params_file}")
     print(f"target_dir  : {target_dir}")
+    if dry_run:
+        print("dry run     : True")
 
     # entries = read_parameters("suisho10.params")
     # write_parameters("suisho10-new.params", entries)
@@ -634,11 +891,11 @@ if __name__ == "__main__":
 
     try:
         if command == "apply":
-            apply_parameters(tune_file, params_file, target_dir)
+            apply_parameters(tune_file, params_file, target_dir, dry_run)
         elif command == "tune":
-            tune_parameters(tune_file, params_file, target_dir)
+            tune_parameters(tune_file, params_file, target_dir, dry_run)
         else:
-            print("Usage : python tune.py [apply|tune] tune_file target_dir")
+            print("Usage : python tune.py [apply|tune] tune_file target_dir [--dry-run]")
             # tune_fileとtarget_dirのデフォルト値は、"suisho10.tune", "source"
     except Exception as e:
         error_msg = traceback.format_exc()